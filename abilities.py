@@ -370,6 +370,7 @@ def choose_ability_class(user, branch_id):
         ab = ABILITIES.get(row.ability_code)
         if not ab or ab.get('branch') != branch_id:
             _db().session.delete(row)
+    _app_module().bump_bonus_version(user.id)
     return True, None
 
 
@@ -383,6 +384,7 @@ def upgrade_ability(user, ability_code):
         row = UserAbility(user_id=user.id, ability_code=ability_code, rank=0)
         _db().session.add(row)
     row.rank = (row.rank or 0) + 1
+    _app_module().bump_bonus_version(user.id)
     return True, None
 
 
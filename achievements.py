@@ -143,6 +143,18 @@ ACHIEVEMENTS = [
 ]
 
 ACHIEVEMENT_BY_CODE = {a[0]: a for a in ACHIEVEMENTS}
+ACHIEVEMENT_ORDER = {a[0]: i for i, a in enumerate(ACHIEVEMENTS)}
+
+# counter_key -> достижения этого счётчика: после действия проверяются только они
+ACHIEVEMENTS_BY_COUNTER = {}
+for _a in ACHIEVEMENTS:
+    ACHIEVEMENTS_BY_COUNTER.setdefault(_a[5], []).append(_a)
+del _a
+
+# Служебный счётчик: версия полной синхронизации, которой уже пройден игрок.
+# Увеличить ACHIEVEMENT_SYNC_VERSION, если поменялся подсчёт в sync_user_achievement_counters.
+COUNTER_SYNC_VERSION = 'achievements_sync_version'
+ACHIEVEMENT_SYNC_VERSION = 1
 
 CLAN_RANK_TIERS = {
     None: 0,
@@ -160,59 +172,91 @@ def _models():
     return m.UserStatCounter, m.UserAchievement
 
 
-def _get_counter_row(user_id, key):
-    db = _db()
+# Счётчики игрока загружаются одним запросом на первый вызов в рамках запроса (flask.g);
+# дальше increment/set/get работают со строками в памяти, а в БД изменения уходят при commit.
+
+class _CounterState:
+    """Счётчики и открытые достижения одного игрока в текущем запросе."""
+
+    __slots__ = ('rows', 'touched', 'unlocked', 'pending')
+
+    def __init__(self, rows):
+        self.rows = rows        # counter_key -> UserStatCounter
+        self.touched = set()    # ключи, изменённые после последней проверки достижений
+        self.unlocked = None    # коды открытых достижений (загружаются при первой проверке)
+        self.pending = []       # добавленные в сессию строки: после rollback их нет в БД
+
+
+def _counter_state(user_id):
+    from flask import g
+    from sqlalchemy import inspect as sa_inspect
+    states = g.setdefault('achievement_counters', {})
+    state = states.get(user_id)
+    if state is not None and not any(sa_inspect(obj).transient for obj in state.pending):
+        return state
     UserStatCounter, _ = _models()
-    row = UserStatCounter.query.filter_by(user_id=user_id, counter_key=key).first()
-    if not row:
+    rows = {r.counter_key: r for r in UserStatCounter.query.filter_by(user_id=user_id).all()}
+    state = states[user_id] = _CounterState(rows)
+    return state
+
+
+def _get_counter_row(state, user_id, key):
+    row = state.rows.get(key)
+    if row is None:
+        UserStatCounter, _ = _models()
         row = UserStatCounter(user_id=user_id, counter_key=key, value=0)
-        db.session.add(row)
-        db.session.flush()
+        _db().session.add(row)
+        state.rows[key] = row
+        state.pending.append(row)
     return row
 
 
 def get_counter(user_id, key):
-    UserStatCounter, _ = _models()
-    row = UserStatCounter.query.filter_by(user_id=user_id, counter_key=key).first()
-    return (row.value or 0) if row else 0
+    row = _counter_state(user_id).rows.get(key)
+    return (row.value or 0) if row is not None else 0
 
 
 def increment_counter(user_id, key, delta=1):
     if not delta:
         return
-    row = _get_counter_row(user_id, key)
+    state = _counter_state(user_id)
+    row = _get_counter_row(state, user_id, key)
     row.value = max(0, (row.value or 0) + delta)
+    state.touched.add(key)
 
 
 def set_counter_max(user_id, key, value):
-    row = _get_counter_row(user_id, key)
-    row.value = max(row.value or 0, int(value))
+    value = int(value or 0)
+    state = _counter_state(user_id)
+    row = state.rows.get(key)
+    if value <= ((row.value or 0) if row is not None else 0):
+        return
+    row = _get_counter_row(state, user_id, key)
+    row.value = value
+    state.touched.add(key)
 
 
 def set_counter_if_higher(user_id, key, value):
     set_counter_max(user_id, key, value)
 
 
+def _pvp_stats_value(user_id, field):
+    """Итог дуэлей из user_pvp_stats (одна строка вместо COUNT по pvp_duel)."""
+    import pvp_stats
+    row = pvp_stats.get(user_id)
+    return int(getattr(row, field) or 0) if row is not None else 0
+
+
 def _count_pvp_wins(user_id):
-    PvPDuel = _app_module().PvPDuel
-    return PvPDuel.query.filter_by(winner_id=user_id).count()
+    return _pvp_stats_value(user_id, 'wins')
 
 
 def _count_pvp_duels(user_id):
-    from sqlalchemy import or_
-    PvPDuel = _app_module().PvPDuel
-    return PvPDuel.query.filter(
-        or_(PvPDuel.challenger_id == user_id, PvPDuel.defender_id == user_id),
-        PvPDuel.status == 'finished',
-    ).count()
+    return _pvp_stats_value(user_id, 'duels')
 
 
 def _count_pvp_wager_wins(user_id):
-    PvPDuel = _app_module().PvPDuel
-    return PvPDuel.query.filter(
-        PvPDuel.winner_id == user_id,
-        PvPDuel.wager > 0,
-    ).count()
+    return _pvp_stats_value(user_id, 'wager_wins')
 
 
 def _count_shop_purchases(user_id):
@@ -228,6 +272,12 @@ def _count_shop_purchases(user_id):
     )
 
 
+def sync_shop_purchases_counter(user_id):
+    """Покупки в лавке изменились: счётчик — максимум числа предметов лавки территории в инвентаре
+    (как в полной синхронизации). Вызывать после add/delete строк UserShopPurchase, до commit."""
+    set_counter_max(user_id, COUNTER_SHOP_PURCHASES, _count_shop_purchases(user_id))
+
+
 def _count_chests_opened(user_id):
     m = _app_module()
     UserShopPurchase = m.UserShopPurchase
@@ -268,8 +318,31 @@ def _max_weapon_enchant(user_id):
     return int(row.weapon_enchant_level or 0) if row else 0
 
 
+def sync_profile_counters(user):
+    """Счётчики, которые берутся прямо из строки игрока (без запросов к БД)."""
+    user_id = user.id
+    set_counter_max(user_id, COUNTER_LEVEL, user.level or 1)
+    set_counter_max(user_id, COUNTER_NUMS_BALANCE_MAX, user.nums_balance or 0)
+    set_counter_max(
+        user_id,
+        COUNTER_SKILLS_SPENT,
+        (user.damage_skill or 0) + (user.defense_skill or 0) + (user.energy_skill or 0),
+    )
+    set_counter_max(user_id, COUNTER_MAX_ENERGY, user.energy)
+    if user.avatar_filename:
+        set_counter_max(user_id, COUNTER_AVATAR_SET, 1)
+    if user.clan_id:
+        set_counter_max(user_id, COUNTER_CLAN_JOINED, 1)
+    tier = CLAN_RANK_TIERS.get(user.clan_rank, 0)
+    if user.clan_id and user.clan_obj and user.id == user.clan_obj.owner_id:
+        tier = max(tier, 5)
+    set_counter_max(user_id, COUNTER_CLAN_RANK_TIER, tier)
+
+
 def sync_user_achievement_counters(user_id):
-    """Синхронизировать счётчики из существующих данных (ретроактивно)."""
+    """Синхронизировать счётчики из существующих данных (ретроактивно).
+    Тяжёлая: считает дуэли, покупки и т.п. по таблицам — вызывается только из
+    полной синхронизации (ensure_achievement_counters_synced, sync_all_achievement_counters)."""
     m = _app_module()
     db = m.db
     User = m.User
@@ -285,14 +358,7 @@ def sync_user_achievement_counters(user_id):
         set_counter_max(user_id, COUNTER_TERRITORY_DAMAGE, stats.total_damage_dealt or 0)
         set_counter_max(user_id, COUNTER_TERRITORY_INFLUENCE, stats.total_influence_points or 0)
 
-    set_counter_max(user_id, COUNTER_LEVEL, user.level or 1)
-    set_counter_max(user_id, COUNTER_NUMS_BALANCE_MAX, user.nums_balance or 0)
-    set_counter_max(
-        user_id,
-        COUNTER_SKILLS_SPENT,
-        (user.damage_skill or 0) + (user.defense_skill or 0) + (user.energy_skill or 0),
-    )
-    set_counter_max(user_id, COUNTER_MAX_ENERGY, user.energy)
+    sync_profile_counters(user)
 
     set_counter_max(user_id, COUNTER_PVP_WINS, _count_pvp_wins(user_id))
     set_counter_max(user_id, COUNTER_PVP_DUELS, _count_pvp_duels(user_id))
@@ -302,21 +368,21 @@ def sync_user_achievement_counters(user_id):
     set_counter_max(user_id, COUNTER_EQUIPMENT_SLOTS, _equipment_slots_filled(user_id))
     set_counter_max(user_id, COUNTER_WEAPON_ENCHANT_MAX, _max_weapon_enchant(user_id))
 
-    if user.avatar_filename:
-        set_counter_max(user_id, COUNTER_AVATAR_SET, 1)
-    if user.clan_id:
-        set_counter_max(user_id, COUNTER_CLAN_JOINED, 1)
     clan_owned = Clan.query.filter_by(owner_id=user_id).first()
     if clan_owned:
         set_counter_max(user_id, COUNTER_CLAN_CREATED, 1)
-    tier = CLAN_RANK_TIERS.get(user.clan_rank, 0)
-    if user.clan_id and user.clan_obj and user.id == user.clan_obj.owner_id:
-        tier = max(tier, 5)
-    set_counter_max(user_id, COUNTER_CLAN_RANK_TIER, tier)
+    set_counter_max(user_id, COUNTER_SYNC_VERSION, ACHIEVEMENT_SYNC_VERSION)
+
 
+def ensure_achievement_counters_synced(user_id):
+    """Полная синхронизация, если игрок ещё не проходил текущую версию (например, после обновления)."""
+    if get_counter(user_id, COUNTER_SYNC_VERSION) < ACHIEVEMENT_SYNC_VERSION:
+        sync_user_achievement_counters(user_id)
 
-def check_and_unlock_achievements(user_id):
-    """Проверить все достижения; вернуть список только что разблокированных кодов."""
+
+def check_and_unlock_achievements(user_id, counter_keys=None):
+    """Проверить достижения; вернуть список только что разблокированных.
+    counter_keys — проверить только достижения этих счётчиков (None — все)."""
     m = _app_module()
     db = m.db
     User = m.User
@@ -326,20 +392,31 @@ def check_and_unlock_achievements(user_id):
     if not user or user.is_admin:
         return []
 
-    unlocked_codes = {
-        r.achievement_code
-        for r in UserAchievement.query.filter_by(user_id=user_id).all()
-    }
+    state = _counter_state(user_id)
+    if state.unlocked is None:
+        state.unlocked = {
+            code for (code,) in
+            db.session.query(UserAchievement.achievement_code).filter_by(user_id=user_id).all()
+        }
+    if counter_keys is None:
+        candidates = ACHIEVEMENTS
+        state.touched.clear()
+    else:
+        candidates = sorted(
+            (a for key in set(counter_keys) for a in ACHIEVEMENTS_BY_COUNTER.get(key, ())),
+            key=lambda a: ACHIEVEMENT_ORDER[a[0]],
+        )
     newly = []
 
-    for code, title, desc, icon, cat, counter_key, target, hidden, reward in ACHIEVEMENTS:
-        if code in unlocked_codes:
+    for code, title, desc, icon, cat, counter_key, target, hidden, reward in candidates:
+        if code in state.unlocked:
             continue
         current = get_counter(user_id, counter_key)
         if current < target:
             continue
         row = UserAchievement(user_id=user_id, achievement_code=code, unlocked_at=datetime.now())
         db.session.add(row)
+        state.pending.append(row)
         if reward > 0:
             user.nums_balance = (user.nums_balance or 0) + reward
         newly.append({
@@ -349,21 +426,70 @@ def check_and_unlock_achievements(user_id):
             'icon': icon,
             'reward_nums': reward,
         })
-        unlocked_codes.add(code)
+        state.unlocked.add(code)
 
     return newly
 
 
+def check_touched_achievements(user_id):
+    """Проверить достижения счётчиков, изменённых в этом запросе после прошлой проверки."""
+    state = _counter_state(user_id)
+    if not state.touched:
+        return []
+    keys, state.touched = state.touched, set()
+    return check_and_unlock_achievements(user_id, keys)
+
+
 def achievement_hook(user_id, *, commit=True):
-    """Синхронизировать и проверить достижения после игрового действия."""
+    """Проверить достижения после игрового действия."""
     db = _db()
-    sync_user_achievement_counters(user_id)
-    newly = check_and_unlock_achievements(user_id)
+    user = db.session.get(_app_module().User, user_id)
+    if user and not user.is_admin:
+        sync_profile_counters(user)
+    newly = check_touched_achievements(user_id)
     if commit:
         db.session.commit()
     return newly
 
 
+def sync_all_achievement_counters(user_ids=None, *, force=False, batch_size=200, log=None):
+    """Полная синхронизация счётчиков и достижений (фоновая задача по запросу администратора
+    и sync_achievements.py). Без force пропускает игроков, уже прошедших текущую версию.
+    Commit после каждой пачки; возвращает dict со статистикой."""
+    from flask import g
+    m = _app_module()
+    db = m.db
+    User = m.User
+    UserStatCounter, _ = _models()
+
+    q = db.session.query(User.id).filter(User.is_admin.is_(False))
+    if user_ids is not None:
+        q = q.filter(User.id.in_(list(user_ids)))
+    if not force:
+        synced = db.session.query(UserStatCounter.user_id).filter(
+            UserStatCounter.counter_key == COUNTER_SYNC_VERSION,
+            UserStatCounter.value >= ACHIEVEMENT_SYNC_VERSION,
+        )
+        q = q.filter(~User.id.in_(synced))
+    batch_size = max(1, int(batch_size))
+    result = {'users': 0, 'unlocked': 0}
+    last_id = 0
+    while True:
+        ids = [r[0] for r in q.filter(User.id > last_id).order_by(User.id).limit(batch_size).all()]
+        if not ids:
+            break
+        for user_id in ids:
+            sync_user_achievement_counters(user_id)
+            result['unlocked'] += len(check_and_unlock_achievements(user_id))
+        db.session.commit()
+        g.pop('achievement_counters', None)
+        result['users'] += len(ids)
+        last_id = ids[-1]
+        if log:
+            log(f"  синхронизировано игроков: {result['users']} (последний id {last_id})")
+    return result
+
+
 def get_achievements_payload(user_id):
     """Данные для UI: список достижений с прогрессом."""
     _, UserAchievement = _models()
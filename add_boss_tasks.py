@@ -20,6 +20,7 @@ from werkzeug.security import generate_password_hash
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from app import app, db, Boss, BossTask
+import boss_stats
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
 
@@ -169,6 +170,7 @@ def add_tasks_from_json(json_file, boss_id=None, boss_name=None, image_base_path
                 )
                 
                 db.session.add(new_task)
+                boss_stats.task_added(boss.id, points)
                 db.session.commit()
                 
                 print(f"✓ Добавлена задача: {title} (points: {points})")
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Проверка ответов на задачи (битва за территорию, PvP-дуэли, Демогоргоны).
+
+Эталонный ответ разбирается один раз — при выдаче задачи — в ключ (answer_type, кортеж),
+дальше каждый ответ игрока разбирается и сравнивается с готовым кортежем функцией из
+ANSWER_CHECKERS. Ключ — плоский кортеж из str/int/float/None, поэтому его можно
+положить в токен задачи (JSON) и восстановить через tuple().
+
+Типы ответа (выбираются по названию задачи и формату эталона, как раньше в app.py):
+  fraction_property  — «Основное свойство дроби»: числитель|знаменатель (старый формат 0|ч|з)
+  common_denominator — «Общий знаменатель»: ч1|з1|ч2|з2
+  mixed              — сложение/вычитание, умножение/деление дробей, смешанные числа: целая|ч|з
+  proper_improper    — «Правильные/неправильные дроби»: ч|з или целая|ч|з
+  exact              — задачи про дроби с обычным (без «|») эталоном: строка после нормализации
+  decimal            — числовой эталон: совпадение строки или числа (точка или запятая)
+  plain              — прочее: совпадение строки после нормализации
+"""
+import re
+
+MIXED_FRACTION_TITLES = ('Сложение и вычитание дробей', 'Умножение и деление дробей', 'Смешанные числа')
+
+_WS_RE = re.compile(r'\s+')
+
+
+def normalize_answer(s):
+    return _WS_RE.sub(' ', str(s).strip().lower()) if s else ''
+
+
+def _ints(parts):
+    """Кортеж int (пустая строка = 0) или None, если что-то не число."""
+    try:
+        return tuple(int(p or 0) for p in parts)
+    except (ValueError, TypeError):
+        return None
+
+
+def _user_parts(answer):
+    """Части ответа игрока через «|» или None, если ответ не строка."""
+    answer = answer or ''
+    if not isinstance(answer, str):
+        return None
+    return [p.strip() for p in answer.split('|')]
+
+
+def _two_parts(parts):
+    """Числитель и знаменатель: из трёх частей — 2-я и 3-я, из двух — обе."""
+    if len(parts) >= 3:
+        return parts[1], parts[2]
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return '', ''
+
+
+# --- Разбор эталона -------------------------------------------------------------------
+
+def _compile_fraction_property(correct):
+    num, den = _two_parts([p.strip() for p in correct.split('|')])
+    ints = _ints((num, den))
+    return (num, den) + (ints if ints else (None, None))
+
+
+def _compile_common_denominator(correct):
+    parts = [p.strip() for p in correct.split('|')][:4]
+    ints = _ints(parts)
+    return tuple(parts) + (ints if ints else (None,) * 4)
+
+
+def _compile_mixed(correct):
+    ints = _ints([p.strip() for p in correct.split('|')][:3])
+    return ints if ints else (None, None, None)
+
+
+def _compile_proper_improper(correct):
+    parts = [p.strip() for p in correct.split('|')]
+    if len(parts) not in (2, 3):
+        return (len(parts),)
+    ints = _ints(parts)
+    return (len(parts),) + (ints if ints else (None,) * len(parts))
+
+
+def _compile_decimal(correct):
+    c = normalize_answer(correct)
+    try:
+        return (c, float(c.replace(',', '.')))
+    except (ValueError, TypeError):
+        return (c, None)
+
+
+def compile_answer_key(title, correct_answer):
+    """(answer_type, кортеж) для эталонного ответа задачи."""
+    correct = correct_answer or ''
+    pipes = correct.count('|')
+    if title == 'Основное свойство дроби' and pipes:
+        return ('fraction_property', _compile_fraction_property(correct))
+    if title == 'Общий знаменатель' and pipes >= 3:
+        return ('common_denominator', _compile_common_denominator(correct))
+    if title in MIXED_FRACTION_TITLES or pipes == 2:
+        if pipes < 2:
+            return ('exact', (normalize_answer(correct),))
+        return ('mixed', _compile_mixed(correct))
+    if title == 'Правильные/неправильные дроби' and pipes:
+        return ('proper_improper', _compile_proper_improper(correct))
+    c, value = _compile_decimal(correct)
+    if value is None:
+        return ('plain', (c,))
+    return ('decimal', (c, value))
+
+
+# --- Проверка ответа игрока ------------------------------------------------------------
+
+def _check_fraction_property(key, answer):
+    parts = _user_parts(answer)
+    if parts is None:
+        return False
+    c_num, c_den, c_n, c_d = key
+    num, den = _two_parts(parts)
+    user = _ints((num, den)) if c_n is not None else None
+    if user is None:
+        return num == c_num and den == c_den
+    return user[1] > 0 and c_d > 0 and user[0] == c_n and user[1] == c_d
+
+
+def _check_common_denominator(key, answer):
+    parts = _user_parts(answer)
+    if parts is None or len(parts) < 4:
+        return False
+    parts = parts[:4]
+    user = _ints(parts) if key[4] is not None else None
+    if user is None:
+        return tuple(parts) == key[:4]
+    return user == key[4:]
+
+
+def _check_mixed(key, answer):
+    parts = _user_parts(answer)
+    if parts is None or key[0] is None:
+        return False
+    if len(parts) == 2:
+        parts = ['0', parts[0], parts[1]]
+    if len(parts) < 3:
+        return False
+    return _ints(parts[:3]) == key
+
+
+def _check_proper_improper(key, answer):
+    parts = _user_parts(answer)
+    if parts is None or key[0] not in (2, 3) or key[1] is None:
+        return False
+    if key[0] == 3:
+        if len(parts) < 3:
+            return False
+        return _ints(parts[:3]) == key[1:]
+    user = _ints(_two_parts(parts))
+    return user is not None and user == key[1:] and user[1] > 0
+
+
+def _check_exact(key, answer):
+    return normalize_answer(answer) == key[0]
+
+
+def _check_decimal(key, answer):
+    u = normalize_answer(answer)
+    if u == key[0]:
+        return True
+    if key[1] is None:
+        return False
+    try:
+        return abs(float(u.replace(',', '.')) - key[1]) < 1e-9
+    except (ValueError, TypeError):
+        return False
+
+
+ANSWER_CHECKERS = {
+    'fraction_property': _check_fraction_property,
+    'common_denominator': _check_common_denominator,
+    'mixed': _check_mixed,
+    'proper_improper': _check_proper_improper,
+    'exact': _check_exact,
+    'decimal': _check_decimal,
+    'plain': _check_decimal,
+}
+
+
+def check_answer(answer_key, answer):
+    """Верен ли ответ игрока для ключа из compile_answer_key (кортеж или список из JSON)."""
+    answer_type, parsed = answer_key
+    checker = ANSWER_CHECKERS.get(answer_type)
+    if checker is None:
+        return False
+    try:
+        return bool(checker(parsed if type(parsed) is tuple else tuple(parsed), answer))
+    except Exception:
+        return False
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, send_file, after_this_request
+from flask import Flask, render_template, request, jsonify, redirect, url_for, flash, send_from_directory, send_file, after_this_request, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -8,16 +8,22 @@ from datetime import datetime, timedelta
 from functools import wraps
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.base import JobLookupError
 from apscheduler.executors.pool import ThreadPoolExecutor
 from sqlalchemy import case, cast, Float, Index, and_, func, text
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session, joinedload
 import json
+import hashlib
 import random
 import os
 import logging
 from logging.handlers import RotatingFileHandler
 import uuid
+import threading
+import atexit
+import time
 
 try:
     from generate_boss_tasks import (
@@ -72,7 +78,24 @@ except ImportError:
 import re
 import shutil
 
-from ban_filter import filter_chat_text
+from ban_filter import filter_chat_text, filter_chat_text_versioned, filter_version as chat_filter_version
+from bonus_cache import BonusCache
+from buff_index import BuffIndex, BuffRecord, buff_terms
+from task_tokens import TaskTokenCodec, is_task_token
+from hot_map import HotMap, MapData, replay_log
+from event_stream import EventBroker, PgNotifyBridge, format_sse
+from demogorgon_sim import ArmyState, SimParams, advance as demogorgon_advance
+from scheduler_lease import AdvisoryLease, CallbackLease, SchedulerMetrics, METRICS_EVENT_MASK
+import leaderboards
+import pvp_stats
+import chat_feed
+import arena_presence
+import boss_stats
+import boss_drops
+import boss_top
+import task_dispenser
+from contextlib import contextmanager
+from answer_checkers import check_answer, compile_answer_key
 import tempfile
 from dotenv import load_dotenv
 
@@ -248,18 +271,38 @@ def _avatar_static_filename(avatar_filename):
 MAX_USER_NAME_LENGTH = 20   # максимум символов для имени персонажа (регистрация, кабинет)
 MIN_USER_NAME_LENGTH = 2
 
-# Настройка планировщика задач (используем ту же БД PostgreSQL)
-jobstores = {
-    'default': SQLAlchemyJobStore(url=_db_uri)
-}
-executors = {
-    'default': ThreadPoolExecutor(20)
-}
+# Настройка планировщика задач (используем ту же БД PostgreSQL).
+# Задачи с фиксированным интервалом (тик Демогоргонов, продление аренды) — в памяти: их заново
+# добавляет каждый новый владелец планировщика, хранить их в БД незачем.
 job_defaults = {
     'coalesce': False,
     'max_instances': 3
 }
-scheduler = BackgroundScheduler(jobstores=jobstores, executors=executors, job_defaults=job_defaults)
+# Метрики задач и аренды планировщика этого процесса (/api/admin/scheduler/metrics)
+_scheduler_metrics = SchedulerMetrics()
+
+
+def _new_scheduler():
+    """Планировщик на один срок лидерства. После shutdown() пул потоков и хранилища APScheduler
+    не перезапускаются (start() пройдёт, но задачи не выполнятся), поэтому каждый срок — новый
+    экземпляр со своими хранилищами и пулом."""
+    new = BackgroundScheduler(
+        jobstores={
+            'default': SQLAlchemyJobStore(url=_db_uri),
+            'memory': MemoryJobStore(),
+        },
+        executors={
+            'default': ThreadPoolExecutor(5)
+        },
+        job_defaults=job_defaults,
+    )
+    new.add_listener(_scheduler_metrics.listener, METRICS_EVENT_MASK)
+    return new
+
+
+scheduler = _new_scheduler()
+# Начало текущего срока лидерства (для проверки, что задачи планировщика выполняются)
+_scheduler_term_started_at = None
 
 db = SQLAlchemy(app)
 
@@ -344,6 +387,10 @@ class ClanSearchChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     text = db.Column(db.String(100), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    # Текст после фильтра мата и версия фильтра (ban_filter.filter_version); text — как написано.
+    # Те же колонки у ClanChatMessage, TerritoryAdminChatMessage, PvPArenaChatMessage
+    text_filtered = db.Column(db.Text, nullable=True)
+    filter_version = db.Column(db.String(20), nullable=True)
 
     user = db.relationship('User', backref=db.backref('clan_search_chat_messages', lazy=True))
 
@@ -367,6 +414,8 @@ class ClanChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     text = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    text_filtered = db.Column(db.Text, nullable=True)
+    filter_version = db.Column(db.String(20), nullable=True)
 
     clan = db.relationship('Clan', backref=db.backref('chat_messages', lazy=True, order_by='ClanChatMessage.created_at'))
     user = db.relationship('User', backref='clan_chat_messages', lazy=True)
@@ -382,6 +431,8 @@ class TerritoryAdminChatMessage(db.Model):
     text = db.Column(db.String(200), nullable=False)
     is_from_admin = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    text_filtered = db.Column(db.Text, nullable=True)
+    filter_version = db.Column(db.String(20), nullable=True)
 
     user = db.relationship('User', backref=db.backref('territory_admin_chat_messages', lazy=True, order_by='TerritoryAdminChatMessage.created_at'))
 
@@ -408,6 +459,8 @@ class PvPArenaChatMessage(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     text = db.Column(db.Text, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    text_filtered = db.Column(db.Text, nullable=True)
+    filter_version = db.Column(db.String(20), nullable=True)
 
     user = db.relationship('User', backref='pvp_arena_chat_messages', lazy=True)
 
@@ -450,6 +503,22 @@ class PvPDuel(db.Model):
     winner = db.relationship('User', foreign_keys=[winner_id], lazy=True)
 
 
+class UserPvPStats(db.Model):
+    """Итоги дуэлей игрока; обновляются при завершении дуэли (_pvp_duel_record_finish),
+    пересчёт по pvp_duel — sync_pvp_stats.py."""
+    __tablename__ = 'user_pvp_stats'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    duels = db.Column(db.Integer, default=0, nullable=False)
+    wins = db.Column(db.Integer, default=0, nullable=False)
+    losses = db.Column(db.Integer, default=0, nullable=False)
+    draws = db.Column(db.Integer, default=0, nullable=False)
+    wager_wins = db.Column(db.Integer, default=0, nullable=False)  # победы в дуэлях со ставкой
+    nums_won = db.Column(db.BigInteger, default=0, nullable=False)  # чистый выигрыш по ставкам
+    nums_lost = db.Column(db.BigInteger, default=0, nullable=False)  # проиграно ставок
+    last_duel_id = db.Column(db.Integer, nullable=True)
+    last_duel_at = db.Column(db.DateTime, nullable=True)
+
+
 # Константы уровней и урона
 # Базовые характеристики (без вложенных очков навыков)
 USER_BASE_DAMAGE = 5
@@ -472,11 +541,65 @@ DEMOGORGON_DAMAGE_TICK_SECONDS = 2
 DEMOGORGON_DAMAGE_PER_TICK = 150  # урон по силе области за один тик
 DEMOGORGON_MIN_MOVE_MINUTES = 5
 DEMOGORGON_MAX_MOVE_MINUTES = 10
+DEMOGORGON_SIM_PARAMS = SimParams(
+    DEMOGORGON_DAMAGE_TICK_SECONDS, DEMOGORGON_DAMAGE_PER_TICK,
+    DEMOGORGON_MIN_MOVE_MINUTES, DEMOGORGON_MAX_MOVE_MINUTES,
+)
 DEMOGORGON_REWARD_NUMS = 100_000
+DEMOGORGON_TOP_CLANS = 5
+# Как часто воркер сверяет снимок /api/territory/demogorgons с версией армии в БД
+DEMOGORGON_SNAPSHOT_CHECK_SECONDS = 1
 
 # Лок планировщика (распределённый)
 SCHEDULER_LOCK_TTL_SECONDS = 60
 SCHEDULER_LOCK_RENEW_SECONDS = 20
+# Как часто экземпляр без планировщика пробует забрать его (владелец упал или потерял аренду)
+SCHEDULER_LEASE_RETRY_SECONDS = 10
+# Ключ pg_try_advisory_lock для аренды планировщика на PostgreSQL
+SCHEDULER_ADVISORY_LOCK_KEY = 0x76616C657261  # 'valera'
+# Ключ pg_advisory_xact_lock для разовых заполнений таблиц и DDL при старте (выполняет один воркер)
+STARTUP_BACKFILL_LOCK_KEY = 0x76616C657262
+
+# Доски рейтинга (leaderboard_entry) проверяются и при изменениях пересобираются задачей планировщика;
+# если её никто не выполняет дольше RATING_STALE_SECONDS, доску обновит сам запрос страницы
+RATING_REFRESH_SECONDS = 60
+RATING_STALE_SECONDS = 600
+
+# Сообщения чатов хранят текст после фильтра мата; после изменения ban.txt задача планировщика
+# перефильтровывает сообщения с прежней версией фильтра пачками по CHAT_REFILTER_BATCH
+CHAT_REFILTER_SECONDS = 60
+CHAT_REFILTER_BATCH = 500
+# Последние сообщения каналов чата в памяти (chat_feed.py): размер буфера, как часто дочитывать
+# новые из БД (сообщения других воркеров) и как часто собирать буфер заново
+CHAT_FEED_SIZE = 50
+CHAT_FEED_CHECK_SECONDS = 1
+CHAT_FEED_REBUILD_SECONDS = 300
+# Сколько последних сообщений буфера перечитывать при дочитывании (id, закоммиченные не по порядку)
+CHAT_FEED_REREAD = 8
+# Счётчики непрочитанного (чат клана, ответы администратора): хвост id последних сообщений канала
+# и как часто дочитывать его из БД; дальше хвоста — COUNT в БД
+CHAT_UNREAD_TAIL = 200
+CHAT_UNREAD_CHECK_SECONDS = 2
+
+# «Горячая» карта битвы (hot_map.py): во время окна захвата состояние областей держит в памяти
+# экземпляр с локом планировщика. Остальные экземпляры применяют удары прямо в БД; актор замечает
+# их по версии строки и перечитывает карту — быстрее всего, когда запросы битвы приходят в этот
+# экземпляр (один воркер или отдельный маршрут на балансировщике).
+TERRITORY_HOT_MAP_ENABLED = os.getenv('TERRITORY_HOT_MAP', '').strip().lower() in ('1', 'true', 'yes', 'on')
+TERRITORY_HOT_MAP_FLUSH_MS = int(os.getenv('TERRITORY_HOT_MAP_FLUSH_MS', '500'))
+TERRITORY_HOT_MAP_LOG = os.getenv('TERRITORY_HOT_MAP_LOG', 'territory_hot_map.log')
+# Последовательность номеров версий карты на PostgreSQL (создаётся миграцией при старте)
+TERRITORY_MAP_VERSION_SEQ = 'territory_map_version_seq'
+
+# Серверные события (event_stream.py, /api/stream): карта, Демогоргоны, дуэли, чат клана и арена
+# приходят на страницы без частого опроса. Открытый поток занимает поток воркера до
+# EVENT_STREAM_MAX_SECONDS — включать только с воркерами gunicorn с потоками (gthread, gevent).
+# Поток выключен или лимит соединений исчерпан — страницы опрашивают API, как раньше.
+EVENT_STREAM_ENABLED = os.getenv('EVENT_STREAM', '').strip().lower() in ('1', 'true', 'yes', 'on')
+EVENT_STREAM_MAX_CONNECTIONS = int(os.getenv('EVENT_STREAM_MAX_CONNECTIONS', '50'))
+EVENT_STREAM_MAX_SECONDS = int(os.getenv('EVENT_STREAM_MAX_SECONDS', '300'))
+EVENT_STREAM_HEARTBEAT_SECONDS = 20
+EVENT_STREAM_CHANNEL = 'game_events'
 
 def xp_required_for_level(level):
     """Суммарный опыт для достижения уровня level.
@@ -549,6 +672,48 @@ def roll_nums_reward(level):
     return max(0, int(round(raw * TASK_NUMS_REWARD_MULTIPLIER)))
 
 
+# Базовый набор задач territory_task (запасной источник, если генераторы недоступны)
+TERRITORY_DEFAULT_TASKS = [
+    ('Сумма', 'Чему равна сумма 15 + 27?', '42', 10),
+    ('Произведение', 'Чему равно 6 × 8?', '48', 10),
+    ('Квадрат', 'Чему равен квадрат числа 7?', '49', 10),
+    ('Уравнение', 'Найдите x: 2x + 10 = 24', '7', 15),
+    ('Периметр', 'Периметр квадрата 20 см. Чему равна сторона?', '5', 10),
+    ('Дробь', 'Сократите дробь 12/18 до несократимой. Напишите только числитель.', '2', 15),
+    ('Степень', 'Чему равно 2^5?', '32', 10),
+    ('Проценты', '20% от 150 — это сколько?', '30', 10),
+    ('Площадь', 'Площадь прямоугольника 24 см², одна сторона 4 см. Чему равна вторая?', '6', 15),
+    ('Среднее', 'Среднее арифметическое чисел 10, 20 и 30?', '20', 10),
+]
+
+
+def _territory_task_public_dict(task_id, title, text, correct_answer, xp_reward, image_url=None):
+    """Задача для выдачи клиенту (без правильного ответа): строка territory_task или токен задачи."""
+    d = {
+        'id': task_id,
+        'title': title,
+        'text': text,
+        'image_url': image_url,
+        'xp_reward': xp_reward
+    }
+    if title == 'Основное свойство дроби' and '|' in (correct_answer or ''):
+        d['answer_type'] = 'fraction'
+    if title == 'Общий знаменатель' and correct_answer and correct_answer.count('|') >= 3:
+        d['answer_type'] = 'common_denominator'
+    if title == 'Правильные/неправильные дроби' and correct_answer and '|' in correct_answer:
+        d['answer_type'] = 'mixed_fraction' if correct_answer.count('|') == 2 else 'fraction'
+    if title in ('Сложение и вычитание дробей', 'Умножение и деление дробей', 'Смешанные числа'):
+        d['answer_type'] = 'add_sub_fractions'
+        if correct_answer and '|' in correct_answer:
+            parts = correct_answer.split('|')
+            d['int_part_zero'] = (len(parts) >= 1 and parts[0].strip() == '0')
+    if title == 'Перевод дробей' and correct_answer and correct_answer.count('|') == 2:
+        d['answer_type'] = 'mixed_fraction'
+        parts = correct_answer.split('|')
+        d['int_part_zero'] = (len(parts) >= 1 and parts[0].strip() == '0')
+    return d
+
+
 class TerritoryTask(db.Model):
     """Задача для битвы за территорию (с опытом за решение)"""
     __tablename__ = 'territory_task'
@@ -561,29 +726,10 @@ class TerritoryTask(db.Model):
 
     def to_dict_public(self):
         """Без правильного ответа — для выдачи клиенту"""
-        d = {
-            'id': self.id,
-            'title': self.title,
-            'text': self.text,
-            'image_url': url_for('static', filename=self.image_filename) if self.image_filename else None,
-            'xp_reward': self.xp_reward
-        }
-        if self.title == 'Основное свойство дроби' and '|' in (self.correct_answer or ''):
-            d['answer_type'] = 'fraction'
-        if self.title == 'Общий знаменатель' and self.correct_answer and self.correct_answer.count('|') >= 3:
-            d['answer_type'] = 'common_denominator'
-        if self.title == 'Правильные/неправильные дроби' and self.correct_answer and '|' in self.correct_answer:
-            d['answer_type'] = 'mixed_fraction' if self.correct_answer.count('|') == 2 else 'fraction'
-        if self.title in ('Сложение и вычитание дробей', 'Умножение и деление дробей', 'Смешанные числа'):
-            d['answer_type'] = 'add_sub_fractions'
-            if self.correct_answer and '|' in self.correct_answer:
-                parts = self.correct_answer.split('|')
-                d['int_part_zero'] = (len(parts) >= 1 and parts[0].strip() == '0')
-        if self.title == 'Перевод дробей' and self.correct_answer and self.correct_answer.count('|') == 2:
-            d['answer_type'] = 'mixed_fraction'
-            parts = self.correct_answer.split('|')
-            d['int_part_zero'] = (len(parts) >= 1 and parts[0].strip() == '0')
-        return d
+        return _territory_task_public_dict(
+            self.id, self.title, self.text, self.correct_answer, self.xp_reward,
+            image_url=url_for('static', filename=self.image_filename) if self.image_filename else None,
+        )
 
 
 class User(UserMixin, db.Model):
@@ -609,6 +755,7 @@ class User(UserMixin, db.Model):
     clan_join_ban_until = db.Column(db.DateTime, nullable=True)  # штраф после выхода из клана: до этого времени нельзя вступать в клан и подавать заявки
     is_admin = db.Column(db.Boolean, default=False, nullable=False)
     ability_class = db.Column(db.String(20), nullable=True)  # warrior|guardian|sage|tactician|duelist
+    bonus_version = db.Column(db.Integer, default=0, nullable=False)  # растёт при смене снаряжения/умений (ключ bonus_cache)
     created_at = db.Column(db.DateTime, default=datetime.now)
 
     clan_obj = db.relationship('Clan', back_populates='members_rel', foreign_keys=[clan_id], lazy=True)
@@ -657,9 +804,7 @@ class User(UserMixin, db.Model):
         """Текущий урон персонажа: база + навыки + снаряжение + умения."""
         base = USER_BASE_DAMAGE + (self.damage_skill or 0)
         try:
-            bonuses = _get_equipment_bonuses(self.id)
-            ab = _get_ability_bonuses(self.id)
-            return base + int(bonuses.get('damage_add', 0) or 0) + int(ab.get('damage_add', 0) or 0)
+            return base + get_combat_snapshot(self.id).damage_add
         except Exception:
             return base
 
@@ -668,9 +813,7 @@ class User(UserMixin, db.Model):
         """Защита: база + навыки + снаряжение + умения."""
         base = USER_BASE_DEFENSE + (self.defense_skill or 0)
         try:
-            bonuses = _get_equipment_bonuses(self.id)
-            ab = _get_ability_bonuses(self.id)
-            return base + int(bonuses.get('defense_add', 0) or 0) + int(ab.get('defense_add', 0) or 0)
+            return base + get_combat_snapshot(self.id).defense_add
         except Exception:
             return base
 
@@ -679,9 +822,7 @@ class User(UserMixin, db.Model):
         """Макс. энергия: база + навыки + снаряжение + умения."""
         base = USER_BASE_ENERGY + (self.energy_skill or 0)
         try:
-            bonuses = _get_equipment_bonuses(self.id)
-            ab = _get_ability_bonuses(self.id)
-            return base + int(bonuses.get('max_energy_add', 0) or 0) + int(ab.get('max_energy_add', 0) or 0)
+            return base + get_combat_snapshot(self.id).max_energy_add
         except Exception:
             return base
 
@@ -755,6 +896,36 @@ class UserTerritoryStats(db.Model):
     total_influence_points = db.Column(db.Integer, default=0, nullable=False)  # очки при защите своей области
 
 
+class LeaderboardEntry(db.Model):
+    """Готовое место в рейтинге (см. leaderboards.py): доска, место, игрок или клан, значения для сортировки."""
+    __tablename__ = 'leaderboard_entry'
+    board = db.Column(db.String(16), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    entity_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.BigInteger, nullable=False, default=0)
+    score2 = db.Column(db.BigInteger, nullable=False, default=0)
+    score3 = db.Column(db.BigInteger, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('board', 'entity_id', name='uq_leaderboard_entry_entity'),)
+
+
+class ChatFeedState(db.Model):
+    """Поколение буферов чата (chat_feed.py): растёт в транзакции, удаляющей сообщения (роспуск клана,
+    сброс битвы), — воркеры, увидев новое значение, собирают буферы каналов заново. Одна запись с id=1."""
+    __tablename__ = 'chat_feed_state'
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class LeaderboardState(db.Model):
+    """Состояние доски рейтинга: число мест, отпечаток исходных данных, время пересборки и проверки."""
+    __tablename__ = 'leaderboard_state'
+    board = db.Column(db.String(16), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    fingerprint = db.Column(db.String(40), nullable=True)
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+    checked_at = db.Column(db.DateTime, nullable=True)
+
+
 class UserStatCounter(db.Model):
     """Счётчики для достижений и статистики."""
     __tablename__ = 'user_stat_counter'
@@ -967,10 +1138,15 @@ def grant_default_territory_shop_items(user: 'User') -> None:
         p.shop_item_id
         for p in UserShopPurchase.query.filter_by(user_id=user.id).all()
     }
+    added = False
     for item in items:
         if item.id in existing_ids:
             continue
         db.session.add(UserShopPurchase(user_id=user.id, shop_item_id=item.id))
+        added = True
+    if added:
+        from achievements import sync_shop_purchases_counter
+        sync_shop_purchases_counter(user.id)
 
 class ActiveItemBuff(db.Model):
     """Активное улучшение от использованного предмета (с длительностью или разовое).
@@ -988,6 +1164,17 @@ class ActiveItemBuff(db.Model):
     shop_item = db.relationship('ShopItem', backref=db.backref('active_buffs', lazy=True))
 
 
+class BuffIndexState(db.Model):
+    """Перестройки индексов баффов воркеров (buff_index.py), растут в транзакции изменения (buff_index_changed).
+    rebuilds — изменения, после которых индекс собирается заново (смена клана баффа, правка эффектов,
+    массовое удаление); version растёт вместе с ним. Добавления и удаления отдельных баффов строку не
+    трогают — их видно по самим строкам active_item_buff. Одна запись с id=1."""
+    __tablename__ = 'buff_index_state'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    rebuilds = db.Column(db.BigInteger, nullable=False, default=0)
+
+
 class SchedulerInstanceLock(db.Model):
     """Распределённый лок для единственного владельца планировщика задач.
     В таблице всегда максимум одна запись с id=1.
@@ -996,8 +1183,10 @@ class SchedulerInstanceLock(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     owner_id = db.Column(db.String(200), nullable=True, index=True)
     owner_pid = db.Column(db.Integer, nullable=True)
-    # Время, до которого лок считается действующим
+    # Время, до которого лок считается действующим (на PostgreSQL — только отметка владельца, лок — advisory)
     expires_at = db.Column(db.DateTime, nullable=True)
+    # Метрики планировщика владельца (JSON), обновляются при каждом продлении аренды
+    metrics = db.Column(db.Text, nullable=True)
 
 
 def _open_scheduler_lock_session() -> Session:
@@ -1076,29 +1265,180 @@ def _scheduler_try_acquire_lock() -> bool:
         session.close()
 
 
-def _scheduler_renew_lock() -> None:
-    """Периодически продлевает лок планировщика, если он всё ещё принадлежит нам."""
+def _scheduler_lock_row_update(owner_only: bool) -> bool:
+    """Записать в строку лока (id=1) этот экземпляр владельцем, новый срок и метрики.
+
+    owner_only=True — продление лока строкой: только если строка уже наша.
+    owner_only=False — отметка владельца при advisory-аренде (лидерство определяет сам advisory lock).
+    """
     now = datetime.now()
-    expires_new = now + timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS)
+    session = _open_scheduler_lock_session()
+    try:
+        with session.begin():
+            lock = (
+                session.query(SchedulerInstanceLock)
+                .filter_by(id=1)
+                .with_for_update(nowait=owner_only)
+                .first()
+            )
+            if lock is None:
+                if owner_only:
+                    return False
+                lock = SchedulerInstanceLock(id=1)
+                session.add(lock)
+            elif owner_only and lock.owner_id != SCHEDULER_INSTANCE_ID:
+                return False
+            lock.owner_id = SCHEDULER_INSTANCE_ID
+            lock.owner_pid = os.getpid()
+            lock.expires_at = now + timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS)
+            lock.metrics = json.dumps(_scheduler_metrics_payload(), default=str)
+            return True
+    finally:
+        session.close()
+
+
+_scheduler_lease = None
+
+
+def _scheduler_get_lease():
+    """Аренда планировщика: advisory lock на PostgreSQL, лок строкой scheduler_instance_lock на SQLite."""
+    global _scheduler_lease
+    if _scheduler_lease is None:
+        engine = db.engine
+        if engine.dialect.name == 'postgresql':
+            cargs, cparams = engine.dialect.create_connect_args(engine.url)
+            _scheduler_lease = AdvisoryLease(
+                lambda: engine.dialect.connect(*cargs, **cparams), SCHEDULER_ADVISORY_LOCK_KEY,
+            )
+        else:
+            _scheduler_lease = CallbackLease(
+                _scheduler_try_acquire_lock, lambda: _scheduler_lock_row_update(owner_only=True),
+            )
+    return _scheduler_lease
+
+
+def _scheduler_metrics_payload() -> dict:
+    """Метрики задач и аренды этого процесса плюс время следующего запуска задач."""
+    payload = _scheduler_metrics.snapshot()
+    payload['instance_id'] = SCHEDULER_INSTANCE_ID
+    payload['published_at'] = datetime.now().isoformat()
+    payload['next_run'] = {}
+    if scheduler.running:
+        payload['next_run'] = {
+            job.id: job.next_run_time.isoformat() if job.next_run_time else None
+            for job in scheduler.get_jobs()
+        }
+    return payload
+
+
+def _scheduler_try_become_leader() -> bool:
+    """Захватить аренду и запустить планировщик в этом экземпляре (вызывать внутри app_context).
+    Время передачи — от последнего продления прежнего владельца до захвата."""
+    if scheduler.running:
+        return True
+    lease = _scheduler_get_lease()
+    previous = None
+    try:
+        session = _open_scheduler_lock_session()
+        try:
+            lock = session.get(SchedulerInstanceLock, 1)
+            if lock is not None:
+                previous = (lock.owner_id, lock.expires_at)
+        finally:
+            session.close()
+        acquired = lease.try_acquire()
+    except Exception as e:
+        logger.error(f'Ошибка при попытке захвата аренды планировщика: {e}')
+        acquired = False
+    handoff_seconds = None
+    if acquired and previous and previous[0] and previous[0] != SCHEDULER_INSTANCE_ID and previous[1]:
+        last_renew = previous[1] - timedelta(seconds=SCHEDULER_LOCK_TTL_SECONDS)
+        handoff_seconds = (datetime.now() - last_renew).total_seconds()
+    _scheduler_metrics.lease_attempt(acquired, handoff_seconds)
+    if not acquired:
+        return False
+    if lease.backend == 'advisory':
+        try:
+            _scheduler_lock_row_update(owner_only=False)
+        except Exception as e:
+            logger.error(f'Не удалось отметить владельца планировщика: {e}')
+    _scheduler_start_jobs()
+    return True
+
+
+def _scheduler_renew_lock() -> None:
+    """Периодически продлевает аренду планировщика; если она потеряна — планировщик
+    в этом экземпляре останавливается, его заберёт другой экземпляр."""
     try:
         with app.app_context():
-            session = _open_scheduler_lock_session()
-            try:
-                with session.begin():
-                    lock = (
-                        session.query(SchedulerInstanceLock)
-                        .filter_by(id=1)
-                        .with_for_update(nowait=True)
-                        .first()
-                    )
-                    if not lock or lock.owner_id != SCHEDULER_INSTANCE_ID:
-                        return
-                    lock.expires_at = expires_new
-                    lock.owner_pid = os.getpid()
-            finally:
-                session.close()
+            lease = _scheduler_get_lease()
+            ok = lease.renew()
+            if ok and lease.backend == 'advisory':
+                _scheduler_lock_row_update(owner_only=False)
     except Exception as e:
+        # Сбой связи с БД — не повод отдавать планировщик: лок строкой живёт SCHEDULER_LOCK_TTL_SECONDS
         logger.error(f'Ошибка продления лока планировщика: {e}')
+        return
+    _scheduler_metrics.lease_renewed(ok)
+    if not ok:
+        _scheduler_step_down()
+
+
+def _scheduler_step_down() -> None:
+    """Остановить планировщик и горячую карту после потери аренды. Следующий срок лидерства
+    начнётся с нового экземпляра планировщика."""
+    global _territory_hot_map_instance, scheduler, _scheduler_term_started_at
+    logger.warning('Аренда планировщика потеряна: планировщик в этом экземпляре остановлен')
+    with _territory_hot_map_guard:
+        hot = _territory_hot_map_instance
+        _territory_hot_map_instance = None
+    if hot is not None:
+        try:
+            hot.stop()
+        except Exception as e:
+            logger.error(f'Ошибка остановки горячей карты: {e}')
+    _scheduler_get_lease().release()
+    stopped = scheduler
+    scheduler = _new_scheduler()
+    _scheduler_term_started_at = None
+    if stopped.running:
+        stopped.shutdown(wait=False)
+
+
+def _scheduler_jobs_stalled() -> bool:
+    """Планировщик запущен, но продление аренды не выполнялось дольше SCHEDULER_LOCK_TTL_SECONDS:
+    задачи не выполняются (например, пул потоков остановлен)."""
+    started = _scheduler_term_started_at
+    if not scheduler.running or started is None:
+        return False
+    last_run = _scheduler_metrics.last_run_at('scheduler_lock_renew')
+    reference = max(started, last_run) if last_run is not None else started
+    return (datetime.now() - reference).total_seconds() > SCHEDULER_LOCK_TTL_SECONDS
+
+
+def _scheduler_standby_loop() -> None:
+    """Экземпляр без планировщика раз в SCHEDULER_LEASE_RETRY_SECONDS пробует его забрать.
+    У владельца — проверка, что задачи выполняются; если нет, аренда отдаётся и берётся заново."""
+    while True:
+        time.sleep(SCHEDULER_LEASE_RETRY_SECONDS)
+        if scheduler.running:
+            if _scheduler_jobs_stalled():
+                logger.error('Задачи планировщика не выполняются: перезапуск планировщика')
+                try:
+                    with app.app_context():
+                        _scheduler_step_down()
+                except Exception as e:
+                    logger.error(f'Ошибка перезапуска планировщика: {e}')
+            continue
+        try:
+            with app.app_context():
+                try:
+                    if _scheduler_try_become_leader():
+                        logger.info('Планировщик задач перешёл в этот экземпляр')
+                finally:
+                    db.session.remove()
+        except Exception as e:
+            logger.error(f'Ошибка ожидания планировщика: {e}')
 
 
 def _weapon_enchant_level_clamped(level) -> int:
@@ -1142,13 +1482,14 @@ def _use_special_shop_item(purchase: 'UserShopPurchase', item: 'ShopItem'):
     special_type = (item.special_type or '').strip().lower()
     if special_type == 'map_clear':
         # Очистка карты: все области становятся нейтральными, сила = 0
-        for state in TerritoryRegionState.query.all():
-            state.owner_class_id = None
-            state.owner_clan_id = None
-            state.strength = 0
-        # Сам предмет одноразовый — удаляем покупку
-        db.session.delete(purchase)
-        db.session.commit()
+        with _territory_map_write():
+            for state in TerritoryRegionState.query.all():
+                state.owner_class_id = None
+                state.owner_clan_id = None
+                state.strength = 0
+            # Сам предмет одноразовый — удаляем покупку
+            db.session.delete(purchase)
+            db.session.commit()
         return jsonify({
             'success': True,
             'message': 'Карта очищена: все области стали нейтральными.',
@@ -1195,6 +1536,8 @@ def _use_special_shop_item(purchase: 'UserShopPurchase', item: 'ShopItem'):
         # Сам предмет одноразовый — удаляем покупку
         db.session.delete(purchase)
         db.session.commit()
+        _demogorgon_snapshot_invalidate()
+        _publish_event('demogorgon', 'state', _demogorgon_event_data(army))
         return jsonify({
             'success': True,
             'message': 'Армия Демогorgonов призвана на карту.',
@@ -1336,17 +1679,21 @@ class Boss(db.Model):
     is_active = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+    # Счётчики здоровья (boss_stats.py): сумма points задач и сумма points правильно решённых задач
+    total_health = db.Column(db.Integer, default=0, nullable=False)
+    damage_dealt = db.Column(db.Integer, default=0, nullable=False)
     
     tasks = db.relationship('BossTask', backref='boss', lazy=True, cascade='all, delete-orphan')
     solutions = db.relationship('BossTaskSolution', backref='boss', lazy=True, cascade='all, delete-orphan')
     drops = db.relationship('BossDrop', backref='boss', lazy=True, cascade='all, delete-orphan')
     drop_rewards = db.relationship('BossDropReward', backref='boss', lazy=True, cascade='all, delete-orphan')
+    drop_tallies = db.relationship('BossDropTally', lazy=True, cascade='all, delete-orphan')
+    top_class_stats = db.relationship('BossTopClassStat', lazy=True, cascade='all, delete-orphan')
+    leaderboard = db.relationship('BossLeaderboardEntry', lazy=True, cascade='all, delete-orphan')
     
     def get_total_health(self) -> int:
-        """Суммарное здоровье босса (сумма points всех задач) без загрузки всех задач в память."""
-        from sqlalchemy import func
-        total = db.session.query(func.sum(BossTask.points)).filter(BossTask.boss_id == self.id).scalar()
-        return int(total or 0)
+        """Суммарное здоровье босса (сумма points всех задач) — счётчик в строке босса."""
+        return int(self.total_health or 0)
 
     def to_dict(self):
         total_health = self.get_total_health()
@@ -1363,17 +1710,9 @@ class Boss(db.Model):
     
     def get_current_health(self, total_health: int | None = None) -> int:
         """Возвращает текущее здоровье босса (сумма очков всех задач минус нанесенный урон)"""
-        from sqlalchemy import func
         if total_health is None:
             total_health = self.get_total_health()
-        # Вычисляем суммарный урон из правильно решенных задач
-        damage_dealt = db.session.query(func.sum(BossTask.points)).join(
-            BossTaskSolution, BossTaskSolution.task_id == BossTask.id
-        ).filter(
-            BossTaskSolution.boss_id == self.id,
-            BossTaskSolution.is_correct == True
-        ).scalar() or 0
-        return int(max(0, int(total_health) - int(damage_dealt or 0)))
+        return int(max(0, int(total_health) - int(self.damage_dealt or 0)))
 
 class BossTask(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -1542,6 +1881,53 @@ class BossDropReward(db.Model):
             'received_at': self.received_at.isoformat() if self.received_at else None
         }
 
+class BossDropTally(db.Model):
+    """Сколько раз дроп выпал пользователю (BossUser.id) — счётчик для лимита max_per_user (boss_drops.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    boss_id = db.Column(db.Integer, db.ForeignKey('boss.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('boss_user.id'), nullable=False)
+    drop_id = db.Column(db.Integer, db.ForeignKey('boss_drop.id'), nullable=False)
+    count = db.Column(db.Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'drop_id', name='uq_boss_drop_tally_user_drop'),
+        Index('idx_boss_drop_tally_boss_user', 'boss_id', 'user_id'),
+    )
+
+class BossTopClassStat(db.Model):
+    """Правильные решения пользователя (BossUser.id) за класс в рейде — основа топа по классам (boss_top.py)"""
+    __tablename__ = 'boss_top_class_stat'
+    id = db.Column(db.Integer, primary_key=True)
+    boss_id = db.Column(db.Integer, db.ForeignKey('boss.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('boss_user.id'), nullable=False)
+    class_id = db.Column(db.Integer, db.ForeignKey('class.id'), nullable=False)
+    name_key = db.Column(db.String(200), nullable=False, default='')  # boss_top.canonical_name_key(имя)
+    solved = db.Column(db.Integer, default=0, nullable=False)
+    last_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('boss_id', 'user_id', 'class_id', name='uq_boss_top_class_stat'),
+        Index('idx_boss_top_class_stat_name', 'boss_id', 'name_key'),
+    )
+
+class BossLeaderboardEntry(db.Model):
+    """Строка топа рейда: пользователь (kind='user') или склеенное имя (kind='name') в основном классе"""
+    __tablename__ = 'boss_leaderboard'
+    id = db.Column(db.Integer, primary_key=True)
+    boss_id = db.Column(db.Integer, db.ForeignKey('boss.id'), nullable=False)
+    kind = db.Column(db.String(10), nullable=False)
+    key = db.Column(db.String(200), nullable=False)  # BossUser.id или ключ имени
+    user_id = db.Column(db.Integer, nullable=True)
+    user_name = db.Column(db.String(200), nullable=True)
+    main_class_id = db.Column(db.Integer, nullable=True)
+    solved = db.Column(db.Integer, default=0, nullable=False)
+    last_at = db.Column(db.DateTime, nullable=True)
+
+    __table_args__ = (
+        db.UniqueConstraint('boss_id', 'kind', 'key', name='uq_boss_leaderboard_key'),
+        Index('idx_boss_leaderboard_class_rank', 'boss_id', 'kind', 'main_class_id', 'solved', 'last_at'),
+    )
+
 
 # Генератор заданий для битвы за территорию (название; логика генерации — позже)
 class TaskGenerator(db.Model):
@@ -1570,6 +1956,10 @@ class TerritoryRegionState(db.Model):
     owner_class_id = db.Column(db.Integer, db.ForeignKey('class.id'), nullable=True)
     owner_clan_id = db.Column(db.Integer, db.ForeignKey('clan.id'), nullable=True)
     strength = db.Column(db.Integer, default=0, nullable=False)
+    # Версия карты: номер последнего изменения области (max по таблице + 1), для /api/territory/map-state?since=
+    version = db.Column(db.BigInteger, default=0, nullable=False)
+    # PostgreSQL: id транзакции, последней изменившей строку (ставит триггер) — водяной знак для ?since=
+    xact_id = db.Column(db.BigInteger, default=0, nullable=False)
     owner_class = db.relationship('Class', foreign_keys=[owner_class_id], lazy=True)
     owner_clan = db.relationship('Clan', foreign_keys=[owner_clan_id], lazy=True)
     __table_args__ = (
@@ -1579,6 +1969,16 @@ class TerritoryRegionState(db.Model):
     )
 
 
+class TerritoryHotMapCheckpoint(db.Model):
+    """Горячая карта: номер последнего действия журнала, записанного в БД, и запрос на перечитывание
+    карты (другой экземпляр изменил области в обход актора). Всегда одна запись с id=1."""
+    __tablename__ = 'territory_hot_map_checkpoint'
+    id = db.Column(db.Integer, primary_key=True)
+    last_seq = db.Column(db.BigInteger, nullable=False, default=0)
+    reload_requested = db.Column(db.Boolean, nullable=False, default=False)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
 class DemogorgonArmy(db.Model):
     """Армия Демогоргонов, призванная особым предметом.
     В каждый момент времени активна максимум одна запись.
@@ -1597,6 +1997,10 @@ class DemogorgonArmy(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
     last_damage_tick_at = db.Column(db.DateTime, default=datetime.now, nullable=False)
     next_move_at = db.Column(db.DateTime, nullable=True)
+    # Номер изменения (перемещение, урон, лечение, завершение) — ключ снимка для /api/territory/demogorgons
+    version = db.Column(db.Integer, nullable=False, default=0)
+    # Топ кланов по урону: JSON [[clan_id, урон], ...], обновляется при каждом ударе (None — старые записи)
+    top_clans = db.Column(db.Text, nullable=True)
 
     shop_item = db.relationship('ShopItem', backref=db.backref('demogorgon_armies', lazy=True))
 
@@ -1698,10 +2102,19 @@ def _invalidate_territory_settings_cache():
 
 
 def _check_achievements(user_id):
-    """Синхронизировать счётчики и разблокировать достижения (без commit)."""
-    from achievements import sync_user_achievement_counters, check_and_unlock_achievements
-    sync_user_achievement_counters(user_id)
-    return check_and_unlock_achievements(user_id)
+    """Проверить достижения счётчиков, изменённых в этом запросе (без commit).
+    Счётчики обновляются в памяти по ходу действия; полная ретроактивная синхронизация
+    здесь не выполняется — см. _check_all_achievements и /api/admin/achievements/sync."""
+    from achievements import achievement_hook
+    return achievement_hook(user_id, commit=False)
+
+
+def _check_all_achievements(user_id):
+    """Все достижения игрока (кабинет): полная синхронизация, если игрок её ещё не проходил."""
+    from achievements import ensure_achievement_counters_synced, achievement_hook, check_and_unlock_achievements
+    ensure_achievement_counters_synced(user_id)
+    newly = achievement_hook(user_id, commit=False)
+    return newly + check_and_unlock_achievements(user_id)
 
 
 def get_territory_registration_enabled():
@@ -1834,17 +2247,19 @@ def validate_user_id(user_id):
     
     return True, user, None
 
-def process_drop_reward(boss_id, user_id, task_id, class_id=None, allow_multiple_drops_per_task=False):
+def process_drop_reward(boss_id, user_id, task_id, class_id=None):
     """
     Обрабатывает выпадение дропа при правильном ответе
     Возвращает (drop_reward_object, error_message)
-    Использует транзакции для атомарности
+    
+    Выбор — по таблице дропов босса из кэша (boss_drops.table), лимит max_per_user — по счётчикам
+    boss_drop_tally. Один дроп за задачу гарантирует уникальный индекс uq_boss_drop_reward_one_per_task:
+    повторная выдача отсекается при вставке, а не предварительной проверкой.
     
     Args:
         boss_id: ID босса
         user_id: ID пользователя
         task_id: ID задачи
-        allow_multiple_drops_per_task: Если False, пользователь может получить дроп только один раз за задачу
     """
     try:
         # Проверяем существование пользователя
@@ -1852,130 +2267,39 @@ def process_drop_reward(boss_id, user_id, task_id, class_id=None, allow_multiple
         if not is_valid:
             return None, error
         
-        # Получаем все дропы для этого босса
-        drops = BossDrop.query.filter_by(boss_id=boss_id).all()
-        if not drops:
+        drop_table = boss_drops.table(boss_id)
+        if drop_table is None:
             return None, None  # Нет дропов - это нормально
-
-        # Учитываем лимит max_per_user для конкретного пользователя (по BossUser.id)
-        # Если лимит достигнут — исключаем этот дроп из выбора.
-        from sqlalchemy import func
-        existing_counts = dict(
-            db.session.query(BossDropReward.drop_id, func.count(BossDropReward.id))
-            .filter(
-                BossDropReward.boss_id == boss_id,
-                BossDropReward.user_id == user_id
-            )
-            .group_by(BossDropReward.drop_id)
-            .all()
-        )
-
-        eligible_drops = []
-        for drop in drops:
-            max_per_user = getattr(drop, 'max_per_user', None)
-            if max_per_user is not None and max_per_user > 0:
-                if existing_counts.get(drop.id, 0) >= max_per_user:
-                    continue
-            eligible_drops.append(drop)
-
-        if not eligible_drops:
-            logger.info(f"Нет доступных дропов для user_id={user_id} (все упёрлись в лимит max_per_user)")
-            return None, None
-        
-        # Проверяем, не получил ли уже пользователь дроп за эту задачу
-        if not allow_multiple_drops_per_task:
-            # Проверяем напрямую по BossDropReward.task_id (логика "один дроп за одну задачу")
-            existing_reward = BossDropReward.query.filter_by(
-                boss_id=boss_id,
-                user_id=user_id,
-                task_id=task_id
-            ).first()
-            
-            if existing_reward:
-                logger.info(f"Пользователь {user_id} уже получил дроп за задачу {task_id}")
-                return None, None  # Уже получил дроп за эту задачу
         
-        # Сначала проверяем, выпал ли вообще шанс на дроп (20% вероятность)
-        drop_chance = random.random()
-        if drop_chance > 0.2:  # 20% вероятность получить дроп
-            logger.info(f"Дроп не выпал: drop_chance={drop_chance:.3f} > 0.2 (пользователь {user_id}, задача {task_id})")
-            return None, None  # Дроп не выпал
-        
-        logger.info(f"Дроп выпал! drop_chance={drop_chance:.3f} <= 0.2 (пользователь {user_id}, задача {task_id})")
-        
-        # Если шанс выпал, выбираем конкретный дроп с учетом их вероятностей
-        # Всегда нормализуем вероятности для корректного расчета
-        total_probability = sum(drop.get_probability_value() for drop in eligible_drops)
-        
-        if total_probability <= 0:
+        # Шанс на дроп (boss_drops.DROP_CHANCE), затем конкретный дроп с учетом вероятностей и лимитов
+        selected_drop = boss_drops.roll(drop_table, lambda: boss_drops.tallies(boss_id, user_id))
+        if selected_drop is None:
+            logger.info(f"Дроп не выпал (пользователь {user_id}, задача {task_id})")
             return None, None
         
-        # Нормализуем вероятности (сумма должна быть = 1.0)
-        rand_value = random.random()
-        cumulative = 0
-        selected_drop = None
-        
-        for drop in eligible_drops:
-            # Нормализуем вероятность каждого дропа
-            prob = drop.get_probability_value() / total_probability
-            cumulative += prob
-            if rand_value <= cumulative:
-                selected_drop = drop
-                break
-        
-        # Если дроп выпал, сохраняем его в транзакции
-        if selected_drop:
-            try:
-                # Доп. проверка лимита перед сохранением (защита от параллельных выдач)
-                max_per_user = getattr(selected_drop, 'max_per_user', None)
-                if max_per_user is not None and max_per_user > 0:
-                    current_count = BossDropReward.query.filter_by(
-                        boss_id=boss_id,
-                        user_id=user_id,
-                        drop_id=selected_drop.id
-                    ).count()
-                    if current_count >= max_per_user:
-                        logger.info(
-                            f"Лимит дропа достигнут: user_id={user_id}, drop_id={selected_drop.id}, "
-                            f"count={current_count}, max_per_user={max_per_user}"
-                        )
-                        return None, None
-
-                # Дополнительная проверка на дубликаты перед сохранением
-                # (защита от race condition)
-                duplicate_check = BossDropReward.query.filter_by(
-                    boss_id=boss_id,
-                    user_id=user_id,
-                    task_id=task_id
-                ).first()
-                
-                if duplicate_check and not allow_multiple_drops_per_task:
-                    logger.info(f"Дроп уже был выдан пользователю {user_id} за задачу {task_id} (race condition)")
-                    return None, None
-                
-                drop_reward = BossDropReward(
-                    boss_id=boss_id,
-                    user_id=user_id,
-                    drop_id=selected_drop.id,
-                    task_id=task_id,
-                    class_id=class_id
-                )
-                db.session.add(drop_reward)
-                db.session.commit()
-                
-                logger.info(f"Дроп выпал: user_id={user_id}, drop_id={selected_drop.id}, boss_id={boss_id}, task_id={task_id}")
-                return drop_reward, None
-            except IntegrityError as e:
+        try:
+            drop_reward = boss_drops.grant(boss_id, user_id, selected_drop, task_id=task_id, class_id=class_id)
+            if drop_reward is None:
+                # Лимит успели выбрать параллельной выдачей
                 db.session.rollback()
-                logger.error(f"Ошибка целостности при сохранении дропа: {e}")
-                # Возможно, дроп уже был сохранен параллельно
+                logger.info(
+                    f"Лимит дропа достигнут: user_id={user_id}, drop_id={selected_drop.id}, "
+                    f"max_per_user={selected_drop.max_per_user}"
+                )
                 return None, None
-            except Exception as e:
-                db.session.rollback()
-                logger.error(f"Неожиданная ошибка при сохранении дропа: {e}")
-                return None, 'Ошибка при сохранении дропа'
-        
-        return None, None  # Дроп не выпал - это нормально
+            db.session.commit()
+            
+            logger.info(f"Дроп выпал: user_id={user_id}, drop_id={selected_drop.id}, boss_id={boss_id}, task_id={task_id}")
+            return drop_reward, None
+        except IntegrityError as e:
+            db.session.rollback()
+            # Дроп за эту задачу уже выдан (или счётчик создан параллельно)
+            logger.info(f"Дроп не сохранён (уже выдан за задачу {task_id} пользователю {user_id}): {e}")
+            return None, None
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Неожиданная ошибка при сохранении дропа: {e}")
+            return None, 'Ошибка при сохранении дропа'
         
     except Exception as e:
         logger.error(f"Ошибка при обработке дропа: {e}")
@@ -2062,6 +2386,9 @@ def ensure_database_tables():
     created = sorted(after - before)
     if created:
         print(f"Созданы таблицы: {', '.join(created)}")
+    if 'user_pvp_stats' in created:
+        # Новая таблица итогов дуэлей — заполнить по истории pvp_duel
+        print(f"Заполнены итоги PvP: {pvp_stats.backfill()} игроков")
     fix_postgresql_sequences()
 
 
@@ -2120,19 +2447,58 @@ def _get_active_demogorgon() -> DemogorgonArmy | None:
     return DemogorgonArmy.query.filter_by(is_active=True).first()
 
 
+def _demogorgon_event_data(army, region_strength=None):
+    """Состояние армии для события demogorgon (поля как у /api/territory/demogorgons, без иконки и топа)."""
+    if not army or not army.is_active or (army.health or 0) <= 0:
+        return {'active': False}
+    return {
+        'active': True,
+        'army_id': army.id,
+        'region_index': army.region_index,
+        'pos_x': army.pos_x,
+        'pos_y': army.pos_y,
+        'health': army.health,
+        'max_health': army.max_health,
+        'region_strength': region_strength,
+    }
+
+
+def _demogorgon_top_clans(army: DemogorgonArmy) -> list[tuple[int, int]]:
+    """Топ кланов по урону по армии: [(clan_id, урон), ...] по убыванию, не больше DEMOGORGON_TOP_CLANS."""
+    if army.top_clans is not None:
+        try:
+            return [(int(clan_id), int(damage)) for clan_id, damage in json.loads(army.top_clans)]
+        except (TypeError, ValueError):
+            pass
+    rows = (
+        db.session.query(DemogorgonDamage.clan_id, DemogorgonDamage.total_damage)
+        .filter(DemogorgonDamage.army_id == army.id)
+        .order_by(DemogorgonDamage.total_damage.desc())
+        .limit(DEMOGORGON_TOP_CLANS)
+        .all()
+    )
+    return [(clan_id, int(damage or 0)) for clan_id, damage in rows]
+
+
+def _demogorgon_top_clans_hit(army: DemogorgonArmy, clan_id: int, total_damage: int) -> None:
+    """Обновить army.top_clans после удара клана (total_damage — его суммарный урон после удара).
+    Урон клана только растёт, поэтому попасть в топ или подняться в нём можно только своим ударом —
+    достаточно поправить позицию этого клана. Вызывать под блокировкой строки армии."""
+    top = [entry for entry in _demogorgon_top_clans(army) if entry[0] != clan_id]
+    top.append((clan_id, int(total_damage)))
+    top.sort(key=lambda entry: -entry[1])
+    army.top_clans = json.dumps(top[:DEMOGORGON_TOP_CLANS])
+
+
 def _demogorgon_finish(army: DemogorgonArmy) -> None:
     """Завершение жизни армии Демогоргонов: определение победителя и выдача награды.
     Вызывать только когда army.health <= 0 и army.is_active.
     """
     if not army or not army.is_active:
         return
-    top_row = (
-        DemogorgonDamage.query.filter_by(army_id=army.id)
-        .order_by(DemogorgonDamage.total_damage.desc())
-        .first()
-    )
-    if top_row and top_row.clan_id:
-        clan = Clan.query.get(top_row.clan_id)
+    top = _demogorgon_top_clans(army)
+    if top:
+        clan = Clan.query.get(top[0][0])
         if clan and clan.owner_id:
             leader = User.query.get(clan.owner_id)
             if leader:
@@ -2141,132 +2507,472 @@ def _demogorgon_finish(army: DemogorgonArmy) -> None:
 
 
 def _demogorgon_tick():
-    """Фоновая логика Демогоргонов: поедание силы областей, перемещение, завершение."""
+    """Фоновая логика Демогоргонов: поедание силы областей, перемещение, завершение.
+
+    Работает только в экземпляре с локом планировщика (единственный писатель состояния армии).
+    За один вызов применяет все тики с last_damage_tick_at (demogorgon_sim.advance), поэтому
+    пропущенные запуски задачи и перезапуск планировщика ничего не теряют и не удваивают.
+    """
+    if not scheduler.running:
+        return
     army = _get_active_demogorgon()
     if not army:
         return
+    # Ответы по армии тоже меняют здоровье и version: тик читает и пишет строку под блокировкой,
+    # иначе version от устаревшего значения совпадёт с версией ответа и снимок не обновится
+    army = (
+        DemogorgonArmy.query.filter_by(id=army.id)
+        .populate_existing()
+        .with_for_update()
+        .first()
+    )
+    if not army or not army.is_active:
+        db.session.rollback()
+        return
     now = datetime.now()
+    before = (army.region_index, army.pos_x, army.pos_y, army.is_active)
     try:
-        current_region_strength = None
-        all_regions_zero = False
-
-        if (now - (army.last_damage_tick_at or army.created_at)).total_seconds() >= DEMOGORGON_DAMAGE_TICK_SECONDS:
-            state = TerritoryRegionState.query.filter_by(region_index=army.region_index).first()
-            if state:
-                state.strength = max(0, int(state.strength or 0) - DEMOGORGON_DAMAGE_PER_TICK)
-                current_region_strength = int(state.strength or 0)
-            army.last_damage_tick_at = now
-
-        def _choose_next_region_prefer_strongest(current_region_index: int | None) -> int | None:
-            states = TerritoryRegionState.query.order_by(TerritoryRegionState.region_index).all()
-            if not states:
-                return None
-            positives = [s for s in states if int(s.strength or 0) > 0]
-            if not positives:
-                return None
-            max_strength = max(int(s.strength or 0) for s in positives)
-            candidates = [s for s in positives if int(s.strength or 0) == max_strength]
-            if current_region_index is not None and len(candidates) > 1:
-                non_current = [s for s in candidates if s.region_index != current_region_index]
-                if non_current:
-                    candidates = non_current
-            target_state = random.choice(candidates)
-            return target_state.region_index
-
-        if current_region_strength == 0 and army.is_active:
-            states = TerritoryRegionState.query.order_by(TerritoryRegionState.region_index).all()
-            if states:
-                positives = [s for s in states if int(s.strength or 0) > 0]
-                if not positives:
-                    all_regions_zero = True
-                else:
-                    next_idx = _choose_next_region_prefer_strongest(army.region_index)
-                    if next_idx is not None:
-                        army.region_index = next_idx
-                        army.pos_x = random.random()
-                        army.pos_y = random.random()
-                        delay_min = random.randint(DEMOGORGON_MIN_MOVE_MINUTES, DEMOGORGON_MAX_MOVE_MINUTES)
-                        army.next_move_at = now + timedelta(minutes=delay_min)
-
-        if army.next_move_at and now >= army.next_move_at and army.is_active and not all_regions_zero:
-            next_idx = _choose_next_region_prefer_strongest(army.region_index)
-            if next_idx is not None:
-                army.region_index = next_idx
-                army.pos_x = random.random()
-                army.pos_y = random.random()
-            delay_min = random.randint(DEMOGORGON_MIN_MOVE_MINUTES, DEMOGORGON_MAX_MOVE_MINUTES)
-            army.next_move_at = now + timedelta(minutes=delay_min)
-
-        if all_regions_zero and army.is_active:
+        hot = _territory_hot_map()
+        state = ArmyState(
+            army.region_index, army.pos_x, army.pos_y, bool(army.is_active),
+            army.last_damage_tick_at or army.created_at or now, army.next_move_at,
+        )
+        strengths = {ri: strength for ri, (_, strength) in _territory_region_states().items()}
+        result = demogorgon_advance(state, strengths, now, army.id, DEMOGORGON_SIM_PARAMS)
+
+        region_strengths = {}
+        if result.drains:
+            version = _territory_next_map_version() if hot is None else None
+            for ri, amount in sorted(result.drains.items()):
+                if hot is not None:
+                    region_strengths[ri] = hot.drain(ri, amount)
+                    continue
+                region = (
+                    TerritoryRegionState.query.filter_by(region_index=ri)
+                    .populate_existing()
+                    .with_for_update()
+                    .first()
+                )
+                if region:
+                    region.strength = max(0, int(region.strength or 0) - amount)
+                    region.version = version
+                    region_strengths[ri] = int(region.strength)
+
+        new = result.state
+        army.region_index = new.region_index
+        army.pos_x = new.pos_x
+        army.pos_y = new.pos_y
+        army.last_damage_tick_at = new.last_damage_tick_at
+        army.next_move_at = new.next_move_at
+        if not new.is_active and army.is_active:
             army.is_active = False
 
         if army.health <= 0 and army.is_active:
             _demogorgon_finish(army)
+        changed = bool(region_strengths) or before != (army.region_index, army.pos_x, army.pos_y, army.is_active)
+        if changed:
+            army.version = (army.version or 0) + 1
         db.session.commit()
+        if changed:
+            _demogorgon_snapshot_invalidate()
+            current_strength = region_strengths.get(army.region_index, result.strengths.get(army.region_index))
+            _publish_event('demogorgon', 'state', _demogorgon_event_data(army, current_strength))
+            for ri in sorted(region_strengths):
+                _publish_event('map', 'region', {'region_index': ri})
     except Exception as e:
         logger.error(f'Ошибка в тике Демогоргон-армии: {e}')
         db.session.rollback()
 
 
-# Создание таблиц и инициализация при первом старте
-with app.app_context():
-    ensure_database_tables()
-    is_pg = db.engine.dialect.name == 'postgresql'
-    _datetime_type = 'TIMESTAMP' if is_pg else 'DATETIME'
-    _bool_true = 'TRUE' if is_pg else '1'
-    _bool_false = 'FALSE' if is_pg else '0'
+def _demogorgon_tick_job():
+    """Задача планировщика: тик Демогоргонов в контексте приложения (сессия БД закрывается при выходе)."""
+    with app.app_context():
+        _demogorgon_tick()
 
-    # Миграция: добавление новых колонок в таблицу Prize, если их нет
-    try:
-        from sqlalchemy import inspect, text
 
-        inspector = inspect(db.engine)
-        
-        # Проверяем, существует ли таблица prize
-        if 'prize' in inspector.get_table_names():
-            columns = [col['name'] for col in inspector.get_columns('prize')]
-            
-            with db.engine.begin() as conn:
-                if 'students_change' not in columns:
-                    conn.execute(text('ALTER TABLE prize ADD COLUMN students_change INTEGER DEFAULT 0'))
-                    print("Добавлена колонка students_change в таблицу prize")
-                
-                if 'valera_change' not in columns:
-                    conn.execute(text('ALTER TABLE prize ADD COLUMN valera_change INTEGER DEFAULT 0'))
-                    print("Добавлена колонка valera_change в таблицу prize")
-                
-                if 'probability' not in columns:
-                    conn.execute(text("ALTER TABLE prize ADD COLUMN probability VARCHAR(20) DEFAULT 'medium'"))
-                    print("Добавлена колонка probability в таблицу prize")
-    except Exception as e:
-        print(f"Ошибка при миграции таблицы prize: {e}")
-        # Если таблица не существует, db.create_all() создаст её с нужными колонками
-    
-    # Миграция: добавление колонки rating в таблицу student, если её нет
-    try:
-        from sqlalchemy import inspect, text
-        
-        inspector = inspect(db.engine)
-        if 'student' in inspector.get_table_names():
-            columns = [col['name'] for col in inspector.get_columns('student')]
-            if 'rating' not in columns:
-                with db.engine.begin() as conn:
-                    conn.execute(text('ALTER TABLE student ADD COLUMN rating INTEGER DEFAULT 0'))
-                    print("Добавлена колонка rating в таблицу student")
-    except Exception as e:
-        print(f"Ошибка при миграции таблицы student (rating): {e}")
-    
-    # Миграция: добавление таблиц для задач недели
-    try:
-        from sqlalchemy import inspect, text
-        inspector = inspect(db.engine)
-        tables = inspector.get_table_names()
-        
-        if 'weekly_task' not in tables or 'task_solution' not in tables:
-            db.create_all()
-            print("Созданы таблицы для задач недели")
-        else:
-            # Проверяем наличие колонки last_updated
+def _leaderboards_refresh_job():
+    """Задача планировщика: пересобрать изменившиеся доски рейтинга."""
+    with app.app_context():
+        try:
+            leaderboards.refresh_all()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Ошибка обновления рейтинга: {e}')
+
+
+def _chat_filtered_fields(text):
+    """Колонки отфильтрованного текста для нового сообщения чата: Model(..., **_chat_filtered_fields(text))."""
+    filtered, version = filter_chat_text_versioned(text)
+    return {'text_filtered': filtered, 'filter_version': version}
+
+
+def _chat_text(m):
+    """Текст сообщения для показа: сохранённый отфильтрованный; до перефильтровки старых строк — фильтр на лету."""
+    if m.filter_version is not None and m.text_filtered is not None:
+        return m.text_filtered
+    return filter_chat_text(m.text)
+
+
+def _chat_authors(user_ids):
+    """{user_id: (имя, url аватара)} авторов сообщений — одним запросом."""
+    ids = {uid for uid in user_ids if uid is not None}
+    if not ids:
+        return {}
+    rows = db.session.query(User.id, User.character_name, User.username, User.avatar_filename).filter(User.id.in_(ids)).all()
+    return {
+        uid: (
+            character_name or username,
+            url_for('static', filename=_avatar_static_filename(avatar_filename)) if avatar_filename else None,
+        )
+        for uid, character_name, username, avatar_filename in rows
+    }
+
+
+def _chat_message_items(messages):
+    """Сообщения чата клана / поиска клана для JSON."""
+    authors = _chat_authors(m.user_id for m in messages)
+    return [
+        {'id': m.id, 'user_id': m.user_id, 'author_name': authors.get(m.user_id, ('?', None))[0],
+         'text': _chat_text(m), 'created_at': m.created_at.isoformat() if m.created_at else None}
+        for m in messages
+    ]
+
+
+def _pvp_chat_message_items(messages):
+    """Сообщения чата арены для JSON (с аватаром)."""
+    authors = _chat_authors(m.user_id for m in messages)
+    items = []
+    for m in messages:
+        name, avatar_url = authors.get(m.user_id, ('?', None))
+        items.append({
+            'id': m.id,
+            'user_id': m.user_id,
+            'user_name': name,
+            'avatar_url': avatar_url,
+            'text': _chat_text(m),
+            'created_at': m.created_at.isoformat() if m.created_at else None,
+        })
+    return items
+
+
+_chat_feed = chat_feed.ChatFeed(CHAT_FEED_SIZE, CHAT_FEED_CHECK_SECONDS, CHAT_FEED_REBUILD_SECONDS, CHAT_FEED_REREAD)
+# (когда прочитано, поколение) — ChatFeedState.generation читается не чаще раза в CHAT_FEED_CHECK_SECONDS
+_chat_feed_generation_cache = (0.0, None)
+
+
+def _chat_feed_generation():
+    """Поколение удалений сообщений чата из БД (с кэшем на CHAT_FEED_CHECK_SECONDS)."""
+    global _chat_feed_generation_cache
+    checked_at, generation = _chat_feed_generation_cache
+    now = time.monotonic()
+    if generation is None or now - checked_at >= CHAT_FEED_CHECK_SECONDS:
+        generation = db.session.query(ChatFeedState.generation).filter_by(id=1).scalar() or 0
+        _chat_feed_generation_cache = (now, generation)
+    return generation
+
+
+def _chat_messages_deleted(channel=None):
+    """Сообщения канала (None — всех) удаляются в текущей транзакции: поднять поколение в БД, чтобы
+    буферы перечитали все воркеры; буферы этого процесса сбрасываются сразу (до commit)."""
+    updated = ChatFeedState.query.filter_by(id=1).update(
+        {ChatFeedState.generation: ChatFeedState.generation + 1}, synchronize_session=False
+    )
+    if not updated:
+        db.session.add(ChatFeedState(id=1, generation=1))
+    _chat_feed.clear(channel)
+    _chat_unread.clear(channel)
+
+
+def _chat_list(channel, model, base, render, limit, before_id=None, after_id=None):
+    """Сообщения канала чата: (items, has_more); has_more — None для опроса after_id.
+
+    after_id (новые для опроса) и первая загрузка отвечаются из буфера канала (_chat_feed), если
+    в нём есть нужные сообщения; before_id (старые) и отставшие клиенты — из БД, has_more по limit+1."""
+    if after_id or not before_id:
+        def load_latest(n):
+            return render(list(reversed(base.order_by(model.id.desc()).limit(n).all())))
+
+        def load_after(head_id, n):
+            return render(base.filter(model.id > head_id).order_by(model.id.asc()).limit(n).all())
+
+        version = (chat_filter_version(), _chat_feed_generation())
+        items, complete = _chat_feed.read(channel, version, load_latest, load_after)
+        if after_id:
+            new_items = chat_feed.after(items, complete, after_id)
+            if new_items is None:
+                new_items = render(base.filter(model.id > after_id).order_by(model.id.asc()).all())
+            return new_items, None
+        page = chat_feed.latest(items, complete, limit)
+        if page is not None:
+            return page
+    query = base.filter(model.id < before_id) if before_id else base
+    messages = query.order_by(model.id.desc()).limit(limit + 1).all()
+    return render(list(reversed(messages[:limit]))), len(messages) > limit
+
+
+# Хвосты каналов для счётчиков непрочитанного: id сообщения и ключ (автор в чате клана, адресат ответа администратора)
+_chat_unread = chat_feed.ChatFeed(CHAT_UNREAD_TAIL, CHAT_UNREAD_CHECK_SECONDS, CHAT_FEED_REBUILD_SECONDS, CHAT_FEED_REREAD)
+CHAT_UNREAD_ADMIN_CHANNEL = 'admin-replies'
+
+
+def _chat_unread_count(channel, id_column, query, make_key, after_id, key=None, skip_key=None):
+    """Непрочитанные в канале (id > after_id) по хвосту _chat_unread; None, если хвоста не хватило.
+    query — выборка строк канала (первая колонка — id_column), make_key(row) — ключ строки."""
+    def render(rows):
+        return [{'id': row[0], 'key': make_key(row)} for row in rows]
+
+    def load_latest(n):
+        return render(reversed(query.order_by(id_column.desc()).limit(n).all()))
+
+    def load_after(head_id, n):
+        return render(query.filter(id_column > head_id).order_by(id_column.asc()).limit(n).all())
+
+    items, complete = _chat_unread.read(channel, _chat_feed_generation(), load_latest, load_after)
+    return chat_feed.unread(items, complete, after_id, key, skip_key)
+
+
+def _clan_chat_unread(user, after_id):
+    """Новые сообщения чата клана игрока от других участников (id > after_id)."""
+    count = _chat_unread_count(
+        f'clan:{user.clan_id}', ClanChatMessage.id,
+        db.session.query(ClanChatMessage.id, ClanChatMessage.user_id).filter(ClanChatMessage.clan_id == user.clan_id),
+        lambda row: row[1], after_id, skip_key=user.id,
+    )
+    if count is None:
+        count = ClanChatMessage.query.filter(
+            ClanChatMessage.clan_id == user.clan_id,
+            ClanChatMessage.id > after_id,
+            ClanChatMessage.user_id != user.id,
+        ).count()
+    return count
+
+
+def _admin_chat_reply_key(user_id, guest_key):
+    return f'u:{user_id}' if user_id else f'g:{guest_key}'
+
+
+def _admin_chat_unread(user_id, guest_key, after_id):
+    """Ответы администратора игроку (user_id) или гостю (guest_key) с id > after_id."""
+    count = _chat_unread_count(
+        CHAT_UNREAD_ADMIN_CHANNEL, TerritoryAdminChatMessage.id,
+        db.session.query(
+            TerritoryAdminChatMessage.id, TerritoryAdminChatMessage.user_id, TerritoryAdminChatMessage.guest_key,
+        ).filter(TerritoryAdminChatMessage.is_from_admin == True),
+        lambda row: _admin_chat_reply_key(row[1], row[2]), after_id, key=_admin_chat_reply_key(user_id, guest_key),
+    )
+    if count is None:
+        owner = (TerritoryAdminChatMessage.user_id == user_id) if user_id else (TerritoryAdminChatMessage.guest_key == guest_key)
+        count = TerritoryAdminChatMessage.query.filter(
+            owner,
+            TerritoryAdminChatMessage.is_from_admin == True,
+            TerritoryAdminChatMessage.id > after_id,
+        ).count()
+    return count
+
+
+# Версия фильтра, которой уже обработаны все сообщения (в этом процессе); пока совпадает — чаты не сканируются
+_chat_refilter_done_version = None
+
+
+def _chat_refilter(batch_size=CHAT_REFILTER_BATCH):
+    """Перефильтровать сообщения чатов с другой (или пустой) версией фильтра. Число обновлённых строк."""
+    global _chat_refilter_done_version
+    version = chat_filter_version()
+    if version == _chat_refilter_done_version:
+        return 0
+    updated = 0
+    for model in (ClanChatMessage, PvPArenaChatMessage, ClanSearchChatMessage, TerritoryAdminChatMessage):
+        after_id = 0
+        while True:
+            rows = (
+                db.session.query(model.id, model.text)
+                .filter(
+                    model.id > after_id,
+                    db.or_(model.filter_version.is_(None), model.filter_version != version),
+                )
+                .order_by(model.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not rows:
+                break
+            db.session.bulk_update_mappings(model, [
+                {'id': row_id, 'text_filtered': filter_chat_text(row_text), 'filter_version': version}
+                for row_id, row_text in rows
+            ])
+            db.session.commit()
+            updated += len(rows)
+            after_id = rows[-1][0]
+    _chat_refilter_done_version = version
+    if updated:
+        logger.info(f'Перефильтровано сообщений чатов: {updated} (фильтр {version})')
+    return updated
+
+
+def _chat_refilter_job():
+    """Задача планировщика: перефильтровать чаты после изменения ban.txt."""
+    with app.app_context():
+        try:
+            _chat_refilter()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f'Ошибка перефильтровки чатов: {e}')
+
+
+def _scheduler_start_jobs():
+    """Запуск планировщика в экземпляре, захватившем аренду: восстановление горячей карты,
+    пропущенное обновление задачи недели и регистрация задач."""
+    global _scheduler_term_started_at
+    scheduler.start()
+    _scheduler_term_started_at = datetime.now()
+    if TERRITORY_HOT_MAP_ENABLED:
+        _territory_hot_map_recover()
+
+    # Проверяем, не пропущена ли дата обновления задачи
+    active_task = WeeklyTask.query.filter_by(is_active=True).first()
+    if active_task and active_task.last_updated:
+        # Вычисляем следующее воскресенье от времени последнего обновления
+        task_update_time = active_task.last_updated
+        if task_update_time.tzinfo:
+            task_update_time = task_update_time.replace(tzinfo=None)
+
+        # Вычисляем следующее воскресенье в 09:00 от времени обновления задачи
+        days_until_sunday = (6 - task_update_time.weekday()) % 7
+        if days_until_sunday == 0:
+            target_time = task_update_time.replace(hour=9, minute=0, second=0, microsecond=0)
+            if task_update_time >= target_time:
+                days_until_sunday = 7
+
+        next_sunday_from_update = task_update_time.replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=days_until_sunday)
+
+        # Если следующее воскресенье уже прошло, обновляем задачу сейчас
+        now = datetime.now()
+        if next_sunday_from_update < now:
+            print(f"Обнаружена пропущенная дата обновления задачи ({next_sunday_from_update}). Обновляю задачу сейчас...")
+            update_weekly_task()
+            print("Задача обновлена. Планирую следующее обновление на воскресенье в 09:00")
+
+    # Добавляем регулярную задачу на каждое воскресенье в 09:00
+    scheduler.add_job(
+        update_weekly_task,
+        'cron',
+        day_of_week='sun',
+        hour=9,
+        minute=0,
+        id='update_weekly_task',
+        replace_existing=True
+    )
+    # Тик армии Демогorgonов: раз в DEMOGORGON_DAMAGE_TICK_SECONDS
+    scheduler.add_job(
+        _demogorgon_tick_job,
+        'interval',
+        seconds=DEMOGORGON_DAMAGE_TICK_SECONDS,
+        id='demogorgon_tick',
+        jobstore='memory',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+    # Продление лока планировщика
+    scheduler.add_job(
+        _scheduler_renew_lock,
+        'interval',
+        seconds=SCHEDULER_LOCK_RENEW_SECONDS,
+        id='scheduler_lock_renew',
+        jobstore='memory',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+    # Доски рейтинга: проверка изменений и пересборка
+    scheduler.add_job(
+        _leaderboards_refresh_job,
+        'interval',
+        seconds=RATING_REFRESH_SECONDS,
+        id='leaderboards_refresh',
+        jobstore='memory',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+    scheduler.add_job(
+        _chat_refilter_job,
+        'interval',
+        seconds=CHAT_REFILTER_SECONDS,
+        id='chat_refilter',
+        jobstore='memory',
+        coalesce=True,
+        max_instances=1,
+        replace_existing=True
+    )
+    # Копии этих задач, сохранённые в БД прежними версиями, иначе выполнялись бы дважды
+    for job_id in ('demogorgon_tick', 'scheduler_lock_renew'):
+        try:
+            scheduler.remove_job(job_id, jobstore='default')
+        except JobLookupError:
+            pass
+    print("Планировщик задач запущен в этом экземпляре. Задача недели будет обновляться каждое воскресенье в 09:00")
+
+
+# Создание таблиц и инициализация при первом старте
+with app.app_context():
+    ensure_database_tables()
+    is_pg = db.engine.dialect.name == 'postgresql'
+    _datetime_type = 'TIMESTAMP' if is_pg else 'DATETIME'
+    _bool_true = 'TRUE' if is_pg else '1'
+    _bool_false = 'FALSE' if is_pg else '0'
+
+    # Миграция: добавление новых колонок в таблицу Prize, если их нет
+    try:
+        from sqlalchemy import inspect, text
+
+        inspector = inspect(db.engine)
+        
+        # Проверяем, существует ли таблица prize
+        if 'prize' in inspector.get_table_names():
+            columns = [col['name'] for col in inspector.get_columns('prize')]
+            
+            with db.engine.begin() as conn:
+                if 'students_change' not in columns:
+                    conn.execute(text('ALTER TABLE prize ADD COLUMN students_change INTEGER DEFAULT 0'))
+                    print("Добавлена колонка students_change в таблицу prize")
+                
+                if 'valera_change' not in columns:
+                    conn.execute(text('ALTER TABLE prize ADD COLUMN valera_change INTEGER DEFAULT 0'))
+                    print("Добавлена колонка valera_change в таблицу prize")
+                
+                if 'probability' not in columns:
+                    conn.execute(text("ALTER TABLE prize ADD COLUMN probability VARCHAR(20) DEFAULT 'medium'"))
+                    print("Добавлена колонка probability в таблицу prize")
+    except Exception as e:
+        print(f"Ошибка при миграции таблицы prize: {e}")
+        # Если таблица не существует, db.create_all() создаст её с нужными колонками
+    
+    # Миграция: добавление колонки rating в таблицу student, если её нет
+    try:
+        from sqlalchemy import inspect, text
+        
+        inspector = inspect(db.engine)
+        if 'student' in inspector.get_table_names():
+            columns = [col['name'] for col in inspector.get_columns('student')]
+            if 'rating' not in columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE student ADD COLUMN rating INTEGER DEFAULT 0'))
+                    print("Добавлена колонка rating в таблицу student")
+    except Exception as e:
+        print(f"Ошибка при миграции таблицы student (rating): {e}")
+    
+    # Миграция: добавление таблиц для задач недели
+    try:
+        from sqlalchemy import inspect, text
+        inspector = inspect(db.engine)
+        tables = inspector.get_table_names()
+        
+        if 'weekly_task' not in tables or 'task_solution' not in tables:
+            db.create_all()
+            print("Созданы таблицы для задач недели")
+        else:
+            # Проверяем наличие колонки last_updated
             if 'weekly_task' in tables:
                 columns = [col['name'] for col in inspector.get_columns('weekly_task')]
                 if 'last_updated' not in columns:
@@ -2309,6 +3015,17 @@ with app.app_context():
                     conn.execute(text('ALTER TABLE boss_task_solution ADD COLUMN user_id INTEGER'))
                     print("Добавлена колонка user_id в таблицу boss_task_solution")
 
+        # Миграция: счётчики здоровья босса; после добавления — заполнить пересчётом по задачам
+        if 'boss' in tables:
+            columns = [col['name'] for col in inspector.get_columns('boss')]
+            added = [name for name in boss_stats.FIELDS if name not in columns]
+            for name in added:
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE boss ADD COLUMN {name} INTEGER DEFAULT 0 NOT NULL'))
+                    print(f"Добавлена колонка {name} в таблицу boss")
+            if added:
+                print(f"Пересчитано здоровье боссов: {boss_stats.reconcile()}")
+
         # Миграция: добавление колонки max_per_user в boss_drop, если её нет
         if 'boss_drop' in tables:
             columns = [col['name'] for col in inspector.get_columns('boss_drop')]
@@ -2329,6 +3046,29 @@ with app.app_context():
                 with db.engine.begin() as conn:
                     conn.execute(text('ALTER TABLE boss_drop_reward ADD COLUMN class_id INTEGER'))
                     print("Добавлена колонка class_id в таблицу boss_drop_reward")
+
+        # Разовые заполнения новых таблиц по старым данным. Воркеры стартуют одновременно: на PostgreSQL
+        # проверка и заполнение идут под advisory lock до commit — заполняет первый, остальные после
+        # него видят строки и пропускают
+        def _startup_backfill_lock():
+            if is_pg:
+                db.session.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': STARTUP_BACKFILL_LOCK_KEY})
+
+        # Миграция: счётчики выпавших дропов (таблицу создаёт ensure_database_tables) — заполнить по выдачам
+        if 'boss_drop_reward' in tables:
+            _startup_backfill_lock()
+            if BossDropTally.query.first() is None and BossDropReward.query.first() is not None:
+                print(f"Заполнены счётчики дропов: {boss_drops.rebuild_tallies()}")
+            db.session.commit()
+
+        # Миграция: таблица лидеров рейда (таблицы создаёт ensure_database_tables) — собрать по решениям
+        if 'boss_task_solution' in tables:
+            _startup_backfill_lock()
+            if BossLeaderboardEntry.query.first() is None and BossTaskSolution.query.filter(
+                BossTaskSolution.user_id.isnot(None)
+            ).first() is not None:
+                print(f"Собрана таблица лидеров рейда: {boss_top.rebuild()}")
+            db.session.commit()
         
         # Создание индексов для оптимизации (если их еще нет)
         try:
@@ -2649,12 +3389,24 @@ with app.app_context():
                 with db.engine.begin() as conn:
                     conn.execute(text("ALTER TABLE scheduler_instance_lock ADD COLUMN owner_pid INTEGER"))
                     print("Добавлена колонка owner_pid в scheduler_instance_lock")
+            if 'metrics' not in lock_columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text("ALTER TABLE scheduler_instance_lock ADD COLUMN metrics TEXT"))
+                    print("Добавлена колонка metrics в scheduler_instance_lock")
         if 'demogorgon_army' in tables:
             army_columns = [col['name'] for col in inspector.get_columns('demogorgon_army')]
             if 'shop_item_id' not in army_columns:
                 with db.engine.begin() as conn:
                     conn.execute(text("ALTER TABLE demogorgon_army ADD COLUMN shop_item_id INTEGER"))
                     print("Добавлена колонка shop_item_id в demogorgon_army")
+            if 'version' not in army_columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text("ALTER TABLE demogorgon_army ADD COLUMN version INTEGER DEFAULT 0 NOT NULL"))
+                    print("Добавлена колонка version в demogorgon_army")
+            if 'top_clans' not in army_columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text("ALTER TABLE demogorgon_army ADD COLUMN top_clans TEXT"))
+                    print("Добавлена колонка top_clans в demogorgon_army")
     except Exception as e:
         print(f"Ошибка при создании таблиц лавки: {e}")
         db.create_all()
@@ -2701,6 +3453,18 @@ with app.app_context():
                 if is_pg and not user_id_nullable:
                     conn.execute(text('ALTER TABLE territory_admin_chat_message ALTER COLUMN user_id DROP NOT NULL'))
                     print("Колонка user_id в territory_admin_chat_message: разрешён NULL")
+        # Миграция: отфильтрованный текст и версия фильтра в чатах (заполняет задача chat_refilter)
+        for chat_table in ('clan_chat_message', 'pvp_arena_chat_message', 'clan_search_chat_message', 'territory_admin_chat_message'):
+            if chat_table not in tables:
+                continue
+            chat_columns = [col['name'] for col in inspector.get_columns(chat_table)]
+            with db.engine.begin() as conn:
+                if 'text_filtered' not in chat_columns:
+                    conn.execute(text(f'ALTER TABLE {chat_table} ADD COLUMN text_filtered TEXT'))
+                    print(f"Добавлена колонка text_filtered в {chat_table}")
+                if 'filter_version' not in chat_columns:
+                    conn.execute(text(f'ALTER TABLE {chat_table} ADD COLUMN filter_version VARCHAR(20)'))
+                    print(f"Добавлена колонка filter_version в {chat_table}")
         if 'user' in tables:
             columns = [col['name'] for col in inspector.get_columns('user')]
             with db.engine.begin() as conn:
@@ -2746,6 +3510,9 @@ with app.app_context():
                 if 'ability_class' not in columns:
                     conn.execute(text('ALTER TABLE "user" ADD COLUMN ability_class VARCHAR(20)'))
                     print("Добавлена колонка ability_class в user")
+                if 'bonus_version' not in columns:
+                    conn.execute(text('ALTER TABLE "user" ADD COLUMN bonus_version INTEGER DEFAULT 0 NOT NULL'))
+                    print("Добавлена колонка bonus_version в user")
         if 'clan' in tables:
             clan_columns = [col['name'] for col in inspector.get_columns('clan')]
             if 'can_use_gif_flag' not in clan_columns:
@@ -2770,20 +3537,8 @@ with app.app_context():
             db.create_all()
             print("Создана таблица territory_task")
         if 'territory_task' in tables and TerritoryTask.query.count() == 0:
-            default_tasks = [
-                ('Сумма', 'Чему равна сумма 15 + 27?', '42', 10),
-                ('Произведение', 'Чему равно 6 × 8?', '48', 10),
-                ('Квадрат', 'Чему равен квадрат числа 7?', '49', 10),
-                ('Уравнение', 'Найдите x: 2x + 10 = 24', '7', 15),
-                ('Периметр', 'Периметр квадрата 20 см. Чему равна сторона?', '5', 10),
-                ('Дробь', 'Сократите дробь 12/18 до несократимой. Напишите только числитель.', '2', 15),
-                ('Степень', 'Чему равно 2^5?', '32', 10),
-                ('Проценты', '20% от 150 — это сколько?', '30', 10),
-                ('Площадь', 'Площадь прямоугольника 24 см², одна сторона 4 см. Чему равна вторая?', '6', 15),
-                ('Среднее', 'Среднее арифметическое чисел 10, 20 и 30?', '20', 10),
-            ]
-            for title, text, answer, xp in default_tasks:
-                db.session.add(TerritoryTask(title=title, text=text, correct_answer=answer, xp_reward=xp))
+            for title, task_text, answer, xp in TERRITORY_DEFAULT_TASKS:
+                db.session.add(TerritoryTask(title=title, text=task_text, correct_answer=answer, xp_reward=xp))
             db.session.commit()
             print("Заполнены задачи для битвы за территорию")
         if 'territory_region_state' in tables:
@@ -2792,6 +3547,39 @@ with app.app_context():
                 with db.engine.begin() as conn:
                     conn.execute(text('ALTER TABLE territory_region_state ADD COLUMN owner_clan_id INTEGER'))
                     print("Добавлена колонка owner_clan_id в territory_region_state")
+            if 'version' not in columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE territory_region_state ADD COLUMN version BIGINT DEFAULT 0 NOT NULL'))
+                    print("Добавлена колонка version в territory_region_state")
+            if 'xact_id' not in columns:
+                with db.engine.begin() as conn:
+                    conn.execute(text('ALTER TABLE territory_region_state ADD COLUMN xact_id BIGINT DEFAULT 0 NOT NULL'))
+                    print("Добавлена колонка xact_id в territory_region_state")
+            if is_pg:
+                # Последовательность не ниже уже выданных номеров (до неё — max(version) + 1)
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'CREATE SEQUENCE IF NOT EXISTS {TERRITORY_MAP_VERSION_SEQ}'))
+                    conn.execute(text(
+                        f"SELECT setval('{TERRITORY_MAP_VERSION_SEQ}', GREATEST("
+                        f"(SELECT COALESCE(MAX(version), 0) FROM territory_region_state), "
+                        f"(SELECT last_value FROM {TERRITORY_MAP_VERSION_SEQ}), 1))"
+                    ))
+                # xact_id ставит триггер — при любой записи строки (удары, горячая карта, очистка, скрипты)
+                with db.engine.begin() as conn:
+                    conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': STARTUP_BACKFILL_LOCK_KEY})
+                    conn.execute(text(
+                        'CREATE OR REPLACE FUNCTION territory_region_state_xact_id() RETURNS trigger AS $$ '
+                        'BEGIN NEW.xact_id := pg_current_xact_id()::text::bigint; RETURN NEW; END $$ LANGUAGE plpgsql'
+                    ))
+                    exists = conn.execute(text(
+                        "SELECT 1 FROM pg_trigger WHERE tgname = 'territory_region_state_xact_id'"
+                    )).first()
+                    if exists is None:
+                        conn.execute(text(
+                            'CREATE TRIGGER territory_region_state_xact_id BEFORE INSERT OR UPDATE '
+                            'ON territory_region_state FOR EACH ROW EXECUTE FUNCTION territory_region_state_xact_id()'
+                        ))
+                        print("Создан триггер territory_region_state_xact_id")
     except Exception as e:
         print(f"Ошибка при миграции кланов: {e}")
         db.create_all()
@@ -2834,61 +3622,10 @@ with app.app_context():
                 db.session.commit()
                 print(f"Активирована задача недели (все задачи решены): {first_task.title}")
     
-    # Запуск планировщика задач: только один живой экземпляр (через распределённый лок)
-    if not scheduler.running and _scheduler_try_acquire_lock():
-        scheduler.start()
-        
-        # Проверяем, не пропущена ли дата обновления задачи
-        active_task = WeeklyTask.query.filter_by(is_active=True).first()
-        if active_task and active_task.last_updated:
-            # Вычисляем следующее воскресенье от времени последнего обновления
-            task_update_time = active_task.last_updated
-            if task_update_time.tzinfo:
-                task_update_time = task_update_time.replace(tzinfo=None)
-            
-            # Вычисляем следующее воскресенье в 09:00 от времени обновления задачи
-            days_until_sunday = (6 - task_update_time.weekday()) % 7
-            if days_until_sunday == 0:
-                target_time = task_update_time.replace(hour=9, minute=0, second=0, microsecond=0)
-                if task_update_time >= target_time:
-                    days_until_sunday = 7
-            
-            next_sunday_from_update = task_update_time.replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=days_until_sunday)
-            
-            # Если следующее воскресенье уже прошло, обновляем задачу сейчас
-            now = datetime.now()
-            if next_sunday_from_update < now:
-                print(f"Обнаружена пропущенная дата обновления задачи ({next_sunday_from_update}). Обновляю задачу сейчас...")
-                update_weekly_task()
-                print("Задача обновлена. Планирую следующее обновление на воскресенье в 09:00")
-        
-        # Добавляем регулярную задачу на каждое воскресенье в 09:00
-        scheduler.add_job(
-            update_weekly_task,
-            'cron',
-            day_of_week='sun',
-            hour=9,
-            minute=0,
-            id='update_weekly_task',
-            replace_existing=True
-        )
-        # Тик армии Демогorgonов: раз в DEMOGORGON_DAMAGE_TICK_SECONDS
-        scheduler.add_job(
-            _demogorgon_tick,
-            'interval',
-            seconds=DEMOGORGON_DAMAGE_TICK_SECONDS,
-            id='demogorgon_tick',
-            replace_existing=True
-        )
-        # Продление лока планировщика
-        scheduler.add_job(
-            _scheduler_renew_lock,
-            'interval',
-            seconds=SCHEDULER_LOCK_RENEW_SECONDS,
-            id='scheduler_lock_renew',
-            replace_existing=True
-        )
-        print("Планировщик задач запущен в этом экземпляре. Задача недели будет обновляться каждое воскресенье в 09:00")
+    # Запуск планировщика задач: только один живой экземпляр (аренда, см. _scheduler_get_lease).
+    # Остальные ждут в фоне и забирают планировщик, если владелец упал или потерял аренду.
+    _scheduler_try_become_leader()
+    threading.Thread(target=_scheduler_standby_loop, name='scheduler-standby', daemon=True).start()
 
 # Маршруты авторизации
 @app.route('/login', methods=['GET', 'POST'])
@@ -3041,7 +3778,7 @@ def cabinet():
         }
     from achievements import get_achievements_payload, get_extended_stats
     from abilities import ability_points_available
-    _check_achievements(user.id)
+    _check_all_achievements(user.id)
     db.session.commit()
     return render_template(
         'cabinet.html',
@@ -3067,7 +3804,7 @@ def api_cabinet_achievements():
     if current_user.is_admin:
         return jsonify({'success': False, 'error': 'Недоступно'}), 403
     from achievements import get_achievements_payload, get_extended_stats
-    sync_newly = _check_achievements(current_user.id)
+    sync_newly = _check_all_achievements(current_user.id)
     db.session.commit()
     return jsonify({
         'success': True,
@@ -3415,6 +4152,7 @@ def _purge_shop_item_before_delete(shop_item_id: int) -> None:
         for row in db.session.query(UserShopPurchase.id).filter(UserShopPurchase.shop_item_id == shop_item_id).all()
     ]
     if purchase_ids:
+        bump_bonus_versions_for_shop_item(shop_item_id)
         UserEquipment.query.filter(UserEquipment.purchase_id.in_(purchase_ids)).delete(synchronize_session=False)
         PvPDuel.query.filter(PvPDuel.reward_purchase_id.in_(purchase_ids)).update(
             {PvPDuel.reward_purchase_id: None},
@@ -3422,6 +4160,7 @@ def _purge_shop_item_before_delete(shop_item_id: int) -> None:
         )
         UserShopPurchase.query.filter(UserShopPurchase.id.in_(purchase_ids)).delete(synchronize_session=False)
     ActiveItemBuff.query.filter_by(shop_item_id=shop_item_id).delete(synchronize_session=False)
+    buff_index_changed()
     DemogorgonArmy.query.filter(DemogorgonArmy.shop_item_id == shop_item_id).update(
         {DemogorgonArmy.shop_item_id: None},
         synchronize_session=False,
@@ -3493,15 +4232,137 @@ def _active_buffs_query(user_id=None, clan_id=None, region_index=None):
     return q
 
 
-def _is_buff_effect_active(effect, used_at, one_shot, now):
-    """Эффект активен, если: разовый ещё не использован; с длительностью — used_at + duration >= now."""
-    if one_shot:
-        return True
-    if effect.duration_minutes is None:
-        return True
+# Индекс активных баффов процесса: векторы множителей по целям (user/clan/region)
+buff_index = BuffIndex()
+# Сверка отпечатка эффектов товаров без изменения rebuilds — для правок в обход приложения (скрипты наполнения)
+BUFF_INDEX_CHECK_SECONDS = 60
+
+
+def _buff_pct_sign(category):
+    """Приведение знака процента: проклятие — всегда минус, усиление — всегда плюс."""
+    if category == SHOP_CATEGORY_CURSE:
+        return lambda pct: -pct if pct > 0 else pct
+    if category == SHOP_CATEGORY_ENHANCEMENT:
+        return lambda pct: -pct if pct < 0 else pct
+    return None
+
+
+def _compile_buff_record(b):
+    """ActiveItemBuff (с загруженными shop_item и effects) -> BuffRecord или None."""
     from datetime import timedelta
-    expires = used_at + timedelta(minutes=effect.duration_minutes)
-    return now <= expires
+    item = b.shop_item
+    if not item:
+        return None
+    if b.user_id is not None:
+        scope, key = 'user', b.user_id
+    elif b.clan_id is not None:
+        scope, key = 'clan', b.clan_id
+    elif b.region_index is not None:
+        scope, key = 'region', b.region_index
+    else:
+        return None
+    effects = list(item.effects)
+    display_end = None
+    for e in effects:
+        if e.duration_minutes is not None:
+            end = b.used_at + timedelta(minutes=e.duration_minutes)
+            if display_end is None or end > display_end:
+                display_end = end
+    terms = buff_terms(
+        [(e.effect_type, e.percent_change, e.duration_minutes) for e in effects],
+        b.used_at, b.one_shot, _buff_pct_sign(item.category),
+    )
+    return BuffRecord(
+        b.id, scope, key, item.id, b.used_at, bool(b.one_shot), terms, display_end,
+        item_name=item.name, item_description=item.description or '',
+        item_image_filename=item.image_filename,
+    )
+
+
+def _buff_index_fingerprint():
+    """Отпечаток эффектов товаров (count, max id) — правка эффектов пересоздаёт строки."""
+    from sqlalchemy import text as sql_text
+    row = db.session.execute(sql_text('SELECT COUNT(*), MAX(id) FROM shop_item_effect')).first()
+    return tuple(int(v or 0) for v in row)
+
+
+def _load_buff_records(ids=None):
+    """Баффы вместе с товарами и эффектами одним запросом (только ids, если заданы).
+    Возвращает (id всех прочитанных строк, записи)."""
+    q = ActiveItemBuff.query.options(
+        joinedload(ActiveItemBuff.shop_item).joinedload(ShopItem.effects)
+    )
+    if ids is not None:
+        q = q.filter(ActiveItemBuff.id.in_(ids))
+    rows = q.all()
+    records = [rec for rec in (_compile_buff_record(b) for b in rows) if rec is not None]
+    return [b.id for b in rows], records
+
+
+def _buff_index_state():
+    """(rebuilds из buff_index_state, count, max id, sum id строк active_item_buff) одним запросом.
+    Добавления и удаления баффов не пишут общую строку — их видно по отпечатку самих строк."""
+    from sqlalchemy import text as sql_text
+    row = db.session.execute(sql_text(
+        'SELECT (SELECT rebuilds FROM buff_index_state WHERE id = 1), COUNT(*), MAX(id), SUM(id) '
+        'FROM active_item_buff'
+    )).first()
+    return tuple(int(v or 0) for v in row)
+
+
+def _buff_index_sync():
+    """Сверить индекс баффов с БД (не чаще раза за запрос).
+
+    Сменилось rebuilds — индекс перестраивается целиком; сменился отпечаток строк active_item_buff —
+    id из БД сравниваются с загруженными: удалённые убираются, новые догружаются по id (порядок commit
+    не важен). Отпечаток эффектов товаров сверяется раз в BUFF_INDEX_CHECK_SECONDS — на случай правок
+    в обход buff_index_changed.
+    """
+    if has_app_context() and g.get('buff_index_synced'):
+        return
+    state = _buff_index_state()
+    old_state = buff_index.state
+    checked = time.monotonic()
+    periodic = checked - buff_index.checked_at >= BUFF_INDEX_CHECK_SECONDS
+    if state != old_state or periodic:
+        now = datetime.now()
+        fp = _buff_index_fingerprint() if periodic or old_state is None or state[0] != old_state[0] else None
+        if old_state is None or state[0] != old_state[0] or (fp is not None and fp != buff_index.fingerprint):
+            ids, records = _load_buff_records()
+            buff_index.reset(records, now, ids, fp)
+        elif state != old_state:
+            db_ids = {buff_id for (buff_id,) in db.session.query(ActiveItemBuff.id).all()}
+            known = buff_index.known_ids()
+            added = db_ids - known
+            if added:
+                ids, records = _load_buff_records(sorted(added))
+                buff_index.add(records, now, ids)
+            buff_index.remove(known - db_ids)
+        buff_index.state = state
+        if fp is not None:
+            buff_index.checked_at = checked
+    if has_app_context():
+        g.buff_index_synced = True
+
+
+def buff_index_changed(rebuild=True):
+    """Баффы изменены в текущей транзакции (до commit).
+
+    rebuild=False — баффы только добавлены или удалены: общая строка не пишется, воркеры (и этот)
+    увидят разницу по отпечатку строк active_item_buff. rebuild=True — поднять rebuilds в
+    buff_index_state: полная перестройка во всех воркерах (смена клана баффа, правка эффектов товара,
+    массовое удаление).
+    """
+    if rebuild:
+        updated = BuffIndexState.query.filter_by(id=1).update(
+            {BuffIndexState.version: BuffIndexState.version + 1, BuffIndexState.rebuilds: BuffIndexState.rebuilds + 1},
+            synchronize_session=False,
+        )
+        if not updated:
+            db.session.add(BuffIndexState(id=1, version=1, rebuilds=1))
+        buff_index.invalidate()
+    if has_app_context():
+        g.pop('buff_index_synced', None)
 
 
 def _territory_shop_buff_still_active(buff, now):
@@ -3526,24 +4387,12 @@ def _territory_shop_buff_still_active(buff, now):
 
 
 def _single_buff_to_display(b, now):
-    """Один активный бафф в формат для отображения или None (если не подходит по длительности)."""
-    from datetime import timedelta
-    item = b.shop_item
-    if not item:
-        return None
-    max_end = None
-    has_duration = False
-    for e in item.effects:
-        if e.duration_minutes is not None:
-            has_duration = True
-            end = b.used_at + timedelta(minutes=e.duration_minutes)
-            if max_end is None or end > max_end:
-                max_end = end
-    if b.one_shot and not has_duration:
-        max_end = None
+    """Один активный бафф (BuffRecord из индекса) в формат для отображения или None
+    (если у него нет длительности или она истекла)."""
+    max_end = b.display_end
     if max_end is None or now > max_end:
         return None
-    static_path = _avatar_static_filename(item.image_filename) if item.image_filename else None
+    static_path = _avatar_static_filename(b.item_image_filename) if b.item_image_filename else None
     image_url = url_for('static', filename=static_path, _external=True) if static_path else None
     used_iso = b.used_at.isoformat() if b.used_at else None
     expires_iso = max_end.isoformat() if max_end else None
@@ -3551,9 +4400,9 @@ def _single_buff_to_display(b, now):
     expires_display = max_end.strftime('%d.%m.%Y %H:%M') if max_end else None
     return {
         'id': b.id,
-        'shop_item_id': item.id,
-        'name': item.name,
-        'description': item.description or '',
+        'shop_item_id': b.shop_item_id,
+        'name': b.item_name,
+        'description': b.item_description,
         'image_url': image_url,
         'used_at': used_iso,
         'expires_at': expires_iso,
@@ -3567,7 +4416,15 @@ def get_active_buffs_for_display(user_id=None, clan_id=None, region_index=None):
     """Список активных баффов для отображения (название, иконка, время использования, макс. время окончания).
     Возвращаются только баффы с длительностью действия (для отображения иконок на странице битвы)."""
     now = datetime.now()
-    rows = _active_buffs_query(user_id=user_id, clan_id=clan_id, region_index=region_index).all()
+    _buff_index_sync()
+    if user_id is not None:
+        rows = buff_index.records_for('user', user_id)
+    elif clan_id is not None:
+        rows = buff_index.records_for('clan', clan_id)
+    elif region_index is not None:
+        rows = buff_index.records_for('region', region_index)
+    else:
+        rows = []
     out = []
     for b in rows:
         d = _single_buff_to_display(b, now)
@@ -3581,83 +4438,291 @@ def get_active_buffs_for_display_by_regions(region_indices):
     if not region_indices:
         return {}
     now = datetime.now()
-    rows = ActiveItemBuff.query.filter(
-        ActiveItemBuff.region_index.in_(region_indices)
-    ).all()
+    _buff_index_sync()
     by_region = {i: [] for i in region_indices}
-    for b in rows:
-        d = _single_buff_to_display(b, now)
-        if d and b.region_index is not None:
-            by_region.setdefault(b.region_index, []).append(d)
+    for i in region_indices:
+        for b in buff_index.records_for('region', i):
+            d = _single_buff_to_display(b, now)
+            if d:
+                by_region[i].append(d)
     return by_region
 
 
-def _get_equipment_bonuses(user_id: int | None):
-    """
-    Суммарные бонусы от надетого снаряжения для пользователя.
-    Возвращает dict с ключами:
-      damage_add, defense_add, max_energy_add (абсолютные значения),
-      xp_pct, nums_pct (суммарные проценты).
-    """
-    result = {
+def _empty_equipment_bonuses():
+    return {
         'damage_add': 0.0,
         'defense_add': 0.0,
         'max_energy_add': 0.0,
         'xp_pct': 0.0,
         'nums_pct': 0.0,
     }
-    if not user_id:
-        return result
-    # Явно подтягиваем покупку в том же запросе, чтобы weapon_enchant_level всегда совпадал с БД
-    # (при только join() связь ue.purchase может догружаться отдельным SELECT).
-    rows = (
-        db.session.query(UserEquipment, UserShopPurchase, ShopItem)
-        .select_from(UserEquipment)
-        .join(UserShopPurchase, UserEquipment.purchase_id == UserShopPurchase.id)
-        .join(ShopItem, UserShopPurchase.shop_item_id == ShopItem.id)
-        .filter(
-            UserEquipment.user_id == user_id,
-            ShopItem.category == SHOP_CATEGORY_EQUIPMENT,
+
+
+def _empty_ability_bonuses():
+    return {
+        'damage_add': 0, 'defense_add': 0, 'max_energy_add': 0,
+        'damage_pct': 0.0, 'defense_pct': 0.0,
+        'xp_reward_pct': 0.0, 'nums_reward_pct': 0.0,
+        'pvp_damage_pct': 0.0, 'pvp_damage_add': 0, 'pvp_hp_add': 0,
+    }
+
+
+class CombatSnapshot:
+    """Бонусы снаряжения и умений игрока, собранные один раз за запрос.
+
+    equipment — как _get_equipment_bonuses (damage_add, defense_add, max_energy_add, xp_pct, nums_pct),
+    abilities — как abilities.aggregate_ability_bonuses. Навыки (damage_skill и т.п.) сюда не входят:
+    они читаются из User напрямую и всегда актуальны.
+    """
+    __slots__ = ('user_id', 'equipment', 'abilities')
+
+    def __init__(self, user_id, equipment=None, abilities=None):
+        self.user_id = user_id
+        self.equipment = equipment if equipment is not None else _empty_equipment_bonuses()
+        self.abilities = abilities if abilities is not None else _empty_ability_bonuses()
+
+    def _add(self, key):
+        return int(self.equipment.get(key, 0) or 0) + int(self.abilities.get(key, 0) or 0)
+
+    @property
+    def damage_add(self):
+        return self._add('damage_add')
+
+    @property
+    def defense_add(self):
+        return self._add('defense_add')
+
+    @property
+    def max_energy_add(self):
+        return self._add('max_energy_add')
+
+
+def _build_combat_snapshots(user_ids):
+    """Собрать CombatSnapshot для нескольких игроков: один запрос по снаряжению (с эффектами), один по умениям."""
+    from abilities import aggregate_ability_bonuses
+
+    ids = sorted({int(uid) for uid in user_ids if uid})
+    equipment = {uid: _empty_equipment_bonuses() for uid in ids}
+    ranks_by_user = {uid: {} for uid in ids}
+    class_by_user = {}
+    if ids:
+        # Покупка в том же запросе, чтобы weapon_enchant_level всегда совпадал с БД
+        eq_rows = (
+            db.session.query(
+                UserEquipment.user_id,
+                UserShopPurchase.weapon_enchant_level,
+                ShopItem.equipment_slot,
+                ShopItemEffect.effect_type,
+                ShopItemEffect.percent_change,
+            )
+            .select_from(UserEquipment)
+            .join(UserShopPurchase, UserEquipment.purchase_id == UserShopPurchase.id)
+            .join(ShopItem, UserShopPurchase.shop_item_id == ShopItem.id)
+            .join(ShopItemEffect, ShopItemEffect.shop_item_id == ShopItem.id)
+            .filter(
+                UserEquipment.user_id.in_(ids),
+                ShopItem.category == SHOP_CATEGORY_EQUIPMENT,
+            )
+            .all()
         )
-        .all()
-    )
-    for _ue, purchase, item in rows:
-        if not item:
-            continue
-        is_wpn = (item.equipment_slot or '').strip().lower() == 'weapon' and purchase is not None
-        w_lv = _weapon_enchant_level_clamped(getattr(purchase, 'weapon_enchant_level', 0)) if is_wpn else 0
-        for e in item.effects:
-            raw = float(e.percent_change or 0)
-            if is_wpn:
-                val = _weapon_enchant_effective_effect_value(raw, w_lv)
+        for user_id, enchant_level, equipment_slot, effect_type, percent_change in eq_rows:
+            result = equipment[user_id]
+            raw = float(percent_change or 0)
+            if (equipment_slot or '').strip().lower() == 'weapon':
+                val = _weapon_enchant_effective_effect_value(raw, _weapon_enchant_level_clamped(enchant_level))
             else:
                 val = raw
-            if e.effect_type == 'damage':
+            if effect_type == 'damage':
                 result['damage_add'] += val
-            elif e.effect_type == 'defense':
+            elif effect_type == 'defense':
                 result['defense_add'] += val
-            elif e.effect_type == 'max_energy':
+            elif effect_type == 'max_energy':
                 result['max_energy_add'] += val
-            elif e.effect_type == 'xp_reward':
+            elif effect_type == 'xp_reward':
                 result['xp_pct'] += val
-            elif e.effect_type == 'nums_reward':
+            elif effect_type == 'nums_reward':
                 result['nums_pct'] += val
+        ab_rows = (
+            db.session.query(User.id, User.ability_class, UserAbility.ability_code, UserAbility.rank)
+            .outerjoin(UserAbility, UserAbility.user_id == User.id)
+            .filter(User.id.in_(ids))
+            .all()
+        )
+        for user_id, ability_class, ability_code, rank in ab_rows:
+            class_by_user[user_id] = (ability_class or '').strip() or None
+            if ability_code:
+                ranks_by_user[user_id][ability_code] = int(rank or 0)
+    snapshots = {}
+    for uid in ids:
+        chosen = class_by_user.get(uid)
+        try:
+            ab = aggregate_ability_bonuses(ranks=ranks_by_user[uid], chosen_class=chosen) if chosen else None
+        except Exception:
+            ab = None
+        snapshots[uid] = CombatSnapshot(uid, equipment[uid], ab)
+    return snapshots
+
+
+# Межзапросный кэш бонусов (снаряжение + умения) по user_id; действителен для user.bonus_version
+bonus_cache = BonusCache(
+    maxsize=int(os.getenv('BONUS_CACHE_SIZE', '4096')),
+    ttl_seconds=int(os.getenv('BONUS_CACHE_TTL_SECONDS', '600')),
+)
+
+
+def _bonus_versions(user_ids):
+    """user_id -> bonus_version: из уже загруженных объектов User, остальные — одним запросом."""
+    from sqlalchemy.orm.util import identity_key
+
+    versions = {}
+    need = []
+    for uid in user_ids:
+        obj = db.session.identity_map.get(identity_key(User, uid))
+        value = obj.__dict__.get('bonus_version') if obj is not None else None
+        if isinstance(value, int):
+            versions[uid] = value
+        else:
+            need.append(uid)
+    if need:
+        for uid, version in db.session.query(User.id, User.bonus_version).filter(User.id.in_(need)).all():
+            versions[uid] = int(version or 0)
+    return versions
+
+
+def _load_combat_snapshots(user_ids):
+    """Снимки из bonus_cache по текущим версиям; промахи собираются одним пакетом и кладутся в кэш."""
+    ids = sorted({int(uid) for uid in user_ids if uid})
+    versions = _bonus_versions(ids)
+    # Версию, поднятую в ещё не зафиксированной транзакции, не кэшируем: при rollback она повторится
+    bumped = g.get('bonus_versions_bumped', ()) if has_app_context() else ()
+    result = {}
+    to_build = []
+    for uid in ids:
+        hit = bonus_cache.get(uid, versions[uid]) if uid in versions else None
+        if hit is not None:
+            result[uid] = CombatSnapshot(uid, hit[0], hit[1])
+        else:
+            to_build.append(uid)
+    if to_build:
+        built = _build_combat_snapshots(to_build)
+        for uid, snap in built.items():
+            if uid in versions and uid not in bumped:
+                bonus_cache.put(uid, versions[uid], (snap.equipment, snap.abilities))
+        result.update(built)
     return result
 
 
+def _combat_snapshot_cache():
+    """Кэш снимков текущего запроса (flask.g); вне контекста приложения — None."""
+    if not has_app_context():
+        return None
+    cache = g.get('combat_snapshots')
+    if cache is None:
+        cache = {}
+        g.combat_snapshots = cache
+    return cache
+
+
+def get_combat_snapshots(user_ids):
+    """Снимки для нескольких игроков: недостающие собираются одним пакетом и кладутся в кэш запроса."""
+    cache = _combat_snapshot_cache()
+    if cache is None:
+        return _load_combat_snapshots(user_ids)
+    missing = [uid for uid in user_ids if uid and uid not in cache]
+    if missing:
+        cache.update(_load_combat_snapshots(missing))
+    return {uid: cache[uid] for uid in user_ids if uid in cache}
+
+
+def get_combat_snapshot(user_id):
+    """CombatSnapshot игрока (один раз за запрос)."""
+    if not user_id:
+        return CombatSnapshot(None)
+    return get_combat_snapshots([user_id]).get(user_id) or CombatSnapshot(user_id)
+
+
+def invalidate_combat_snapshot(user_id=None):
+    """Сбросить снимок после смены снаряжения, заточки, класса или рангов умений (None — все в запросе)."""
+    cache = _combat_snapshot_cache()
+    if cache is None:
+        return
+    if user_id is None:
+        cache.clear()
+    else:
+        cache.pop(user_id, None)
+
+
+def bump_bonus_versions(user_ids=None):
+    """Поднять user.bonus_version (атомарно в БД) и сбросить кэши бонусов. user_ids=None — у всех игроков.
+
+    Вызывать в транзакции, меняющей снаряжение, заточку, класс или ранги умений.
+    """
+    from sqlalchemy.orm.util import identity_key
+
+    q = User.query
+    if user_ids is not None:
+        user_ids = [int(uid) for uid in user_ids if uid]
+        if not user_ids:
+            return
+        q = q.filter(User.id.in_(user_ids))
+    q.update({User.bonus_version: User.bonus_version + 1}, synchronize_session=False)
+    if user_ids is None:
+        bonus_cache.clear()
+        invalidate_combat_snapshot()
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, User):
+                db.session.expire(obj, ['bonus_version'])
+        return
+    bumped = None
+    if has_app_context():
+        bumped = g.get('bonus_versions_bumped')
+        if bumped is None:
+            bumped = set()
+            g.bonus_versions_bumped = bumped
+    for uid in user_ids:
+        bonus_cache.discard(uid)
+        invalidate_combat_snapshot(uid)
+        if bumped is not None:
+            bumped.add(uid)
+        obj = db.session.identity_map.get(identity_key(User, uid))
+        if obj is not None:
+            db.session.expire(obj, ['bonus_version'])
+
+
+def bump_bonus_version(user_id):
+    """bump_bonus_versions для одного игрока."""
+    bump_bonus_versions([user_id])
+
+
+def bump_bonus_versions_for_shop_item(shop_item_id):
+    """Поднять версии у всех, на ком надет товар shop_item_id (изменение/удаление товара в админке)."""
+    user_ids = [
+        row[0]
+        for row in db.session.query(UserEquipment.user_id)
+        .join(UserShopPurchase, UserEquipment.purchase_id == UserShopPurchase.id)
+        .filter(UserShopPurchase.shop_item_id == shop_item_id)
+        .distinct()
+        .all()
+    ]
+    bump_bonus_versions(user_ids)
+
+
+def _get_equipment_bonuses(user_id: int | None):
+    """
+    Суммарные бонусы от надетого снаряжения для пользователя.
+    Возвращает dict с ключами:
+      damage_add, defense_add, max_energy_add (абсолютные значения),
+      xp_pct, nums_pct (суммарные проценты).
+    """
+    return dict(get_combat_snapshot(user_id).equipment)
+
+
 def _get_ability_bonuses(user_id):
     """Суммарные бонусы от дерева умений (только выбранный класс)."""
     try:
-        from abilities import aggregate_ability_bonuses, get_user_ability_class
-        chosen = get_user_ability_class(User.query.get(user_id))
-        return aggregate_ability_bonuses(user_id=user_id, chosen_class=chosen)
+        return dict(get_combat_snapshot(user_id).abilities)
     except Exception:
-        return {
-            'damage_add': 0, 'defense_add': 0, 'max_energy_add': 0,
-            'damage_pct': 0.0, 'defense_pct': 0.0,
-            'xp_reward_pct': 0.0, 'nums_reward_pct': 0.0,
-            'pvp_damage_pct': 0.0, 'pvp_damage_add': 0, 'pvp_hp_add': 0,
-        }
+        return _empty_ability_bonuses()
 
 
 def _get_multipliers_for_action(user_id, clan_id, region_index, is_attack):
@@ -3668,57 +4733,35 @@ def _get_multipliers_for_action(user_id, clan_id, region_index, is_attack):
     Возвращает dict: damage_pct, defense_pct, xp_reward_pct, nums_reward_pct (суммы процентов).
     """
     now = datetime.now()
-    damage_pct = 0.0
-    defense_pct = 0.0
-    xp_reward_pct = 0.0
-    nums_reward_pct = 0.0
-
-    def apply_effects(buff):
-        nonlocal damage_pct, defense_pct, xp_reward_pct, nums_reward_pct
-        item = buff.shop_item
-        if not item:
-            return
-        for e in item.effects:
-            if not _is_buff_effect_active(e, buff.used_at, buff.one_shot, now):
-                continue
-            pct = e.percent_change or 0
-            if item.category == SHOP_CATEGORY_CURSE and pct > 0:
-                pct = -pct
-            elif item.category == SHOP_CATEGORY_ENHANCEMENT and pct < 0:
-                pct = -pct
-            if e.effect_type == 'damage':
-                damage_pct += pct
-            elif e.effect_type == 'defense':
-                defense_pct += pct
-            elif e.effect_type == 'xp_reward':
-                xp_reward_pct += pct
-            elif e.effect_type == 'nums_reward':
-                nums_reward_pct += pct
-
+    _buff_index_sync()
+    targets = []
     # Личные и клановые баффы (для текущего пользователя)
     if user_id is not None:
-        for b in _active_buffs_query(user_id=user_id).all():
-            apply_effects(b)
+        targets.append(('user', user_id))
         if clan_id is not None:
-            for b in _active_buffs_query(clan_id=clan_id).all():
-                apply_effects(b)
+            targets.append(('clan', clan_id))
     # Баффы области
     if region_index is not None:
-        for b in _active_buffs_query(region_index=region_index).all():
-            apply_effects(b)
+        targets.append(('region', region_index))
+    damage_pct = defense_pct = xp_reward_pct = nums_reward_pct = 0.0
+    for scope, key in targets:
+        d, df, xp, nums = buff_index.vector(scope, key, now)
+        damage_pct += d
+        defense_pct += df
+        xp_reward_pct += xp
+        nums_reward_pct += nums
 
     # Постоянные бонусы от снаряжения (category=equipment) к опыту и Нумам
     if user_id is not None:
-        eq = _get_equipment_bonuses(user_id)
-        if isinstance(eq, dict):
-            xp_reward_pct += eq.get('xp_pct', 0.0) or 0.0
-            nums_reward_pct += eq.get('nums_pct', 0.0) or 0.0
-        ab = _get_ability_bonuses(user_id)
-        if isinstance(ab, dict):
-            damage_pct += ab.get('damage_pct', 0.0) or 0.0
-            defense_pct += ab.get('defense_pct', 0.0) or 0.0
-            xp_reward_pct += ab.get('xp_reward_pct', 0.0) or 0.0
-            nums_reward_pct += ab.get('nums_reward_pct', 0.0) or 0.0
+        snapshot = get_combat_snapshot(user_id)
+        eq = snapshot.equipment
+        xp_reward_pct += eq.get('xp_pct', 0.0) or 0.0
+        nums_reward_pct += eq.get('nums_pct', 0.0) or 0.0
+        ab = snapshot.abilities
+        damage_pct += ab.get('damage_pct', 0.0) or 0.0
+        defense_pct += ab.get('defense_pct', 0.0) or 0.0
+        xp_reward_pct += ab.get('xp_reward_pct', 0.0) or 0.0
+        nums_reward_pct += ab.get('nums_reward_pct', 0.0) or 0.0
 
     return {
         'damage_pct': damage_pct,
@@ -3731,8 +4774,12 @@ def _get_multipliers_for_action(user_id, clan_id, region_index, is_attack):
 def _consume_one_shot_buffs(user_id, clan_id, region_index):
     """Удалить разовые баффы после применения действия (вызывать после применения урона/опыта/нумов)."""
     q = _active_buffs_query(user_id=user_id, clan_id=clan_id, region_index=region_index).filter(ActiveItemBuff.one_shot == True)
+    removed = []
     for b in q.all():
+        removed.append(b.id)
         db.session.delete(b)
+    if removed:
+        buff_index_changed(rebuild=False)
 
 
 # Порядок грейдов снаряжения для сортировки в лавке (d → c → b → a → s)
@@ -3825,8 +4872,9 @@ def api_shop_purchase():
     current_user.nums_balance = balance - price
     purchase = UserShopPurchase(user_id=current_user.id, shop_item_id=item.id)
     db.session.add(purchase)
-    from achievements import increment_counter, COUNTER_NUMS_SPENT
+    from achievements import increment_counter, sync_shop_purchases_counter, COUNTER_NUMS_SPENT
     increment_counter(current_user.id, COUNTER_NUMS_SPENT, price)
+    sync_shop_purchases_counter(current_user.id)
     newly = _check_achievements(current_user.id)
     db.session.commit()
     return jsonify({
@@ -3984,7 +5032,7 @@ def api_cabinet_equipment_state():
             'weapon_enchant_level': wlv if is_weapon else 0,
             'enchant_overlay_url': _weapon_enchant_overlay_url(wlv) if is_weapon and wlv > 0 else None,
         }
-    bonuses = _get_equipment_bonuses(current_user.id)
+    bonuses = get_combat_snapshot(current_user.id).equipment
     return jsonify({
         'success': True,
         'slots': slots,
@@ -4046,8 +5094,12 @@ def api_cabinet_equipment_equip():
         if prev:
             db.session.delete(prev)
         db.session.add(UserEquipment(user_id=current_user.id, purchase_id=purchase.id, slot=slot))
-    from achievements import increment_counter, COUNTER_EQUIP_ACTIONS
+    bump_bonus_version(current_user.id)
+    from achievements import increment_counter, set_counter_max, COUNTER_EQUIP_ACTIONS, COUNTER_EQUIPMENT_SLOTS
     increment_counter(current_user.id, COUNTER_EQUIP_ACTIONS)
+    set_counter_max(
+        current_user.id, COUNTER_EQUIPMENT_SLOTS, UserEquipment.query.filter_by(user_id=current_user.id).count(),
+    )
     newly = _check_achievements(current_user.id)
     db.session.commit()
     return api_cabinet_equipment_state()
@@ -4072,6 +5124,7 @@ def api_cabinet_equipment_unequip():
         db.session.delete(ue)
         removed_any = True
     if removed_any:
+        bump_bonus_version(current_user.id)
         # Если макс. энергия уменьшилась, текущую энергию не увеличиваем, но можно скорректировать сверху
         current_user.ensure_energy_refill()
         if current_user.current_energy is not None and current_user.current_energy > current_user.energy:
@@ -4101,6 +5154,7 @@ def api_cabinet_inventory_sell(purchase_id):
         removed_any = True
     # Если максимальная энергия уменьшилась из-за снятого предмета — подрежем текущую до нового максимума
     if removed_any:
+        bump_bonus_version(current_user.id)
         current_user.ensure_energy_refill()
         if current_user.current_energy is not None and current_user.current_energy > current_user.energy:
             current_user.current_energy = current_user.energy
@@ -4241,12 +5295,15 @@ def api_cabinet_inventory_use(purchase_id):
         one_shot=one_shot,
     )
     db.session.add(buff)
+    buff_index_changed(rebuild=False)
     db.session.delete(purchase)
     from achievements import increment_counter, COUNTER_ITEMS_USED, COUNTER_BUFFS_APPLIED
     increment_counter(current_user.id, COUNTER_ITEMS_USED)
     increment_counter(current_user.id, COUNTER_BUFFS_APPLIED)
     newly = _check_achievements(current_user.id)
     db.session.commit()
+    if reg_idx is not None:
+        _publish_event('map', 'buffs', {'region_index': reg_idx})
     return jsonify({
         'success': True,
         'message': 'Предмет использован',
@@ -4300,6 +5357,7 @@ def api_cabinet_inventory_enchant_weapon():
 
     if success:
         weapon_p.weapon_enchant_level = cur_lv + 1
+        bump_bonus_version(current_user.id)
         db.session.delete(scroll_p)
         from achievements import set_counter_max, COUNTER_WEAPON_ENCHANT_MAX
         set_counter_max(current_user.id, COUNTER_WEAPON_ENCHANT_MAX, cur_lv + 1)
@@ -4324,6 +5382,7 @@ def api_cabinet_inventory_enchant_weapon():
         db.session.delete(ue)
         removed_any = True
     if removed_any:
+        bump_bonus_version(current_user.id)
         current_user.ensure_energy_refill()
         if current_user.current_energy is not None and current_user.current_energy > current_user.energy:
             current_user.current_energy = current_user.energy
@@ -4448,6 +5507,11 @@ def api_cabinet_chest_consume(purchase_id):
     if opt.grant_shop_item_id:
         db.session.add(UserShopPurchase(user_id=current_user.id, shop_item_id=int(opt.grant_shop_item_id)))
     db.session.delete(purchase)
+    if opt.grant_shop_item_id:
+        # Сундук заменён наградой: считается после удаления сундука
+        from achievements import sync_shop_purchases_counter
+        sync_shop_purchases_counter(current_user.id)
+        _check_achievements(current_user.id)
     db.session.commit()
     if opt.grant_shop_item_id:
         return jsonify({'success': True, 'message': 'Награда добавлена в инвентарь.'})
@@ -4539,20 +5603,34 @@ def api_clan_leave():
     clan_id = clan.id
     if clan.owner_id == current_user.id:
         # Создатель выходит: исключаем всех участников, затем распускаем клан
-        User.query.filter_by(clan_id=clan_id).update({'clan_id': None, 'clan_rank': None})
-        TerritoryRegionState.query.filter_by(owner_clan_id=clan_id).update({'owner_clan_id': None, 'strength': 0})
-        ClanJoinRequest.query.filter_by(clan_id=clan_id).delete()
-        ClanChatMessage.query.filter_by(clan_id=clan_id).delete()
-        ActiveItemBuff.query.filter_by(clan_id=clan_id).update({'clan_id': None})
-        db.session.delete(clan)
-    else:
-        current_user.clan_id = None
-        current_user.clan_rank = None
-        current_user.clan_join_ban_until = datetime.now() + timedelta(hours=USER_CLAN_JOIN_BAN_HOURS)
+        with _territory_map_write():
+            User.query.filter_by(clan_id=clan_id).update({'clan_id': None, 'clan_rank': None})
+            TerritoryRegionState.query.filter_by(owner_clan_id=clan_id).update({'owner_clan_id': None, 'strength': 0})
+            ClanJoinRequest.query.filter_by(clan_id=clan_id).delete()
+            ClanChatMessage.query.filter_by(clan_id=clan_id).delete()
+            _chat_messages_deleted(f'clan:{clan_id}')
+            ActiveItemBuff.query.filter_by(clan_id=clan_id).update({'clan_id': None})
+            buff_index_changed()
+            db.session.delete(clan)
+            db.session.commit()
+        return jsonify({'success': True})
+    current_user.clan_id = None
+    current_user.clan_rank = None
+    current_user.clan_join_ban_until = datetime.now() + timedelta(hours=USER_CLAN_JOIN_BAN_HOURS)
     db.session.commit()
     return jsonify({'success': True})
 
 
+def _clan_pending_join_count(user):
+    """Заявки на вступление в клан игрока, если он может их принимать (владелец, Герцог, Маркиз); иначе None."""
+    clan = getattr(user, 'clan_obj', None)
+    if not clan:
+        return None
+    if clan.owner_id != user.id and (user.clan_rank or CLAN_RANK_VASSAL) not in (CLAN_RANK_DUKE, CLAN_RANK_MARQUIS):
+        return None
+    return ClanJoinRequest.query.filter_by(clan_id=clan.id, status='pending').count()
+
+
 @app.route('/api/clan/join-request', methods=['POST'])
 @login_required
 def api_clan_join_request():
@@ -4858,12 +5936,7 @@ def api_clan_chat_unread_count():
     if not current_user.clan_id:
         return jsonify({'success': False, 'error': 'Вы не в клане'}), 400
     after_id = request.args.get('after_id', type=int) or 0
-    count = ClanChatMessage.query.filter(
-        ClanChatMessage.clan_id == current_user.clan_id,
-        ClanChatMessage.id > after_id,
-        ClanChatMessage.user_id != current_user.id,
-    ).count()
-    return jsonify({'success': True, 'count': count})
+    return jsonify({'success': True, 'count': _clan_chat_unread(current_user, after_id)})
 
 
 @app.route('/api/clan/chat', methods=['GET'])
@@ -4878,39 +5951,12 @@ def api_clan_chat_list():
     before_id = request.args.get('before_id', type=int)
     after_id = request.args.get('after_id', type=int)
     base = ClanChatMessage.query.filter_by(clan_id=current_user.clan_id)
-
-    if after_id:
-        # Только новые сообщения (для опроса)
-        messages = base.filter(ClanChatMessage.id > after_id).order_by(ClanChatMessage.id.asc()).all()
-        items = [
-            {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-             'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-            for m in messages
-        ]
+    items, has_more = _chat_list(
+        f'clan:{current_user.clan_id}', ClanChatMessage, base, _chat_message_items, limit, before_id, after_id,
+    )
+    if has_more is None:
         return jsonify({'success': True, 'messages': items})
-    if before_id:
-        # Подгрузка старых сообщений
-        messages = base.filter(ClanChatMessage.id < before_id).order_by(
-            ClanChatMessage.id.desc()
-        ).limit(limit + 1).all()
-        has_more = len(messages) > limit
-        messages = list(reversed(messages[:limit]))
-        items = [
-            {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-             'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-            for m in messages
-        ]
-        return jsonify({'success': True, 'messages': items, 'has_more': has_more})
-    # Первая загрузка: последние limit сообщений
-    total = base.count()
-    messages = base.order_by(ClanChatMessage.id.desc()).limit(limit).all()
-    messages = list(reversed(messages))
-    items = [
-        {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-         'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-        for m in messages
-    ]
-    return jsonify({'success': True, 'messages': items, 'has_more': total > limit})
+    return jsonify({'success': True, 'messages': items, 'has_more': has_more})
 
 
 @app.route('/api/clan/chat', methods=['POST'])
@@ -4925,20 +5971,22 @@ def api_clan_chat_send():
         return jsonify({'success': False, 'error': 'Текст сообщения не может быть пустым'}), 400
     if len(text) > 2000:
         return jsonify({'success': False, 'error': 'Сообщение слишком длинное'}), 400
-    text = filter_chat_text(text)
-    msg = ClanChatMessage(clan_id=current_user.clan_id, user_id=current_user.id, text=text)
+    msg = ClanChatMessage(clan_id=current_user.clan_id, user_id=current_user.id, text=text, **_chat_filtered_fields(text))
     db.session.add(msg)
     from achievements import increment_counter, COUNTER_CLAN_CHAT
     increment_counter(current_user.id, COUNTER_CLAN_CHAT)
     newly = _check_achievements(current_user.id)
     db.session.commit()
+    _chat_feed.touch(f'clan:{msg.clan_id}')
+    _chat_unread.touch(f'clan:{msg.clan_id}')
+    _publish_event(f'clan-chat:{msg.clan_id}', 'message', {'id': msg.id})
     return jsonify({
         'success': True,
         'message': {
             'id': msg.id,
             'user_id': msg.user_id,
             'author_name': current_user.character_name or current_user.username,
-            'text': msg.text,
+            'text': msg.text_filtered,
             'created_at': msg.created_at.isoformat() if msg.created_at else None,
         },
         'newly_unlocked': newly,
@@ -4954,7 +6002,7 @@ def _admin_chat_message_to_item(m):
     return {
         'id': m.id,
         'author_name': m.author_name or 'Администратор',
-        'text': filter_chat_text(m.text),
+        'text': _chat_text(m),
         'is_from_admin': m.is_from_admin,
         'created_at': m.created_at.isoformat() if m.created_at else None,
     }
@@ -4983,13 +6031,13 @@ def api_territory_admin_chat_send():
         return jsonify({'success': False, 'error': 'Сообщение не более {} символов'.format(TERRITORY_ADMIN_CHAT_TEXT_MAX)}), 400
     if len(author_name) > 200:
         author_name = author_name[:200]
-    text = filter_chat_text(text)
     msg = TerritoryAdminChatMessage(
         user_id=user_id,
         guest_key=guest_key,
         author_name=author_name,
         text=text,
         is_from_admin=False,
+        **_chat_filtered_fields(text),
     )
     db.session.add(msg)
     db.session.commit()
@@ -5032,23 +6080,33 @@ def api_territory_admin_chat_unread_count():
     after_id = request.args.get('after_id', type=int) or 0
     guest_key = (request.args.get('guest_key') or '').strip() or None
     if current_user.is_authenticated:
-        q = TerritoryAdminChatMessage.query.filter(
-            TerritoryAdminChatMessage.user_id == current_user.id,
-            TerritoryAdminChatMessage.is_from_admin == True,
-            TerritoryAdminChatMessage.id > after_id,
-        )
+        count = _admin_chat_unread(current_user.id, None, after_id)
     elif guest_key:
-        q = TerritoryAdminChatMessage.query.filter(
-            TerritoryAdminChatMessage.guest_key == guest_key,
-            TerritoryAdminChatMessage.is_from_admin == True,
-            TerritoryAdminChatMessage.id > after_id,
-        )
+        count = _admin_chat_unread(None, guest_key, after_id)
     else:
         return jsonify({'success': True, 'count': 0})
-    count = q.count()
     return jsonify({'success': True, 'count': count})
 
 
+@app.route('/api/badges')
+def api_badges():
+    """Все счётчики непрочитанного для страницы одним запросом. Доступно и гостям.
+    Параметры: clan_after_id, admin_after_id, guest_key (для гостя). Ответ: clan_chat, admin_chat,
+    join_requests; null — счётчик не показывается (нет клана, нет прав на заявки, гость без guest_key)."""
+    clan_after_id = request.args.get('clan_after_id', type=int) or 0
+    admin_after_id = request.args.get('admin_after_id', type=int) or 0
+    guest_key = (request.args.get('guest_key') or '').strip() or None
+    out = {'success': True, 'clan_chat': None, 'admin_chat': None, 'join_requests': None}
+    if current_user.is_authenticated:
+        out['admin_chat'] = _admin_chat_unread(current_user.id, None, admin_after_id)
+        if current_user.clan_id:
+            out['clan_chat'] = _clan_chat_unread(current_user, clan_after_id)
+            out['join_requests'] = _clan_pending_join_count(current_user)
+    elif guest_key:
+        out['admin_chat'] = _admin_chat_unread(None, guest_key, admin_after_id)
+    return jsonify(out)
+
+
 # Главная — карта битвы (как раньше)
 @app.route('/')
 def index():
@@ -5999,7 +7057,8 @@ def admin_territory_region_save(region_index):
     if 'task_generator_id' in data:
         gen_id = data.get('task_generator_id')
         cfg.task_generator_id = int(gen_id) if gen_id else None
-    db.session.commit()
+    with _territory_map_write():
+        db.session.commit()
     return jsonify({'success': True})
 
 
@@ -6099,24 +7158,27 @@ def admin_territory_clan_members(clan_id):
 def admin_territory_clan_delete(clan_id):
     """Удаляет клан: исключает участников, сбрасывает владение областями и связанными сущностями, удаляет клан."""
     clan = db.get_or_404(Clan, clan_id)
-    # Исключить всех участников
-    User.query.filter_by(clan_id=clan_id).update({'clan_id': None})
-    # Сбросить владение областями
-    TerritoryRegionState.query.filter_by(owner_clan_id=clan_id).update(
-        {'owner_clan_id': None, 'strength': 0}
-    )
-    # Удалить заявки на вступление
-    ClanJoinRequest.query.filter_by(clan_id=clan_id).delete()
-    # Удалить объявления о найме
-    ClanRecruitmentAd.query.filter_by(clan_id=clan_id).delete()
-    # Удалить сообщения чата клана
-    ClanChatMessage.query.filter_by(clan_id=clan_id).delete()
-    # Удалить метку клана на карте
-    ClanTerritoryMarker.query.filter_by(clan_id=clan_id).delete()
-    # Сбросить клановые бафы
-    ActiveItemBuff.query.filter_by(clan_id=clan_id).delete()
-    db.session.delete(clan)
-    db.session.commit()
+    with _territory_map_write():
+        # Исключить всех участников
+        User.query.filter_by(clan_id=clan_id).update({'clan_id': None})
+        # Сбросить владение областями
+        TerritoryRegionState.query.filter_by(owner_clan_id=clan_id).update(
+            {'owner_clan_id': None, 'strength': 0}
+        )
+        # Удалить заявки на вступление
+        ClanJoinRequest.query.filter_by(clan_id=clan_id).delete()
+        # Удалить объявления о найме
+        ClanRecruitmentAd.query.filter_by(clan_id=clan_id).delete()
+        # Удалить сообщения чата клана
+        ClanChatMessage.query.filter_by(clan_id=clan_id).delete()
+        _chat_messages_deleted(f'clan:{clan_id}')
+        # Удалить метку клана на карте
+        ClanTerritoryMarker.query.filter_by(clan_id=clan_id).delete()
+        # Сбросить клановые бафы
+        ActiveItemBuff.query.filter_by(clan_id=clan_id).delete()
+        buff_index_changed()
+        db.session.delete(clan)
+        db.session.commit()
     return jsonify({'success': True})
 
 
@@ -6183,75 +7245,159 @@ def admin_territory_reset():
     if not current_user.check_password(password):
         return jsonify({'success': False, 'error': 'Неверный пароль'}), 403
 
-    non_admin_users = User.query.filter_by(is_admin=False).all()
-    non_admin_ids = [u.id for u in non_admin_users]
+    with _territory_map_write():
+        non_admin_users = User.query.filter_by(is_admin=False).all()
+        non_admin_ids = [u.id for u in non_admin_users]
 
-    for i in range(28):
-        st = TerritoryRegionState.query.filter_by(region_index=i).first()
-        if st:
-            st.owner_class_id = None
-            st.owner_clan_id = None
-            st.strength = 0
-        else:
-            db.session.add(TerritoryRegionState(region_index=i, owner_class_id=None, owner_clan_id=None, strength=0))
-    for stats in UserTerritoryStats.query.all():
-        stats.total_damage_dealt = 0
-        stats.total_influence_points = 0
-
-    TerritoryRegionStructure.query.delete(synchronize_session=False)
-    DemogorgonDamage.query.delete(synchronize_session=False)
-    DemogorgonArmy.query.delete(synchronize_session=False)
-    ClanTerritoryMarker.query.delete(synchronize_session=False)
-    ActiveItemBuff.query.delete(synchronize_session=False)
-    ClanChatMessage.query.delete(synchronize_session=False)
-    ClanJoinRequest.query.delete(synchronize_session=False)
-    ClanRecruitmentAd.query.delete(synchronize_session=False)
-
-    User.query.update({User.clan_id: None, User.clan_rank: None}, synchronize_session=False)
-    Clan.query.delete(synchronize_session=False)
-
-    # PvP арена и дуэли (история побед/поражений и активные бои)
-    PvPDuel.query.delete(synchronize_session=False)
-    PvPDuelChallenge.query.delete(synchronize_session=False)
-    PvPArenaChatMessage.query.delete(synchronize_session=False)
-    PvPArenaPresence.query.delete(synchronize_session=False)
-
-    if non_admin_ids:
-        pur_rows = (
-            db.session.query(UserShopPurchase.id)
-            .join(ShopItem, UserShopPurchase.shop_item_id == ShopItem.id)
-            .filter(
-                UserShopPurchase.user_id.in_(non_admin_ids),
-                ShopItem.shop_context == SHOP_CONTEXT_TERRITORY,
+        for i in range(28):
+            st = TerritoryRegionState.query.filter_by(region_index=i).first()
+            if st:
+                st.owner_class_id = None
+                st.owner_clan_id = None
+                st.strength = 0
+            else:
+                db.session.add(TerritoryRegionState(region_index=i, owner_class_id=None, owner_clan_id=None, strength=0))
+        for stats in UserTerritoryStats.query.all():
+            stats.total_damage_dealt = 0
+            stats.total_influence_points = 0
+
+        TerritoryRegionStructure.query.delete(synchronize_session=False)
+        DemogorgonDamage.query.delete(synchronize_session=False)
+        DemogorgonArmy.query.delete(synchronize_session=False)
+        ClanTerritoryMarker.query.delete(synchronize_session=False)
+        ActiveItemBuff.query.delete(synchronize_session=False)
+        buff_index_changed()
+        ClanChatMessage.query.delete(synchronize_session=False)
+        ClanJoinRequest.query.delete(synchronize_session=False)
+        ClanRecruitmentAd.query.delete(synchronize_session=False)
+
+        User.query.update({User.clan_id: None, User.clan_rank: None}, synchronize_session=False)
+        Clan.query.delete(synchronize_session=False)
+
+        # PvP арена и дуэли (история побед/поражений и активные бои)
+        PvPDuel.query.delete(synchronize_session=False)
+        UserPvPStats.query.delete(synchronize_session=False)
+        PvPDuelChallenge.query.delete(synchronize_session=False)
+        PvPArenaChatMessage.query.delete(synchronize_session=False)
+        _chat_messages_deleted()
+        PvPArenaPresence.query.delete(synchronize_session=False)
+
+        if non_admin_ids:
+            pur_rows = (
+                db.session.query(UserShopPurchase.id)
+                .join(ShopItem, UserShopPurchase.shop_item_id == ShopItem.id)
+                .filter(
+                    UserShopPurchase.user_id.in_(non_admin_ids),
+                    ShopItem.shop_context == SHOP_CONTEXT_TERRITORY,
+                )
+                .all()
             )
-            .all()
-        )
-        pur_ids = [r[0] for r in pur_rows]
-        if pur_ids:
-            UserEquipment.query.filter(UserEquipment.purchase_id.in_(pur_ids)).delete(synchronize_session=False)
-            UserShopPurchase.query.filter(UserShopPurchase.id.in_(pur_ids)).delete(synchronize_session=False)
+            pur_ids = [r[0] for r in pur_rows]
+            if pur_ids:
+                UserEquipment.query.filter(UserEquipment.purchase_id.in_(pur_ids)).delete(synchronize_session=False)
+                UserShopPurchase.query.filter(UserShopPurchase.id.in_(pur_ids)).delete(synchronize_session=False)
+
+            UserAbility.query.filter(UserAbility.user_id.in_(non_admin_ids)).delete(synchronize_session=False)
+            User.query.filter_by(is_admin=False).update(
+                {
+                    User.level: 1,
+                    User.experience: 0,
+                    User.damage_skill: 0,
+                    User.defense_skill: 0,
+                    User.energy_skill: 0,
+                    User.ability_class: None,
+                    User.current_energy: None,
+                    User.energy_last_refill_at: None,
+                    User.nums_balance: 0,
+                    User.clan_join_ban_until: None,
+                },
+                synchronize_session=False,
+            )
+            for u in non_admin_users:
+                grant_default_territory_shop_items(u)
 
-        UserAbility.query.filter(UserAbility.user_id.in_(non_admin_ids)).delete(synchronize_session=False)
-        User.query.filter_by(is_admin=False).update(
-            {
-                User.level: 1,
-                User.experience: 0,
-                User.damage_skill: 0,
-                User.defense_skill: 0,
-                User.energy_skill: 0,
-                User.ability_class: None,
-                User.current_energy: None,
-                User.energy_last_refill_at: None,
-                User.nums_balance: 0,
-                User.clan_join_ban_until: None,
-            },
-            synchronize_session=False,
+        # Снаряжение, умения, класс и бафы сняты (бафы и клан — и у админов): кэши бонусов устарели у всех
+        bump_bonus_versions()
+        db.session.commit()
+        _pvp_arena_heartbeats.clear()
+        _pvp_arena_roster.clear()
+    return jsonify({'success': True})
+
+
+# --- Админ: полная синхронизация достижений (фоновая задача по запросу) ---
+_achievement_sync_lock = threading.Lock()
+_achievement_sync_status = {'running': False, 'started_at': None, 'finished_at': None, 'result': None, 'error': None}
+
+
+def _run_achievement_sync_job(force):
+    """Фоновый поток: sync_all_achievement_counters в своём контексте приложения."""
+    from achievements import sync_all_achievement_counters
+    with app.app_context():
+        try:
+            result = sync_all_achievement_counters(force=force, log=app.logger.info)
+            _achievement_sync_status.update(result=result, error=None)
+            app.logger.info(f"Синхронизация достижений завершена: {result}")
+        except Exception as e:
+            db.session.rollback()
+            _achievement_sync_status.update(result=None, error=str(e))
+            app.logger.exception("Ошибка синхронизации достижений")
+        finally:
+            db.session.remove()
+            _achievement_sync_status.update(running=False, finished_at=datetime.now().isoformat())
+            _achievement_sync_lock.release()
+
+
+@app.route('/api/admin/achievements/sync', methods=['GET', 'POST'])
+@admin_required
+def api_admin_achievements_sync():
+    """GET — состояние синхронизации; POST — запустить (force: пересчитать и уже синхронизированных).
+    Синхронизация идёт в фоне в этом процессе, одна за раз."""
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        if not _achievement_sync_lock.acquire(blocking=False):
+            return jsonify({'success': False, 'error': 'Синхронизация уже идёт', **_achievement_sync_status}), 409
+        _achievement_sync_status.update(
+            running=True, started_at=datetime.now().isoformat(), finished_at=None, result=None, error=None,
         )
-        for u in non_admin_users:
-            grant_default_territory_shop_items(u)
+        threading.Thread(
+            target=_run_achievement_sync_job, args=(bool(data.get('force')),),
+            name='achievement-sync', daemon=True,
+        ).start()
+    return jsonify({'success': True, **_achievement_sync_status})
 
-    db.session.commit()
-    return jsonify({'success': True})
+
+@app.route('/api/admin/scheduler/metrics')
+@admin_required
+def api_admin_scheduler_metrics():
+    """Метрики планировщика: задачи (запуски, длительность, задержка старта, пропуски, наложения)
+    и аренда (захваты, потери, время передачи). Запрос мог попасть в любой воркер: если планировщик
+    не здесь, метрики задач — последние, что владелец записал в scheduler_instance_lock при продлении."""
+    lock = db.session.get(SchedulerInstanceLock, 1)
+    owner = None
+    if lock is not None:
+        owner = {
+            'instance_id': lock.owner_id,
+            'pid': lock.owner_pid,
+            'expires_at': lock.expires_at.isoformat() if lock.expires_at else None,
+        }
+    is_leader = bool(scheduler.running)
+    if is_leader:
+        metrics = _scheduler_metrics_payload()
+    else:
+        try:
+            metrics = json.loads(lock.metrics) if lock is not None and lock.metrics else None
+        except ValueError:
+            metrics = None
+    return jsonify({
+        'success': True,
+        'instance_id': SCHEDULER_INSTANCE_ID,
+        'is_leader': is_leader,
+        'lease_backend': _scheduler_get_lease().backend,
+        'owner': owner,
+        'metrics': metrics,
+        'metrics_source': 'live' if is_leader else 'owner',
+        'local_lease': _scheduler_metrics.snapshot()['lease'],
+    })
 
 
 # --- Админ: чаты с пользователями (битва за территорию) ---
@@ -6272,7 +7418,8 @@ def api_admin_territory_admin_chat_threads():
         last_msg = TerritoryAdminChatMessage.query.filter_by(user_id=user_id).order_by(
             TerritoryAdminChatMessage.created_at.desc()
         ).first()
-        preview = (last_msg.text[:50] + '…') if last_msg and len(last_msg.text) > 50 else (last_msg.text if last_msg else '')
+        last_text = _chat_text(last_msg) if last_msg else ''
+        preview = (last_text[:50] + '…') if len(last_text) > 50 else last_text
         out.append({
             'user_id': user_id,
             'guest_key': None,
@@ -6294,7 +7441,8 @@ def api_admin_territory_admin_chat_threads():
             TerritoryAdminChatMessage.created_at.desc()
         ).first()
         last_at = last_msg.created_at if last_msg else None
-        preview = (last_msg.text[:50] + '…') if last_msg and len(last_msg.text) > 50 else (last_msg.text if last_msg else '')
+        last_text = _chat_text(last_msg) if last_msg else ''
+        preview = (last_text[:50] + '…') if len(last_text) > 50 else last_text
         first_user_msg = TerritoryAdminChatMessage.query.filter_by(guest_key=gk, is_from_admin=False).order_by(
             TerritoryAdminChatMessage.id.asc()
         ).first()
@@ -6332,7 +7480,7 @@ def api_admin_territory_admin_chat_thread_messages(user_id):
         items.append({
             'id': m.id,
             'author_name': author,
-            'text': m.text,
+            'text': _chat_text(m),
             'is_from_admin': m.is_from_admin,
             'created_at': m.created_at.isoformat() if m.created_at else None,
         })
@@ -6352,7 +7500,7 @@ def api_admin_territory_admin_chat_thread_guest_messages(guest_key):
         items.append({
             'id': m.id,
             'author_name': author,
-            'text': m.text,
+            'text': _chat_text(m),
             'is_from_admin': m.is_from_admin,
             'created_at': m.created_at.isoformat() if m.created_at else None,
         })
@@ -6370,16 +7518,16 @@ def api_admin_territory_admin_chat_reply(user_id):
         return jsonify({'success': False, 'error': 'Текст ответа не может быть пустым'}), 400
     if len(text) > TERRITORY_ADMIN_CHAT_TEXT_MAX:
         return jsonify({'success': False, 'error': 'Ответ не более {} символов'.format(TERRITORY_ADMIN_CHAT_TEXT_MAX)}), 400
-    text = filter_chat_text(text)
-    msg = TerritoryAdminChatMessage(user_id=user_id, guest_key=None, author_name=None, text=text, is_from_admin=True)
+    msg = TerritoryAdminChatMessage(user_id=user_id, guest_key=None, author_name=None, text=text, is_from_admin=True, **_chat_filtered_fields(text))
     db.session.add(msg)
     db.session.commit()
+    _chat_unread.touch(CHAT_UNREAD_ADMIN_CHANNEL)
     return jsonify({
         'success': True,
         'message': {
             'id': msg.id,
             'author_name': 'Администратор',
-            'text': msg.text,
+            'text': msg.text_filtered,
             'is_from_admin': True,
             'created_at': msg.created_at.isoformat() if msg.created_at else None,
         }
@@ -6398,16 +7546,16 @@ def api_admin_territory_admin_chat_reply_guest(guest_key):
         return jsonify({'success': False, 'error': 'Ответ не более {} символов'.format(TERRITORY_ADMIN_CHAT_TEXT_MAX)}), 400
     if not TerritoryAdminChatMessage.query.filter_by(guest_key=guest_key).first():
         return jsonify({'success': False, 'error': 'Тред не найден'}), 404
-    text = filter_chat_text(text)
-    msg = TerritoryAdminChatMessage(user_id=None, guest_key=guest_key, author_name=None, text=text, is_from_admin=True)
+    msg = TerritoryAdminChatMessage(user_id=None, guest_key=guest_key, author_name=None, text=text, is_from_admin=True, **_chat_filtered_fields(text))
     db.session.add(msg)
     db.session.commit()
+    _chat_unread.touch(CHAT_UNREAD_ADMIN_CHANNEL)
     return jsonify({
         'success': True,
         'message': {
             'id': msg.id,
             'author_name': 'Администратор',
-            'text': msg.text,
+            'text': msg.text_filtered,
             'is_from_admin': True,
             'created_at': msg.created_at.isoformat() if msg.created_at else None,
         }
@@ -6607,6 +7755,9 @@ def api_admin_shop_item_update_delete(item_id):
         if p_open:
             item.chest_image_open_filename = p_open
     ShopItemEffect.query.filter_by(shop_item_id=item.id).delete()
+    # Эффекты товара меняются у всех, кто его носит, и у действующих баффов
+    bump_bonus_versions_for_shop_item(item.id)
+    buff_index_changed()
     if item.category == SHOP_CATEGORY_CHEST:
         item.equipment_slot = None
         item.grade = None
@@ -6733,6 +7884,7 @@ def update_boss(boss_id):
     
     boss.updated_at = datetime.now()
     db.session.commit()
+    boss_stats.invalidate(boss_id)
     return jsonify({'success': True, 'boss': boss.to_dict()})
 
 # API для удаления босса
@@ -6750,6 +7902,9 @@ def delete_boss(boss_id):
     
     db.session.delete(boss)
     db.session.commit()
+    boss_stats.invalidate(boss_id)
+    boss_drops.invalidate(boss_id)
+    _boss_task_dispenser.invalidate(boss_id)
     return jsonify({'success': True})
 
 # API для переключения активности босса
@@ -6767,6 +7922,9 @@ def toggle_boss_active(boss_id):
     
     boss.updated_at = datetime.now()
     db.session.commit()
+    boss_stats.invalidate()
+    # Очередь задач собирается заново при активации
+    _boss_task_dispenser.invalidate()
     return jsonify({'success': True, 'boss': boss.to_dict()})
 
 # API для получения задач босса
@@ -6872,7 +8030,9 @@ def create_boss_task(boss_id):
             points=points
         )
         db.session.add(new_task)
+        boss_stats.task_added(boss_id, points)
         db.session.commit()
+        _boss_task_dispenser.invalidate(boss_id)
         
         return jsonify({'success': True, 'task': new_task.to_dict()})
     except Exception as e:
@@ -6890,6 +8050,7 @@ def update_boss_task(boss_id, task_id):
         return jsonify({'success': False, 'error': 'Задача не принадлежит этому боссу'}), 400
     
     try:
+        old_points = task.points
         if request.is_json:
             data = request.json
             title = data.get('title', '').strip()
@@ -6940,7 +8101,9 @@ def update_boss_task(boss_id, task_id):
                 file.save(filepath)
                 task.image_filename = filename
         
+        boss_stats.task_points_changed(task, old_points)
         db.session.commit()
+        _boss_task_dispenser.invalidate(boss_id)
         return jsonify({'success': True, 'task': task.to_dict()})
     except Exception as e:
         db.session.rollback()
@@ -6962,8 +8125,12 @@ def delete_boss_task(boss_id, task_id):
         if os.path.exists(filepath):
             os.remove(filepath)
     
+    boss_stats.task_removed(task)
+    # Решения задачи удаляются вместе с ней — вычесть их из топа босса в этой же транзакции
+    boss_top.task_removed(boss_id, task.id)
     db.session.delete(task)
     db.session.commit()
+    _boss_task_dispenser.invalidate(boss_id)
     return jsonify({'success': True})
 
 # Страница рейд босса (доступна для всех)
@@ -6983,17 +8150,9 @@ def raid_boss_page():
     # Получаем все классы для выбора
     classes = Class.query.all()
     
-    # Вычисляем урон по классам
-    class_damage = {}
-    for class_obj in classes:
-        damage = db.session.query(db.func.sum(BossTask.points)).join(
-            BossTaskSolution, BossTaskSolution.task_id == BossTask.id
-        ).filter(
-            BossTaskSolution.boss_id == active_boss.id,
-            BossTaskSolution.class_id == class_obj.id,
-            BossTaskSolution.is_correct == True
-        ).scalar() or 0
-        class_damage[class_obj.id] = damage
+    # Урон по классам — одной группировкой
+    damage_by_class = boss_stats.class_damage(active_boss.id)
+    class_damage = {class_obj.id: damage_by_class.get(class_obj.id, 0) for class_obj in classes}
     
     return render_template(
         'raid_boss.html',
@@ -7023,6 +8182,520 @@ TERRITORY_MAX_STRENGTH = 5000
 TERRITORY_STRENGTH_STEP_SAME = 25
 TERRITORY_STRENGTH_STEP_OTHER = 25
 
+# Атомарное применение урона/влияния к области (PostgreSQL): одна блокировка строки,
+# один UPDATE области и один UPDATE статистики игрока за один запрос к БД.
+# CTE prev фиксирует состояние до удара (RETURNING видит только новые значения).
+# version — следующий номер версии карты (см. _territory_next_map_version), :version.
+_TERRITORY_CAPTURE_PG_SQL = """
+WITH prev AS (
+    SELECT id, owner_clan_id, strength,
+        CASE WHEN owner_clan_id = :clan_id THEN :defense_power ELSE :attack_power END AS power
+    FROM territory_region_state
+    WHERE region_index = :region_index
+    FOR UPDATE
+), upd AS (
+    UPDATE territory_region_state AS s
+    SET owner_clan_id = CASE
+            WHEN prev.owner_clan_id IS NULL OR prev.owner_clan_id = :clan_id OR prev.strength <= prev.power
+                THEN :clan_id
+            ELSE prev.owner_clan_id
+        END,
+        strength = CASE
+            WHEN prev.owner_clan_id IS NULL OR prev.owner_clan_id = :clan_id
+                THEN LEAST(:max_strength, prev.strength + prev.power)
+            WHEN prev.strength <= prev.power THEN prev.power
+            ELSE prev.strength - prev.power
+        END,
+        version = :version
+    FROM prev
+    WHERE s.id = prev.id
+    RETURNING s.owner_clan_id, s.strength, prev.owner_clan_id AS old_owner_clan_id, prev.strength AS old_strength,
+        prev.power AS power
+), stats AS (
+    UPDATE user_territory_stats AS us
+    SET total_damage_dealt = us.total_damage_dealt + CASE
+            WHEN upd.old_owner_clan_id IS NOT NULL AND upd.old_owner_clan_id <> :clan_id THEN upd.power
+            ELSE 0
+        END,
+        total_influence_points = us.total_influence_points + CASE
+            WHEN upd.old_owner_clan_id IS NULL OR upd.old_owner_clan_id = :clan_id OR upd.old_strength <= upd.power
+                THEN upd.power
+            ELSE 0
+        END
+    FROM upd
+    WHERE us.user_id = :user_id
+    RETURNING us.id
+)
+SELECT owner_clan_id, strength, old_owner_clan_id, old_strength, power FROM upd
+"""
+
+
+# Новая версия сразу всем областям (изменения карты в обход ударов: очистка, роспуск клана,
+# сооружения) — клиенты с since= получат всю карту. :version — _territory_next_map_version().
+_TERRITORY_MAP_BUMP_VERSION_SQL = 'UPDATE territory_region_state SET version = :version'
+
+# Изменения карты для ?since= на PostgreSQL без горячей карты. Номера version выдаются до commit и
+# становятся видимыми не по порядку, поэтому клиенту отдаётся не max(version), а водяной знак —
+# xmin снимка: все транзакции с меньшим id завершены и видны в том же снимке. Следующий опрос
+# получает строки с xact_id >= знака — в том числе закоммиченные позже. Знак и строки читаются
+# одним запросом (в READ COMMITTED у каждого запроса свой снимок).
+_TERRITORY_MAP_CHANGES_PG_SQL = """
+WITH w AS (SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint AS mark)
+SELECT w.mark, s.region_index, s.owner_clan_id, s.strength, s.version
+FROM w LEFT JOIN territory_region_state AS s ON {condition}
+"""
+
+
+def _territory_capture_outcome(old_owner_clan_id, old_strength, clan_id, power):
+    """Результат удара по области: (новый владелец, новая сила, урон, влияние).
+
+    Та же логика, что в _TERRITORY_CAPTURE_PG_SQL: нейтральная/своя область усиливается
+    (не выше TERRITORY_MAX_STRENGTH), чужая теряет силу; при падении до 0 — переходит клану с силой power.
+    """
+    old_strength = int(old_strength or 0)
+    if old_owner_clan_id is None or old_owner_clan_id == clan_id:
+        return clan_id, min(TERRITORY_MAX_STRENGTH, old_strength + power), 0, power
+    if old_strength <= power:
+        return clan_id, power, power, power
+    return old_owner_clan_id, old_strength - power, power, 0
+
+
+def _territory_next_map_version(session=None):
+    """Следующий номер версии карты для изменяемой области.
+
+    На PostgreSQL — nextval(TERRITORY_MAP_VERSION_SEQ): номера уникальны, но транзакции могут
+    закоммититься не по порядку номеров — поэтому /api/territory/map-state без горячей карты опирается
+    не на них, а на xact_id (_TERRITORY_MAP_CHANGES_PG_SQL). На других СУБД (SQLite в разработке) —
+    max по territory_region_state + 1.
+    """
+    session = session or db.session
+    if session.get_bind().dialect.name == 'postgresql':
+        return int(session.execute(text(f"SELECT nextval('{TERRITORY_MAP_VERSION_SEQ}')")).scalar())
+    return int(session.query(func.coalesce(func.max(TerritoryRegionState.version), 0)).scalar() or 0) + 1
+
+
+def _territory_map_version_seen(session, version):
+    """Номер version выдан в обход последовательности (горячая карта): следующие nextval — больше него."""
+    if session.get_bind().dialect.name != 'postgresql' or not version:
+        return
+    session.execute(
+        text(
+            f"SELECT setval('{TERRITORY_MAP_VERSION_SEQ}', :v) "
+            f"WHERE :v > (SELECT last_value FROM {TERRITORY_MAP_VERSION_SEQ})"
+        ),
+        {'v': int(version)},
+    )
+
+
+def _territory_capture_apply(region_index, clan_id, user_id, attack_power, defense_power):
+    """Применить урон/влияние клана clan_id к области region_index без потерянных обновлений.
+
+    Строки territory_region_state и user_territory_stats должны существовать.
+    Сила удара выбирается по владельцу заблокированной строки: defense_power — своя область,
+    attack_power — чужая/нейтральная (владелец мог смениться после чтения в запросе).
+    На PostgreSQL смена владельца, ограничение силы и статистика игрока решаются одним запросом;
+    на других СУБД — блокирующий SELECT и обновление в той же транзакции.
+    Возвращает dict: owner_clan_id, strength, captured_neutral, captured_enemy, damage, influence,
+    is_own_region или None, если области нет.
+    """
+    from sqlalchemy import text
+
+    attack_power, defense_power = int(attack_power), int(defense_power)
+    if db.engine.dialect.name == 'postgresql':
+        row = db.session.execute(text(_TERRITORY_CAPTURE_PG_SQL), {
+            'region_index': region_index,
+            'clan_id': clan_id,
+            'user_id': user_id,
+            'attack_power': attack_power,
+            'defense_power': defense_power,
+            'max_strength': TERRITORY_MAX_STRENGTH,
+            'version': _territory_next_map_version(),
+        }).first()
+        if row is None:
+            return None
+        owner_clan_id, strength, old_owner_clan_id, old_strength, power = row
+        _, _, damage, influence = _territory_capture_outcome(old_owner_clan_id, old_strength, clan_id, power)
+        # ORM-копии этих строк в сессии устарели после прямого UPDATE
+        for obj in list(db.session.identity_map.values()):
+            if isinstance(obj, (TerritoryRegionState, UserTerritoryStats)):
+                db.session.expire(obj)
+    else:
+        state = (
+            TerritoryRegionState.query.filter_by(region_index=region_index)
+            .populate_existing()
+            .with_for_update()
+            .first()
+        )
+        if state is None:
+            return None
+        old_owner_clan_id, old_strength = state.owner_clan_id, state.strength
+        power = defense_power if old_owner_clan_id == clan_id else attack_power
+        owner_clan_id, strength, damage, influence = _territory_capture_outcome(
+            old_owner_clan_id, old_strength, clan_id, power
+        )
+        state.owner_clan_id = owner_clan_id
+        state.strength = strength
+        state.version = _territory_next_map_version()
+        stats_values = {}
+        if damage:
+            stats_values['total_damage_dealt'] = UserTerritoryStats.total_damage_dealt + damage
+        if influence:
+            stats_values['total_influence_points'] = UserTerritoryStats.total_influence_points + influence
+        if stats_values:
+            UserTerritoryStats.query.filter_by(user_id=user_id).update(stats_values, synchronize_session='fetch')
+    return {
+        'owner_clan_id': owner_clan_id,
+        'strength': int(strength or 0),
+        'captured_neutral': old_owner_clan_id is None,
+        'captured_enemy': (
+            old_owner_clan_id is not None and old_owner_clan_id != clan_id
+            and owner_clan_id == clan_id and int(old_strength or 0) > 0
+        ),
+        'damage': damage,
+        'influence': influence,
+        'is_own_region': old_owner_clan_id == clan_id,
+    }
+
+
+# --- Горячая карта (TERRITORY_HOT_MAP) ---
+_territory_hot_map_instance = None
+_territory_hot_map_guard = threading.Lock()
+
+
+def _territory_hot_map_last_seq(session):
+    cp = session.get(TerritoryHotMapCheckpoint, 1)
+    return int(cp.last_seq or 0) if cp else 0
+
+
+def _territory_hot_map_load():
+    """MapData из БД (поток актора). Недостающие строки territory_region_state создаются.
+    Карта читается свежей — просьба перечитать её в чекпоинте снимается."""
+    session = _open_scheduler_lock_session()
+    try:
+        with session.begin():
+            cp = session.query(TerritoryHotMapCheckpoint).filter_by(id=1).with_for_update().first()
+            if cp is not None and cp.reload_requested:
+                cp.reload_requested = False
+            config = session.query(TerritoryRegionConfig).all()
+            states = {s.region_index: s for s in session.query(TerritoryRegionState).all()}
+            for cfg in config:
+                if cfg.region_index not in states:
+                    st = TerritoryRegionState(region_index=cfg.region_index, owner_class_id=None, owner_clan_id=None, strength=0)
+                    session.add(st)
+                    states[cfg.region_index] = st
+            structure_mults = {
+                st.region_index: (
+                    float(TERRITORY_STRUCTURE_ATTACK_DAMAGE_MULT.get(st.structure_type, 1.0)),
+                    float(TERRITORY_STRUCTURE_DEFENSE_POWER_MULT.get(st.structure_type, 1.0)),
+                )
+                for st in session.query(TerritoryRegionStructure).all()
+            }
+            issued = 0
+            if session.get_bind().dialect.name == 'postgresql':
+                issued = session.execute(text(f'SELECT last_value FROM {TERRITORY_MAP_VERSION_SEQ}')).scalar()
+            return MapData(
+                regions={ri: (st.owner_clan_id, int(st.strength or 0)) for ri, st in states.items()},
+                versions={ri: int(st.version or 0) for ri, st in states.items()},
+                locked={cfg.region_index for cfg in config if cfg.is_locked},
+                structure_mults=structure_mults,
+                last_seq=_territory_hot_map_last_seq(session),
+                version=int(issued or 0),
+            )
+    finally:
+        session.close()
+
+
+def _territory_hot_map_flush(regions, stats, last_seq):
+    """Записать пачку изменений горячей карты одной транзакцией; True — карту нужно перечитать.
+
+    Чекпоинт блокируется первым (тот же порядок, что у _territory_map_write на других экземплярах).
+    Если другой экземпляр менял карту (reload_requested), области не пишутся: изменения актора
+    считались от устаревшего состояния. Иначе каждая область пишется, только если её версия в БД
+    та, от которой считал актор: удар, применённый к БД на другом экземпляре, не затирается.
+    Приращения статистики игроков пишутся всегда.
+    """
+    from sqlalchemy import text
+
+    session = _open_scheduler_lock_session()
+    try:
+        with session.begin():
+            cp = session.query(TerritoryHotMapCheckpoint).filter_by(id=1).with_for_update().first()
+            if cp is None:
+                cp = TerritoryHotMapCheckpoint(id=1, last_seq=0, reload_requested=False)
+                session.add(cp)
+            reload_requested = bool(cp.reload_requested)
+            conflicts = 0
+            if regions and not reload_requested:
+                update_sql = text(
+                    'UPDATE territory_region_state SET owner_clan_id = :o, strength = :s, '
+                    'version = COALESCE(:v, version) WHERE region_index = :r'
+                )
+                guarded_sql = text(
+                    'UPDATE territory_region_state SET owner_clan_id = :o, strength = :s, '
+                    'version = COALESCE(:v, version) WHERE region_index = :r AND version = :e'
+                )
+                for ri, (owner, strength, v, expected) in sorted(regions.items()):
+                    params = {'r': ri, 'o': owner, 's': strength, 'v': v, 'e': expected}
+                    result = session.execute(update_sql if expected is None else guarded_sql, params)
+                    if expected is not None and result.rowcount == 0:
+                        conflicts += 1
+                _territory_map_version_seen(session, max((r[2] or 0 for r in regions.values()), default=0))
+            elif regions:
+                logger.warning(f'Горячая карта: карту меняли в обход актора, не записано областей: {len(regions)}')
+            if conflicts:
+                logger.warning(f'Горячая карта: области изменены другим экземпляром, не записано: {conflicts}')
+            if stats:
+                session.execute(
+                    text(
+                        'UPDATE user_territory_stats SET total_damage_dealt = total_damage_dealt + :d, '
+                        'total_influence_points = total_influence_points + :i WHERE user_id = :u'
+                    ),
+                    [{'u': uid, 'd': d, 'i': i} for uid, (d, i) in stats.items()],
+                )
+            if reload_requested or conflicts:
+                # Области менял другой экземпляр: новая версия всем, чтобы клиенты перечитали карту
+                session.execute(text(_TERRITORY_MAP_BUMP_VERSION_SQL), {'version': _territory_next_map_version(session)})
+            if regions or stats or reload_requested:
+                cp.last_seq = max(int(cp.last_seq or 0), int(last_seq))
+                cp.reload_requested = False
+                cp.updated_at = datetime.now()
+            return reload_requested or bool(conflicts)
+    finally:
+        session.close()
+
+
+def _territory_hot_map_recover():
+    """При старте экземпляра с планировщиком: дописать в БД действия журнала, потерянные при падении."""
+    if not TERRITORY_HOT_MAP_LOG or not os.path.exists(TERRITORY_HOT_MAP_LOG):
+        return
+    session = _open_scheduler_lock_session()
+    try:
+        last_seq = _territory_hot_map_last_seq(session)
+    finally:
+        session.close()
+    restored = replay_log(TERRITORY_HOT_MAP_LOG, last_seq, _territory_hot_map_flush)
+    if restored:
+        logger.warning(f'Горячая карта: восстановлено из журнала областей: {restored}')
+
+
+@atexit.register
+def _territory_hot_map_shutdown():
+    """Записать накопленное горячей картой при штатной остановке процесса."""
+    hot = _territory_hot_map_instance
+    if hot is not None:
+        try:
+            hot.stop()
+        except Exception as e:
+            logger.error(f'Горячая карта: ошибка остановки: {e}')
+
+
+def _territory_capture_window_open():
+    capture_enabled, start, end = get_territory_capture_settings()
+    now = datetime.now()
+    return bool(capture_enabled) and (not start or now >= start) and (not end or now <= end)
+
+
+def _territory_hot_map():
+    """HotMap этого экземпляра, если горячая карта включена, экземпляр держит лок планировщика
+    и идёт окно захвата; иначе None. Запускает/останавливает актора на границах окна."""
+    global _territory_hot_map_instance
+    if not TERRITORY_HOT_MAP_ENABLED or not scheduler.running:
+        return None
+    active = _territory_capture_window_open()
+    hot = _territory_hot_map_instance
+    if active and hot is not None and hot.alive:
+        return hot
+    if not active and hot is None:
+        return None
+    with _territory_hot_map_guard:
+        hot = _territory_hot_map_instance
+        if active and (hot is None or not hot.alive):
+            hot = HotMap(
+                load=_territory_hot_map_load,
+                flush=_territory_hot_map_flush,
+                outcome=_territory_capture_outcome,
+                log_path=TERRITORY_HOT_MAP_LOG,
+                flush_interval_ms=TERRITORY_HOT_MAP_FLUSH_MS,
+                context=app.app_context,
+            )
+            hot.start()
+            _territory_hot_map_instance = hot
+            logger.info('Горячая карта запущена')
+        elif not active and hot is not None:
+            hot.stop()
+            _territory_hot_map_instance = None
+            logger.info('Горячая карта остановлена')
+            hot = None
+    return hot
+
+
+def _territory_hot_map_elsewhere():
+    """Горячая карта включена, но состояние карты держит другой экземпляр."""
+    return TERRITORY_HOT_MAP_ENABLED and not scheduler.running
+
+
+@contextmanager
+def _territory_map_write():
+    """Обёртка для изменений областей в обход ударов (очистка карты, роспуск клана, сооружения,
+    блокировка области): горячая карта сначала пишет накопленное в БД и ждёт, после блока —
+    перечитывает карту. На другом экземпляре — просьба перечитать в той же транзакции, что и
+    изменение: чекпоинт блокируется до блока, поэтому запись актора не проскочит между ними.
+    После блока все области получают новую версию карты (клиенты перечитают её целиком)."""
+    from sqlalchemy import text
+
+    hot = _territory_hot_map()
+    if hot is not None:
+        with hot.paused():
+            yield
+            db.session.execute(text(_TERRITORY_MAP_BUMP_VERSION_SQL), {'version': _territory_next_map_version()})
+            db.session.commit()
+        _publish_event('map', 'reload')
+        return
+    if _territory_hot_map_elsewhere():
+        cp = TerritoryHotMapCheckpoint.query.filter_by(id=1).populate_existing().with_for_update().first()
+        if cp is None:
+            db.session.add(TerritoryHotMapCheckpoint(id=1, last_seq=0, reload_requested=True))
+        else:
+            cp.reload_requested = True
+    yield
+    db.session.execute(text(_TERRITORY_MAP_BUMP_VERSION_SQL), {'version': _territory_next_map_version()})
+    db.session.commit()
+    _publish_event('map', 'reload')
+
+
+def _territory_region_states():
+    """{region_index: (owner_clan_id, strength)} — из горячей карты или из БД."""
+    hot = _territory_hot_map()
+    if hot is not None:
+        return hot.snapshot()
+    return {
+        ri: (owner, int(strength or 0))
+        for ri, owner, strength in db.session.query(
+            TerritoryRegionState.region_index, TerritoryRegionState.owner_clan_id, TerritoryRegionState.strength
+        ).all()
+    }
+
+
+def _territory_map_state_by_index():
+    """{region_index: {owner_clan_id, strength[, structure_type, last_payout_at]}} для карты.
+    Владелец и сила — из горячей карты во время окна захвата, иначе из БД."""
+    state_by_index = {
+        ri: {'owner_clan_id': owner, 'strength': strength}
+        for ri, (owner, strength) in sorted(_territory_region_states().items())
+    }
+    for st in TerritoryRegionStructure.query.all():
+        data = state_by_index.setdefault(st.region_index, {'owner_clan_id': None, 'strength': 0})
+        data['structure_type'] = st.structure_type
+        data['last_payout_at'] = st.last_payout_at.isoformat() if st.last_payout_at else None
+    return state_by_index
+
+
+# --- Серверные события (EVENT_STREAM) ---
+_event_broker = None
+_event_broker_pid = None
+_event_broker_guard = threading.Lock()
+
+
+def _event_stream_broker():
+    """EventBroker этого процесса. В каждом воркере (после fork) — свой брокер и, на PostgreSQL,
+    свой поток LISTEN для событий остальных воркеров."""
+    global _event_broker, _event_broker_pid
+    pid = os.getpid()
+    if _event_broker is not None and _event_broker_pid == pid:
+        return _event_broker
+    with _event_broker_guard:
+        if _event_broker is None or _event_broker_pid != pid:
+            broker = EventBroker()
+            engine = db.engine
+            if engine.dialect.name == 'postgresql':
+                cargs, cparams = engine.dialect.create_connect_args(engine.url)
+                bridge = PgNotifyBridge(
+                    broker, lambda: engine.dialect.connect(*cargs, **cparams), EVENT_STREAM_CHANNEL,
+                )
+                bridge.start()
+                broker.attach_bridge(bridge)
+            _event_broker, _event_broker_pid = broker, pid
+    return _event_broker
+
+
+def _publish_event(topic, event, data=None):
+    """Отправить событие подписчикам темы (вызывать после commit). Ошибки не мешают запросу."""
+    if not EVENT_STREAM_ENABLED:
+        return
+    try:
+        _event_stream_broker().publish(topic, event, data)
+    except Exception as e:
+        logger.error(f'Поток событий: не удалось отправить {topic}/{event}: {e}')
+
+
+@app.context_processor
+def _event_stream_template_context():
+    return {'event_stream_enabled': EVENT_STREAM_ENABLED}
+
+
+def _event_stream_topics(requested):
+    """Темы из ?topics=, на которые текущий пользователь может подписаться:
+    map, demogorgon — всем; arena — вошедшим; duel:<id> — участникам дуэли; clan-chat:<id> — членам клана."""
+    topics = set()
+    for topic in requested:
+        topic = topic.strip()
+        if topic in ('map', 'demogorgon'):
+            topics.add(topic)
+            continue
+        if not current_user.is_authenticated:
+            continue
+        kind, _, ident = topic.partition(':')
+        if kind == 'arena' and not ident:
+            topics.add(topic)
+        elif kind == 'duel' and ident.isdigit():
+            duel = db.session.get(PvPDuel, int(ident))
+            if duel and current_user.id in (duel.challenger_id, duel.defender_id):
+                topics.add(topic)
+        elif kind == 'clan-chat' and ident.isdigit():
+            if current_user.clan_id and int(ident) == current_user.clan_id:
+                topics.add(topic)
+    return sorted(topics)
+
+
+@app.route('/api/stream')
+def api_event_stream():
+    """Серверные события (text/event-stream) по темам ?topics=map,demogorgon,duel:<id>,clan-chat:<id>,arena.
+
+    Первое сообщение — hello со списком принятых тем (на остальные страница продолжает опрос),
+    дальше — {topic, event, data}; event=resync — перечитать данные по всем темам.
+    Через EVENT_STREAM_MAX_SECONDS поток закрывается, браузер переподключается сам.
+    """
+    if not EVENT_STREAM_ENABLED:
+        return jsonify({'success': False, 'error': 'Поток событий отключён'}), 404
+    topics = _event_stream_topics((request.args.get('topics') or '').split(','))
+    if not topics:
+        return jsonify({'success': False, 'error': 'Нет доступных тем'}), 400
+    broker = _event_stream_broker()
+    if broker.connections >= EVENT_STREAM_MAX_CONNECTIONS:
+        return jsonify({'success': False, 'error': 'Слишком много подключений'}), 503
+    sub = broker.subscribe(topics)
+    # Соединение с БД на время потока не держим
+    db.session.remove()
+    deadline = time.monotonic() + EVENT_STREAM_MAX_SECONDS
+
+    def generate():
+        try:
+            yield format_sse({'topics': topics}, event='hello', retry_ms=3000)
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                message = sub.get(timeout=min(EVENT_STREAM_HEARTBEAT_SECONDS, remaining))
+                yield ': ping\n\n' if message is None else format_sse(message)
+        finally:
+            broker.unsubscribe(sub)
+
+    return app.response_class(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+
 @app.route('/territory-battle')
 def territory_battle_page():
     # Администратор видит страницу как незарегистрированный пользователь (только просмотр, без участия)
@@ -7048,23 +8721,12 @@ def territory_battle_page():
         })
     regions_config = TerritoryRegionConfig.query.order_by(TerritoryRegionConfig.region_index).all()
     regions_json = [{'region_index': r.region_index, 'display_name': r.display_name, 'description': r.description or '', 'is_locked': r.is_locked} for r in regions_config]
-    states = TerritoryRegionState.query.order_by(TerritoryRegionState.region_index).all()
-    state_by_index = {s.region_index: {'owner_clan_id': s.owner_clan_id, 'strength': s.strength} for s in states}
     # Начислить доход с сооружений лидеру клана при заходе на страницу только создателя клана (как восстановление энергии — за всё прошедшее время)
     if user_logged_in and not is_admin and clan_id and getattr(current_user, 'clan_obj', None) and current_user.clan_obj.owner_id == current_user.id:
         process_territory_structure_payouts(clan_id)
-    structures_by_region = {s.region_index: {'structure_type': s.structure_type, 'last_payout_at': s.last_payout_at} for s in TerritoryRegionStructure.query.all()}
-    for ri, data in structures_by_region.items():
-        if ri in state_by_index:
-            state_by_index[ri]['structure_type'] = data['structure_type']
-            state_by_index[ri]['last_payout_at'] = data['last_payout_at'].isoformat() if data['last_payout_at'] else None
-        else:
-            state_by_index[ri] = {
-                'owner_clan_id': None,
-                'strength': 0,
-                'structure_type': data['structure_type'],
-                'last_payout_at': data['last_payout_at'].isoformat() if data['last_payout_at'] else None,
-            }
+    # Версию берём до состояния: изменения между ними клиент получит первым опросом map-state
+    map_version = _territory_map_version()
+    state_by_index = _territory_map_state_by_index()
     current_energy = None
     energy_max = None
     avatar_url = None
@@ -7082,13 +8744,8 @@ def territory_battle_page():
     capture_end_time_ms = int(capture_end_time.timestamp() * 1000) if capture_end_time else None
     featured_update = GameUpdate.query.filter_by(show_on_main=True).order_by(GameUpdate.created_at.desc()).first()
     clan_pending_join_count = 0
-    if user_logged_in and not is_admin and getattr(current_user, 'clan_obj', None):
-        can_see_join_requests = (
-            current_user.clan_obj.owner_id == current_user.id
-            or (current_user.clan_rank or CLAN_RANK_VASSAL) in (CLAN_RANK_DUKE, CLAN_RANK_MARQUIS)
-        )
-        if can_see_join_requests:
-            clan_pending_join_count = ClanJoinRequest.query.filter_by(clan_id=current_user.clan_obj.id, status='pending').count()
+    if user_logged_in and not is_admin:
+        clan_pending_join_count = _clan_pending_join_count(current_user) or 0
     # Активные баффы для отображения иконок (только с длительностью; разовые не показываем в списке)
     user_active_buffs = []
     clan_active_buffs = []
@@ -7131,12 +8788,98 @@ def territory_battle_page():
         user_active_buffs=user_active_buffs,
         clan_active_buffs=clan_active_buffs,
         region_active_buffs=region_active_buffs,
+        region_buffs_version=_territory_payload_hash(region_active_buffs),
+        map_version=map_version,
         is_clan_owner=is_clan_owner,
         clan_marker=clan_marker,
         featured_update=featured_update,
     )
 
 
+def _territory_map_version():
+    """Текущая версия карты для ?since=: номер последнего изменения областей (горячая карта, SQLite)
+    или водяной знак "x<xmin>" на PostgreSQL (_TERRITORY_MAP_CHANGES_PG_SQL)."""
+    hot = _territory_hot_map()
+    if hot is not None:
+        return hot.version
+    if db.engine.dialect.name == 'postgresql':
+        return 'x%d' % db.session.execute(text('SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint')).scalar()
+    return int(db.session.query(func.coalesce(func.max(TerritoryRegionState.version), 0)).scalar() or 0)
+
+
+def _territory_map_changes(since=None):
+    """(версия карты, {region_index: {owner_clan_id, strength, version}}) — области, изменённые после
+    версии since (строка из ?since=), или все, если since нет, он из другого вида версий (горячая карта
+    и водяной знак PostgreSQL не сравниваются) или больше текущей версии (карту сбрасывали)."""
+    since = (since or '').strip()
+    hot = _territory_hot_map()
+    if hot is not None:
+        version = hot.version
+        since = int(since) if since.isdigit() else -1
+        version, changed = hot.changes_since(since if since <= version else -1)
+    elif db.engine.dialect.name == 'postgresql':
+        mark = int(since[1:]) if since[:1] == 'x' and since[1:].isdigit() else None
+        sql = _TERRITORY_MAP_CHANGES_PG_SQL.format(condition='TRUE' if mark is None else 's.xact_id >= :since')
+        changed = {}
+        version = None
+        for mark_now, ri, owner, strength, v in db.session.execute(text(sql), {'since': mark}).all():
+            version = 'x%d' % mark_now
+            if ri is not None:
+                changed[ri] = (owner, strength, v)
+    else:
+        version = _territory_map_version()
+        q = db.session.query(
+            TerritoryRegionState.region_index, TerritoryRegionState.owner_clan_id,
+            TerritoryRegionState.strength, TerritoryRegionState.version,
+        )
+        if since.isdigit() and int(since) <= version:
+            q = q.filter(TerritoryRegionState.version > int(since))
+        changed = {ri: (owner, strength, v) for ri, owner, strength, v in q.all()}
+    return version, {
+        ri: {'owner_clan_id': owner, 'strength': int(strength or 0), 'version': int(v or 0)}
+        for ri, (owner, strength, v) in sorted(changed.items())
+    }
+
+
+def _territory_payload_hash(payload):
+    return hashlib.sha1(json.dumps(payload, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+@app.route('/api/territory/map-state')
+def api_territory_map_state():
+    """Состояние областей карты для обновления без перезагрузки страницы (опрос раз в 1–2 с во время битвы).
+
+    ?since=<version> — только области, изменённые после этой версии карты (владелец, сила, сооружение);
+    без since — все. ?buffs=<buffs_version> — баффы областей (region_buffs) приходят, только если
+    они изменились. Ответ с ETag: при If-None-Match с тем же значением — 304 без тела.
+    """
+    since = request.args.get('since')
+    version, regions = _territory_map_changes(since)
+    if regions:
+        structures = TerritoryRegionStructure.query.filter(
+            TerritoryRegionStructure.region_index.in_(list(regions))
+        ).all()
+        by_index = {st.region_index: st for st in structures}
+        for ri, data in regions.items():
+            st = by_index.get(ri)
+            data['structure_type'] = st.structure_type if st else None
+            data['last_payout_at'] = st.last_payout_at.isoformat() if st and st.last_payout_at else None
+    region_indices = [ri for (ri,) in db.session.query(TerritoryRegionConfig.region_index).all()]
+    region_buffs = get_active_buffs_for_display_by_regions(region_indices)
+    buffs_version = _territory_payload_hash(region_buffs)
+    payload = {'success': True, 'version': version, 'regions': regions, 'buffs_version': buffs_version}
+    if request.args.get('buffs') != buffs_version:
+        payload['region_buffs'] = region_buffs
+    etag = _territory_payload_hash(payload)
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = jsonify(payload)
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
 @app.route('/api/territory/regions')
 def api_territory_regions():
     """Список областей для выбора (например, при использовании предмета «на область»)."""
@@ -7144,29 +8887,22 @@ def api_territory_regions():
     return jsonify([{'region_index': r.region_index, 'display_name': r.display_name or f'Область {r.region_index + 1}'} for r in regions])
 
 
-@app.route('/api/territory/demogorgons', methods=['GET'])
-def api_territory_demogorgons_state():
-    """Состояние армии Демогоргонов для отображения на карте."""
-    # Подстрахуемся: применим тик логики, даже если фонового планировщика нет
-    try:
-        _demogorgon_tick()
-    except Exception:
-        # Ошибку тикера здесь гасим, основное состояние всё равно покажем
-        db.session.rollback()
+# Снимок ответа /api/territory/demogorgons в памяти процесса:
+# ((army_id, version, created_at) или None, время сверки с БД, etag, тело JSON, (army_id, icon_url))
+_demogorgon_snapshot_cache = None
 
-    army = _get_active_demogorgon()
-    if not army or not army.is_active or army.health <= 0:
-        return jsonify({'active': False})
-    state = TerritoryRegionState.query.filter_by(region_index=army.region_index).first()
-    region_strength = int(state.strength or 0) if state else 0
-
-    # Иконка армии: сначала пробуем использовать изображение товара, которым она была призвана.
-    # Если привязки нет (старые записи) — ищем любой товар типа special/demogorgons и берём его иконку.
-    icon_url = None
+
+def _demogorgon_snapshot_invalidate():
+    """Сбросить снимок этого процесса (после изменения армии здесь же)."""
+    global _demogorgon_snapshot_cache
+    _demogorgon_snapshot_cache = None
+
+
+def _demogorgon_icon_url(army: DemogorgonArmy) -> str | None:
+    """Иконка армии: изображение товара, которым она призвана; для старых записей без привязки —
+    любой товар типа special/demogorgons."""
     try:
-        source_item = None
-        if getattr(army, 'shop_item', None):
-            source_item = army.shop_item
+        source_item = army.shop_item
         if not source_item:
             source_item = (
                 ShopItem.query.filter(
@@ -7178,37 +8914,92 @@ def api_territory_demogorgons_state():
         if source_item and source_item.image_filename:
             static_path = _avatar_static_filename(source_item.image_filename)
             if static_path:
-                icon_url = url_for('static', filename=static_path)
+                return url_for('static', filename=static_path)
     except Exception:
-        icon_url = None
-    # Топ кланов по урону (по желанию можно показать в UI)
-    top_rows = (
-        DemogorgonDamage.query.filter_by(army_id=army.id)
-        .order_by(DemogorgonDamage.total_damage.desc())
-        .limit(5)
-        .all()
+        pass
+    return None
+
+
+def _demogorgon_snapshot():
+    """(etag, тело JSON) ответа /api/territory/demogorgons.
+
+    Снимок пересобирается, только когда меняется (id, version, created_at) активной армии — армия сдвинулась,
+    получила урон или лечение, завершилась. Сверка с БД — один запрос по индексу не чаще раза
+    в DEMOGORGON_SNAPSHOT_CHECK_SECONDS; изменения в этом процессе сбрасывают снимок сразу.
+    Иконка считается один раз на армию, топ кланов берётся готовым из army.top_clans.
+    """
+    global _demogorgon_snapshot_cache
+    cached = _demogorgon_snapshot_cache
+    now = time.monotonic()
+    if cached is not None and now - cached[1] < DEMOGORGON_SNAPSHOT_CHECK_SECONDS:
+        return cached[2], cached[3]
+    row = (
+        db.session.query(DemogorgonArmy.id, DemogorgonArmy.version, DemogorgonArmy.created_at)
+        .filter(DemogorgonArmy.is_active == True, DemogorgonArmy.health > 0)
+        .first()
     )
-    top_clans = []
-    for row in top_rows:
-        clan = row.clan
-        if not clan:
-            continue
-        top_clans.append({
-            'clan_id': clan.id,
-            'name': clan.name,
-            'damage': row.total_damage,
-        })
-    return jsonify({
-        'active': True,
-        'region_index': army.region_index,
-        'pos_x': army.pos_x,
-        'pos_y': army.pos_y,
-        'health': army.health,
-        'max_health': army.max_health,
-        'region_strength': region_strength,
-        'icon_url': icon_url,
-        'top_clans': top_clans,
-    })
+    key = tuple(row) if row else None
+    if cached is not None and cached[0] == key:
+        _demogorgon_snapshot_cache = (key, now) + cached[2:]
+        return cached[2], cached[3]
+
+    army = db.session.get(DemogorgonArmy, key[0]) if key else None
+    icon = None
+    if army is None or not army.is_active or army.health <= 0:
+        key, payload = None, {'active': False}
+    else:
+        key = (army.id, army.version, army.created_at)
+        hot = _territory_hot_map()
+        if hot is not None:
+            region_strength = int((hot.region(army.region_index) or (None, 0))[1] or 0)
+        else:
+            state = TerritoryRegionState.query.filter_by(region_index=army.region_index).first()
+            region_strength = int(state.strength or 0) if state else 0
+        if cached is not None and cached[4] and cached[4][0] == army.id:
+            icon = cached[4]
+        else:
+            icon = (army.id, _demogorgon_icon_url(army))
+        top = _demogorgon_top_clans(army)
+        names = dict(
+            db.session.query(Clan.id, Clan.name).filter(Clan.id.in_([clan_id for clan_id, _ in top])).all()
+        ) if top else {}
+        payload = {
+            'active': True,
+            'army_id': army.id,
+            'region_index': army.region_index,
+            'pos_x': army.pos_x,
+            'pos_y': army.pos_y,
+            'health': army.health,
+            'max_health': army.max_health,
+            'region_strength': region_strength,
+            'icon_url': icon[1],
+            'top_clans': [
+                {'clan_id': clan_id, 'name': names[clan_id], 'damage': damage}
+                for clan_id, damage in top if clan_id in names
+            ],
+        }
+    body = app.json.dumps(payload)
+    etag = _territory_payload_hash(payload)
+    _demogorgon_snapshot_cache = (key, now, etag, body, icon)
+    return etag, body
+
+
+@app.route('/api/territory/demogorgons', methods=['GET'])
+def api_territory_demogorgons_state():
+    """Состояние армии Демогоргонов для отображения на карте.
+
+    Только чтение из снимка в памяти (_demogorgon_snapshot): армию двигает _demogorgon_tick
+    в экземпляре с планировщиком, урон — ответы игроков. Ответ с ETag (при совпадении
+    If-None-Match — 304) и кэшируется на один тик.
+    """
+    etag, body = _demogorgon_snapshot()
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag, weak=True)
+    resp.headers['Cache-Control'] = f'public, max-age={DEMOGORGON_DAMAGE_TICK_SECONDS}'
+    return resp
 
 
 @app.route('/api/territory/demogorgons/task', methods=['POST'])
@@ -7241,10 +9032,9 @@ def api_territory_demogorgons_task():
 
     # Берём задачу тем же способом, что и для дуэлей, чтобы корректно работали дроби и спец. форматы
     difficulty = _territory_difficulty_from_level(max(1, current_user.level or 1))
-    task, task_dict = _pvp_random_task(difficulty)
+    task, task_dict = _pvp_random_task(difficulty, 'demogorgon')
     if not task or not task_dict:
         return jsonify({'success': False, 'error': 'Нет доступных задач'}), 404
-    db.session.commit()
     return jsonify({'success': True, 'task': task_dict, 'current_energy': energy_after})
 
 
@@ -7264,13 +9054,21 @@ def api_territory_demogorgons_answer():
     answer = data.get('answer')
     if not task_id:
         return jsonify({'success': False, 'error': 'task_id required'}), 400
-    task = TerritoryTask.query.get(task_id)
+    task = _resolve_answer_task(task_id, ('demogorgon',))
     if not task:
         return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
     is_correct = _check_task_answer(task, answer)
     damage_done = 0
     reward_item = None
     attacker_damage = int(current_user.damage or 0)
+    # Удары по армии — по очереди: здоровье и топ кланов меняются от текущих значений
+    army = (
+        DemogorgonArmy.query.filter_by(id=army.id)
+        .populate_existing()
+        .with_for_update()
+        .first()
+    )
+    health_before = army.health
     if is_correct and army.is_active and army.health > 0:
         # 50% от урона атакующего — урон по армии
         damage_done = max(0, int(attacker_damage * 0.5))
@@ -7281,6 +9079,7 @@ def api_territory_demogorgons_answer():
                 row = DemogorgonDamage(army_id=army.id, clan_id=current_user.clan_id, total_damage=0)
                 db.session.add(row)
             row.total_damage = (row.total_damage or 0) + damage_done
+            _demogorgon_top_clans_hit(army, current_user.clan_id, row.total_damage)
             if random.random() < DEMOGORGON_DAMAGE_DROP_CHANCE:
                 drop_purchase = _award_pvp_style_random_shop_item_to_user(current_user)
                 if drop_purchase:
@@ -7306,7 +9105,11 @@ def api_territory_demogorgons_answer():
         from achievements import increment_counter, COUNTER_DEMOGORGON_HITS
         increment_counter(current_user.id, COUNTER_DEMOGORGON_HITS)
         newly = _check_achievements(current_user.id)
+    if army.health != health_before:
+        army.version = (army.version or 0) + 1
     db.session.commit()
+    _demogorgon_snapshot_invalidate()
+    _publish_event('demogorgon', 'state', _demogorgon_event_data(army))
     return jsonify({
         'success': True,
         'correct': is_correct,
@@ -7408,14 +9211,15 @@ def api_territory_battle_structure_build():
     config = TerritoryRegionConfig.query.filter_by(region_index=region_index).first()
     if not config or config.is_locked:
         return jsonify({'success': False, 'error': 'Область недоступна'}), 400
-    current_user.nums_balance = (current_user.nums_balance or 0) - cost
     now = datetime.now()
-    db.session.add(TerritoryRegionStructure(region_index=region_index, structure_type=structure_type, last_payout_at=now))
-    from achievements import increment_counter, COUNTER_STRUCTURES_BUILT, COUNTER_NUMS_SPENT
-    increment_counter(current_user.id, COUNTER_STRUCTURES_BUILT)
-    increment_counter(current_user.id, COUNTER_NUMS_SPENT, cost)
-    newly = _check_achievements(current_user.id)
-    db.session.commit()
+    with _territory_map_write():
+        current_user.nums_balance = (current_user.nums_balance or 0) - cost
+        db.session.add(TerritoryRegionStructure(region_index=region_index, structure_type=structure_type, last_payout_at=now))
+        from achievements import increment_counter, COUNTER_STRUCTURES_BUILT, COUNTER_NUMS_SPENT
+        increment_counter(current_user.id, COUNTER_STRUCTURES_BUILT)
+        increment_counter(current_user.id, COUNTER_NUMS_SPENT, cost)
+        newly = _check_achievements(current_user.id)
+        db.session.commit()
     return jsonify({
         'success': True,
         'region_index': region_index,
@@ -7444,7 +9248,8 @@ def api_territory_battle_structure_destroy():
     if not existing:
         return jsonify({'success': False, 'error': 'На области нет сооружения'}), 400
     db.session.delete(existing)
-    db.session.commit()
+    with _territory_map_write():
+        db.session.commit()
     return jsonify({'success': True, 'region_index': region_index})
 
 
@@ -7590,37 +9395,12 @@ def api_territory_clan_search_chat_list():
     limit = min(int(request.args.get('limit', 20)), 100)
     before_id = request.args.get('before_id', type=int)
     after_id = request.args.get('after_id', type=int)
-    base = ClanSearchChatMessage.query
-
-    if after_id:
-        messages = base.filter(ClanSearchChatMessage.id > after_id).order_by(ClanSearchChatMessage.id.asc()).all()
-        items = [
-            {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-             'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-            for m in messages
-        ]
+    items, has_more = _chat_list(
+        'clan-search', ClanSearchChatMessage, ClanSearchChatMessage.query, _chat_message_items, limit, before_id, after_id,
+    )
+    if has_more is None:
         return jsonify({'success': True, 'messages': items})
-    if before_id:
-        messages = base.filter(ClanSearchChatMessage.id < before_id).order_by(
-            ClanSearchChatMessage.id.desc()
-        ).limit(limit + 1).all()
-        has_more = len(messages) > limit
-        messages = list(reversed(messages[:limit]))
-        items = [
-            {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-             'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-            for m in messages
-        ]
-        return jsonify({'success': True, 'messages': items, 'has_more': has_more})
-    total = base.count()
-    messages = base.order_by(ClanSearchChatMessage.id.desc()).limit(limit).all()
-    messages = list(reversed(messages))
-    items = [
-        {'id': m.id, 'user_id': m.user_id, 'author_name': m.user.character_name or m.user.username,
-         'text': filter_chat_text(m.text), 'created_at': m.created_at.isoformat() if m.created_at else None}
-        for m in messages
-    ]
-    return jsonify({'success': True, 'messages': items, 'has_more': total > limit})
+    return jsonify({'success': True, 'messages': items, 'has_more': has_more})
 
 
 @app.route('/api/territory/clan-search/chat', methods=['POST'])
@@ -7633,7 +9413,6 @@ def api_territory_clan_search_chat_send():
         return jsonify({'success': False, 'error': 'Текст сообщения не может быть пустым'}), 400
     if len(text) > 100:
         return jsonify({'success': False, 'error': 'Сообщение не должно превышать 100 символов'}), 400
-    text = filter_chat_text(text)
     now = datetime.now()
     last = ClanSearchChatMessage.query.filter_by(user_id=current_user.id).order_by(
         ClanSearchChatMessage.created_at.desc()
@@ -7647,16 +9426,17 @@ def api_territory_clan_search_chat_send():
                 'error': 'Не чаще одного сообщения в 5 минут. Подождите {} сек.'.format(wait),
                 'wait_seconds': wait,
             }), 400
-    msg = ClanSearchChatMessage(user_id=current_user.id, text=text)
+    msg = ClanSearchChatMessage(user_id=current_user.id, text=text, **_chat_filtered_fields(text))
     db.session.add(msg)
     db.session.commit()
+    _chat_feed.touch('clan-search')
     return jsonify({
         'success': True,
         'message': {
             'id': msg.id,
             'user_id': msg.user_id,
             'author_name': current_user.character_name or current_user.username,
-            'text': msg.text,
+            'text': msg.text_filtered,
             'created_at': msg.created_at.isoformat() if msg.created_at else None,
         }
     })
@@ -7708,10 +9488,8 @@ def api_rating_user_profile(user_id):
     stats_row = UserTerritoryStats.query.filter_by(user_id=u.id).first()
     t_dmg = (stats_row.total_damage_dealt or 0) if stats_row else 0
     t_inf = (stats_row.total_influence_points or 0) if stats_row else 0
-    pvp_wins = db.session.query(func.count(PvPDuel.id)).filter(
-        PvPDuel.status == 'finished',
-        PvPDuel.winner_id == u.id,
-    ).scalar() or 0
+    pvp_row = pvp_stats.get(u.id)
+    pvp_wins = pvp_row.wins if pvp_row else 0
 
     clan_payload = None
     if u.clan_id:
@@ -7725,11 +9503,9 @@ def api_rating_user_profile(user_id):
 
     avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
     try:
-        bonuses = _get_equipment_bonuses(u.id)
+        bonuses = get_combat_snapshot(u.id).equipment
     except Exception:
         bonuses = {}
-    if not isinstance(bonuses, dict):
-        bonuses = {}
 
     achievements_unlocked = UserAchievement.query.filter_by(user_id=u.id).count()
 
@@ -7779,168 +9555,122 @@ def api_rating_user_profile(user_id):
     })
 
 
+def _rating_page_window(board, page):
+    """(состояние доски, номер страницы, всего страниц, строки доски на странице)."""
+    state = leaderboards.board_state(board, max_age_seconds=RATING_STALE_SECONDS)
+    total_items = int(state.total or 0) if state else 0
+    total_pages = max(1, (total_items + RATING_PAGE_SIZE - 1) // RATING_PAGE_SIZE)
+    page = min(page, total_pages)
+    entries = leaderboards.page_entries(board, (page - 1) * RATING_PAGE_SIZE, RATING_PAGE_SIZE)
+    return state, page, total_pages, entries
+
+
+def _rating_my_place(board, entity_id):
+    """Место текущего игрока (или его клана) на доске: {rank, page} или None."""
+    entry = leaderboards.rank_of(board, entity_id)
+    if entry is None:
+        return None
+    return {'rank': entry.rank, 'page': (entry.rank - 1) // RATING_PAGE_SIZE + 1}
+
+
+def _rating_user_item(u, rank):
+    avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
+    return {
+        'rank': rank,
+        'id': u.id,
+        'character_name': u.character_name or u.username,
+        'level': u.level or 1,
+        'avatar_url': avatar_url,
+        'clan_rank': u.clan_rank,
+        'clan_title': u.clan_title,
+    }
+
+
 @app.route('/game-rating')
 def game_rating_page():
-    """Рейтинг: выбор вкладки (топ кланов / топ PvE / топ PvP) с пагинацией по 20 записей."""
+    """Рейтинг: выбор вкладки (топ кланов / топ PvE / топ PvP) с пагинацией по 20 записей.
+    Места берутся из готовых досок leaderboard_entry (leaderboards.py)."""
     tab = request.args.get('tab', 'clans')
     if tab not in ('clans', 'pve', 'pvp'):
         tab = 'clans'
     page = max(1, request.args.get('page', 1, type=int))
+    state, page, total_pages, entries = _rating_page_window(tab, page)
+    total_items = int(state.total or 0) if state else 0
+    rating_updated_at = (state.checked_at or state.refreshed_at) if state else None
+    my_place = None
 
     if tab == 'clans':
-        # Все кланы: территория (убыв.), при равенстве — сумма урона+защиты участников (убыв.)
-        all_clans_territory = db.session.query(
-            Clan.id,
-            func.coalesce(func.count(TerritoryRegionState.region_index), 0).label('territory_count')
-        ).outerjoin(TerritoryRegionState, Clan.id == TerritoryRegionState.owner_clan_id).group_by(Clan.id).all()
-
-        score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(UserTerritoryStats.total_influence_points, 0)
-        clan_scores_rows = db.session.query(
-            User.clan_id,
-            func.coalesce(func.sum(score_expr), 0).label('clan_score')
-        ).outerjoin(UserTerritoryStats, User.id == UserTerritoryStats.user_id).filter(
-            User.clan_id.isnot(None)
-        ).group_by(User.clan_id).all()
-        clan_score_by_id = {row[0]: int(row[1] or 0) for row in clan_scores_rows}
-
-        sorted_clans = sorted(
-            all_clans_territory,
-            key=lambda r: (r[1], clan_score_by_id.get(r[0], 0)),
-            reverse=True
-        )
-        total_items = len(sorted_clans)
-        total_pages = max(1, (total_items + RATING_PAGE_SIZE - 1) // RATING_PAGE_SIZE)
-        page = min(page, total_pages)
-        start = (page - 1) * RATING_PAGE_SIZE
-        page_clans = sorted_clans[start:start + RATING_PAGE_SIZE]
-        clan_ids = [r[0] for r in page_clans]
-
+        # Кланы: территория (убыв.), при равенстве — сумма урона+защиты участников (убыв.)
+        clan_ids = [e.entity_id for e in entries]
         clans = Clan.query.filter(Clan.id.in_(clan_ids)).all() if clan_ids else []
         clan_by_id = {c.id: c for c in clans}
 
-        score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(UserTerritoryStats.total_influence_points, 0)
-        all_members = db.session.query(User, UserTerritoryStats).outerjoin(
-            UserTerritoryStats, User.id == UserTerritoryStats.user_id
-        ).filter(User.clan_id.in_(clan_ids)).order_by(User.clan_id, score_expr.desc()).all() if clan_ids else []
-
+        # Топ-10 участников каждого клана страницы — ROW_NUMBER по клану, без загрузки всех участников
         top_per_clan = {}
-        for u, stats in all_members:
-            cid = u.clan_id
-            if cid not in top_per_clan:
-                top_per_clan[cid] = []
-            if len(top_per_clan[cid]) < 10:
-                top_per_clan[cid].append((u, stats))
+        if clan_ids:
+            score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(UserTerritoryStats.total_influence_points, 0)
+            member_rank = func.row_number().over(
+                partition_by=User.clan_id, order_by=(score_expr.desc(), User.id.asc())
+            ).label('member_rank')
+            ranked = db.session.query(User.id.label('user_id'), member_rank).outerjoin(
+                UserTerritoryStats, User.id == UserTerritoryStats.user_id
+            ).filter(User.clan_id.in_(clan_ids)).subquery()
+            rows = db.session.query(User, ranked.c.member_rank).join(
+                ranked, User.id == ranked.c.user_id
+            ).filter(ranked.c.member_rank <= 10).order_by(User.clan_id, ranked.c.member_rank).all()
+            for u, _ in rows:
+                top_per_clan.setdefault(u.clan_id, []).append(u)
 
         clans_data = []
-        for clan_id, territory_count in page_clans:
-            clan = clan_by_id.get(clan_id)
+        for entry in entries:
+            clan = clan_by_id.get(entry.entity_id)
             if not clan:
                 continue
             flag_url = url_for('static', filename=_avatar_static_filename(clan.flag_filename)) if clan.flag_filename else None
-            members_data = []
-            for u, stats in top_per_clan.get(clan_id, []):
-                avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
-                dmg = (stats.total_damage_dealt or 0) if stats else 0
-                inf = (stats.total_influence_points or 0) if stats else 0
-                members_data.append({
-                    'id': u.id,
-                    'character_name': u.character_name or u.username,
-                    'level': u.level or 1,
-                    'avatar_url': avatar_url,
-                    'total_damage_dealt': dmg,
-                    'total_influence_points': inf,
-                })
             clans_data.append({
                 'id': clan.id,
                 'name': clan.name,
                 'flag_url': flag_url,
-                'territory_count': territory_count,
-                'members': members_data,
-            })
-
-        return render_template(
-            'game_rating.html',
-            tab=tab,
-            clans_data=clans_data,
-            page=page,
-            total_pages=total_pages,
-            total_items=total_items,
-            pve_items=None,
-            pvp_items=None,
-        )
-
-    if tab == 'pve':
-        # Все пользователи по (total_damage_dealt + total_influence_points) убыв.
-        score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(UserTerritoryStats.total_influence_points, 0)
-        q = db.session.query(User, UserTerritoryStats).outerjoin(
-            UserTerritoryStats, User.id == UserTerritoryStats.user_id
-        ).order_by(score_expr.desc())
-        total_items = q.count()
-        total_pages = max(1, (total_items + RATING_PAGE_SIZE - 1) // RATING_PAGE_SIZE)
-        page = min(page, total_pages)
-        offset = (page - 1) * RATING_PAGE_SIZE
-        rows = q.offset(offset).limit(RATING_PAGE_SIZE).all()
-
-        pve_items = []
-        for idx, (u, stats) in enumerate(rows):
-            dmg = (stats.total_damage_dealt or 0) if stats else 0
-            inf = (stats.total_influence_points or 0) if stats else 0
-            avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
-            pve_items.append({
-                'rank': offset + idx + 1,
-                'id': u.id,
-                'character_name': u.character_name or u.username,
-                'level': u.level or 1,
-                'avatar_url': avatar_url,
-                'total_damage_dealt': dmg,
-                'total_influence_points': inf,
-                'total_score': dmg + inf,
-                'clan_rank': u.clan_rank,
-                'clan_title': u.clan_title,
+                'territory_count': int(entry.score or 0),
+                'members': [_rating_user_item(u, None) for u in top_per_clan.get(clan.id, [])],
             })
+        if current_user.is_authenticated and current_user.clan_id:
+            my_place = _rating_my_place(tab, current_user.clan_id)
 
         return render_template(
             'game_rating.html',
             tab=tab,
-            clans_data=[],
+            clans_data=clans_data,
             page=page,
             total_pages=total_pages,
             total_items=total_items,
-            pve_items=pve_items,
+            pve_items=None,
             pvp_items=None,
+            my_place=my_place,
+            rating_updated_at=rating_updated_at,
         )
 
-    # tab == 'pvp': по числу выигранных дуэлей
-    wins_subq = db.session.query(
-        PvPDuel.winner_id,
-        func.count(PvPDuel.id).label('wins')
-    ).filter(
-        PvPDuel.status == 'finished',
-        PvPDuel.winner_id.isnot(None)
-    ).group_by(PvPDuel.winner_id).subquery()
-
-    q = db.session.query(User, func.coalesce(wins_subq.c.wins, 0).label('wins')).outerjoin(
-        wins_subq, User.id == wins_subq.c.winner_id
-    ).order_by(func.coalesce(wins_subq.c.wins, 0).desc(), User.id.asc())
-    total_items = q.count()
-    total_pages = max(1, (total_items + RATING_PAGE_SIZE - 1) // RATING_PAGE_SIZE)
-    page = min(page, total_pages)
-    offset = (page - 1) * RATING_PAGE_SIZE
-    rows = q.offset(offset).limit(RATING_PAGE_SIZE).all()
-
-    pvp_items = []
-    for idx, (u, wins) in enumerate(rows):
-        avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
-        pvp_items.append({
-            'rank': offset + idx + 1,
-            'id': u.id,
-            'character_name': u.character_name or u.username,
-            'level': u.level or 1,
-            'avatar_url': avatar_url,
-            'wins': int(wins or 0),
-            'clan_rank': u.clan_rank,
-            'clan_title': u.clan_title,
-        })
+    user_ids = [e.entity_id for e in entries]
+    users_by_id = {u.id: u for u in User.query.filter(User.id.in_(user_ids)).all()} if user_ids else {}
+    items = []
+    for entry in entries:
+        u = users_by_id.get(entry.entity_id)
+        if not u:
+            continue
+        item = _rating_user_item(u, entry.rank)
+        if tab == 'pve':
+            # Все пользователи по (total_damage_dealt + total_influence_points) убыв.
+            item.update({
+                'total_damage_dealt': int(entry.score2 or 0),
+                'total_influence_points': int(entry.score3 or 0),
+                'total_score': int(entry.score or 0),
+            })
+        else:
+            # По числу выигранных дуэлей
+            item['wins'] = int(entry.score or 0)
+        items.append(item)
+    if current_user.is_authenticated:
+        my_place = _rating_my_place(tab, current_user.id)
 
     return render_template(
         'game_rating.html',
@@ -7949,8 +9679,10 @@ def game_rating_page():
         page=page,
         total_pages=total_pages,
         total_items=total_items,
-        pve_items=None,
-        pvp_items=pvp_items,
+        pve_items=items if tab == 'pve' else None,
+        pvp_items=items if tab == 'pvp' else None,
+        my_place=my_place,
+        rating_updated_at=rating_updated_at,
     )
 
 
@@ -7960,125 +9692,11 @@ def territory_clans_top():
     return redirect(url_for('game_rating_page', tab='clans', page=1))
 
 
-def _normalize_answer(s):
-    return re.sub(r'\s+', ' ', str(s).strip().lower()) if s else ''
-
-
-def _answers_equal(user_answer, correct_answer):
-    """Сравнение ответов: строки и числовые (в т.ч. десятичные с . или ,)."""
-    u = _normalize_answer(user_answer)
-    c = _normalize_answer(correct_answer)
-    if u == c:
-        return True
-    try:
-        u_n = float(u.replace(',', '.'))
-        c_n = float(c.replace(',', '.'))
-        return abs(u_n - c_n) < 1e-9
-    except (ValueError, TypeError):
-        return False
-
-
 def _check_task_answer(task, answer):
-    """Проверка ответа на задачу (та же логика, что в битве за территорию). Возвращает bool."""
-    if task.title == 'Основное свойство дроби' and task.correct_answer and '|' in task.correct_answer:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(correct_parts) >= 3:
-                correct_num, correct_den = correct_parts[1], correct_parts[2]
-            elif len(correct_parts) == 2:
-                correct_num, correct_den = correct_parts[0], correct_parts[1]
-            else:
-                correct_num, correct_den = '', ''
-            if len(user_parts) >= 3:
-                user_num, user_den = user_parts[1], user_parts[2]
-            elif len(user_parts) == 2:
-                user_num, user_den = user_parts[0], user_parts[1]
-            else:
-                user_num, user_den = '', ''
-            try:
-                u_n, u_d = int(user_num or 0), int(user_den or 0)
-                c_n, c_d = int(correct_num or 0), int(correct_den or 0)
-                return u_d > 0 and c_d > 0 and u_n == c_n and u_d == c_d
-            except (ValueError, TypeError):
-                return user_num == correct_num and user_den == correct_den
-        except Exception:
-            return False
-    if task.title == 'Общий знаменатель' and task.correct_answer and task.correct_answer.count('|') >= 3:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(correct_parts) >= 4 and len(user_parts) >= 4:
-                try:
-                    return (
-                        int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                        and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                        and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                        and int(user_parts[3] or 0) == int(correct_parts[3] or 0)
-                    )
-                except (ValueError, TypeError):
-                    return (
-                        user_parts[0] == correct_parts[0] and user_parts[1] == correct_parts[1]
-                        and user_parts[2] == correct_parts[2] and user_parts[3] == correct_parts[3]
-                    )
-            return False
-        except Exception:
-            return False
-    if (task.title in ('Сложение и вычитание дробей', 'Умножение и деление дробей', 'Смешанные числа') or
-            (task.correct_answer and task.correct_answer.count('|') == 2 and len(task.correct_answer.split('|')) == 3)):
-        if not task.correct_answer or task.correct_answer.count('|') < 2:
-            return _normalize_answer(answer) == _normalize_answer(task.correct_answer)
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            if len(correct_parts) < 3:
-                return _normalize_answer(answer) == _normalize_answer(task.correct_answer)
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(user_parts) == 2:
-                user_parts = ['0', user_parts[0], user_parts[1]]
-            if len(user_parts) >= 3:
-                try:
-                    return (
-                        int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                        and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                        and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                    )
-                except (ValueError, TypeError, IndexError):
-                    return False
-            return False
-        except Exception:
-            return False
-    if task.title == 'Правильные/неправильные дроби' and task.correct_answer and '|' in task.correct_answer:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(correct_parts) == 3:
-                try:
-                    return (
-                        int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                        and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                        and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                    )
-                except (ValueError, TypeError, IndexError):
-                    return False
-            elif len(correct_parts) == 2:
-                if len(user_parts) >= 3:
-                    user_num, user_den = user_parts[1], user_parts[2]
-                elif len(user_parts) == 2:
-                    user_num, user_den = user_parts[0], user_parts[1]
-                else:
-                    user_num, user_den = '', ''
-                try:
-                    return (
-                        int(user_num or 0) == int(correct_parts[0] or 0)
-                        and int(user_den or 0) == int(correct_parts[1] or 0)
-                        and int(user_den or 0) > 0
-                    )
-                except (ValueError, TypeError):
-                    return False
-            return False
-        except Exception:
-            return False
-    return _answers_equal(answer, task.correct_answer)
+    """Проверка ответа на задачу (битва за территорию, PvP, Демогоргоны). Возвращает bool.
+    Токен задачи несёт уже разобранный эталон (answer_key); для строки territory_task он разбирается здесь."""
+    key = getattr(task, 'answer_key', None) or compile_answer_key(task.title, task.correct_answer)
+    return check_answer(key, answer)
 
 
 def _territory_difficulty_from_level(level: int) -> int:
@@ -8117,6 +9735,59 @@ TERRITORY_GENERATOR_BY_NAME = {
 }
 
 
+# Сгенерированные задачи не пишутся в territory_task: ответ и опыт едут к клиенту в подписанном токене
+task_tokens = TaskTokenCodec(
+    app.config['SECRET_KEY'],
+    ttl_seconds=int(os.getenv('TASK_TOKEN_TTL_SECONDS', '7200')),
+)
+
+
+def _issue_task(title, text, correct_answer, xp_reward, scope, gen_task=None, image_url=None):
+    """Выпустить токен задачи для текущего игрока. Возвращает (IssuedTask, dict для клиента).
+    gen_task — словарь генератора: из него переносятся поля отображения (дроби, подсказки)."""
+    task = task_tokens.issue(
+        title, correct_answer, xp_reward, current_user.id, scope,
+        answer_key=compile_answer_key(title, correct_answer),
+    )
+    d = _territory_task_public_dict(task.id, task.title, text, task.correct_answer, task.xp_reward, image_url=image_url)
+    t = gen_task or {}
+    if t.get('answer_type'):
+        d['answer_type'] = t['answer_type']
+    if t.get('display_frac1'):
+        d['display_frac1'] = t['display_frac1']
+    if t.get('display_frac2'):
+        d['display_frac2'] = t['display_frac2']
+    if t.get('display_frac'):
+        d['display_frac'] = t['display_frac']
+    if t.get('display_operator') is not None:
+        d['display_operator'] = t['display_operator']
+    if 'int_part_zero' in t:
+        d['int_part_zero'] = t['int_part_zero']
+    if t.get('multi_frac_expression'):
+        d['multi_frac_expression'] = True
+    if t.get('answer_hint'):
+        d['answer_hint'] = t['answer_hint']
+    if t.get('display_kind'):
+        d['display_kind'] = t['display_kind']
+    return task, d
+
+
+def _resolve_answer_task(task_id, scopes):
+    """Задача по task_id из запроса ответа: токен проверяется без БД (игрок и scope должны совпасть).
+    Числовой id — задача, выданная до перехода на токены (строка territory_task)."""
+    if is_task_token(task_id):
+        return task_tokens.verify(task_id, current_user.id, scopes)
+    try:
+        return TerritoryTask.query.get(int(task_id))
+    except (TypeError, ValueError):
+        return None
+
+
+def _territory_task_scope(region_index):
+    """scope токена задачи битвы за территорию: задача действует только в той области, где выдана."""
+    return 'territory' if region_index is None else f'territory:{region_index}'
+
+
 def _user_current_energy_cached(user):
     """Текущая энергия пользователя без повторного вызова ensure_energy_refill (вызывать после одного refill)."""
     return max(0, user.current_energy if user.current_energy is not None else user.energy)
@@ -8157,33 +9828,14 @@ def api_territory_task():
                     try:
                         gen_task = gen_fn(difficulty)
                         if gen_task:
-                            task = TerritoryTask(
-                                title=gen_task.get('title', 'Задача'),
-                                text=gen_task.get('description', ''),
-                                correct_answer=gen_task.get('correct_answer', ''),
-                                xp_reward=gen_task.get('points', 20)
+                            task, task_dict = _issue_task(
+                                gen_task.get('title', 'Задача'),
+                                gen_task.get('description', ''),
+                                gen_task.get('correct_answer', ''),
+                                gen_task.get('points', 20),
+                                _territory_task_scope(region_index),
+                                gen_task=gen_task,
                             )
-                            db.session.add(task)
-                            db.session.commit()
-                            task_dict = task.to_dict_public()
-                            if gen_task.get('answer_type'):
-                                task_dict['answer_type'] = gen_task['answer_type']
-                            if gen_task.get('display_frac1'):
-                                task_dict['display_frac1'] = gen_task['display_frac1']
-                            if gen_task.get('display_frac2'):
-                                task_dict['display_frac2'] = gen_task['display_frac2']
-                            if gen_task.get('display_frac'):
-                                task_dict['display_frac'] = gen_task['display_frac']
-                            if gen_task.get('display_operator') is not None:
-                                task_dict['display_operator'] = gen_task['display_operator']
-                            if 'int_part_zero' in gen_task:
-                                task_dict['int_part_zero'] = gen_task['int_part_zero']
-                            if gen_task.get('multi_frac_expression'):
-                                task_dict['multi_frac_expression'] = True
-                            if gen_task.get('answer_hint'):
-                                task_dict['answer_hint'] = gen_task['answer_hint']
-                            if gen_task.get('display_kind'):
-                                task_dict['display_kind'] = gen_task['display_kind']
                             return jsonify({
                                 'success': True,
                                 'task': task_dict,
@@ -8193,11 +9845,9 @@ def api_territory_task():
                         logger.exception('Ошибка генерации задачи для области %s (генератор %s): %s',
                                          region_index, gen.name, e)
     # Иначе — используем тот же механизм генерации, что и для PvP-дуэлей
-    task, task_dict = _pvp_random_task(difficulty)
+    task, task_dict = _pvp_random_task(difficulty, _territory_task_scope(region_index))
     if not task or not task_dict:
         return jsonify({'success': False, 'error': 'Нет доступных задач'}), 404
-    # _pvp_random_task делает flush, здесь фиксируем сохранение задачи вместе с уже списанной энергией
-    db.session.commit()
     return jsonify({
         'success': True,
         'task': task_dict,
@@ -8227,144 +9877,47 @@ def api_territory_apply_action():
         return jsonify({'success': False, 'error': 'Для участия в битве нужен клан'}), 400
     current_user.ensure_energy_refill()
     current_energy = _user_current_energy_cached(current_user)
-    stats = current_user.get_territory_stats()
-    task = TerritoryTask.query.get(task_id)
+    current_user.get_territory_stats()  # строка статистики нужна _territory_capture_apply
+    task = _resolve_answer_task(task_id, ('territory', _territory_task_scope(region_index)))
     if not task:
         return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
-    # Ответ-дробь: только числитель и знаменатель (num|den); в БД может быть старый формат int|num|den
-    if task.title == 'Основное свойство дроби' and task.correct_answer and '|' in task.correct_answer:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            # Из эталона: старый формат "0|6|7" -> числитель и знаменатель (индексы 1 и 2)
-            if len(correct_parts) >= 3:
-                correct_num, correct_den = correct_parts[1], correct_parts[2]
-            elif len(correct_parts) == 2:
-                correct_num, correct_den = correct_parts[0], correct_parts[1]
-            else:
-                correct_num, correct_den = '', ''
-            # Ответ пользователя: только числитель и знаменатель (два поля)
-            if len(user_parts) >= 3:
-                user_num, user_den = user_parts[1], user_parts[2]
-            elif len(user_parts) == 2:
-                user_num, user_den = user_parts[0], user_parts[1]
-            else:
-                user_num, user_den = '', ''
-            # Сравниваем как числа (чтобы "6" и "06" засчитывались)
-            try:
-                u_n, u_d = int(user_num or 0), int(user_den or 0)
-                c_n, c_d = int(correct_num or 0), int(correct_den or 0)
-                correct = (u_d > 0 and c_d > 0 and u_n == c_n and u_d == c_d)
-            except (ValueError, TypeError):
-                correct = (user_num == correct_num and user_den == correct_den)
-        except Exception:
-            correct = False
-    elif task.title == 'Общий знаменатель' and task.correct_answer and task.correct_answer.count('|') >= 3:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(correct_parts) >= 4 and len(user_parts) >= 4:
-                try:
-                    correct = (
-                        int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                        and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                        and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                        and int(user_parts[3] or 0) == int(correct_parts[3] or 0)
-                    )
-                except (ValueError, TypeError):
-                    correct = (
-                        user_parts[0] == correct_parts[0] and user_parts[1] == correct_parts[1]
-                        and user_parts[2] == correct_parts[2] and user_parts[3] == correct_parts[3]
-                    )
-            else:
-                correct = False
-        except Exception:
-            correct = False
-    elif (task.title in ('Сложение и вычитание дробей', 'Умножение и деление дробей', 'Смешанные числа') or
-          (task.correct_answer and task.correct_answer.count('|') == 2 and len(task.correct_answer.split('|')) == 3)):
-        if not task.correct_answer or task.correct_answer.count('|') < 2:
-            correct = _normalize_answer(answer) == _normalize_answer(task.correct_answer)
-        else:
-            try:
-                correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-                user_parts = [p.strip() for p in (answer or '').split('|')]
-                if len(correct_parts) >= 3:
-                    if len(user_parts) == 2:
-                        user_parts = ['0', user_parts[0], user_parts[1]]
-                    if len(user_parts) >= 3:
-                        try:
-                            correct = (
-                                int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                                and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                                and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                            )
-                        except (ValueError, TypeError, IndexError):
-                            correct = False
-                    else:
-                        correct = False
-                else:
-                    correct = _normalize_answer(answer) == _normalize_answer(task.correct_answer)
-            except Exception:
-                correct = False
-    elif task.title == 'Правильные/неправильные дроби' and task.correct_answer and '|' in task.correct_answer:
-        try:
-            correct_parts = [p.strip() for p in task.correct_answer.split('|')]
-            user_parts = [p.strip() for p in (answer or '').split('|')]
-            if len(correct_parts) == 3:
-                try:
-                    correct = (
-                        int(user_parts[0] or 0) == int(correct_parts[0] or 0)
-                        and int(user_parts[1] or 0) == int(correct_parts[1] or 0)
-                        and int(user_parts[2] or 0) == int(correct_parts[2] or 0)
-                    )
-                except (ValueError, TypeError, IndexError):
-                    correct = False
-            elif len(correct_parts) == 2:
-                if len(user_parts) >= 3:
-                    user_num, user_den = user_parts[1], user_parts[2]
-                elif len(user_parts) == 2:
-                    user_num, user_den = user_parts[0], user_parts[1]
-                else:
-                    user_num, user_den = '', ''
-                try:
-                    correct = (
-                        int(user_num or 0) == int(correct_parts[0] or 0)
-                        and int(user_den or 0) == int(correct_parts[1] or 0)
-                        and int(user_den or 0) > 0
-                    )
-                except (ValueError, TypeError):
-                    correct = False
-            else:
-                correct = False
-        except Exception:
-            correct = False
-    else:
-        correct = _answers_equal(answer, task.correct_answer)
+    correct = _check_task_answer(task, answer)
     clan_id = current_user.clan_id
-    cfg = TerritoryRegionConfig.query.filter_by(region_index=region_index).first()
-    if cfg and cfg.is_locked:
-        return jsonify({'success': False, 'error': 'Region is locked'}), 400
-    state = TerritoryRegionState.query.filter_by(region_index=region_index).first()
-    if not state:
-        state = TerritoryRegionState(region_index=region_index, owner_class_id=None, owner_clan_id=None, strength=0)
-        db.session.add(state)
+    # На экземпляре без горячей карты удар идёт атомарным UPDATE в БД; актор горячей карты
+    # не затрёт его (запись с проверкой версии) и перечитает область
+    hot = _territory_hot_map()
+    if hot is not None:
+        if hot.is_locked(region_index):
+            return jsonify({'success': False, 'error': 'Region is locked'}), 400
+        region = hot.region(region_index)
+        if region is None:
+            return jsonify({'success': False, 'error': 'Область не найдена'}), 404
+        owner_clan_id, strength = region
+        attack_struct_mult, defend_struct_mult = hot.structure_multipliers(region_index)
+    else:
+        cfg = TerritoryRegionConfig.query.filter_by(region_index=region_index).first()
+        if cfg and cfg.is_locked:
+            return jsonify({'success': False, 'error': 'Region is locked'}), 400
+        state = TerritoryRegionState.query.filter_by(region_index=region_index).first()
+        if not state:
+            state = TerritoryRegionState(region_index=region_index, owner_class_id=None, owner_clan_id=None, strength=0)
+            db.session.add(state)
+            db.session.flush()
+        owner_clan_id, strength = state.owner_clan_id, state.strength
+        attack_struct_mult, defend_struct_mult = _structure_combat_multipliers_for_region(region_index)
     # Энергия уже списана при открытии модалки с заданием (api_territory_task)
     # Урон при атаке (чужая/нейтральная область), защита при усилении своей
-    is_own_region = (state.owner_clan_id == clan_id)
-    base_power = current_user.defense if is_own_region else current_user.damage
+    is_own_region = (owner_clan_id == clan_id)
     mult = _get_multipliers_for_action(current_user.id, clan_id, region_index, is_attack=not is_own_region)
-    power_pct = mult['defense_pct'] if is_own_region else mult['damage_pct']
-    power = max(1, int(round(base_power * (1 + power_pct / 100.0))))
-    attack_struct_mult, defend_struct_mult = _structure_combat_multipliers_for_region(region_index)
-    if is_own_region:
-        power = max(1, int(round(power * defend_struct_mult)))
-    else:
-        power = max(1, int(round(power * attack_struct_mult)))
+    attack_power = max(1, int(round(current_user.damage * (1 + mult['damage_pct'] / 100.0))))
+    attack_power = max(1, int(round(attack_power * attack_struct_mult)))
+    defense_power = max(1, int(round(current_user.defense * (1 + mult['defense_pct'] / 100.0))))
+    defense_power = max(1, int(round(defense_power * defend_struct_mult)))
     if not correct:
         db.session.commit()
         return jsonify({
             'success': True, 'correct': False,
-            'owner_clan_id': state.owner_clan_id, 'strength': state.strength,
+            'owner_clan_id': owner_clan_id, 'strength': strength,
             'current_energy': current_energy
         })
     # Множители опыта и нумов от баффов
@@ -8380,48 +9933,46 @@ def api_territory_apply_action():
     # Начисляем Нумы за правильное решение (с разбросом по уровню)
     nums_gained = max(0, int(round(roll_nums_reward(current_user.level) * nums_mult)))
     current_user.nums_balance = (current_user.nums_balance or 0) + nums_gained
-    was_neutral = state.owner_clan_id is None
-    was_enemy = state.owner_clan_id is not None and state.owner_clan_id != clan_id
-    enemy_strength_before = state.strength if was_enemy else 0
-    captured_neutral = False
-    captured_enemy = False
-    if state.owner_clan_id is None:
-        state.owner_clan_id = clan_id
-        state.strength = min(TERRITORY_MAX_STRENGTH, state.strength + power)
-        stats.total_influence_points += power
-        captured_neutral = was_neutral
-    elif state.owner_clan_id == clan_id:
-        state.strength = min(TERRITORY_MAX_STRENGTH, state.strength + power)
-        stats.total_influence_points += power
-    else:
-        state.strength = max(0, state.strength - power)
-        stats.total_damage_dealt += power
-        if state.strength == 0:
-            captured_enemy = enemy_strength_before > 0
-            state.owner_clan_id = clan_id
-            state.strength = power
-            stats.total_influence_points += power
     _consume_one_shot_buffs(current_user.id, clan_id, region_index)
     from achievements import (
         increment_counter, set_counter_max,
         COUNTER_TERRITORY_CORRECT, COUNTER_NEUTRAL_CAPTURES, COUNTER_TERRITORY_CAPTURES,
+        COUNTER_TERRITORY_DAMAGE, COUNTER_TERRITORY_INFLUENCE,
         COUNTER_NUMS_EARNED, COUNTER_NUMS_BALANCE_MAX,
     )
     increment_counter(current_user.id, COUNTER_TERRITORY_CORRECT)
-    if captured_neutral:
-        increment_counter(current_user.id, COUNTER_NEUTRAL_CAPTURES)
-    if captured_enemy:
-        increment_counter(current_user.id, COUNTER_TERRITORY_CAPTURES)
     if nums_gained:
         increment_counter(current_user.id, COUNTER_NUMS_EARNED, nums_gained)
     set_counter_max(current_user.id, COUNTER_NUMS_BALANCE_MAX, current_user.nums_balance or 0)
+    if hot is None:
+        # Владелец мог смениться с момента чтения state — исход удара решает атомарный UPDATE
+        db.session.flush()
+        capture = _territory_capture_apply(region_index, clan_id, current_user.id, attack_power, defense_power)
+        if capture is None:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'Область не найдена'}), 404
+    else:
+        # Актор применяет удар сразу и без отката (карта в памяти, журнал, урон в статистике),
+        # поэтому отдаём его только после commit опыта, нумов и списания баффов.
+        # Владельца на момент удара определяет актор — он и выбирает силу
+        db.session.commit()
+        capture = hot.capture(region_index, clan_id, current_user.id, attack_power, defense_power)
+        if capture is None:
+            return jsonify({'success': False, 'error': 'Область не найдена'}), 404
+    increment_counter(current_user.id, COUNTER_TERRITORY_DAMAGE, capture['damage'])
+    increment_counter(current_user.id, COUNTER_TERRITORY_INFLUENCE, capture['influence'])
+    if capture['captured_neutral']:
+        increment_counter(current_user.id, COUNTER_NEUTRAL_CAPTURES)
+    if capture['captured_enemy']:
+        increment_counter(current_user.id, COUNTER_TERRITORY_CAPTURES)
     newly = _check_achievements(current_user.id)
     db.session.commit()
+    _publish_event('map', 'region', {'region_index': region_index})
     xp_needed = current_user.xp_needed_for_next_level
     xp_pct = round((current_user.xp_in_current_level / xp_needed * 100), 1) if xp_needed else 100
     return jsonify({
         'success': True, 'correct': True,
-        'owner_clan_id': state.owner_clan_id, 'strength': state.strength,
+        'owner_clan_id': capture['owner_clan_id'], 'strength': capture['strength'],
         'xp_gained': effective_xp, 'level': new_level, 'leveled_up': leveled_up,
         'nums_gained': nums_gained,
         'player_nums_balance': current_user.nums_balance or 0,
@@ -8443,6 +9994,12 @@ PVP_HEALTH_PER_LEVEL = 20
 PVP_REWARD_BASE_MULT = 50
 PVP_REWARD_SPREAD = 0.3
 PVP_DUEL_DURATION_MINUTES = 5
+# Присутствие на арене (arena_presence.py): last_seen_at пишется в БД не чаще раза в
+# PVP_ARENA_HEARTBEAT_SECONDS на игрока, список участников перечитывается раз в PVP_ARENA_ROSTER_SECONDS,
+# просроченные строки удаляются не чаще раза в PVP_ARENA_CLEANUP_SECONDS (в списке они и так не видны)
+PVP_ARENA_HEARTBEAT_SECONDS = 30
+PVP_ARENA_ROSTER_SECONDS = 2
+PVP_ARENA_CLEANUP_SECONDS = 60
 
 # Вероятности диапазонов цен для PvP-приза
 PVP_REWARD_PROB_LOW = 0.7    # до 500 включительно
@@ -8455,6 +10012,9 @@ DEMOGORGON_DAMAGE_DROP_CHANCE = 0.2
 
 _pvp_last_seen_column_ensured = False
 _pvp_wager_columns_ensured = False
+_pvp_arena_heartbeats = arena_presence.Heartbeats(PVP_ARENA_HEARTBEAT_SECONDS)
+_pvp_arena_roster = arena_presence.Roster(PVP_ARENA_ROSTER_SECONDS)
+_pvp_arena_cleaned_at = 0.0
 
 
 def _pvp_ensure_wager_columns():
@@ -8508,8 +10068,15 @@ def _pvp_arena_ensure_last_seen_column():
     _pvp_last_seen_column_ensured = True
 
 
-def _pvp_arena_cleanup_stale():
-    """Удалить присутствия на арене, у которых last_seen_at старше PVP_ARENA_INACTIVITY_MINUTES или не задан."""
+def _pvp_arena_cleanup_stale(force=False):
+    """Удалить присутствия на арене, у которых last_seen_at старше PVP_ARENA_INACTIVITY_MINUTES или не задан.
+    Не чаще раза в PVP_ARENA_CLEANUP_SECONDS (force — сейчас): список участников и проверки соперника
+    и так не считают просроченных присутствующими."""
+    global _pvp_arena_cleaned_at
+    now = time.monotonic()
+    if not force and now - _pvp_arena_cleaned_at < PVP_ARENA_CLEANUP_SECONDS:
+        return
+    _pvp_arena_cleaned_at = now
     _pvp_arena_ensure_last_seen_column()
     limit = datetime.now() - timedelta(minutes=PVP_ARENA_INACTIVITY_MINUTES)
     stale = PvPArenaPresence.query.filter(
@@ -8517,17 +10084,25 @@ def _pvp_arena_cleanup_stale():
     ).all()
     for p in stale:
         db.session.delete(p)
+        _pvp_arena_heartbeats.forget(p.user_id)
     if stale:
         db.session.commit()
+        _pvp_arena_roster.invalidate()
 
 
 def _pvp_arena_touch_presence():
-    """Обновить last_seen_at у текущего пользователя на арене. Возвращает presence или None."""
+    """Отметить активность текущего пользователя на арене. True, если он на арене.
+
+    last_seen_at пишется не чаще раза в PVP_ARENA_HEARTBEAT_SECONDS: между записями строка
+    присутствия не читается (отметка _pvp_arena_heartbeats этого процесса)."""
+    if _pvp_arena_heartbeats.fresh(current_user.id):
+        return True
     presence = PvPArenaPresence.query.filter_by(user_id=current_user.id).first()
     if presence:
         presence.last_seen_at = datetime.now()
         db.session.commit()
-    return presence
+        _pvp_arena_heartbeats.seen(current_user.id)
+    return presence is not None
 
 
 def _pvp_arena_presence_valid(presence):
@@ -8551,6 +10126,8 @@ def pvp_arena_page():
     if presence and not on_arena:
         db.session.delete(presence)
         db.session.commit()
+        _pvp_arena_heartbeats.forget(current_user.id)
+        _pvp_arena_roster.invalidate()
         on_arena = False
     # Если пользователь в активной дуэли — перенаправить на страницу дуэли
     active_duel = PvPDuel.query.filter(
@@ -8577,7 +10154,8 @@ def pvp_arena_page():
 def api_pvp_enter():
     if (current_user.level or 1) < PVP_MIN_LEVEL:
         return jsonify({'success': False, 'error': f'Вход на арену доступен с {PVP_MIN_LEVEL} уровня'}), 403
-    _pvp_arena_cleanup_stale()
+    # Просроченное присутствие удаляется сразу: повторный вход после него — новое посещение арены
+    _pvp_arena_cleanup_stale(force=True)
     presence = PvPArenaPresence.query.filter_by(user_id=current_user.id).first()
     first_visit = False
     if not presence:
@@ -8591,6 +10169,10 @@ def api_pvp_enter():
         increment_counter(current_user.id, COUNTER_PVP_ARENA_VISITS)
     newly = _check_achievements(current_user.id)
     db.session.commit()
+    _pvp_arena_heartbeats.seen(current_user.id)
+    if first_visit:
+        _pvp_arena_roster.invalidate()
+        _publish_event('arena', 'participants')
     return jsonify({'success': True, 'newly_unlocked': newly})
 
 
@@ -8606,39 +10188,65 @@ def api_pvp_leave():
         PvPDuelChallenge.status == 'pending',
     ).delete(synchronize_session=False)
     db.session.commit()
+    _pvp_arena_heartbeats.forget(current_user.id)
+    _pvp_arena_roster.invalidate()
+    _publish_event('arena', 'participants')
+    _publish_event('arena', 'challenges')
     return jsonify({'success': True})
 
 
 @app.route('/api/pvp/participants')
 @login_required
 def api_pvp_participants():
-    """Список всех пользователей на арене. can_challenge — можно ли вызвать (диапазон уровней ±PVP_LEVEL_RANGE)."""
+    """Список всех пользователей на арене (по возрастанию уровня). can_challenge — можно ли вызвать (диапазон уровней ±PVP_LEVEL_RANGE)."""
     _pvp_arena_touch_presence()
     _pvp_arena_cleanup_stale()
-    presences = PvPArenaPresence.query.all()
+    roster = _pvp_arena_roster.get(_pvp_arena_roster_rows, _pvp_arena_card_signature, _pvp_arena_build_cards)
     my_level = current_user.level or 1
-    low, high = my_level - PVP_LEVEL_RANGE, my_level + PVP_LEVEL_RANGE
-    participants = []
-    for p in presences:
-        if p.user_id == current_user.id:
-            continue
-        u = User.query.get(p.user_id)
-        if not u:
-            continue
-        lvl = u.level or 1
-        can_challenge = low <= lvl <= high
+    lo, hi = roster.band(my_level - PVP_LEVEL_RANGE, my_level + PVP_LEVEL_RANGE)
+    participants = [
+        dict(card, can_challenge=lo <= i < hi)
+        for i, card in enumerate(roster.cards)
+        if card['id'] != current_user.id
+    ]
+    return jsonify({'success': True, 'participants': participants})
+
+
+def _pvp_arena_roster_rows():
+    """Участники арены с непросроченным присутствием (одним запросом, без удаления просроченных)."""
+    _pvp_arena_ensure_last_seen_column()
+    limit = datetime.now() - timedelta(minutes=PVP_ARENA_INACTIVITY_MINUTES)
+    return (
+        User.query.join(PvPArenaPresence, PvPArenaPresence.user_id == User.id)
+        .filter(PvPArenaPresence.last_seen_at >= limit)
+        .all()
+    )
+
+
+def _pvp_arena_card_signature(u):
+    """От чего зависит карточка участника: урон и защита — от навыков и bonus_version."""
+    return (
+        u.username, u.character_name, u.level, u.avatar_filename,
+        u.damage_skill, u.defense_skill, u.bonus_version,
+    )
+
+
+def _pvp_arena_build_cards(users):
+    """Карточки участников арены: user_id -> dict (урон/защита по снимкам, собранным одним пакетом)."""
+    get_combat_snapshots([u.id for u in users])
+    cards = {}
+    for u in users:
         avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if getattr(u, 'avatar_filename', None) else None
-        participants.append({
+        cards[u.id] = {
             'id': u.id,
             'username': u.username,
             'character_name': u.character_name or u.username,
-            'level': lvl,
+            'level': u.level or 1,
             'damage': u.damage,
             'defense': u.defense,
             'avatar_url': avatar_url,
-            'can_challenge': can_challenge,
-        })
-    return jsonify({'success': True, 'participants': participants})
+        }
+    return cards
 
 
 @app.route('/api/pvp/chat', methods=['GET'])
@@ -8650,28 +10258,9 @@ def api_pvp_chat_get():
         return jsonify({'success': False, 'error': 'Вы не на арене'}), 403
     limit = min(100, request.args.get('limit', 20, type=int))
     before_id = request.args.get('before_id', type=int)
-    if before_id is not None:
-        messages = PvPArenaChatMessage.query.filter(PvPArenaChatMessage.id < before_id).order_by(PvPArenaChatMessage.id.desc()).limit(limit).all()
-        messages = list(reversed(messages))
-        has_more = len(messages) == limit
-    else:
-        messages = PvPArenaChatMessage.query.order_by(PvPArenaChatMessage.id.desc()).limit(limit).all()
-        messages = list(reversed(messages))
-        min_id = min((m.id for m in messages), default=None)
-        has_more = PvPArenaChatMessage.query.filter(PvPArenaChatMessage.id < min_id).first() is not None if min_id is not None else False
-    out = []
-    for m in messages:
-        u = User.query.get(m.user_id)
-        name = (u.character_name or u.username) if u else '?'
-        avatar_url = url_for('static', filename=_avatar_static_filename(u.avatar_filename)) if u and getattr(u, 'avatar_filename', None) else None
-        out.append({
-            'id': m.id,
-            'user_id': m.user_id,
-            'user_name': name,
-            'avatar_url': avatar_url,
-            'text': filter_chat_text(m.text),
-            'created_at': m.created_at.isoformat() if m.created_at else None,
-        })
+    out, has_more = _chat_list(
+        'arena', PvPArenaChatMessage, PvPArenaChatMessage.query, _pvp_chat_message_items, limit, before_id,
+    )
     return jsonify({'success': True, 'messages': out, 'has_more': has_more})
 
 
@@ -8685,10 +10274,11 @@ def api_pvp_chat_post():
     text = (data.get('text') or '').strip()
     if not text or len(text) > 2000:
         return jsonify({'success': False, 'error': 'Сообщение пустое или слишком длинное'}), 400
-    text = filter_chat_text(text)
-    msg = PvPArenaChatMessage(user_id=current_user.id, text=text)
+    msg = PvPArenaChatMessage(user_id=current_user.id, text=text, **_chat_filtered_fields(text))
     db.session.add(msg)
     db.session.commit()
+    _chat_feed.touch('arena')
+    _publish_event('arena', 'chat', {'id': msg.id})
     return jsonify({'success': True, 'id': msg.id})
 
 
@@ -8769,6 +10359,7 @@ def api_pvp_challenge():
     challenge = PvPDuelChallenge(challenger_id=current_user.id, defender_id=defender.id, status='pending', wager=wager)
     db.session.add(challenge)
     db.session.commit()
+    _publish_event('arena', 'challenges', {'user_ids': [defender.id]})
     return jsonify({'success': True, 'challenge_id': challenge.id})
 
 
@@ -8838,6 +10429,7 @@ def api_pvp_accept_challenge():
     )
     db.session.add(duel)
     db.session.commit()
+    _publish_event('arena', 'duel', {'user_ids': [ch.id, de.id], 'duel_id': duel.id})
     return jsonify({'success': True, 'duel_id': duel.id})
 
 
@@ -8868,6 +10460,7 @@ def api_pvp_decline_challenge():
         return jsonify({'success': False, 'error': 'Вызов не найден или уже обработан'}), 404
     challenge.status = 'declined'
     db.session.commit()
+    _publish_event('arena', 'challenges', {'user_ids': [challenge.challenger_id, challenge.defender_id]})
     return jsonify({'success': True})
 
 
@@ -8933,6 +10526,8 @@ def _award_pvp_style_random_shop_item_to_user(user):
     purchase = UserShopPurchase(user_id=user.id, shop_item_id=item.id)
     db.session.add(purchase)
     db.session.flush()
+    from achievements import sync_shop_purchases_counter
+    sync_shop_purchases_counter(user.id)
     return purchase
 
 
@@ -8963,6 +10558,18 @@ def _pvp_duel_award_random_item(duel):
     return purchase
 
 
+def _pvp_duel_record_finish(duel):
+    """Итоги дуэлей и счётчики достижений обоих участников завершённой дуэли (вызывать один раз при завершении)."""
+    pvp_stats.record_finish(duel)
+    from achievements import increment_counter, COUNTER_PVP_DUELS, COUNTER_PVP_WINS, COUNTER_PVP_WAGER_WINS
+    for uid in (duel.challenger_id, duel.defender_id):
+        increment_counter(uid, COUNTER_PVP_DUELS)
+    if duel.winner_id:
+        increment_counter(duel.winner_id, COUNTER_PVP_WINS)
+        if (duel.wager or 0) > 0:
+            increment_counter(duel.winner_id, COUNTER_PVP_WAGER_WINS)
+
+
 def _pvp_duel_check_time_limit(duel):
     """Если дуэль активна и время вышло (5 мин) — завершить по оставшемуся здоровью. Победитель тот, у кого больше HP; при равенстве — ничья."""
     if duel.status != 'active' or not duel.created_at:
@@ -8970,6 +10577,10 @@ def _pvp_duel_check_time_limit(duel):
     end_time = duel.created_at + timedelta(minutes=PVP_DUEL_DURATION_MINUTES)
     if datetime.now() <= end_time:
         return
+    # Завершает один запрос: остальные ждут блокировку строки и видят finished
+    db.session.refresh(duel, with_for_update=True)
+    if duel.status != 'active':
+        return
     if duel.challenger_health > duel.defender_health:
         duel.winner_id = duel.challenger_id
     elif duel.defender_health > duel.challenger_health:
@@ -8981,13 +10592,17 @@ def _pvp_duel_check_time_limit(duel):
     if duel.winner_id:
         _pvp_duel_award_random_item(duel)
     _pvp_duel_apply_stake_result(duel)
+    _pvp_duel_record_finish(duel)
+    for uid in (duel.challenger_id, duel.defender_id):
+        _check_achievements(uid)
     db.session.commit()
+    _publish_event(f'duel:{duel.id}', 'state')
 
 
 def _pvp_duel_damage(attacker, defender):
     """Урон в дуэли: max(5, атака атакующего − защита соперника * 0.2) + бонусы умений."""
     atk = attacker.damage
-    ab = _get_ability_bonuses(attacker.id)
+    ab = get_combat_snapshot(attacker.id).abilities
     pvp_pct = float(ab.get('pvp_damage_pct', 0) or 0)
     pvp_add = int(ab.get('pvp_damage_add', 0) or 0)
     atk = int(round(atk * (1 + pvp_pct / 100.0))) + pvp_add
@@ -8999,7 +10614,7 @@ def _pvp_duel_damage(attacker, defender):
 def _pvp_max_health(user):
     """Макс. HP в дуэли с учётом умений."""
     base = PVP_HEALTH_PER_LEVEL * (user.level or 1)
-    ab = _get_ability_bonuses(user.id)
+    ab = get_combat_snapshot(user.id).abilities
     return base + int(ab.get('pvp_hp_add', 0) or 0)
 
 
@@ -9094,8 +10709,9 @@ def api_pvp_duel_state(duel_id):
     })
 
 
-def _pvp_random_task(difficulty):
-    """Случайная задача для дуэли: случайный генератор или из БД."""
+def _pvp_random_task(difficulty, scope):
+    """Случайная задача для дуэли: случайный генератор или из БД (базовый набор territory_task).
+    Возвращает (IssuedTask, dict для клиента); scope — где токен задачи будет принят."""
     if TERRITORY_GENERATOR_BY_NAME:
         name = random.choice(list(TERRITORY_GENERATOR_BY_NAME.keys()))
         gen_fn = TERRITORY_GENERATOR_BY_NAME[name]
@@ -9103,40 +10719,23 @@ def _pvp_random_task(difficulty):
             try:
                 t = gen_fn(difficulty)
                 if t:
-                    task = TerritoryTask(
-                        title=t.get('title', 'Задача'),
-                        text=t.get('description', ''),
-                        correct_answer=t.get('correct_answer', ''),
-                        xp_reward=t.get('points', 20),
+                    return _issue_task(
+                        t.get('title', 'Задача'),
+                        t.get('description', ''),
+                        t.get('correct_answer', ''),
+                        t.get('points', 20),
+                        scope,
+                        gen_task=t,
                     )
-                    db.session.add(task)
-                    db.session.flush()
-                    d = task.to_dict_public()
-                    if t.get('answer_type'):
-                        d['answer_type'] = t['answer_type']
-                    if t.get('display_frac1'):
-                        d['display_frac1'] = t['display_frac1']
-                    if t.get('display_frac2'):
-                        d['display_frac2'] = t['display_frac2']
-                    if t.get('display_frac'):
-                        d['display_frac'] = t['display_frac']
-                    if t.get('display_operator') is not None:
-                        d['display_operator'] = t['display_operator']
-                    if 'int_part_zero' in t:
-                        d['int_part_zero'] = t['int_part_zero']
-                    if t.get('multi_frac_expression'):
-                        d['multi_frac_expression'] = True
-                    if t.get('answer_hint'):
-                        d['answer_hint'] = t['answer_hint']
-                    if t.get('display_kind'):
-                        d['display_kind'] = t['display_kind']
-                    return task, d
             except Exception as e:
                 logger.exception('PvP task gen error: %s', e)
-    task = TerritoryTask.query.order_by(db.func.random()).first()
-    if not task:
+    row = TerritoryTask.query.order_by(db.func.random()).first()
+    if not row:
         return None, None
-    return task, task.to_dict_public()
+    return _issue_task(
+        row.title, row.text, row.correct_answer, row.xp_reward, scope,
+        image_url=url_for('static', filename=row.image_filename) if row.image_filename else None,
+    )
 
 
 @app.route('/api/pvp/duel/<int:duel_id>/task')
@@ -9150,7 +10749,7 @@ def api_pvp_duel_task(duel_id):
         return jsonify({'success': False, 'error': 'Дуэль завершена'}), 400
     avg_level = ((duel.challenger.level or 1) + (duel.defender.level or 1)) // 2
     difficulty = _territory_difficulty_from_level(max(1, avg_level))
-    task, task_dict = _pvp_random_task(difficulty)
+    task, task_dict = _pvp_random_task(difficulty, f'duel:{duel.id}')
     if not task or not task_dict:
         return jsonify({'success': False, 'error': 'Нет доступных задач'}), 404
     db.session.commit()
@@ -9160,7 +10759,8 @@ def api_pvp_duel_task(duel_id):
 @app.route('/api/pvp/duel/<int:duel_id>/answer', methods=['POST'])
 @login_required
 def api_pvp_duel_answer(duel_id):
-    duel = PvPDuel.query.get(duel_id)
+    # Строка дуэли блокируется: ответы соперников и завершение идут по очереди, итоги считаются один раз
+    duel = PvPDuel.query.filter_by(id=duel_id).populate_existing().with_for_update().first()
     if not duel or current_user.id not in (duel.challenger_id, duel.defender_id):
         return jsonify({'success': False, 'error': 'Дуэль не найдена'}), 404
     _pvp_duel_check_time_limit(duel)
@@ -9171,7 +10771,7 @@ def api_pvp_duel_answer(duel_id):
     answer = data.get('answer')
     if task_id is None:
         return jsonify({'success': False, 'error': 'task_id обязателен'}), 400
-    task = TerritoryTask.query.get(task_id)
+    task = _resolve_answer_task(task_id, (f'duel:{duel.id}',))
     if not task:
         return jsonify({'success': False, 'error': 'Задача не найдена'}), 404
     correct = _check_task_answer(task, answer)
@@ -9194,6 +10794,7 @@ def api_pvp_duel_answer(duel_id):
             if duel.winner_id:
                 _pvp_duel_award_random_item(duel)
             _pvp_duel_apply_stake_result(duel)
+            _pvp_duel_record_finish(duel)
     newly_me = []
     if duel.status == 'finished':
         for uid in (duel.challenger_id, duel.defender_id):
@@ -9201,6 +10802,8 @@ def api_pvp_duel_answer(duel_id):
             if uid == current_user.id:
                 newly_me = u_new
     db.session.commit()
+    if correct:
+        _publish_event(f'duel:{duel.id}', 'state')
     me_is_challenger = current_user.id == duel.challenger_id
     return jsonify({
         'success': True,
@@ -9241,7 +10844,7 @@ def _apply_surrender_penalty(user):
 @login_required
 def api_pvp_duel_surrender(duel_id):
     """Сдаться и выйти из дуэли. Игрок проигрывает, победителем становится соперник. За сдачу — штраф."""
-    duel = PvPDuel.query.get(duel_id)
+    duel = PvPDuel.query.filter_by(id=duel_id).populate_existing().with_for_update().first()
     if not duel or current_user.id not in (duel.challenger_id, duel.defender_id):
         return jsonify({'success': False, 'error': 'Дуэль не найдена'}), 404
     if duel.status != 'active':
@@ -9254,12 +10857,14 @@ def api_pvp_duel_surrender(duel_id):
     duel.finished_at = datetime.now()
     _pvp_duel_award_random_item(duel)
     _pvp_duel_apply_stake_result(duel)
+    _pvp_duel_record_finish(duel)
     newly_me = []
     for uid in (duel.challenger_id, duel.defender_id):
         u_new = _check_achievements(uid)
         if uid == current_user.id:
             newly_me = u_new
     db.session.commit()
+    _publish_event(f'duel:{duel.id}', 'state')
     return jsonify({'success': True, 'newly_unlocked': newly_me})
 
 
@@ -9268,48 +10873,85 @@ def api_pvp_duel_surrender(duel_id):
 def chest_test_page():
     return render_template('chest_test.html')
 
+# Раздача задач рейд-босса: перемешанная очередь нерешённых задач в памяти процесса (task_dispenser).
+# Решения других воркеров дочитываются при смене урона по боссу и не реже раза в BOSS_TASK_CHECK_SECONDS,
+# с запасом BOSS_TASK_REREAD решений ниже последнего известного (поздние commit меньших id).
+BOSS_TASK_CHECK_SECONDS = 5
+BOSS_TASK_REBUILD_SECONDS = 600
+BOSS_TASK_REREAD = 32
+_boss_task_dispenser = task_dispenser.TaskDispenser(
+    BOSS_TASK_CHECK_SECONDS, BOSS_TASK_REBUILD_SECONDS, reread=BOSS_TASK_REREAD,
+)
+
+
+def _boss_unsolved_task_ids(boss_id, recent):
+    """(id нерешённых задач босса, последние recent id правильных решений) — для сборки очереди."""
+    solved_exists = db.session.query(BossTaskSolution.id).filter(
+        BossTaskSolution.task_id == BossTask.id,
+        BossTaskSolution.is_correct == True
+    ).exists()
+    solution_ids = [
+        solution_id for (solution_id,) in
+        db.session.query(BossTaskSolution.id).filter(
+            BossTaskSolution.boss_id == boss_id,
+            BossTaskSolution.is_correct == True
+        ).order_by(BossTaskSolution.id.desc()).limit(recent).all()
+    ]
+    task_ids = [
+        task_id for (task_id,) in
+        db.session.query(BossTask.id).filter(BossTask.boss_id == boss_id).filter(~solved_exists).all()
+    ]
+    return task_ids, solution_ids
+
+
+def _boss_solved_task_ids_since(boss_id, solution_id):
+    """[(id решения, id задачи)] правильных решений с id > solution_id — дочитать чужие решения."""
+    return db.session.query(BossTaskSolution.id, BossTaskSolution.task_id).filter(
+        BossTaskSolution.boss_id == boss_id,
+        BossTaskSolution.is_correct == True,
+        BossTaskSolution.id > solution_id
+    ).all()
+
+
+def _boss_next_task(boss):
+    """Следующая нерешённая задача босса из очереди или None, если решены все."""
+    for _ in range(2):
+        task_id = _boss_task_dispenser.next(
+            boss.id,
+            boss.total_health,
+            boss.damage_dealt,
+            lambda recent: _boss_unsolved_task_ids(boss.id, recent),
+            lambda solution_id: _boss_solved_task_ids_since(boss.id, solution_id),
+        )
+        if task_id is None:
+            return None
+        task = db.session.get(BossTask, task_id)
+        if task is not None and task.boss_id == boss.id:
+            return task
+        # Задачу удалили в другом воркере — собрать очередь заново
+        _boss_task_dispenser.invalidate(boss.id)
+    return None
+
+
 # API для получения случайной доступной задачи босса
 @app.route('/api/raid-boss/task', methods=['GET'])
 def get_random_boss_task():
-    from sqlalchemy import func
     active_boss = Boss.query.filter_by(is_active=True).first()
     if not active_boss:
         return jsonify({'success': False, 'error': 'Нет активного босса'}), 404
     
-    # Получаем задачи, которые ещё не решены, ОДНИМ запросом (без N+1)
-    solved_exists = db.session.query(BossTaskSolution.id).filter(
-        BossTaskSolution.task_id == BossTask.id,
-        BossTaskSolution.is_correct == True
-    ).exists()
-    available_query = (
-        BossTask.query
-        .filter(BossTask.boss_id == active_boss.id)
-        .filter(~solved_exists)
-        .order_by(BossTask.id.asc())
-    )
-    
-    total_available = available_query.count()
-    if total_available <= 0:
-        return jsonify({
-            'success': True, 
-            'boss_defeated': True,
-            'message': 'Босс побежден! Все задачи решены.'
-        })
-    
-    # Выбираем случайную задачу (без загрузки всех задач в память)
-    offset = random.randrange(total_available)
-    random_task = available_query.offset(offset).limit(1).first()
+    # Очередь выдаёт задачи по кругу в случайном порядке: одновременные игроки получают разные задачи
+    random_task = _boss_next_task(active_boss)
     if not random_task:
-        # Редкий случай гонки/изменений: считаем, что задач больше нет
         return jsonify({
-            'success': True,
+            'success': True, 
             'boss_defeated': True,
             'message': 'Босс побежден! Все задачи решены.'
         })
 
     return jsonify({
         'success': True,
-        # Мы гарантировали, что задача не решена, поэтому не делаем лишний запрос в to_dict()
+        # Очередь содержит только нерешённые задачи, поэтому не делаем лишний запрос в to_dict()
         'task': random_task.to_dict(is_solved_override=False),
         'boss_defeated': False
     })
@@ -9335,7 +10977,10 @@ def save_boss_user():
         if user_id is not None and str(user_id).strip() != '':
             is_uid_valid, user_obj, uid_error = validate_user_id(user_id)
             if is_uid_valid and user_obj:
+                old_name = user_obj.name
                 user_obj.name = name
+                if old_name != name:
+                    boss_top.renamed(user_obj, old_name)
                 db.session.commit()
                 logger.info(f"Обновлено имя пользователя: user_id={user_obj.id}, name={name}")
                 return jsonify({
@@ -9445,7 +11090,12 @@ def submit_boss_task_answer():
                 is_correct=True
             )
             db.session.add(solution)
+            db.session.flush()
+            # Урон — в той же транзакции, после вставки: повторный ответ отсекается уникальным индексом раньше
+            boss_stats.record_solve(active_boss.id, task.points)
+            boss_top.record_solve(active_boss.id, validated_user, class_id, solution.solved_at)
             db.session.commit()
+            _boss_task_dispenser.solved(active_boss.id, task.id)
             logger.info(
                 f"Правильный ответ сохранен: task_id={task_id}, "
                 f"user_id={validated_user.id if validated_user else None}"
@@ -9520,28 +11170,26 @@ def get_boss_stats():
     
     if not boss:
         return jsonify({'success': False, 'error': 'Нет босса'}), 404
-    
-    # Получаем все классы
-    classes = Class.query.all()
+    # Опрашивается всеми классами рейда — ответ кэшируется, пока не изменились счётчики босса
+    version = (boss.total_health, boss.damage_dealt, boss.is_active, boss.name)
+    return jsonify(boss_stats.cached_stats(boss.id, version, lambda: _boss_stats_payload(boss)))
+
+
+def _boss_stats_payload(boss):
+    """Ответ /api/raid-boss/stats: здоровье босса и урон по классам."""
+    # Урон по классам — одной группировкой вместо запроса на класс
+    damage_by_class = boss_stats.class_damage(boss.id)
     class_damage = {}
-    
-    for class_obj in classes:
-        damage = db.session.query(db.func.sum(BossTask.points)).join(
-            BossTaskSolution, BossTaskSolution.task_id == BossTask.id
-        ).filter(
-            BossTaskSolution.boss_id == boss.id,
-            BossTaskSolution.class_id == class_obj.id,
-            BossTaskSolution.is_correct == True
-        ).scalar() or 0
-        class_damage[class_obj.id] = {
-            'class_name': class_obj.name,
-            'damage': damage
+    for class_id, class_name in db.session.query(Class.id, Class.name).all():
+        class_damage[class_id] = {
+            'class_name': class_name,
+            'damage': damage_by_class.get(class_id, 0)
         }
     
     total_health = boss.get_total_health()
     current_health = boss.get_current_health(total_health=total_health)
     
-    return jsonify({
+    return {
         'success': True,
         'boss': {
             'id': boss.id,
@@ -9551,7 +11199,7 @@ def get_boss_stats():
             'is_active': boss.is_active
         },
         'class_damage': class_damage
-    })
+    }
 
 
 # Публичное API: топ игроков по классу для страницы рейд-босса
@@ -9584,29 +11232,19 @@ def raid_boss_top_users_by_class():
         return jsonify({'success': False, 'error': 'Босс ещё не побеждён'}), 403
 
     # Для публичной страницы рейда склеиваем одинаковые имена (без учёта регистра)
-    _, top_by_class = _get_boss_top_players_by_class_merged_names_data(boss_id=boss.id, limit=limit)
-
     if class_id is not None:
+        # Один класс — одна выборка из таблицы лидеров (пустой список, если участников нет)
         class_id_int = int(class_id)
-        cls_block = next((x for x in top_by_class if int(x.get('class_id')) == class_id_int), None)
-        if not cls_block:
-            # если данных нет — возвращаем пустой список (класс мог существовать, но без участников)
-            class_obj = Class.query.get(class_id_int)
-            return jsonify({
-                'success': True,
-                'boss': boss.to_dict(),
-                'class_id': class_id_int,
-                'class_name': class_obj.name if class_obj else None,
-                'users': []
-            })
+        class_obj = Class.query.get(class_id_int)
         return jsonify({
             'success': True,
             'boss': boss.to_dict(),
-            'class_id': int(cls_block.get('class_id')),
-            'class_name': cls_block.get('class_name'),
-            'users': cls_block.get('users', [])
+            'class_id': class_id_int,
+            'class_name': class_obj.name if class_obj else None,
+            'users': boss_top.top(boss.id, boss_top.KIND_NAME, class_id_int, limit)
         })
 
+    _, top_by_class = _get_boss_top_players_by_class_merged_names_data(boss_id=boss.id, limit=limit)
     return jsonify({
         'success': True,
         'boss': boss.to_dict(),
@@ -9653,6 +11291,7 @@ def create_boss_drop(boss_id):
     )
     db.session.add(new_drop)
     db.session.commit()
+    boss_drops.invalidate(boss_id)
     
     return jsonify({'success': True, 'drop': new_drop.to_dict()})
 
@@ -9684,6 +11323,7 @@ def update_boss_drop(boss_id, drop_id):
             drop.max_per_user = None if value <= 0 else value
     
     db.session.commit()
+    boss_drops.invalidate(boss_id)
     return jsonify({'success': True, 'drop': drop.to_dict()})
 
 @app.route('/api/bosses/<int:boss_id>/drops/<int:drop_id>', methods=['DELETE'])
@@ -9695,8 +11335,10 @@ def delete_boss_drop(boss_id, drop_id):
     if drop.boss_id != boss_id:
         return jsonify({'success': False, 'error': 'Дроп не принадлежит этому боссу'}), 400
     
+    BossDropTally.query.filter_by(drop_id=drop.id).delete(synchronize_session=False)
     db.session.delete(drop)
     db.session.commit()
+    boss_drops.invalidate(boss_id)
     return jsonify({'success': True})
 
 # API для получения списка пользователей босса
@@ -9721,127 +11363,22 @@ def _get_boss_top_users_by_class_data(boss_id: int, limit: int = 10):
     top_by_class: список объектов:
       {class_id, class_name, users: [{user_id, user_name, solved_correct, last_correct_at, position}]}
 
-    Правила:
+    Правила (таблица лидеров boss_top, строки kind='user'):
     - "Основной" класс пользователя выбирается по большинству его правильных решений.
       Тай-брейк: более поздний solved_at, затем меньший class_id.
     - Число решенных задач для рейтинга = количество правильных решений пользователя В ЕГО ОСНОВНОМ КЛАССЕ.
       (Это устраняет ситуацию, когда пользователь попадает в топ класса за счёт решений другим классом.)
     - Ранжирование внутри класса: solved_correct desc, last_correct_at desc, user_id asc.
     """
-    from sqlalchemy import func
-
     boss = db.get_or_404(Boss, boss_id)
-
-    # Считаем, сколько правильных решений каждый пользователь отправил за каждый класс
-    class_counts = db.session.query(
-        BossTaskSolution.user_id.label('user_id'),
-        BossTaskSolution.class_id.label('class_id'),
-        func.count(BossTaskSolution.id).label('cnt'),
-        func.max(BossTaskSolution.solved_at).label('last_at')
-    ).filter(
-        BossTaskSolution.boss_id == boss_id,
-        BossTaskSolution.is_correct == True,
-        BossTaskSolution.user_id.isnot(None)
-    ).group_by(
-        BossTaskSolution.user_id,
-        BossTaskSolution.class_id
-    ).subquery()
-
-    # Ранжируем классы внутри каждого пользователя, чтобы выбрать "основной"
-    main_class_ranked = db.session.query(
-        class_counts.c.user_id.label('user_id'),
-        class_counts.c.class_id.label('main_class_id'),
-        func.row_number().over(
-            partition_by=class_counts.c.user_id,
-            order_by=(
-                class_counts.c.cnt.desc(),
-                class_counts.c.last_at.desc(),
-                class_counts.c.class_id.asc()
-            )
-        ).label('rn')
-    ).subquery()
-
-    main_class = db.session.query(
-        main_class_ranked.c.user_id,
-        main_class_ranked.c.main_class_id
-    ).filter(
-        main_class_ranked.c.rn == 1
-    ).subquery()
-
-    # Для рейтинга берём счётчик/последнюю дату ИМЕННО по основному классу
-    main_class_stats = db.session.query(
-        class_counts.c.user_id.label('user_id'),
-        class_counts.c.class_id.label('class_id'),
-        class_counts.c.cnt.label('solved_correct'),
-        class_counts.c.last_at.label('last_correct_at')
-    ).subquery()
-
-    ranked = db.session.query(
-        main_class.c.main_class_id.label('class_id'),
-        Class.name.label('class_name'),
-        BossUser.id.label('user_id'),
-        BossUser.name.label('user_name'),
-        main_class_stats.c.solved_correct.label('solved_correct'),
-        main_class_stats.c.last_correct_at.label('last_correct_at'),
-        func.row_number().over(
-            partition_by=main_class.c.main_class_id,
-            order_by=(
-                main_class_stats.c.solved_correct.desc(),
-                main_class_stats.c.last_correct_at.desc(),
-                BossUser.id.asc()
-            )
-        ).label('pos')
-    ).join(
-        BossUser, BossUser.id == main_class.c.user_id
-    ).join(
-        Class, Class.id == main_class.c.main_class_id
-    ).join(
-        main_class_stats,
-        db.and_(
-            main_class_stats.c.user_id == main_class.c.user_id,
-            main_class_stats.c.class_id == main_class.c.main_class_id
-        )
-    ).subquery()
-
-    rows = db.session.query(
-        ranked.c.class_id,
-        ranked.c.class_name,
-        ranked.c.user_id,
-        ranked.c.user_name,
-        ranked.c.solved_correct,
-        ranked.c.last_correct_at,
-        ranked.c.pos
-    ).filter(
-        ranked.c.pos <= int(limit)
-    ).order_by(
-        ranked.c.class_name.asc(),
-        ranked.c.pos.asc()
-    ).all()
-
-    by_class: dict[int, dict] = {}
-    for r in rows:
-        class_id = int(r.class_id)
-        if class_id not in by_class:
-            by_class[class_id] = {
-                'class_id': class_id,
-                'class_name': r.class_name,
-                'users': []
-            }
-        by_class[class_id]['users'].append({
-            'user_id': int(r.user_id),
-            'user_name': r.user_name,
-            'solved_correct': int(r.solved_correct or 0),
-            'last_correct_at': r.last_correct_at.isoformat() if r.last_correct_at else None,
-            'position': int(r.pos)
-        })
-
-    return boss, list(by_class.values())
+    return boss, boss_top.top_by_class(boss_id, boss_top.KIND_USER, limit)
 
 
 def _get_boss_top_players_by_class_merged_names_data(boss_id: int, limit: int = 10):
     """
     Версия топа по классам, которая объединяет пользователей с одинаковыми именами
-    (без учёта регистра) и суммирует число правильных решений.
+    (без учёта регистра, пунктуации и порядка слов — boss_top.canonical_name_key)
+    и суммирует число правильных решений (строки kind='name' таблицы лидеров).
 
     Возвращает (boss, top_by_class), где top_by_class:
       {class_id, class_name, users: [{user_id, user_name, solved_correct, last_correct_at, position}]}
@@ -9850,146 +11387,8 @@ def _get_boss_top_players_by_class_merged_names_data(boss_id: int, limit: int =
     - В этом режиме один "пользователь" может соответствовать нескольким BossUser.id.
       Для стабильности отдаём user_id = минимальный BossUser.id среди объединённых.
     """
-    import re
-    from sqlalchemy import func
-
     boss = db.get_or_404(Boss, boss_id)
-
-    def canonical_name_key(raw: str) -> str:
-        """
-        Делает ключ, одинаковый для:
-          - разного регистра
-          - лишних пробелов/пунктуации
-          - перестановки слов (например, "иванов иван" == "иван иванов")
-        """
-        s = (raw or '').strip().lower()
-        if not s:
-            return ''
-        s = s.replace('ё', 'е')
-        # всё, что не буква/цифра — в пробел
-        s = re.sub(r'[^0-9a-zа-я]+', ' ', s, flags=re.IGNORECASE)
-        parts = [p for p in s.split() if p]
-        if not parts:
-            return ''
-        parts.sort()
-        return ' '.join(parts)
-
-    # База: считаем по "сырому" ключу (lower(trim(name))) и классу, затем уже склеиваем в Python
-    raw_key_expr = func.lower(func.trim(BossUser.name))
-    base_rows = db.session.query(
-        raw_key_expr.label('raw_key'),
-        BossTaskSolution.class_id.label('class_id'),
-        func.count(BossTaskSolution.id).label('cnt'),
-        func.max(BossTaskSolution.solved_at).label('last_at'),
-        func.min(BossUser.id).label('min_user_id'),
-        func.min(BossUser.name).label('any_name')
-    ).join(
-        BossUser, BossUser.id == BossTaskSolution.user_id
-    ).filter(
-        BossTaskSolution.boss_id == boss_id,
-        BossTaskSolution.is_correct == True,
-        BossTaskSolution.user_id.isnot(None),
-        BossUser.name.isnot(None),
-        func.length(func.trim(BossUser.name)) > 0
-    ).group_by(
-        raw_key_expr,
-        BossTaskSolution.class_id
-    ).all()
-
-    # 1) Склеиваем варианты имён в один ключ + суммируем по классу
-    per_name_class: dict[tuple[str, int], dict] = {}
-    # для отображения имени: выберем вариант с наибольшим суммарным cnt (тай-брейк: last_at)
-    display_choice: dict[str, dict] = {}
-
-    for r in base_rows:
-        raw_key = str(r.raw_key or '').strip()
-        canon = canonical_name_key(raw_key)
-        if not canon:
-            continue
-        class_id = int(r.class_id)
-        cnt = int(r.cnt or 0)
-        last_at = r.last_at
-        min_user_id = int(r.min_user_id) if r.min_user_id is not None else None
-        any_name = r.any_name
-
-        k = (canon, class_id)
-        agg = per_name_class.get(k)
-        if not agg:
-            per_name_class[k] = {
-                'canon': canon,
-                'class_id': class_id,
-                'cnt': cnt,
-                'last_at': last_at,
-                'min_user_id': min_user_id,
-            }
-        else:
-            agg['cnt'] += cnt
-            if last_at and (agg['last_at'] is None or last_at > agg['last_at']):
-                agg['last_at'] = last_at
-            if min_user_id is not None:
-                if agg['min_user_id'] is None or min_user_id < agg['min_user_id']:
-                    agg['min_user_id'] = min_user_id
-
-        dc = display_choice.get(canon)
-        score = (cnt, last_at or 0)
-        if not dc or score > dc['score']:
-            display_choice[canon] = {
-                'score': score,
-                'name': any_name or raw_key
-            }
-
-    # 2) Для каждого канонического имени выбираем "основной" класс
-    per_name: dict[str, dict] = {}
-    for (canon, class_id), st in per_name_class.items():
-        cur = per_name.get(canon)
-        cand = (st['cnt'], st['last_at'] or 0, -class_id)  # -class_id чтобы меньший class_id был "больше" при сравнении
-        if not cur or cand > cur['best']:
-            per_name[canon] = {
-                'best': cand,
-                'main_class_id': class_id,
-                'solved_correct': st['cnt'],
-                'last_correct_at': st['last_at'],
-                'min_user_id': st['min_user_id'],
-            }
-
-    # 3) Группируем по основному классу и ранжируем
-    class_names = {c.id: c.name for c in Class.query.all()}
-    by_class_users: dict[int, list] = {}
-    for canon, info in per_name.items():
-        class_id = int(info['main_class_id'])
-        by_class_users.setdefault(class_id, []).append({
-            'canon': canon,
-            'user_id': info['min_user_id'],
-            'user_name': (display_choice.get(canon) or {}).get('name') or canon,
-            'solved_correct': int(info['solved_correct'] or 0),
-            'last_correct_at': info['last_correct_at'],
-        })
-
-    top_by_class: list[dict] = []
-    for class_id, users in by_class_users.items():
-        users.sort(key=lambda u: (
-            -int(u['solved_correct'] or 0),
-            -(u['last_correct_at'].timestamp() if u['last_correct_at'] else 0),
-            u['canon']
-        ))
-        users = users[: int(limit)]
-        out_users = []
-        for idx, u in enumerate(users, start=1):
-            out_users.append({
-                'user_id': u['user_id'],
-                'user_name': u['user_name'],
-                'solved_correct': int(u['solved_correct'] or 0),
-                'last_correct_at': u['last_correct_at'].isoformat() if u['last_correct_at'] else None,
-                'position': idx
-            })
-        top_by_class.append({
-            'class_id': int(class_id),
-            'class_name': class_names.get(class_id),
-            'users': out_users
-        })
-
-    top_by_class.sort(key=lambda x: (x.get('class_name') or ''))
-    return boss, top_by_class
+    return boss, boss_top.top_by_class(boss_id, boss_top.KIND_NAME, limit)
 
 
 # API: топ-10 пользователей по каждому классу (класс определяется по большинству отправленных решений)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Присутствие на PvP арене в памяти процесса: отметки активности и снимок списка участников.
+
+Источник истины — таблица pvp_arena_presence (её видят все воркеры), но опросы арены её почти
+не трогают:
+  - Heartbeats — когда этот процесс последний раз записал игроку last_seen_at. Пока отметка
+    свежее interval, запрос игрока с арены не читает и не пишет строку присутствия; запись
+    раз в interval при тайм-ауте неактивности в минуты ничего не меняет. Просроченные отметки
+    удаляются лениво — при обращении и при редкой полной чистке.
+  - Roster — список участников для всех клиентов процесса: карточки (имя, уровень, аватар,
+    урон, защита) по возрастанию уровня, перечитывается не чаще раза в ttl_seconds. Карточка
+    игрока пересобирается, только если изменилась его подпись (уровень, навыки, версия бонусов…).
+    Диапазон уровней для вызова — два бинарных поиска по отсортированным уровням.
+"""
+import threading
+import time
+from bisect import bisect_left, bisect_right
+
+
+class Heartbeats:
+    """user_id -> время последней записи присутствия в БД (time.monotonic)."""
+
+    def __init__(self, interval=30.0, clock=time.monotonic):
+        self.interval = float(interval)
+        self._clock = clock
+        self._seen = {}
+        self._swept_at = clock()
+        self._lock = threading.Lock()
+
+    def fresh(self, user_id):
+        """Присутствие игрока записано этим процессом меньше interval назад."""
+        now = self._clock()
+        with self._lock:
+            seen_at = self._seen.get(user_id)
+            if seen_at is None:
+                return False
+            if now - seen_at < self.interval:
+                return True
+            del self._seen[user_id]
+            return False
+
+    def seen(self, user_id):
+        """Присутствие игрока только что записано в БД."""
+        now = self._clock()
+        with self._lock:
+            self._seen[user_id] = now
+            if now - self._swept_at >= self.interval:
+                self._seen = {uid: t for uid, t in self._seen.items() if now - t < self.interval}
+                self._swept_at = now
+
+    def forget(self, user_id):
+        with self._lock:
+            self._seen.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._seen.clear()
+
+    def __len__(self):
+        return len(self._seen)
+
+
+class RosterSnapshot:
+    """Карточки участников по возрастанию уровня."""
+    __slots__ = ('cards', 'levels', 'loaded_at')
+
+    def __init__(self, cards, loaded_at):
+        self.cards = sorted(cards, key=lambda c: (c['level'], c['id']))
+        self.levels = [c['level'] for c in self.cards]
+        self.loaded_at = loaded_at
+
+    def band(self, low, high):
+        """(lo, hi): cards[lo:hi] — участники с уровнем от low до high включительно."""
+        return bisect_left(self.levels, low), bisect_right(self.levels, high)
+
+
+class Roster:
+    """Общий для процесса снимок участников арены."""
+
+    def __init__(self, ttl_seconds=2.0, clock=time.monotonic):
+        self.ttl_seconds = float(ttl_seconds)
+        self._clock = clock
+        self._snapshot = None
+        # user_id -> (подпись, карточка)
+        self._cards = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.loads = 0
+        self.cards_built = 0
+
+    def get(self, load_rows, signature, build_cards):
+        """Снимок участников.
+
+        load_rows() — строки участников (у каждой .id); signature(row) — от чего зависит карточка;
+        build_cards(rows) — {user_id: карточка} для строк, чья подпись изменилась.
+        """
+        with self._lock:
+            now = self._clock()
+            snapshot = self._snapshot
+            if snapshot is not None and now - snapshot.loaded_at < self.ttl_seconds:
+                self.hits += 1
+                return snapshot
+            rows = load_rows()
+            signatures = {row.id: signature(row) for row in rows}
+            stale = [row for row in rows if self._cards.get(row.id, (None,))[0] != signatures[row.id]]
+            if stale:
+                built = build_cards(stale)
+                self.cards_built += len(built)
+                for row in stale:
+                    if row.id in built:
+                        self._cards[row.id] = (signatures[row.id], built[row.id])
+            # Ушедшие с арены карточки не храним
+            self._cards = {uid: entry for uid, entry in self._cards.items() if uid in signatures}
+            self._snapshot = RosterSnapshot([entry[1] for entry in self._cards.values()], now)
+            self.loads += 1
+            return self._snapshot
+
+    def invalidate(self):
+        """Состав арены изменился в этом процессе — следующий get() перечитает список."""
+        with self._lock:
+            self._snapshot = None
+
+    def clear(self):
+        with self._lock:
+            self._snapshot = None
+            self._cards.clear()
+
+    def stats(self):
+        with self._lock:
+            size = len(self._snapshot.cards) if self._snapshot is not None else 0
+        return {'participants': size, 'hits': self.hits, 'loads': self.loads, 'cards_built': self.cards_built}
@@ -2,43 +2,174 @@
 """
 Фильтр ненормативной лексики по списку из ban.txt.
 Используется в чатах: клан, администратор, PvP арена, поиск клана.
+
+Список компилируется один раз: строки-регулярки — каждая в свой паттерн, буквенные слова —
+в одно регулярное выражение по префиксному дереву (общие начала слов не проверяются повторно),
+так что текст проходится один раз, а не по разу на каждое слово. Совпадение — только целое слово:
+(?<!\\w) и (?!\\w) в юникодном режиме считают буквами и кириллицу. Из нескольких слов,
+начинающихся в одном месте, берётся самое длинное («блядь», а не «бля»).
+
+Изменение ban.txt подхватывается без перезапуска: не чаще раза в RELOAD_CHECK_SECONDS
+сравниваются время изменения и размер файла, при отличии список собирается заново.
+
+Версия фильтра (filter_version) — хеш содержимого списка и FILTER_ALGORITHM: одинакова во всех
+процессах с одним ban.txt. Чаты хранят её рядом с отфильтрованным текстом, по ней задача
+перефильтровки находит сообщения, отфильтрованные прежним списком.
 """
+import hashlib
 import os
 import re
+import threading
+import time
+from collections import namedtuple
 
 _BAN_FILE = os.path.join(os.path.dirname(__file__), 'ban.txt')
-_regex_patterns = []
-_literal_words = []
-_loaded = False
-
-
-def _load_ban_list():
-    global _regex_patterns, _literal_words, _loaded
-    if _loaded:
-        return
-    _loaded = True
-    if not os.path.isfile(_BAN_FILE):
-        return
+RELOAD_CHECK_SECONDS = 5
+# Менять при изменении правил замены, чтобы сохранённые тексты перефильтровались
+FILTER_ALGORITHM = 1
+
+# signature — (mtime_ns, size) файла или None; regex_patterns — паттерны из строк-регулярок;
+# literal_re — все буквенные слова одним выражением (None, если слов нет); version — версия фильтра
+_Matcher = namedtuple('_Matcher', 'signature regex_patterns literal_re word_count version')
+
+# Строка ban.txt вида \w*корень\w* — «всё слово, где есть корень»
+_WORD_PATTERN_RE = re.compile(r'\\w\*(\w+)\\w\*')
+
+_matcher = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def _stars(m):
+    return '*' * len(m.group(0))
+
+
+def _trie_regex(words):
+    """Регулярка-альтернатива по префиксному дереву слов: (?:а(?:б|в)?|…); длинные ветки раньше конца слова."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+
+    def build(node):
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ''
+        if '' in node:
+            return '(?:' + '|'.join(branches) + ')?'
+        if len(branches) == 1:
+            return branches[0]
+        return '(?:' + '|'.join(branches) + ')'
+
+    return build(trie)
+
+
+def _file_signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _merge_word_patterns(patterns):
+    """Идущие подряд паттерны вида \\w*корень\\w* — в один: каждый из них заменяет целиком слово,
+    содержащее свой корень, так что вместе они заменяют слова с любым из корней. Начало — только
+    с начала слова (совпадение и так всегда начинается там), чтобы не перебирать каждую позицию."""
+    merged, run = [], []
+
+    def flush():
+        if len(run) == 1:
+            merged.append(run[0][1])
+        elif run:
+            merged.append(re.compile(
+                r'(?<!\w)\w*' + _trie_regex({root.lower() for root, _ in run}) + r'\w*', re.IGNORECASE | re.UNICODE
+            ))
+        run.clear()
+
+    for p in patterns:
+        root = _WORD_PATTERN_RE.fullmatch(p.pattern)
+        if root:
+            run.append((root.group(1), p))
+            continue
+        flush()
+        merged.append(p)
+    flush()
+    return merged
+
+
+def compile_ban_list(lines, signature=None):
+    """Собрать фильтр из строк ban.txt."""
     regex_meta = set(r'\[]()*+?{}|^$.')
-    with open(_BAN_FILE, 'r', encoding='utf-8') as f:
-        for line in f:
-            line = line.strip()
-            if not line:
+    regex_patterns, words = [], set()
+    digest = hashlib.sha1()
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        digest.update(line.encode('utf-8') + b'\n')
+        # Пробуем скомпилировать как regex
+        try:
+            if any(c in line for c in regex_meta) or '\\' in line:
+                regex_patterns.append(re.compile(line, re.IGNORECASE | re.UNICODE))
                 continue
-            # Пробуем скомпилировать как regex
-            try:
-                if any(c in line for c in regex_meta) or '\\' in line:
-                    p = re.compile(line, re.IGNORECASE | re.UNICODE)
-                    _regex_patterns.append(p)
-                else:
-                    _literal_words.append(line)
-            except re.error:
-                _literal_words.append(line)
-    # Сначала заменяем длинные слова, чтобы "блядь" не превратилась в "*дь" после "бля"
-    _literal_words.sort(key=len, reverse=True)
-
-
-def filter_chat_text(text):
+        except re.error:
+            pass
+        words.add(line.lower())
+    regex_patterns = _merge_word_patterns(regex_patterns)
+    literal_re = None
+    if words:
+        literal_re = re.compile(r'(?<!\w)' + _trie_regex(words) + r'(?!\w)', re.IGNORECASE | re.UNICODE)
+    version = f'{FILTER_ALGORITHM}-{digest.hexdigest()[:12]}'
+    return _Matcher(signature, tuple(regex_patterns), literal_re, len(words), version)
+
+
+def load_ban_file(path=_BAN_FILE):
+    signature = _file_signature(path)
+    if signature is None:
+        return compile_ban_list((), None)
+    with open(path, 'r', encoding='utf-8') as f:
+        return compile_ban_list(f, signature)
+
+
+def _current():
+    """Текущий фильтр; раз в RELOAD_CHECK_SECONDS — проверка, не изменился ли ban.txt."""
+    global _matcher, _checked_at
+    matcher = _matcher
+    now = time.monotonic()
+    if matcher is not None and now - _checked_at < RELOAD_CHECK_SECONDS:
+        return matcher
+    with _lock:
+        if _matcher is None or now - _checked_at >= RELOAD_CHECK_SECONDS:
+            if _matcher is None or _file_signature(_BAN_FILE) != _matcher.signature:
+                _matcher = load_ban_file(_BAN_FILE)
+            _checked_at = now
+        return _matcher
+
+
+def reload_ban_list():
+    """Перечитать ban.txt сейчас."""
+    global _matcher, _checked_at
+    with _lock:
+        _matcher = load_ban_file(_BAN_FILE)
+        _checked_at = time.monotonic()
+    return _matcher
+
+
+def filter_version():
+    """Версия текущего списка (с проверкой изменения ban.txt)."""
+    return _current().version
+
+
+def filter_chat_text_versioned(text):
+    """(отфильтрованный текст, версия фильтра) — одним и тем же списком."""
+    matcher = _current()
+    return filter_chat_text(text, matcher), matcher.version
+
+
+def filter_chat_text(text, matcher=None):
     """
     Заменяет в тексте все вхождения слов/паттернов из ban.txt:
     каждая буква матерного слова заменяется на '*', например сука -> ****.
@@ -46,17 +177,12 @@ def filter_chat_text(text):
     """
     if not text:
         return text
-    _load_ban_list()
+    matcher = matcher or _current()
     result = text
-    for p in _regex_patterns:
-        result = p.sub(lambda m: '*' * len(m.group(0)), result)
+    for p in matcher.regex_patterns:
+        result = p.sub(_stars, result)
     # Для буквенных слов из ban.txt заменяем ТОЛЬКО целые слова, чтобы
-    # не зацеплять части других слов (\"тебя сука\" -> \"тебя ****\").
-    for word in _literal_words:
-        if len(word) == 0:
-            continue
-        replacement = '*' * len(word)
-        # \b работает с юникодом, поэтому границы слов для русских букв учитываются.
-        pattern = r'\b' + re.escape(word) + r'\b'
-        result = re.sub(pattern, replacement, result, flags=re.IGNORECASE)
+    # не зацеплять части других слов ("тебя сука" -> "тебя ****").
+    if matcher.literal_re is not None:
+        result = matcher.literal_re.sub(_stars, result)
     return result
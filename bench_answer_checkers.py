@@ -0,0 +1,57 @@
+"""
+Микро-бенчмарк проверки ответов (answer_checkers).
+
+Для каждого типа ответа берётся типичная задача и --n раз проверяется ответ игрока двумя
+способами:
+  - по готовому ключу (эталон разобран один раз при выдаче задачи, как в токене);
+  - с разбором эталона на каждой проверке (compile_answer_key + check_answer).
+
+Запуск:
+  python bench_answer_checkers.py
+  python bench_answer_checkers.py --n 200000
+"""
+from __future__ import annotations
+
+import argparse
+import time
+from typing import Sequence
+
+from answer_checkers import check_answer, compile_answer_key
+
+# answer_type -> (название задачи, эталон, ответ игрока)
+CASES = {
+    'fraction_property': ('Основное свойство дроби', '0|6|7', '6|7'),
+    'common_denominator': ('Общий знаменатель', '9|12|8|12', '9|12|8|12'),
+    'mixed': ('Сложение и вычитание дробей', '1|2|5', '1|2|5'),
+    'proper_improper': ('Правильные/неправильные дроби', '11|4', '11|4'),
+    'exact': ('Смешанные числа', '7', '7'),
+    'decimal': ('Проценты', '12.5', '12,5'),
+    'plain': ('Величины', 'x = 5', 'X =  5'),
+}
+
+
+def _run(fn, n: int) -> float:
+    started = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return time.perf_counter() - started
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n", type=int, default=1_000_000, help="Проверок на тип ответа")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    print(f"{'тип':<20}{'ключ, нс':>12}{'разбор+проверка, нс':>24}")
+    for answer_type, (title, correct, answer) in CASES.items():
+        key = compile_answer_key(title, correct)
+        assert key[0] == answer_type, key
+        assert check_answer(key, answer), (answer_type, answer)
+        compiled = _run(lambda: check_answer(key, answer), args.n)
+        parsed = _run(lambda: check_answer(compile_answer_key(title, correct), answer), args.n)
+        print(f"{answer_type:<20}{compiled / args.n * 1e9:>12.0f}{parsed / args.n * 1e9:>24.0f}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
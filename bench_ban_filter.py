@@ -0,0 +1,158 @@
+"""
+Бенчмарк фильтра мата (ban_filter.filter_chat_text) против прежней реализации.
+
+Прежняя реализация — цикл по словам ban.txt с re.sub(r'\\b' + слово + r'\\b') на каждое слово
+(около 2000 проходов по тексту на сообщение). Оба варианта прогоняются по одному набору
+сообщений; выводится время на сообщение и число сообщений, где результаты различаются
+(код 1, если различаются).
+
+Набор сообщений:
+  --from-db   — тексты чатов из БД (клан, арена, поиск клана, чат с администратором);
+  --file      — файл, одно сообщение на строку;
+  иначе       — синтетические сообщения из обычных слов и слов ban.txt (--seed).
+
+Запуск:
+  python bench_ban_filter.py
+  python bench_ban_filter.py --from-db --limit 20000
+  python bench_ban_filter.py --file chat_dump.txt --repeat 3
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import re
+import sys
+import time
+from typing import Sequence
+
+import ban_filter
+
+_PLAIN_WORDS = (
+    'привет', 'как', 'дела', 'идём', 'на', 'босса', 'кто', 'в', 'клан', 'атакуем', 'область', 'сейчас',
+    'дуэль', 'ставка', 'победа', 'спасибо', 'го', 'арена', 'защита', 'урон', 'задача', 'ответ', 'ок',
+    'ну', 'ты', 'где', 'жду', 'завтра', 'всем', 'удачи', 'команда', 'сила', 'hello', 'gg', 'lol',
+)
+
+
+def _legacy_filter(ban_lines):
+    """Прежний filter_chat_text: регулярки по очереди, затем re.sub по каждому слову."""
+    regex_meta = set(r'\[]()*+?{}|^$.')
+    regex_patterns, literal_words = [], []
+    for line in ban_lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if any(c in line for c in regex_meta) or '\\' in line:
+                regex_patterns.append(re.compile(line, re.IGNORECASE | re.UNICODE))
+            else:
+                literal_words.append(line)
+        except re.error:
+            literal_words.append(line)
+    literal_words.sort(key=len, reverse=True)
+
+    def run(text):
+        if not text:
+            return text
+        result = text
+        for p in regex_patterns:
+            result = p.sub(lambda m: '*' * len(m.group(0)), result)
+        for word in literal_words:
+            pattern = r'\b' + re.escape(word) + r'\b'
+            result = re.sub(pattern, '*' * len(word), result, flags=re.IGNORECASE)
+        return result
+
+    return run
+
+
+def _synthetic(ban_lines, n, seed):
+    rng = random.Random(seed)
+    bad = [line.strip() for line in ban_lines if line.strip() and not any(c in line for c in r'\[]()*+?{}|^$.')]
+    messages = []
+    for _ in range(n):
+        words = [rng.choice(_PLAIN_WORDS) for _ in range(rng.randint(2, 14))]
+        for _ in range(rng.choice((0, 0, 0, 1, 1, 2))):
+            word = rng.choice(bad)
+            word = word.upper() if rng.random() < 0.1 else word.capitalize() if rng.random() < 0.2 else word
+            if rng.random() < 0.2:
+                # Мат внутри слова: целым словом не совпадает, но ловится регулярками
+                word = rng.choice(_PLAIN_WORDS) + word
+            words.insert(rng.randrange(len(words) + 1), word + rng.choice(('', '', '!', ',', '...')))
+        messages.append(' '.join(words))
+    return messages
+
+
+def _from_db(limit):
+    from app import app, ClanChatMessage, ClanSearchChatMessage, PvPArenaChatMessage, TerritoryAdminChatMessage
+
+    messages = []
+    with app.app_context():
+        for model in (ClanChatMessage, PvPArenaChatMessage, ClanSearchChatMessage, TerritoryAdminChatMessage):
+            rows = model.query.with_entities(model.text).order_by(model.id.desc()).limit(limit).all()
+            messages.extend(text for (text,) in rows if text)
+    return messages
+
+
+def _time(fn, messages, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in messages:
+            fn(text)
+    return time.perf_counter() - started
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--from-db", action="store_true", help="Сообщения чатов из БД")
+    parser.add_argument("--file", help="Файл с сообщениями, по одному на строку")
+    parser.add_argument("--limit", type=int, default=5000, help="Сообщений из каждого чата (--from-db)")
+    parser.add_argument("--n", type=int, default=300, help="Синтетических сообщений")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=1, help="Повторов прогона по набору")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with open(ban_filter._BAN_FILE, 'r', encoding='utf-8') as f:
+        ban_lines = f.read().splitlines()
+
+    if args.from_db:
+        messages, source = _from_db(args.limit), 'БД'
+    elif args.file:
+        with open(args.file, 'r', encoding='utf-8') as f:
+            messages, source = [line.rstrip('\n') for line in f if line.strip()], args.file
+    else:
+        messages, source = _synthetic(ban_lines, args.n, args.seed), 'синтетика'
+    if not messages:
+        print("Нет сообщений", file=sys.stderr)
+        return 1
+
+    started = time.perf_counter()
+    matcher = ban_filter.compile_ban_list(ban_lines)
+    compile_ms = (time.perf_counter() - started) * 1000
+    legacy = _legacy_filter(ban_lines)
+
+    def compiled(text):
+        return ban_filter.filter_chat_text(text, matcher)
+
+    diffs = [(text, legacy(text), compiled(text)) for text in messages]
+    diffs = [d for d in diffs if d[1] != d[2]]
+    filtered = sum(1 for text in messages if compiled(text) != text)
+
+    legacy_s = _time(legacy, messages, args.repeat)
+    compiled_s = _time(compiled, messages, args.repeat)
+    total = len(messages) * args.repeat
+    print(f"Сообщений: {len(messages)} ({source}), с матом: {filtered}, слов в списке: {matcher.word_count}, "
+          f"регулярок: {len(matcher.regex_patterns)}, сборка фильтра: {compile_ms:.1f} мс")
+    print(f"  {'прежний':<16}{legacy_s / total * 1e6:12.1f} мкс на сообщение")
+    print(f"  {'одним проходом':<16}{compiled_s / total * 1e6:12.1f} мкс на сообщение"
+          f"  (x{legacy_s / max(compiled_s, 1e-9):.0f})")
+    for text, old, new in diffs[:10]:
+        print(f"  расхождение: {text!r}\n    прежний: {old!r}\n    новый:   {new!r}", file=sys.stderr)
+    if diffs:
+        print(f"Расхождений: {len(diffs)}", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,129 @@
+"""
+Бенчмарк ответа /api/raid-boss/stats: прежний расчёт против счётчиков и группировки.
+
+Прежний расчёт — SUM по задачам (здоровье), SUM по задачам и решениям (урон) и по запросу SUM
+на каждый класс. Новый — счётчики из строки boss и одна группировка по class_id
+(boss_stats.class_damage); «из кэша» — повторный опрос без изменения счётчиков (boss_stats.cached_stats).
+
+Данные создаются в текущей БД внутри транзакции (временные классы, босс, задачи, правильные
+решения — по одному на задачу) и в конце откатываются. Код 1, если урон по классам у прежнего
+и нового расчёта различается.
+
+Запуск:
+  python bench_boss_stats.py
+  python bench_boss_stats.py --classes 50 --solutions 100000 --repeat 20
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from typing import Sequence
+
+from sqlalchemy import func, insert
+
+from app import app, db, Boss, BossTask, BossTaskSolution, Class, _boss_stats_payload
+import boss_stats
+
+
+def _legacy_payload(boss):
+    """Прежний get_boss_stats: две суммы на здоровье и запрос на каждый класс."""
+    total = db.session.query(func.sum(BossTask.points)).filter(BossTask.boss_id == boss.id).scalar() or 0
+    dealt = db.session.query(func.sum(BossTask.points)).join(
+        BossTaskSolution, BossTaskSolution.task_id == BossTask.id
+    ).filter(BossTaskSolution.boss_id == boss.id, BossTaskSolution.is_correct == True).scalar() or 0  # noqa: E712
+    class_damage = {}
+    for class_obj in Class.query.all():
+        damage = db.session.query(func.sum(BossTask.points)).join(
+            BossTaskSolution, BossTaskSolution.task_id == BossTask.id
+        ).filter(
+            BossTaskSolution.boss_id == boss.id,
+            BossTaskSolution.class_id == class_obj.id,
+            BossTaskSolution.is_correct == True,  # noqa: E712
+        ).scalar() or 0
+        class_damage[class_obj.id] = {'class_name': class_obj.name, 'damage': int(damage)}
+    return {'total_health': int(total), 'current_health': max(0, int(total) - int(dealt)), 'class_damage': class_damage}
+
+
+def _seed(n_classes, n_solutions, seed):
+    rng = random.Random(seed)
+    classes = [Class(name=f'__bench_boss_{seed}_{i}') for i in range(n_classes)]
+    db.session.add_all(classes)
+    boss = Boss(name='__bench_boss', is_active=False)
+    db.session.add(boss)
+    db.session.flush()
+    class_ids = [c.id for c in classes]
+    task_ids = db.session.execute(
+        insert(BossTask).returning(BossTask.id),
+        [{'boss_id': boss.id, 'title': f't{i}', 'correct_answer': '1', 'points': rng.randint(1, 50)} for i in range(n_solutions)],
+    ).scalars().all()
+    db.session.execute(insert(BossTaskSolution), [
+        {'boss_id': boss.id, 'task_id': task_id, 'class_id': rng.choice(class_ids),
+         'user_name': 'bench', 'answer': '1', 'is_correct': True}
+        for task_id in task_ids
+    ])
+    values = boss_stats.recount([boss.id])[boss.id]
+    boss.total_health = values['total_health']
+    boss.damage_dealt = values['damage_dealt']
+    db.session.flush()
+    return boss
+
+
+def _time(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        result = fn()
+    return (time.perf_counter() - started) / repeat, result
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--classes", type=int, default=50, help="Временных классов")
+    parser.add_argument("--solutions", type=int, default=100000, help="Задач и правильных решений")
+    parser.add_argument("--repeat", type=int, default=20, help="Повторов каждого варианта")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        try:
+            started = time.perf_counter()
+            boss = _seed(args.classes, args.solutions, args.seed)
+            seed_s = time.perf_counter() - started
+            classes_total = db.session.query(func.count(Class.id)).scalar()
+            dialect = db.engine.dialect.name
+
+            legacy_s, legacy = _time(lambda: _legacy_payload(boss), args.repeat)
+            new_s, new = _time(lambda: _boss_stats_payload(boss), args.repeat)
+            version = (boss.total_health, boss.damage_dealt, boss.is_active, boss.name)
+            boss_stats.cached_stats(boss.id, version, lambda: new)
+            cached_s, _ = _time(lambda: boss_stats.cached_stats(boss.id, version, lambda: _boss_stats_payload(boss)), args.repeat)
+        finally:
+            db.session.rollback()
+            boss_stats.invalidate()
+
+    print(f"Классов: {classes_total} (временных {args.classes}), решений: {args.solutions}, "
+          f"подготовка данных: {seed_s:.1f} с, БД: {dialect}")
+    print(f"  {'прежний':<14}{legacy_s * 1000:10.2f} мс на ответ  ({classes_total + 3} запросов)")
+    print(f"  {'группировка':<14}{new_s * 1000:10.2f} мс на ответ  (2 запроса)  x{legacy_s / max(new_s, 1e-9):.1f}")
+    print(f"  {'из кэша':<14}{cached_s * 1000:10.3f} мс на ответ  (0 запросов)")
+
+    problems = []
+    if (legacy['total_health'], legacy['current_health']) != (new['boss']['total_health'], new['boss']['current_health']):
+        problems.append(f"здоровье: прежний {legacy['total_health']}/{legacy['current_health']}, "
+                        f"новый {new['boss']['total_health']}/{new['boss']['current_health']}")
+    for class_id, row in legacy['class_damage'].items():
+        have = new['class_damage'].get(class_id, {}).get('damage')
+        if have != row['damage']:
+            problems.append(f"класс {class_id}: прежний {row['damage']}, новый {have}")
+    for line in problems[:10]:
+        print(f"  расхождение — {line}", file=sys.stderr)
+    if problems:
+        print(f"Расхождений: {len(problems)}", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,167 @@
+"""
+Нагрузочная проверка атомарного удара по области (app._territory_capture_apply).
+
+N потоков одновременно «отвечают» по одной области от имени одного игрока его клана. Два сценария:
+
+- own — усиление своей области с нулевой силой: итоговая сила равна
+  min(TERRITORY_MAX_STRENGTH, N * power), влияние игрока выросло ровно на N * power;
+- enemy — захват чужой области с силой k * power (k = N // 2): k ударов снимают силу и на k-м
+  область переходит клану игрока, остальные N - k её усиливают. Итог: владелец — клан игрока,
+  сила min(TERRITORY_MAX_STRENGTH, (N - k + 1) * power), урон игрока +k * power,
+  влияние +(N - k + 1) * power.
+
+Если ни одно обновление не потеряно, итоги совпадают с ожидаемыми. Область и статистика игрока
+восстанавливаются после прогона в любом случае (и при ошибке), с новой версией карты — клиенты
+?since= увидят восстановленное состояние. Запускать вне окна захвата: прогон меняет живую область.
+
+Запуск:
+  python bench_territory_capture.py --region 0 --user-id 5
+  python bench_territory_capture.py --region 0 --user-id 5 --requests 200 --threads 32 --power 7
+  python bench_territory_capture.py --region 0 --user-id 5 --scenario enemy --enemy-clan-id 3
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Sequence
+
+from app import (
+    app,
+    db,
+    Clan,
+    TerritoryRegionState,
+    User,
+    UserTerritoryStats,
+    TERRITORY_MAX_STRENGTH,
+    _territory_capture_apply,
+    _territory_next_map_version,
+)
+
+
+def _one_hit(region_index: int, clan_id: int, user_id: int, power: int) -> float:
+    started = time.perf_counter()
+    with app.app_context():
+        try:
+            _territory_capture_apply(region_index, clan_id, user_id, power, power)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    return time.perf_counter() - started
+
+
+def _set_region(region_index: int, owner_clan_id, strength: int) -> None:
+    state = TerritoryRegionState.query.filter_by(region_index=region_index).with_for_update().first()
+    state.owner_clan_id = owner_clan_id
+    state.strength = strength
+    state.version = _territory_next_map_version()
+
+
+def _run(label, args, clan_id, owner_clan_id, start_strength, expect):
+    """Прогон сценария: (строки отчёта, успех). expect — (сила, урон, влияние)."""
+    with app.app_context():
+        _set_region(args.region, owner_clan_id, start_strength)
+        stats = UserTerritoryStats.query.filter_by(user_id=args.user_id).first()
+        damage_before = stats.total_damage_dealt or 0
+        influence_before = stats.total_influence_points or 0
+        db.session.commit()
+
+    latencies = []
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        futures = [
+            pool.submit(_one_hit, args.region, clan_id, args.user_id, args.power)
+            for _ in range(args.requests)
+        ]
+        for f in futures:
+            latencies.append(f.result())
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        state = TerritoryRegionState.query.filter_by(region_index=args.region).first()
+        stats = UserTerritoryStats.query.filter_by(user_id=args.user_id).first()
+        strength, owner = state.strength, state.owner_clan_id
+        damage_gain = (stats.total_damage_dealt or 0) - damage_before
+        influence_gain = (stats.total_influence_points or 0) - influence_before
+
+    expected_strength, expected_damage, expected_influence = expect
+    strength_ok = strength == expected_strength and owner == clan_id
+    stats_ok = damage_gain == expected_damage and influence_gain == expected_influence
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000
+    lines = [
+        f"{label}: {elapsed:.3f} с ({args.requests / elapsed:.1f} ударов/с), p50 {p50:.1f} мс, p95 {p95:.1f} мс",
+        f"  Область: клан {owner}, сила {strength} (ожидалось клан {clan_id}, сила {expected_strength})"
+        f" — {'OK' if strength_ok else 'ПОТЕРИ'}",
+        f"  Игрок: урон +{damage_gain}, влияние +{influence_gain} (ожидалось +{expected_damage}, +{expected_influence})"
+        f" — {'OK' if stats_ok else 'ПОТЕРИ'}",
+    ]
+    return lines, strength_ok and stats_ok
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--region", type=int, required=True, help="region_index области")
+    parser.add_argument("--user-id", type=int, required=True, help="Игрок (должен состоять в клане)")
+    parser.add_argument("--requests", type=int, default=100, help="Сколько ответов отправить в каждом сценарии")
+    parser.add_argument("--threads", type=int, default=20, help="Параллельных потоков")
+    parser.add_argument("--power", type=int, default=5, help="Сила одного удара")
+    parser.add_argument("--scenario", choices=("own", "enemy", "both"), default="both")
+    parser.add_argument("--enemy-clan-id", type=int, help="Клан-владелец для сценария enemy (по умолчанию любой другой)")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        user = db.session.get(User, args.user_id)
+        if not user or not user.clan_id:
+            print("Игрок не найден или не состоит в клане.", file=sys.stderr)
+            return 1
+        state = TerritoryRegionState.query.filter_by(region_index=args.region).first()
+        if not state:
+            print(f"Нет строки territory_region_state для region_index={args.region}.", file=sys.stderr)
+            return 1
+        clan_id = user.clan_id
+        enemy_clan_id = args.enemy_clan_id
+        if args.scenario != "own" and enemy_clan_id is None:
+            enemy_clan_id = db.session.query(Clan.id).filter(Clan.id != clan_id).order_by(Clan.id).limit(1).scalar()
+        if args.scenario != "own" and (enemy_clan_id is None or enemy_clan_id == clan_id):
+            print("Для сценария enemy нужен другой клан (--enemy-clan-id).", file=sys.stderr)
+            return 1
+        dialect = db.engine.dialect.name
+        stats = user.get_territory_stats()
+        db.session.commit()
+        saved_owner, saved_strength = state.owner_clan_id, state.strength
+        saved_damage, saved_influence = stats.total_damage_dealt, stats.total_influence_points
+
+    n, p = args.requests, args.power
+    k = max(1, n // 2)
+    scenarios = []
+    if args.scenario in ("own", "both"):
+        scenarios.append(("own", clan_id, 0, (min(TERRITORY_MAX_STRENGTH, n * p), 0, n * p)))
+    if args.scenario in ("enemy", "both"):
+        flipped = max(0, n - k + 1)
+        scenarios.append(("enemy", enemy_clan_id, k * p, (min(TERRITORY_MAX_STRENGTH, flipped * p), k * p, flipped * p)))
+
+    print(f"БД: {dialect}; запросов: {n}; потоков: {args.threads}; сила удара: {p}")
+    ok = True
+    try:
+        for label, owner_clan_id, start_strength, expect in scenarios:
+            lines, passed = _run(label, args, clan_id, owner_clan_id, start_strength, expect)
+            for line in lines:
+                print(line)
+            ok = ok and passed
+    finally:
+        with app.app_context():
+            _set_region(args.region, saved_owner, saved_strength)
+            UserTerritoryStats.query.filter_by(user_id=args.user_id).update({
+                UserTerritoryStats.total_damage_dealt: saved_damage,
+                UserTerritoryStats.total_influence_points: saved_influence,
+            }, synchronize_session=False)
+            db.session.commit()
+    return 0 if ok else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
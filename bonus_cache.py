@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Кэш агрегированных бонусов снаряжения и умений игрока (LRU в памяти процесса).
+
+Запись действительна только для своей версии: версия хранится в строке user (user.bonus_version)
+и увеличивается в той же транзакции, что меняет снаряжение, заточку или умения. Поэтому
+все воркеры gunicorn видят инвалидацию сразу после commit, без общего кэш-сервера.
+TTL — страховка от изменений в обход приложения (ручной SQL и т.п.).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class BonusCache:
+    """Потокобезопасный LRU: user_id -> (version, value, stored_at)."""
+
+    def __init__(self, maxsize=4096, ttl_seconds=600):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_seconds = max(0, int(ttl_seconds))
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, version):
+        """Значение для (user_id, version) или None."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None or entry[0] != version or (self.ttl_seconds and now - entry[2] > self.ttl_seconds):
+                if entry is not None:
+                    del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, version, value):
+        with self._lock:
+            self._data[user_id] = (version, value, time.monotonic())
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def discard(self, user_id):
+        with self._lock:
+            self._data.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Дроп рейд-босса: таблицы выбора Уолкера (alias method) и счётчики выпавших дропов по игрокам.
+
+Таблица дропов босса строится один раз (table) и выбирает дроп за O(1): индекс — равномерно,
+затем монетка prob[i] решает между i и alias[i]. Веса — BossDrop.get_probability_value(), выбор
+нормирован на их сумму, как и раньше. Таблица живёт в процессе до invalidate() (CRUD дропов)
+и не дольше TABLE_CACHE_SECONDS — изменения дропов в других воркерах.
+
+Лимит max_per_user считается по boss_drop_tally — счётчику (игрок, дроп), который растёт в той же
+транзакции, что и запись BossDropReward (grant). Увеличение условное: UPDATE ... WHERE count < лимит,
+поэтому параллельные выдачи не превышают лимит без повторных проверок. Дропы, упёршиеся в лимит,
+исключаются из выбора отбраковкой: выбор повторяется по той же таблице, распределение по
+оставшимся дропам остаётся пропорциональным весам. «Один дроп за задачу» держит уникальный
+индекс uq_boss_drop_reward_one_per_task — повтор отсекается IntegrityError при вставке.
+
+Распределение проверяется Монте-Карло скриптом check_boss_drops.py.
+"""
+import random
+import sys
+import threading
+import time
+from collections import namedtuple
+
+# Шанс, что правильный ответ вообще приносит дроп
+DROP_CHANCE = 0.2
+TABLE_CACHE_SECONDS = 30
+# Попыток отбраковки до перехода на линейный выбор среди доступных дропов
+MAX_REJECTIONS = 32
+
+Drop = namedtuple('Drop', 'id max_per_user weight')
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _app_module():
+    """Модуль с db и моделями (при `python app.py` это __main__, не дубликат app)."""
+    main = sys.modules.get('__main__')
+    if main is not None and hasattr(main, 'db'):
+        return main
+    import app as app_module
+    return app_module
+
+
+class AliasTable:
+    """Выбор одного из items с вероятностями, пропорциональными weights, за O(1)."""
+    __slots__ = ('items', 'prob', 'alias', 'total', 'capped')
+
+    def __init__(self, items, weights):
+        n = len(items)
+        self.items = list(items)
+        self.total = float(sum(weights))
+        self.capped = any(getattr(item, 'max_per_user', None) for item in self.items)
+        scaled = [float(w) * n / self.total for w in weights]
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        small = [i for i, p in enumerate(scaled) if p < 1.0]
+        large = [i for i, p in enumerate(scaled) if p >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            (small if scaled[l] < 1.0 else large).append(l)
+        # Остатки — погрешность округления: вероятность 1
+
+    def sample(self, rng=random):
+        i = int(rng.random() * len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+    def __len__(self):
+        return len(self.items)
+
+
+def build(drops):
+    """Таблица по строкам BossDrop (None, если выбирать не из чего)."""
+    entries = [Drop(d.id, d.max_per_user if d.max_per_user and d.max_per_user > 0 else None,
+                    float(d.get_probability_value())) for d in drops]
+    entries = [e for e in entries if e.weight > 0]
+    if not entries:
+        return None
+    return AliasTable(entries, [e.weight for e in entries])
+
+
+def table(boss_id):
+    """Таблица дропов босса из кэша процесса (None — у босса нет дропов)."""
+    now = time.monotonic()
+    with _tables_lock:
+        entry = _tables.get(boss_id)
+        if entry is not None and now - entry[0] < TABLE_CACHE_SECONDS:
+            return entry[1]
+    m = _app_module()
+    result = build(m.BossDrop.query.filter_by(boss_id=boss_id).order_by(m.BossDrop.id).all())
+    with _tables_lock:
+        _tables[boss_id] = (now, result)
+    return result
+
+
+def invalidate(boss_id=None):
+    """Дропы босса изменились (None — всех боссов)."""
+    with _tables_lock:
+        if boss_id is None:
+            _tables.clear()
+        else:
+            _tables.pop(boss_id, None)
+
+
+def pick(alias_table, counts=None, rng=random):
+    """Дроп из таблицы без упёршихся в лимит (counts: {drop_id: сколько уже выпало}); None — таких нет."""
+    counts = counts or {}
+
+    def available(drop):
+        return drop.max_per_user is None or counts.get(drop.id, 0) < drop.max_per_user
+
+    for _ in range(MAX_REJECTIONS):
+        drop = alias_table.sample(rng)
+        if available(drop):
+            return drop
+    # Доступные дропы — малая доля веса: линейный выбор среди них
+    eligible = [drop for drop in alias_table.items if available(drop)]
+    if not eligible:
+        return None
+    point = rng.random() * sum(drop.weight for drop in eligible)
+    for drop in eligible:
+        point -= drop.weight
+        if point < 0:
+            return drop
+    return eligible[-1]
+
+
+def roll(alias_table, load_counts=None, rng=random):
+    """Полный бросок: шанс DROP_CHANCE, затем выбор дропа. load_counts() вызывается, только если
+    шанс выпал и у таблицы есть лимиты."""
+    if alias_table is None or rng.random() > DROP_CHANCE:
+        return None
+    counts = load_counts() if load_counts is not None and alias_table.capped else None
+    return pick(alias_table, counts, rng)
+
+
+def tallies(boss_id, user_id):
+    """{drop_id: сколько раз дроп выпал игроку} по счётчикам boss_drop_tally."""
+    m = _app_module()
+    return dict(
+        m.db.session.query(m.BossDropTally.drop_id, m.BossDropTally.count)
+        .filter(m.BossDropTally.boss_id == boss_id, m.BossDropTally.user_id == user_id)
+        .all()
+    )
+
+
+def grant(boss_id, user_id, drop, task_id=None, class_id=None):
+    """Записать выпавший дроп и увеличить счётчик (в текущей транзакции, без commit).
+
+    None — дроп упёрся в лимит max_per_user (транзакцию нужно откатить). IntegrityError при flush —
+    дроп за эту задачу уже выдан или счётчик создан параллельно.
+    """
+    m = _app_module()
+    query = m.BossDropTally.query.filter(
+        m.BossDropTally.user_id == user_id,
+        m.BossDropTally.drop_id == drop.id,
+    )
+    if drop.max_per_user is not None:
+        query = query.filter(m.BossDropTally.count < drop.max_per_user)
+    updated = query.update({m.BossDropTally.count: m.BossDropTally.count + 1}, synchronize_session=False)
+    if not updated:
+        exists = m.db.session.query(m.BossDropTally.id).filter_by(user_id=user_id, drop_id=drop.id).first()
+        if exists is not None:
+            return None
+        m.db.session.add(m.BossDropTally(boss_id=boss_id, user_id=user_id, drop_id=drop.id, count=1))
+    reward = m.BossDropReward(boss_id=boss_id, user_id=user_id, drop_id=drop.id, task_id=task_id, class_id=class_id)
+    m.db.session.add(reward)
+    m.db.session.flush()
+    return reward
+
+
+def rebuild_tallies(boss_ids=None):
+    """Пересобрать счётчики по boss_drop_reward (одна группировка). Коммитит. Возвращает число строк."""
+    m = _app_module()
+    from sqlalchemy import func, insert, select
+
+    delete = m.BossDropTally.query
+    counts = select(
+        m.BossDropReward.boss_id, m.BossDropReward.user_id, m.BossDropReward.drop_id, func.count(m.BossDropReward.id)
+    ).group_by(m.BossDropReward.boss_id, m.BossDropReward.user_id, m.BossDropReward.drop_id)
+    if boss_ids:
+        delete = delete.filter(m.BossDropTally.boss_id.in_(boss_ids))
+        counts = counts.where(m.BossDropReward.boss_id.in_(boss_ids))
+    delete.delete(synchronize_session=False)
+    result = m.db.session.execute(
+        insert(m.BossDropTally).from_select(['boss_id', 'user_id', 'drop_id', 'count'], counts)
+    )
+    m.db.session.commit()
+    return result.rowcount
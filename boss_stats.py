@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Здоровье рейд-босса счётчиками в строке boss: total_health (сумма points задач) и
+damage_dealt (сумма points задач с правильным решением).
+
+Счётчики меняются атомарным UPDATE boss SET x = x + delta в той же транзакции, что и причина:
+правильный ответ (record_solve), добавление, изменение стоимости и удаление задачи
+(task_added / task_points_changed / task_removed). Страницы рейда читают два числа из строки
+босса вместо SUM по задачам и решениям.
+
+recount() — полный пересчёт по boss_task и boss_task_solution (две группировки); на нём построены
+проверка (check) и исправление (reconcile), см. sync_boss_health.py.
+
+Урон по классам (class_damage) — одна группировка по class_id вместо запроса на каждый класс.
+
+Ответ /api/raid-boss/stats кэшируется в процессе (cached_stats) вместе с версией — счётчиками
+из строки босса: правильный ответ в любом воркере меняет damage_dealt, и следующий опрос
+собирает ответ заново. STATS_CACHE_SECONDS ограничивает жизнь снимка для того, что в версию
+не входит (новые и переименованные классы).
+"""
+import sys
+import threading
+import time
+
+FIELDS = ('total_health', 'damage_dealt')
+STATS_CACHE_SECONDS = 30
+
+_stats_cache = {}
+_stats_lock = threading.Lock()
+
+
+def _app_module():
+    """Модуль с db и моделями (при `python app.py` это __main__, не дубликат app)."""
+    main = sys.modules.get('__main__')
+    if main is not None and hasattr(main, 'db'):
+        return main
+    import app as app_module
+    return app_module
+
+
+def _adjust(boss_id, total_delta=0, damage_delta=0):
+    """Атомарно сдвинуть счётчики босса (в текущей транзакции)."""
+    if not boss_id or not (total_delta or damage_delta):
+        return
+    from sqlalchemy.orm.util import identity_key
+
+    m = _app_module()
+    values = {}
+    if total_delta:
+        values[m.Boss.total_health] = m.Boss.total_health + int(total_delta)
+    if damage_delta:
+        values[m.Boss.damage_dealt] = m.Boss.damage_dealt + int(damage_delta)
+    m.Boss.query.filter(m.Boss.id == boss_id).update(values, synchronize_session=False)
+    boss = m.db.session.identity_map.get(identity_key(m.Boss, boss_id))
+    if boss is not None:
+        # Загруженный объект перечитает счётчики после commit
+        m.db.session.expire(boss, ['total_health', 'damage_dealt'])
+    invalidate(boss_id)
+
+
+def _correct_solutions(task_id):
+    m = _app_module()
+    from sqlalchemy import func
+    return m.db.session.query(func.count(m.BossTaskSolution.id)).filter(
+        m.BossTaskSolution.task_id == task_id,
+        m.BossTaskSolution.is_correct == True,  # noqa: E712
+    ).scalar() or 0
+
+
+def record_solve(boss_id, points):
+    """Правильное решение задачи стоимостью points (в транзакции записи решения)."""
+    _adjust(boss_id, damage_delta=points or 0)
+
+
+def task_added(boss_id, points):
+    _adjust(boss_id, total_delta=points or 0)
+
+
+def task_points_changed(task, old_points):
+    """Стоимость задачи изменилась: урон по ней уже учтён со старой стоимостью у каждого правильного решения."""
+    delta = int(task.points or 0) - int(old_points or 0)
+    if delta:
+        _adjust(task.boss_id, total_delta=delta, damage_delta=delta * _correct_solutions(task.id))
+
+
+def task_removed(task):
+    """Задача удаляется вместе со своими решениями (до db.session.delete)."""
+    points = int(task.points or 0)
+    _adjust(task.boss_id, total_delta=-points, damage_delta=-points * _correct_solutions(task.id))
+
+
+def recount(boss_ids=None, session=None):
+    """Счётчики по задачам и решениям: {boss_id: {'total_health': ..., 'damage_dealt': ...}}."""
+    m = _app_module()
+    from sqlalchemy import func
+
+    session = session or m.db.session
+    totals = session.query(m.BossTask.boss_id, func.sum(m.BossTask.points)).group_by(m.BossTask.boss_id)
+    damage = session.query(m.BossTaskSolution.boss_id, func.sum(m.BossTask.points)).join(
+        m.BossTask, m.BossTaskSolution.task_id == m.BossTask.id
+    ).filter(m.BossTaskSolution.is_correct == True).group_by(m.BossTaskSolution.boss_id)  # noqa: E712
+    boss_query = session.query(m.Boss.id)
+    if boss_ids:
+        totals = totals.filter(m.BossTask.boss_id.in_(boss_ids))
+        damage = damage.filter(m.BossTaskSolution.boss_id.in_(boss_ids))
+        boss_query = boss_query.filter(m.Boss.id.in_(boss_ids))
+    result = {boss_id: {'total_health': 0, 'damage_dealt': 0} for (boss_id,) in boss_query.all()}
+    for boss_id, value in totals.all():
+        if boss_id in result:
+            result[boss_id]['total_health'] = int(value or 0)
+    for boss_id, value in damage.all():
+        if boss_id in result:
+            result[boss_id]['damage_dealt'] = int(value or 0)
+    return result
+
+
+def check(boss_ids=None):
+    """Расхождения счётчиков с пересчётом: [(boss_id, поле, сохранено, должно быть)]."""
+    m = _app_module()
+    expected = recount(boss_ids)
+    stored = {
+        boss_id: (total, dealt)
+        for boss_id, total, dealt in m.db.session.query(m.Boss.id, m.Boss.total_health, m.Boss.damage_dealt)
+        .filter(m.Boss.id.in_(list(expected))).all()
+    } if expected else {}
+    problems = []
+    for boss_id in sorted(expected):
+        have = dict(zip(FIELDS, stored.get(boss_id, (None, None))))
+        for name in FIELDS:
+            if int(have[name] or 0) != expected[boss_id][name]:
+                problems.append((boss_id, name, have[name], expected[boss_id][name]))
+    return problems
+
+
+def reconcile(boss_ids=None):
+    """Записать счётчики из пересчёта (строки боссов под FOR UPDATE). Коммитит.
+    Возвращает число исправленных боссов."""
+    m = _app_module()
+    query = m.Boss.query.populate_existing().with_for_update()
+    if boss_ids:
+        query = query.filter(m.Boss.id.in_(boss_ids))
+    bosses = query.all()
+    # Пересчёт после блокировки: правильные ответы ждут её на UPDATE boss
+    expected = recount([b.id for b in bosses]) if bosses else {}
+    fixed = 0
+    for boss in bosses:
+        values = expected.get(boss.id, {'total_health': 0, 'damage_dealt': 0})
+        if (boss.total_health, boss.damage_dealt) != (values['total_health'], values['damage_dealt']):
+            boss.total_health = values['total_health']
+            boss.damage_dealt = values['damage_dealt']
+            fixed += 1
+    m.db.session.commit()
+    invalidate()
+    return fixed
+
+
+def class_damage(boss_id):
+    """Урон по боссу по классам: {class_id: сумма points правильно решённых задач}."""
+    m = _app_module()
+    from sqlalchemy import func
+
+    rows = m.db.session.query(m.BossTaskSolution.class_id, func.sum(m.BossTask.points)).join(
+        m.BossTask, m.BossTaskSolution.task_id == m.BossTask.id
+    ).filter(
+        m.BossTaskSolution.boss_id == boss_id,
+        m.BossTaskSolution.is_correct == True,  # noqa: E712
+    ).group_by(m.BossTaskSolution.class_id).all()
+    return {class_id: int(damage or 0) for class_id, damage in rows}
+
+
+def cached_stats(boss_id, version, build):
+    """Ответ статистики босса из кэша процесса, если версия (счётчики босса) та же;
+    build() собирает его при промахе."""
+    now = time.monotonic()
+    with _stats_lock:
+        entry = _stats_cache.get(boss_id)
+        if entry is not None and entry[1] == version and now - entry[0] < STATS_CACHE_SECONDS:
+            return entry[2]
+    payload = build()
+    with _stats_lock:
+        _stats_cache[boss_id] = (now, version, payload)
+    return payload
+
+
+def invalidate(boss_id=None):
+    """Сбросить кэш статистики босса (None — всех)."""
+    with _stats_lock:
+        if boss_id is None:
+            _stats_cache.clear()
+        else:
+            _stats_cache.pop(boss_id, None)
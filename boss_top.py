@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+"""
+Топ игроков рейд-босса по классам: таблица лидеров, которая обновляется при каждом правильном ответе.
+
+Две таблицы:
+  - boss_top_class_stat — (босс, игрок, класс): сколько правильных решений игрок отправил за класс
+    и когда последнее; name_key — канонический ключ имени игрока (canonical_name_key).
+  - boss_leaderboard — строка на участника босса: основной класс, решений в нём, последнее решение.
+    Участник вида KIND_USER — один BossUser (ключ — его id), KIND_NAME — все игроки с одинаковым
+    ключом имени (решения по классу суммируются, user_id — минимальный из них).
+
+Основной класс — по большинству решений, тай-брейк: более позднее решение, затем меньший class_id.
+В рейтинг идёт число решений в основном классе. Топ класса (top) — выборка по индексу
+(boss_id, kind, main_class_id, solved) с LIMIT, без оконных функций по всем решениям.
+
+record_solve вызывается в транзакции записи решения. Строки лидеров игрока и его имени блокируются
+первыми (FOR UPDATE), поэтому параллельные ответы одного игрока или одноимённых игроков
+пересчитывают строку по очереди. task_removed — вычет решений удаляемой задачи в той же транзакции
+и под теми же блокировками. rebuild() — полная сборка по boss_task_solution (миграция).
+"""
+import re
+import sys
+from datetime import datetime
+
+KIND_USER = 'user'
+KIND_NAME = 'name'
+
+
+def _app_module():
+    """Модуль с db и моделями (при `python app.py` это __main__, не дубликат app)."""
+    main = sys.modules.get('__main__')
+    if main is not None and hasattr(main, 'db'):
+        return main
+    import app as app_module
+    return app_module
+
+
+def canonical_name_key(raw):
+    """
+    Делает ключ, одинаковый для:
+      - разного регистра
+      - лишних пробелов/пунктуации
+      - перестановки слов (например, "иванов иван" == "иван иванов")
+    """
+    s = (raw or '').strip().lower()
+    if not s:
+        return ''
+    s = s.replace('ё', 'е')
+    # всё, что не буква/цифра — в пробел
+    s = re.sub(r'[^0-9a-zа-я]+', ' ', s, flags=re.IGNORECASE)
+    parts = [p for p in s.split() if p]
+    if not parts:
+        return ''
+    parts.sort()
+    return ' '.join(parts)
+
+
+def _main_class(rows):
+    """(class_id, solved, last_at) основного класса из строк (class_id, solved, last_at)."""
+    best = None
+    for class_id, solved, last_at in rows:
+        rank = (int(solved or 0), last_at or datetime.min, -int(class_id))
+        if best is None or rank > best[0]:
+            best = (rank, (int(class_id), int(solved or 0), last_at))
+    return best[1] if best else None
+
+
+def _entry(boss_id, kind, key):
+    """Строка лидеров под блокировкой; создаётся, если её нет."""
+    m = _app_module()
+    from sqlalchemy.exc import IntegrityError
+
+    Entry = m.BossLeaderboardEntry
+    query = Entry.query.filter_by(boss_id=boss_id, kind=kind, key=key).populate_existing().with_for_update()
+    entry = query.first()
+    if entry is None:
+        try:
+            with m.db.session.begin_nested():
+                entry = Entry(boss_id=boss_id, kind=kind, key=key, solved=0)
+                m.db.session.add(entry)
+        except IntegrityError:
+            # Строку успел создать параллельный ответ
+            entry = query.first()
+    return entry
+
+
+def _refresh_user(entry, user):
+    m = _app_module()
+    Stat = m.BossTopClassStat
+    rows = m.db.session.query(Stat.class_id, Stat.solved, Stat.last_at).filter(
+        Stat.boss_id == entry.boss_id, Stat.user_id == user.id
+    ).all()
+    main = _main_class(rows)
+    if main is None:
+        m.db.session.delete(entry)
+        return
+    entry.main_class_id, entry.solved, entry.last_at = main
+    entry.user_id = user.id
+    entry.user_name = user.name
+
+
+def _refresh_name(entry):
+    m = _app_module()
+    from sqlalchemy import func
+
+    Stat = m.BossTopClassStat
+    by_name = (Stat.boss_id == entry.boss_id, Stat.name_key == entry.key)
+    main = _main_class(
+        m.db.session.query(Stat.class_id, func.sum(Stat.solved), func.max(Stat.last_at))
+        .filter(*by_name).group_by(Stat.class_id).all()
+    )
+    if main is None:
+        m.db.session.delete(entry)
+        return
+    members = m.db.session.query(Stat.user_id, func.sum(Stat.solved), func.max(Stat.last_at)).filter(
+        *by_name
+    ).group_by(Stat.user_id).all()
+    # Отображаемое имя — у игрока с наибольшим числом решений
+    shown = max(members, key=lambda r: (int(r[1] or 0), r[2] or datetime.min))[0]
+    shown_user = m.db.session.get(m.BossUser, shown)
+    entry.main_class_id, entry.solved, entry.last_at = main
+    entry.user_id = min(r[0] for r in members)
+    entry.user_name = shown_user.name if shown_user else entry.key
+
+
+def record_solve(boss_id, user, class_id, solved_at):
+    """Правильное решение игрока user (BossUser) за класс class_id — в транзакции записи решения."""
+    if user is None or not class_id:
+        return
+    m = _app_module()
+    Stat = m.BossTopClassStat
+    class_id = int(class_id)
+
+    user_entry = _entry(boss_id, KIND_USER, str(user.id))
+    name_key = canonical_name_key(user.name)
+    name_entry = _entry(boss_id, KIND_NAME, name_key) if name_key else None
+
+    stat = Stat.query.filter_by(boss_id=boss_id, user_id=user.id, class_id=class_id).first()
+    if stat is None:
+        stat = Stat(boss_id=boss_id, user_id=user.id, class_id=class_id, solved=0)
+        m.db.session.add(stat)
+    stat.solved = int(stat.solved or 0) + 1
+    if solved_at and (stat.last_at is None or solved_at > stat.last_at):
+        stat.last_at = solved_at
+    stat.name_key = name_key
+    m.db.session.flush()
+
+    _refresh_user(user_entry, user)
+    if name_entry is not None:
+        _refresh_name(name_entry)
+
+
+def renamed(user, old_name):
+    """Игрок сменил имя (до commit): перенести его решения под новый ключ имени во всех боссах."""
+    m = _app_module()
+    Stat = m.BossTopClassStat
+
+    old_key, new_key = canonical_name_key(old_name), canonical_name_key(user.name)
+    boss_ids = [b for (b,) in m.db.session.query(Stat.boss_id).filter(Stat.user_id == user.id).distinct().all()]
+    for boss_id in boss_ids:
+        user_entry = _entry(boss_id, KIND_USER, str(user.id))
+        name_entries = [_entry(boss_id, KIND_NAME, key) for key in sorted({old_key, new_key}) if key]
+        Stat.query.filter(Stat.boss_id == boss_id, Stat.user_id == user.id).update(
+            {Stat.name_key: new_key}, synchronize_session=False
+        )
+        _refresh_user(user_entry, user)
+        for entry in name_entries:
+            _refresh_name(entry)
+
+
+def task_removed(boss_id, task_id):
+    """Задача удаляется вместе с решениями (до commit): вычесть её правильные решения из топа.
+
+    Строки лидеров затронутых игроков блокируются первыми — сначала все игроки, затем все имена
+    (по возрастанию ключа), так что с record_solve (игрок, затем его имя) взаимной блокировки нет.
+    """
+    m = _app_module()
+    from sqlalchemy import func
+
+    S, Stat = m.BossTaskSolution, m.BossTopClassStat
+    removed = m.db.session.query(S.user_id, S.class_id, func.count(S.id)).filter(
+        S.task_id == task_id, S.is_correct == True, S.user_id.isnot(None), S.class_id.isnot(None),  # noqa: E712
+    ).group_by(S.user_id, S.class_id).all()
+    if not removed:
+        return
+    user_ids = sorted({user_id for user_id, _, _ in removed})
+    user_entries = [(_entry(boss_id, KIND_USER, str(user_id)), user_id) for user_id in user_ids]
+    name_keys = sorted({key for (key,) in m.db.session.query(Stat.name_key).filter(
+        Stat.boss_id == boss_id, Stat.user_id.in_(user_ids),
+    ).distinct().all() if key})
+    name_entries = [_entry(boss_id, KIND_NAME, key) for key in name_keys]
+
+    for user_id, class_id, count in removed:
+        stat = Stat.query.filter_by(boss_id=boss_id, user_id=user_id, class_id=class_id).populate_existing().first()
+        if stat is None:
+            continue
+        stat.solved = int(stat.solved or 0) - int(count)
+        if stat.solved <= 0:
+            m.db.session.delete(stat)
+            continue
+        stat.last_at = m.db.session.query(func.max(S.solved_at)).filter(
+            S.boss_id == boss_id, S.user_id == user_id, S.class_id == class_id,
+            S.is_correct == True, S.task_id != task_id,  # noqa: E712
+        ).scalar()
+    m.db.session.flush()
+
+    for entry, user_id in user_entries:
+        user = m.db.session.get(m.BossUser, user_id)
+        if user is None:
+            m.db.session.delete(entry)
+            continue
+        _refresh_user(entry, user)
+    for entry in name_entries:
+        _refresh_name(entry)
+
+
+def top(boss_id, kind, class_id, limit=10):
+    """Топ класса: [{user_id, user_name, solved_correct, last_correct_at, position}]."""
+    m = _app_module()
+    Entry = m.BossLeaderboardEntry
+    tie = Entry.user_id.asc() if kind == KIND_USER else Entry.key.asc()
+    rows = Entry.query.filter(
+        Entry.boss_id == boss_id, Entry.kind == kind, Entry.main_class_id == class_id
+    ).order_by(Entry.solved.desc(), Entry.last_at.desc(), tie).limit(int(limit)).all()
+    return [{
+        'user_id': int(row.user_id) if row.user_id is not None else None,
+        'user_name': row.user_name,
+        'solved_correct': int(row.solved or 0),
+        'last_correct_at': row.last_at.isoformat() if row.last_at else None,
+        'position': position,
+    } for position, row in enumerate(rows, start=1)]
+
+
+def top_by_class(boss_id, kind, limit=10):
+    """Топ каждого класса: [{class_id, class_name, users}] по имени класса.
+    Классы без строки в class (удалённые) пропускаются."""
+    m = _app_module()
+    Entry = m.BossLeaderboardEntry
+    class_ids = [c for (c,) in m.db.session.query(Entry.main_class_id).filter(
+        Entry.boss_id == boss_id, Entry.kind == kind
+    ).distinct().all() if c is not None]
+    if not class_ids:
+        return []
+    names = dict(m.db.session.query(m.Class.id, m.Class.name).filter(m.Class.id.in_(class_ids)).all())
+    result = [
+        {'class_id': int(class_id), 'class_name': names[class_id], 'users': top(boss_id, kind, class_id, limit)}
+        for class_id in class_ids if class_id in names
+    ]
+    result.sort(key=lambda x: (x.get('class_name') or ''))
+    return result
+
+
+def rebuild(boss_ids=None):
+    """Собрать таблицы заново по правильным решениям (одна группировка). Коммитит.
+    Возвращает число строк лидеров."""
+    m = _app_module()
+    from sqlalchemy import func
+
+    S, Stat, Entry = m.BossTaskSolution, m.BossTopClassStat, m.BossLeaderboardEntry
+    stats_delete, entries_delete = Stat.query, Entry.query
+    grouped = m.db.session.query(
+        S.boss_id, S.user_id, S.class_id, func.count(S.id), func.max(S.solved_at), m.BossUser.name
+    ).join(m.BossUser, m.BossUser.id == S.user_id).filter(
+        S.is_correct == True,  # noqa: E712
+        S.user_id.isnot(None),
+    ).group_by(S.boss_id, S.user_id, S.class_id, m.BossUser.name)
+    if boss_ids:
+        stats_delete = stats_delete.filter(Stat.boss_id.in_(boss_ids))
+        entries_delete = entries_delete.filter(Entry.boss_id.in_(boss_ids))
+        grouped = grouped.filter(S.boss_id.in_(boss_ids))
+    rows = grouped.all()
+    entries_delete.delete(synchronize_session=False)
+    stats_delete.delete(synchronize_session=False)
+
+    users, names, shown, user_names = {}, {}, {}, {}
+    stats = []
+    for boss_id, user_id, class_id, solved, last_at, user_name in rows:
+        key = canonical_name_key(user_name)
+        stats.append({'boss_id': boss_id, 'user_id': user_id, 'class_id': class_id,
+                      'name_key': key, 'solved': int(solved), 'last_at': last_at})
+        user_names[user_id] = user_name
+        users.setdefault((boss_id, user_id), []).append((class_id, solved, last_at))
+        if key:
+            per_class = names.setdefault((boss_id, key), {})
+            total, last = per_class.get(class_id, (0, None))
+            per_class[class_id] = (total + int(solved), max(filter(None, (last, last_at)), default=None))
+            per_user = shown.setdefault((boss_id, key), {})
+            total, last = per_user.get(user_id, (0, None))
+            per_user[user_id] = (total + int(solved), max(filter(None, (last, last_at)), default=None))
+    if stats:
+        m.db.session.bulk_insert_mappings(Stat, stats)
+
+    entries = []
+    for (boss_id, user_id), class_rows in users.items():
+        class_id, solved, last_at = _main_class(class_rows)
+        entries.append({'boss_id': boss_id, 'kind': KIND_USER, 'key': str(user_id), 'user_id': user_id,
+                        'user_name': user_names[user_id], 'main_class_id': class_id, 'solved': solved, 'last_at': last_at})
+    for (boss_id, key), per_class in names.items():
+        class_id, solved, last_at = _main_class((c, s, l) for c, (s, l) in per_class.items())
+        members = shown[(boss_id, key)]
+        best = max(members, key=lambda uid: (members[uid][0], members[uid][1] or datetime.min))
+        entries.append({'boss_id': boss_id, 'kind': KIND_NAME, 'key': key, 'user_id': min(members),
+                        'user_name': user_names[best], 'main_class_id': class_id, 'solved': solved, 'last_at': last_at})
+    if entries:
+        m.db.session.bulk_insert_mappings(Entry, entries)
+    m.db.session.commit()
+    return len(entries)
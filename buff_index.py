@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Индекс активных баффов (active_item_buff) в памяти процесса.
+
+Для каждой цели — ('user', id), ('clan', id), ('region', index) — хранится готовый вектор
+сумм процентов (damage, defense, xp_reward, nums_reward). Эффекты с длительностью лежат в
+min-куче по времени окончания и вычитаются из вектора, когда срок вышел, поэтому множители
+для действия — это сложение трёх векторов без обхода предметов и эффектов.
+
+Индекс не знает о БД: записи (BuffRecord) собирает app.py, он же решает, когда перезагрузить
+индекс или догрузить разницу по id (rebuilds в buff_index_state и отпечаток строк в app._buff_index_sync).
+Индекс помнит все загруженные id, в том числе истёкших баффов, — по ним считается разница с БД.
+"""
+import heapq
+import threading
+
+# Порядок компонент вектора
+BUFF_VECTOR_TYPES = ('damage', 'defense', 'xp_reward', 'nums_reward')
+_VECTOR_POS = {t: i for i, t in enumerate(BUFF_VECTOR_TYPES)}
+
+
+class BuffRecord:
+    """Скомпилированный бафф: цель, слагаемые вектора и данные для отображения.
+
+    terms — кортеж (позиция в векторе, процент со знаком, окончание или None = бессрочно).
+    display_end — максимальное окончание среди эффектов с длительностью (None — не показывать).
+    """
+    __slots__ = (
+        'id', 'scope', 'key', 'shop_item_id', 'used_at', 'one_shot', 'terms', 'display_end',
+        'item_name', 'item_description', 'item_image_filename',
+    )
+
+    def __init__(self, id, scope, key, shop_item_id, used_at, one_shot, terms, display_end,
+                 item_name='', item_description='', item_image_filename=None):
+        self.id = id
+        self.scope = scope
+        self.key = key
+        self.shop_item_id = shop_item_id
+        self.used_at = used_at
+        self.one_shot = one_shot
+        self.terms = tuple(terms)
+        self.display_end = display_end
+        self.item_name = item_name
+        self.item_description = item_description
+        self.item_image_filename = item_image_filename
+
+
+def buff_terms(effects, used_at, one_shot, sign_fn=None):
+    """Слагаемые вектора из эффектов товара: (effect_type, percent, duration_minutes).
+
+    sign_fn(pct) -> pct приводит знак по категории товара (проклятие/усиление).
+    Разовый бафф действует до срабатывания, поэтому его слагаемые бессрочны.
+    """
+    from datetime import timedelta
+
+    terms = []
+    for effect_type, pct, duration_minutes in effects:
+        pos = _VECTOR_POS.get(effect_type)
+        if pos is None:
+            continue
+        pct = pct or 0
+        if sign_fn is not None:
+            pct = sign_fn(pct)
+        end = None
+        if not one_shot and duration_minutes is not None:
+            end = used_at + timedelta(minutes=duration_minutes)
+        terms.append((pos, float(pct), end))
+    return terms
+
+
+class BuffIndex:
+    """Потокобезопасный индекс: векторы по целям + куча окончаний эффектов."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._records = {}    # buff_id -> BuffRecord
+        self._by_target = {}  # (scope, key) -> set(buff_id)
+        self._vectors = {}    # (scope, key) -> [damage, defense, xp_reward, nums_reward]
+        self._heap = []       # (end, buff_id, term_no)
+        self._counted = {}    # buff_id -> set(term_no), ещё входящие в вектор
+        self._ids = set()     # все загруженные id (и истёкших баффов)
+        # Отпечаток эффектов товаров, состояние БД, с которым сверен индекс, и когда сверялся
+        # отпечаток (значения ведёт app.py)
+        self.fingerprint = None
+        self.state = None
+        self.checked_at = 0.0
+
+    def reset(self, records, now, ids=(), fingerprint=None):
+        """Полная перезагрузка индекса. ids — id всех загруженных строк (и тех, что не дали записи)."""
+        with self._lock:
+            self._records.clear()
+            self._by_target.clear()
+            self._vectors.clear()
+            self._heap = []
+            self._counted.clear()
+            self._ids = set(ids)
+            for rec in records:
+                self._add_locked(rec, now)
+            self.fingerprint = fingerprint
+
+    def add(self, records, now, ids=()):
+        """Добавить новые баффы (ids — id загруженных строк)."""
+        with self._lock:
+            self._ids.update(ids)
+            for rec in records:
+                if rec.id not in self._records:
+                    self._add_locked(rec, now)
+
+    def remove(self, buff_ids):
+        """Убрать баффы (сработавшие разовые, удалённые)."""
+        with self._lock:
+            for buff_id in buff_ids:
+                self._ids.discard(buff_id)
+                self._remove_locked(buff_id)
+
+    def known_ids(self):
+        """Id всех загруженных баффов (копия)."""
+        with self._lock:
+            return set(self._ids)
+
+    def invalidate(self):
+        """Следующая синхронизация перезагрузит индекс целиком."""
+        with self._lock:
+            self.fingerprint = None
+            self.state = None
+
+    def vector(self, scope, key, now):
+        """Текущий вектор цели (копия списка из 4 чисел)."""
+        with self._lock:
+            self._expire_locked(now)
+            vec = self._vectors.get((scope, key))
+            return list(vec) if vec else [0.0, 0.0, 0.0, 0.0]
+
+    def records_for(self, scope, key):
+        """Баффы цели, по возрастанию id."""
+        with self._lock:
+            ids = self._by_target.get((scope, key))
+            if not ids:
+                return []
+            return [self._records[i] for i in sorted(ids)]
+
+    def __len__(self):
+        return len(self._records)
+
+    def _add_locked(self, rec, now):
+        self._ids.add(rec.id)
+        live = [t for t in enumerate(rec.terms) if t[1][2] is None or now <= t[1][2]]
+        if not live and (rec.display_end is None or now > rec.display_end):
+            # Истёкший бафф ни на что не влияет — в индекс не попадает
+            return
+        target = (rec.scope, rec.key)
+        self._records[rec.id] = rec
+        self._by_target.setdefault(target, set()).add(rec.id)
+        if not live:
+            return
+        vec = self._vectors.setdefault(target, [0.0, 0.0, 0.0, 0.0])
+        for term_no, (pos, pct, end) in live:
+            vec[pos] += pct
+            if end is not None:
+                heapq.heappush(self._heap, (end, rec.id, term_no))
+        self._counted[rec.id] = {term_no for term_no, _ in live}
+
+    def _remove_locked(self, buff_id):
+        rec = self._records.pop(buff_id, None)
+        if rec is None:
+            return
+        target = (rec.scope, rec.key)
+        ids = self._by_target.get(target)
+        if ids is not None:
+            ids.discard(buff_id)
+            if not ids:
+                del self._by_target[target]
+                self._vectors.pop(target, None)
+        for term_no in self._counted.pop(buff_id, ()):
+            self._subtract_locked(target, rec.terms[term_no])
+        # Записи кучи этого баффа отбросятся при извлечении
+
+    def _subtract_locked(self, target, term):
+        vec = self._vectors.get(target)
+        if vec is None:
+            return
+        vec[term[0]] -= term[1]
+
+    def _expire_locked(self, now):
+        heap = self._heap
+        while heap and heap[0][0] < now:
+            _, buff_id, term_no = heapq.heappop(heap)
+            counted = self._counted.get(buff_id)
+            if not counted or term_no not in counted:
+                continue
+            counted.discard(term_no)
+            rec = self._records[buff_id]
+            self._subtract_locked((rec.scope, rec.key), rec.terms[term_no])
+            if not counted:
+                del self._counted[buff_id]
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""
+Последние сообщения каналов чата в памяти процесса (кольцевой буфер на канал).
+
+Канал — чат одного клана, арена, поиск клана. В буфере — до size последних сообщений канала
+в готовом для JSON виде (автор, аватар, отфильтрованный текст), по возрастанию id. Опрос
+«новые после after_id» и первая загрузка отвечаются из буфера, если его проверяли не раньше
+check_seconds назад; иначе один запрос «сообщения канала с id > последнего в буфере» дочитывает
+новые (в том числе записанные другими воркерами) — один запрос на канал раз в check_seconds
+вместо запроса на каждый опрос каждого клиента.
+
+После записи в своём процессе канал помечается непроверенным (touch): следующий опрос дочитает
+сообщение из БД. Id выдаются до commit, поэтому сообщение с меньшим id может стать видимым позже
+большего: дочитывание начинается на reread сообщений ниже последнего в буфере, уже известные id
+пропускаются, поздние встают на своё место. Раз в rebuild_seconds и при смене версии (фильтр мата,
+поколение удалений в БД) буфер собирается заново — так подхватываются перефильтровка, удаление
+сообщений и смена имени или аватара автора.
+
+Тот же буфер служит счётчиком непрочитанного: в нём хранятся только id и ключ сообщения (автор
+или адресат), число новых после after_id — подсчёт по хвосту буфера (unread) без COUNT в БД.
+"""
+import threading
+import time
+from collections import deque
+
+# Буфер ещё не собирался (версия канала может быть любой, в том числе None)
+_UNBUILT = object()
+
+class _Ring:
+    __slots__ = ('items', 'complete', 'version', 'checked_at', 'built_at', 'lock')
+
+    def __init__(self, size):
+        self.items = deque(maxlen=size)
+        # complete — в канале нет сообщений старше буфера
+        self.complete = False
+        self.version = _UNBUILT
+        self.checked_at = 0.0
+        self.built_at = 0.0
+        self.lock = threading.Lock()
+
+
+class ChatFeed:
+    """Буферы каналов: read() -> (сообщения по возрастанию id, complete)."""
+
+    def __init__(self, size=50, check_seconds=1.0, rebuild_seconds=300, reread=8, clock=time.monotonic):
+        self.size = max(1, int(size))
+        self.reread = max(0, int(reread))
+        self.check_seconds = float(check_seconds)
+        self.rebuild_seconds = float(rebuild_seconds)
+        self._clock = clock
+        self._rings = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+        self.rebuilds = 0
+
+    def _ring(self, channel):
+        with self._lock:
+            ring = self._rings.get(channel)
+            if ring is None:
+                ring = self._rings[channel] = _Ring(self.size)
+            return ring
+
+    def read(self, channel, version, load_latest, load_after):
+        """Снимок буфера канала.
+
+        load_latest(n) — последние n сообщений канала по возрастанию id;
+        load_after(after_id, n) — до n сообщений канала с id > after_id по возрастанию id.
+        """
+        ring = self._ring(channel)
+        with ring.lock:
+            now = self._clock()
+            if ring.version != version or now - ring.built_at >= self.rebuild_seconds:
+                self._rebuild(ring, version, load_latest, now)
+            elif now - ring.checked_at >= self.check_seconds:
+                # С запасом reread ниже последнего: сообщения, закоммиченные позже соседей с большим id
+                floor = len(ring.items) - self.reread - 1
+                floor_id = ring.items[floor]['id'] if floor >= 0 else 0
+                new_items = load_after(floor_id, self.size + self.reread + 1)
+                if len(new_items) > self.size + self.reread:
+                    # Новых больше, чем помещается, — проще собрать заново
+                    self._rebuild(ring, version, load_latest, now)
+                else:
+                    known = {item['id'] for item in ring.items}
+                    fresh = [item for item in new_items if item['id'] not in known]
+                    if fresh:
+                        merged = sorted(list(ring.items) + fresh, key=lambda item: item['id'])
+                        if len(merged) > self.size:
+                            ring.complete = False
+                        ring.items.clear()
+                        ring.items.extend(merged[-self.size:])
+                    ring.checked_at = now
+                    self.refreshes += 1
+            else:
+                self.hits += 1
+            return list(ring.items), ring.complete
+
+    def _rebuild(self, ring, version, load_latest, now):
+        items = load_latest(self.size + 1)
+        ring.complete = len(items) <= self.size
+        ring.items.clear()
+        ring.items.extend(items[-self.size:])
+        ring.version = version
+        ring.checked_at = ring.built_at = now
+        self.rebuilds += 1
+
+    def touch(self, channel):
+        """В канал записано сообщение — при следующем чтении дочитать из БД."""
+        with self._lock:
+            ring = self._rings.get(channel)
+        if ring is not None:
+            ring.checked_at = 0.0
+
+    def clear(self, channel=None):
+        """Забыть буфер канала (или все) — после удаления сообщений."""
+        with self._lock:
+            if channel is None:
+                self._rings.clear()
+            else:
+                self._rings.pop(channel, None)
+
+    def stats(self):
+        with self._lock:
+            channels = len(self._rings)
+        return {
+            'channels': channels, 'size': self.size, 'hits': self.hits,
+            'refreshes': self.refreshes, 'rebuilds': self.rebuilds,
+        }
+
+
+def after(items, complete, after_id):
+    """Сообщения снимка с id > after_id или None, если снимок их может не содержать
+    (клиент отстал дальше начала буфера)."""
+    if items and after_id < items[0]['id'] and not complete:
+        return None
+    return [item for item in items if item['id'] > after_id]
+
+
+def unread(items, complete, after_id, key=None, skip_key=None):
+    """Число сообщений снимка с id > after_id (только с ключом key / кроме ключа skip_key)
+    или None, если снимок их может не содержать."""
+    if not items or after_id >= items[-1]['id']:
+        return 0
+    if after_id < items[0]['id'] and not complete:
+        return None
+    count = 0
+    for item in reversed(items):
+        if item['id'] <= after_id:
+            break
+        if (key is None or item['key'] == key) and (skip_key is None or item['key'] != skip_key):
+            count += 1
+    return count
+
+
+def latest(items, complete, limit):
+    """(последние limit сообщений, has_more) или None, если буфера не хватает."""
+    if len(items) > limit:
+        return items[-limit:], True
+    if complete:
+        return items, False
+    return None
@@ -0,0 +1,119 @@
+"""
+Проверка answer_checkers на всех генераторах generate_boss_tasks.
+
+Для каждого генератора (generate_*, все уровни сложности) создаётся --samples задач, и для
+каждой задачи проверяется, что:
+  - эталонный ответ принимается;
+  - ответ в формате формы на клиенте тоже принимается (дробь двумя полями, если целая часть 0);
+  - эталон с изменённым последним числом отклоняется;
+  - ключ, прошедший через JSON (как в токене задачи), даёт те же результаты.
+
+Запуск:
+  python check_answer_checkers.py
+  python check_answer_checkers.py --samples 2000 --seed 1
+"""
+from __future__ import annotations
+
+import argparse
+import inspect
+import json
+import random
+import re
+import sys
+from collections import Counter
+from typing import Sequence
+
+import generate_boss_tasks
+from answer_checkers import check_answer, compile_answer_key
+
+_LAST_INT_RE = re.compile(r'(-?\d+)(?!.*\d)')
+
+
+def _generators():
+    """(имя, функция(difficulty)) для всех generate_* без обязательных аргументов кроме difficulty."""
+    out = []
+    for name, fn in sorted(vars(generate_boss_tasks).items()):
+        if not name.startswith('generate_') or not inspect.isfunction(fn):
+            continue
+        if fn.__module__ != generate_boss_tasks.__name__:
+            continue
+        params = inspect.signature(fn).parameters
+        required = [p for p in params.values() if p.default is inspect.Parameter.empty]
+        if any(p.name != 'difficulty' for p in required):
+            continue
+        if 'difficulty' in params:
+            out.append((name, fn, (1, 2, 3)))
+        else:
+            out.append((name, lambda d, fn=fn: fn(), (None,)))
+    return out
+
+
+def _perturbed(answer: str) -> str | None:
+    """Эталон с последним целым числом +1 (None, если чисел нет)."""
+    m = _LAST_INT_RE.search(answer)
+    if not m:
+        return None
+    return answer[:m.start()] + str(int(m.group(1)) + 1) + answer[m.end():]
+
+
+def _client_variants(answer_type: str, answer: str):
+    parts = answer.split('|')
+    if answer_type in ('fraction_property', 'mixed', 'proper_improper') and len(parts) == 3 and parts[0].strip() == '0':
+        yield '|'.join(parts[1:])
+    if answer_type == 'decimal' and '.' in answer:
+        yield answer.replace('.', ',')
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--samples", type=int, default=300, help="Задач на генератор и уровень")
+    parser.add_argument("--seed", type=int, default=None, help="Зерно random")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    failures = []
+    generator_errors = Counter()
+    types_seen = Counter()
+    checked = 0
+    for name, fn, levels in _generators():
+        for level in levels:
+            for _ in range(args.samples):
+                try:
+                    task = fn(level)
+                except Exception as e:
+                    # Сбои генераторов приложение перехватывает само; здесь только отмечаем
+                    generator_errors[f"{name}({level}): {e!r}"] += 1
+                    continue
+                if not task or not task.get('correct_answer'):
+                    continue
+                title, answer = task.get('title', ''), str(task['correct_answer'])
+                key = compile_answer_key(title, answer)
+                key_json = json.loads(json.dumps(key))
+                types_seen[key[0]] += 1
+                checked += 1
+                cases = [(answer, True)]
+                cases += [(v, True) for v in _client_variants(key[0], answer)]
+                wrong = _perturbed(answer)
+                if wrong is not None and wrong != answer:
+                    cases.append((wrong, False))
+                for user_answer, expected in cases:
+                    got = check_answer(key, user_answer)
+                    if got != expected or check_answer(key_json, user_answer) != got:
+                        failures.append(
+                            f"{name}({level}) [{key[0]}] «{title}»: эталон {answer!r}, ответ {user_answer!r} -> {got}"
+                        )
+    print(f"Проверено задач: {checked}; типы ответов: {dict(types_seen)}")
+    for line, count in generator_errors.items():
+        print(f"  генератор упал {count} раз: {line}")
+    if failures:
+        for line in failures[:50]:
+            print("  " + line)
+        print(f"Ошибок: {len(failures)}", file=sys.stderr)
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
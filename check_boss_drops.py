@@ -0,0 +1,114 @@
+"""
+Монте-Карло проверка выбора дропа рейд-босса (boss_drops): эмпирические частоты против
+BossDrop.get_probability_value().
+
+Бросается --rolls полных бросков boss_drops.roll: доля бросков с дропом сравнивается с
+boss_drops.DROP_CHANCE, доля каждого дропа среди выпавших — с его весом, нормированным на сумму
+весов доступных дропов. Второй прогон — с первым дропом, упёршимся в лимит max_per_user:
+он не должен выпадать, остальные делят вероятность пропорционально весам. Отклонение больше
+--sigma стандартных ошибок — расхождение (код 1).
+
+Без --boss-id проверяется набор из дропов всех уровней вероятности (не сохраняется в БД).
+
+Запуск:
+  python check_boss_drops.py
+  python check_boss_drops.py --rolls 5000000 --seed 7
+  python check_boss_drops.py --boss-id 3
+"""
+from __future__ import annotations
+
+import argparse
+import math
+import random
+import sys
+import time
+from collections import Counter
+from typing import Sequence
+
+from app import app, BossDrop
+import boss_drops
+
+
+def _sample_drops():
+    drops = []
+    for i, probability in enumerate(('high', 'medium', 'very_low', 'high', 'other'), start=1):
+        drops.append(BossDrop(id=i, boss_id=0, name=f'drop {i}', probability=probability))
+    return drops
+
+
+def _run(label, drops, capped_ids, rolls, sigma, rng):
+    """Прогон: [(строка отчёта)], [(расхождение)]."""
+    table = boss_drops.build(drops)
+    counts = {drop_id: 1 for drop_id in capped_ids}
+    if capped_ids:
+        # Лимит 1 у упёршихся дропов: выбор должен их обходить
+        entries = [d._replace(max_per_user=1) if d.id in capped_ids else d for d in table.items]
+        table = boss_drops.AliasTable(entries, [d.weight for d in entries])
+    weights = {d.id: float(d.get_probability_value()) for d in drops if d.id not in capped_ids}
+    total = sum(weights.values())
+
+    started = time.perf_counter()
+    hits = Counter()
+    for _ in range(rolls):
+        drop = boss_drops.roll(table, lambda: counts, rng)
+        if drop is not None:
+            hits[drop.id] += 1
+    elapsed = time.perf_counter() - started
+
+    lines, problems = [], []
+    dropped = sum(hits.values())
+
+    def compare(name, observed, n, expected):
+        se = math.sqrt(expected * (1 - expected) / n) if n and 0 < expected < 1 else 0.0
+        z = (observed - expected) / se if se else (0.0 if observed == expected else math.inf)
+        lines.append(f"    {name:<26}{expected:10.5f}{observed:10.5f}{z:+8.2f}")
+        if abs(z) > sigma:
+            problems.append(f"{label}: {name} ожидалось {expected:.5f}, получено {observed:.5f} ({z:+.1f} σ)")
+
+    lines.append(f"  {label}: {rolls} бросков за {elapsed:.1f} с, дропов {dropped}")
+    lines.append(f"    {'':<26}{'ожидание':>10}{'факт':>10}{'σ':>8}")
+    compare('шанс дропа', dropped / rolls, rolls, boss_drops.DROP_CHANCE)
+    for drop in drops:
+        expected = weights.get(drop.id, 0.0) / total if total else 0.0
+        compare(f"#{drop.id} {drop.probability}", hits[drop.id] / dropped if dropped else 0.0, dropped, expected)
+    return lines, problems
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rolls", type=int, default=2000000, help="Бросков в каждом прогоне")
+    parser.add_argument("--boss-id", type=int, help="Дропы этого босса из БД")
+    parser.add_argument("--sigma", type=float, default=5.0, help="Допустимое отклонение в стандартных ошибках")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        if args.boss_id is not None:
+            drops = BossDrop.query.filter_by(boss_id=args.boss_id).order_by(BossDrop.id).all()
+        else:
+            drops = _sample_drops()
+        if not drops:
+            print(f"У босса {args.boss_id} нет дропов", file=sys.stderr)
+            return 1
+
+        rng = random.Random(args.seed)
+        report, problems = _run('все доступны', drops, set(), args.rolls, args.sigma, rng)
+        if len(drops) > 1:
+            lines, more = _run(f"#{drops[0].id} в лимите", drops, {drops[0].id}, args.rolls, args.sigma, rng)
+            report += lines
+            problems += more
+
+    print(f"Дропов: {len(drops)}, шанс дропа {boss_drops.DROP_CHANCE}")
+    for line in report:
+        print(line)
+    for line in problems:
+        print(f"  расхождение — {line}", file=sys.stderr)
+    if problems:
+        print(f"Расхождений: {len(problems)}", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
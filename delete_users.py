@@ -11,12 +11,14 @@ from app import (
     PvPArenaChatMessage,
     PvPDuelChallenge,
     PvPDuel,
+    UserPvPStats,
     UserTerritoryStats,
     UserShopPurchase,
     UserEquipment,
     ActiveItemBuff,
     TerritoryRegionState,
 )
+import pvp_stats
 
 
 USER_IDS = []
@@ -32,11 +34,22 @@ def main() -> None:
             | (PvPDuelChallenge.defender_id.in_(USER_IDS))
         ).delete(synchronize_session=False)
 
-        PvPDuel.query.filter(
+        duels_filter = (
             (PvPDuel.challenger_id.in_(USER_IDS))
             | (PvPDuel.defender_id.in_(USER_IDS))
             | (PvPDuel.current_turn_user_id.in_(USER_IDS))
             | (PvPDuel.winner_id.in_(USER_IDS))
+        )
+        # Соперники: их итоги дуэлей пересчитываются после удаления общих дуэлей
+        opponent_ids = set()
+        for challenger_id, defender_id in db.session.query(PvPDuel.challenger_id, PvPDuel.defender_id).filter(duels_filter):
+            opponent_ids.update((challenger_id, defender_id))
+        opponent_ids -= set(USER_IDS)
+
+        PvPDuel.query.filter(duels_filter).delete(synchronize_session=False)
+
+        UserPvPStats.query.filter(
+            UserPvPStats.user_id.in_(USER_IDS)
         ).delete(synchronize_session=False)
 
         # --- Присутствие и чат PvP арены ---
@@ -106,6 +119,8 @@ def main() -> None:
             db.session.delete(user)
 
         db.session.commit()
+        if opponent_ids:
+            pvp_stats.backfill(sorted(opponent_ids))
         print("Готово: пользователи и все связанные записи удалены.")
 
 
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""
+Армия Демогоргонов как детерминированный автомат: состояние армии + сила областей + время -> новое состояние.
+
+advance() применяет за один вызов все события, наступившие с last_damage_tick_at до now:
+  - тики урона каждые tick_seconds (сетка от last_damage_tick_at, без сдвига на время вызова);
+    тики подряд по одной области считаются пачкой — одно действие на отрезок до обнуления
+    области, плановой смены области или now;
+  - область обнулена — армия уходит в самую сильную область (из нескольких равных — не в текущую),
+    а если сильных областей нет, армия исчезает;
+  - наступило next_move_at — плановая смена области.
+При равенстве времени тик идёт раньше плановой смены, как в прежнем тике по одному вызову.
+
+Случайные выборы (область из равных, координаты, задержка до смены) берутся из random.Random,
+посеянного идентификатором армии и временем события. Поэтому результат зависит только от
+начального состояния и now: один вызов через час даёт то же, что 1800 вызовов раз в 2 секунды.
+
+Здоровье армии здесь не меняется — его уменьшают ответы игроков, завершение армии делает app.py.
+"""
+import math
+import random
+from collections import namedtuple
+from datetime import timedelta
+
+# last_damage_tick_at — время последнего применённого тика; next_move_at — время плановой смены области
+ArmyState = namedtuple('ArmyState', 'region_index pos_x pos_y is_active last_damage_tick_at next_move_at')
+
+SimParams = namedtuple('SimParams', 'tick_seconds damage_per_tick min_move_minutes max_move_minutes')
+
+# strengths — сила областей после шага; drains — {region_index: суммарное снятие силы};
+# ticks — число применённых тиков; moves — [(время, из области, в область)] (в область None — армия исчезла)
+StepResult = namedtuple('StepResult', 'state strengths drains ticks moves')
+
+
+def _rng(seed, at):
+    return random.Random(f'{seed}:{at.isoformat()}')
+
+
+def choose_region(strengths, current_region_index, rng):
+    """Самая сильная область с силой > 0 (из равных — не текущая, если есть другие) или None."""
+    positives = [ri for ri, strength in sorted(strengths.items()) if strength > 0]
+    if not positives:
+        return None
+    max_strength = max(strengths[ri] for ri in positives)
+    candidates = [ri for ri in positives if strengths[ri] == max_strength]
+    if current_region_index is not None and len(candidates) > 1:
+        non_current = [ri for ri in candidates if ri != current_region_index]
+        if non_current:
+            candidates = non_current
+    return rng.choice(candidates)
+
+
+def advance(state, strengths, now, seed, params):
+    """Применить к армии все тики и смены области до момента now.
+
+    strengths — {region_index: сила} на момент вызова (не изменяется).
+    seed — постоянный для армии (id), чтобы повторный расчёт давал тот же результат.
+    """
+    strengths = {ri: int(s or 0) for ri, s in strengths.items()}
+    drains, moves, ticks = {}, [], 0
+    region_index, pos_x, pos_y, is_active, last_tick, next_move = state
+    step = timedelta(seconds=params.tick_seconds)
+    damage = max(1, int(params.damage_per_tick))
+
+    def relocate(at):
+        rng = _rng(seed, at)
+        target = choose_region(strengths, region_index, rng)
+        delay = timedelta(minutes=rng.randint(params.min_move_minutes, params.max_move_minutes))
+        if target is None:
+            return None, pos_x, pos_y, at + delay
+        return target, rng.random(), rng.random(), at + delay
+
+    while is_active:
+        next_tick = last_tick + step
+        if next_move is not None and next_move < next_tick:
+            # Плановая смена области раньше следующего тика
+            if next_move > now:
+                break
+            at = next_move
+            target, new_x, new_y, next_move = relocate(at)
+            if target is not None:
+                moves.append((at, region_index, target))
+                region_index, pos_x, pos_y = target, new_x, new_y
+            continue
+        if next_tick > now:
+            break
+
+        # Тики подряд по текущей области: до now, до плановой смены и до обнуления области
+        n = (now - last_tick) // step
+        if next_move is not None:
+            n = min(n, (next_move - last_tick) // step)
+        strength = strengths.get(region_index)
+        if strength is not None:
+            n = min(n, max(1, math.ceil(strength / damage)))
+        last_tick += step * n
+        ticks += n
+        if strength is None:
+            # Области нет в карте — тики проходят впустую
+            continue
+        drains[region_index] = drains.get(region_index, 0) + damage * n
+        strengths[region_index] = max(0, strength - damage * n)
+        if strengths[region_index] > 0:
+            continue
+
+        # Область съедена — уходим в самую сильную или исчезаем, если сильных нет
+        at = last_tick
+        target, new_x, new_y, delay_until = relocate(at)
+        if target is None:
+            moves.append((at, region_index, None))
+            is_active = False
+            break
+        moves.append((at, region_index, target))
+        region_index, pos_x, pos_y, next_move = target, new_x, new_y, delay_until
+
+    new_state = ArmyState(region_index, pos_x, pos_y, is_active, last_tick, next_move)
+    return StepResult(new_state, strengths, drains, ticks, moves)
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Серверные события (SSE) для страниц игры: /api/stream?topics=map,demogorgon,duel:5,clan-chat:3,arena.
+
+EventBroker — pub/sub в памяти процесса: у каждого открытого потока своя очередь, publish раскладывает
+событие по очередям подписчиков темы. Событие — подсказка «что изменилось» с небольшим payload;
+страница по нему перечитывает данные через те же API, что и при опросе.
+
+Несколько воркеров gunicorn: PgNotifyBridge (только PostgreSQL) отправляет каждое событие через
+NOTIFY в общий канал и слушает его (LISTEN) в отдельном потоке; события, пришедшие от своего же
+процесса, пропускаются (их уже доставил publish). Если поток LISTEN переподключался, подписчики
+получают resync — события за это время могли потеряться.
+
+Если очередь подписчика переполнена (медленный клиент), лишние события отбрасываются,
+а клиент получает одно событие resync.
+"""
+import json
+import logging
+import queue
+import select
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Событие для клиента: «перечитай всё по своим темам»
+RESYNC = 'resync'
+
+
+def format_sse(data, event=None, retry_ms=None):
+    """Одно сообщение в формате text/event-stream."""
+    lines = []
+    if retry_ms is not None:
+        lines.append(f'retry: {int(retry_ms)}')
+    if event:
+        lines.append(f'event: {event}')
+    lines.append('data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')))
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+    """Очередь событий одного потока /api/stream."""
+
+    def __init__(self, topics, maxsize):
+        self.topics = frozenset(topics)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._overflow = False
+        self._lock = threading.Lock()
+
+    def put(self, message):
+        with self._lock:
+            if self._overflow:
+                return
+            try:
+                self._queue.put_nowait(message)
+            except queue.Full:
+                self._overflow = True
+
+    def get(self, timeout):
+        """Следующее событие {topic, event, data}, событие resync после переполнения или None по таймауту."""
+        with self._lock:
+            if self._overflow and self._queue.empty():
+                self._overflow = False
+                return {'topic': None, 'event': RESYNC, 'data': None}
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class EventBroker:
+    """Pub/sub в памяти процесса: тема -> подписки."""
+
+    def __init__(self, queue_size=200):
+        self.queue_size = max(1, int(queue_size))
+        self.origin = uuid.uuid4().hex
+        self._subs = {}
+        self._lock = threading.Lock()
+        self._bridge = None
+        self.published = 0
+        self.delivered = 0
+
+    @property
+    def connections(self):
+        with self._lock:
+            return len({id(s) for subs in self._subs.values() for s in subs})
+
+    def subscribe(self, topics):
+        sub = Subscription(topics, self.queue_size)
+        with self._lock:
+            for topic in sub.topics:
+                self._subs.setdefault(topic, set()).add(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            for topic in sub.topics:
+                subs = self._subs.get(topic)
+                if subs is not None:
+                    subs.discard(sub)
+                    if not subs:
+                        del self._subs[topic]
+
+    def attach_bridge(self, bridge):
+        self._bridge = bridge
+
+    def publish(self, topic, event, data=None):
+        """Доставить событие подписчикам этого процесса и (если есть мост) остальным воркерам."""
+        self.published += 1
+        self.publish_local(topic, event, data)
+        bridge = self._bridge
+        if bridge is not None:
+            bridge.notify({'o': self.origin, 't': topic, 'e': event, 'd': data})
+
+    def publish_local(self, topic, event, data=None):
+        with self._lock:
+            subs = list(self._subs.get(topic, ()))
+        message = {'topic': topic, 'event': event, 'data': data}
+        for sub in subs:
+            sub.put(message)
+        self.delivered += len(subs)
+
+    def resync_all(self):
+        """Всем подписчикам — resync (после потери событий, например переподключения LISTEN)."""
+        with self._lock:
+            subs = {s for topic_subs in self._subs.values() for s in topic_subs}
+        for sub in subs:
+            sub.put({'topic': None, 'event': RESYNC, 'data': None})
+
+    def deliver_remote(self, payload):
+        """Событие из канала NOTIFY (JSON от publish другого процесса)."""
+        try:
+            msg = json.loads(payload)
+        except ValueError:
+            return
+        if msg.get('o') == self.origin:
+            return
+        self.publish_local(msg.get('t'), msg.get('e'), msg.get('d'))
+
+
+class PgNotifyBridge:
+    """Мост между процессами через PostgreSQL LISTEN/NOTIFY (psycopg2).
+
+    connect() -> DBAPI-соединение psycopg2 (например engine.raw_connection().driver_connection);
+    для LISTEN и для NOTIFY используются два отдельных соединения в режиме autocommit.
+    """
+
+    # Ограничение PostgreSQL на payload NOTIFY — 8000 байт
+    MAX_PAYLOAD = 7900
+
+    def __init__(self, broker, connect, channel):
+        self._broker = broker
+        self._connect = connect
+        self._channel = channel
+        self._send_conn = None
+        self._send_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.reconnects = 0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._listen_loop, name='event-stream-listen', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _open(self):
+        conn = self._connect()
+        conn.autocommit = True
+        return conn
+
+    def notify(self, message):
+        payload = json.dumps(message, ensure_ascii=False, separators=(',', ':'))
+        if len(payload.encode('utf-8')) > self.MAX_PAYLOAD:
+            # Большое событие — другим воркерам только подсказка перечитать тему
+            payload = json.dumps({'o': message['o'], 't': message['t'], 'e': RESYNC, 'd': None})
+        with self._send_lock:
+            for attempt in (1, 2):
+                try:
+                    if self._send_conn is None or self._send_conn.closed:
+                        self._send_conn = self._open()
+                    with self._send_conn.cursor() as cur:
+                        cur.execute('SELECT pg_notify(%s, %s)', (self._channel, payload))
+                    return
+                except Exception as e:
+                    self._close_send_conn()
+                    if attempt == 2:
+                        logger.error(f'Поток событий: ошибка NOTIFY: {e}')
+
+    def _close_send_conn(self):
+        try:
+            if self._send_conn is not None:
+                self._send_conn.close()
+        except Exception:
+            pass
+        self._send_conn = None
+
+    def _listen_loop(self):
+        delay = 1
+        first = True
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = self._open()
+                with conn.cursor() as cur:
+                    cur.execute(f'LISTEN "{self._channel}"')
+                if not first:
+                    self.reconnects += 1
+                    self._broker.resync_all()
+                first = False
+                delay = 1
+                while not self._stop.is_set():
+                    if select.select([conn], [], [], 5) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        self._broker.deliver_remote(conn.notifies.pop(0).payload)
+            except Exception as e:
+                logger.error(f'Поток событий: ошибка LISTEN, переподключение через {delay} с: {e}')
+                time.sleep(delay)
+                delay = min(60, delay * 2)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
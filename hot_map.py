@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+"""
+«Горячая» карта битвы за территорию на время окна захвата (TERRITORY_HOT_MAP=1).
+
+Владелец и сила областей, блокировки и множители сооружений держатся в памяти одного процесса —
+экземпляра, который держит лок планировщика. Удары по областям применяет один поток-актор строго
+в порядке очереди; изменённые области и приращения статистики игроков пишутся в БД пачкой раз
+в flush_interval_ms.
+
+Каждое применённое действие до ответа игроку дописывается в журнал (JSON-строка на действие).
+Перед каждой записью в БД журнал сбрасывается на диск (fsync), после commit — очищается.
+При падении процесса теряется не больше одного интервала; что не успело попасть в БД,
+восстанавливает replay_log при следующем старте.
+
+С БД модуль работает только через функции load/flush, которые передаёт app.py:
+  load()  -> MapData
+  flush(regions, stats, last_seq) -> bool
+     regions  — {region_index: (owner_clan_id, strength, version, expected_version)} изменённых
+                областей (абсолютные значения); expected_version — версия строки в БД, от которой
+                считались изменения (None — без проверки, старые строки журнала);
+     stats    — {user_id: [урон, влияние]} приращения user_territory_stats;
+     last_seq — номер последнего действия журнала, попавшего в эту запись.
+     Возвращает True, если карту нужно перечитать из БД: другой экземпляр просил об этом или
+     область изменили в обход актора (версия строки не совпала — такая запись не применяется).
+
+Версия карты: каждое действие присваивает области следующий номер (после max version из БД и
+MapData.version — последнего номера, выданного в БД), по нему /api/territory/map-state отдаёт
+только изменившиеся области (changes_since).
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# regions: {region_index: (owner_clan_id, strength)}; versions: {region_index: version};
+# locked: множество region_index; structure_mults: {region_index: (множитель атаки, множитель защиты)};
+# last_seq — из чекпоинта в БД; version — последний номер версии карты, выданный в БД (0 — нет)
+MapData = namedtuple('MapData', 'regions versions locked structure_mults last_seq version', defaults=(0,))
+
+
+def read_log(path, after_seq):
+    """Действия журнала с seq > after_seq: (последние значения областей, приращения статистики, max seq)."""
+    regions, stats, max_seq = {}, {}, after_seq
+    if not path or not os.path.exists(path):
+        return regions, stats, max_seq
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                break  # недописанная последняя строка
+            seq = entry['seq']
+            max_seq = max(max_seq, seq)
+            if seq <= after_seq:
+                continue
+            regions[entry['r']] = (entry['o'], entry['s'], entry.get('v'), entry.get('e'))
+            if entry.get('u') and (entry.get('d') or entry.get('i')):
+                delta = stats.setdefault(entry['u'], [0, 0])
+                delta[0] += entry.get('d') or 0
+                delta[1] += entry.get('i') or 0
+    return regions, stats, max_seq
+
+
+def replay_log(path, last_seq, flush):
+    """Дописать в БД действия журнала, не попавшие в неё до падения, и очистить журнал.
+    Возвращает число восстановленных областей."""
+    regions, stats, max_seq = read_log(path, last_seq)
+    if regions or stats:
+        flush(regions, stats, max_seq)
+    if path and os.path.exists(path):
+        open(path, 'w').close()
+    return len(regions)
+
+
+class HotMap:
+    """Состояние карты в памяти и поток-актор, применяющий к нему действия по очереди."""
+
+    def __init__(self, load, flush, outcome, log_path, flush_interval_ms=500, context=None):
+        """outcome(old_owner_clan_id, old_strength, clan_id, power) -> (владелец, сила, урон, влияние).
+        context — фабрика контекст-менеджера для потока актора (app.app_context)."""
+        self._load_fn = load
+        self._flush_fn = flush
+        self._outcome = outcome
+        self._log_path = log_path
+        self._interval = max(10, int(flush_interval_ms)) / 1000.0
+        self._context = context
+        self._queue = queue.Queue()
+        self._regions = {}
+        self._versions = {}
+        # Версии областей в БД на момент последней загрузки/записи — условие записи в flush
+        self._db_versions = {}
+        self._version = 0
+        self._locked = frozenset()
+        self._structure_mults = {}
+        self._dirty = set()
+        self._stats = {}
+        self._seq = 0
+        self._log_file = None
+        self._log_dirty = False
+        self._started = threading.Event()
+        self._start_error = None
+        self._thread = None
+
+    # --- Поток-актор ---------------------------------------------------------------
+
+    def start(self, timeout=30):
+        self._thread = threading.Thread(target=self._run, name='territory-hot-map', daemon=True)
+        self._thread.start()
+        if not self._started.wait(timeout):
+            raise RuntimeError('Горячая карта не запустилась')
+        if self._start_error is not None:
+            raise self._start_error
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        ctx = self._context() if self._context else None
+        if ctx is not None:
+            ctx.__enter__()
+        try:
+            try:
+                self._load()
+            except Exception as e:
+                self._start_error = e
+                return
+            finally:
+                self._started.set()
+            next_flush = time.monotonic() + self._interval
+            while True:
+                try:
+                    msg = self._queue.get(timeout=max(0.0, next_flush - time.monotonic()))
+                except queue.Empty:
+                    msg = None
+                if msg is not None:
+                    kind, args, fut = msg
+                    if kind == 'stop':
+                        self._flush()
+                        fut.set_result(None)
+                        return
+                    try:
+                        fut.set_result(getattr(self, '_do_' + kind)(*args))
+                    except Exception as e:
+                        fut.set_exception(e)
+                if time.monotonic() >= next_flush:
+                    try:
+                        self._flush()
+                    except Exception:
+                        # Изменения остаются в памяти и журнале — повторим на следующем интервале
+                        logger.exception('Горячая карта: ошибка записи в БД')
+                    next_flush = time.monotonic() + self._interval
+        finally:
+            if self._log_file is not None:
+                self._log_file.close()
+                self._log_file = None
+            if ctx is not None:
+                ctx.__exit__(None, None, None)
+
+    def _call(self, kind, *args, timeout=10):
+        if not self.alive:
+            raise RuntimeError('Горячая карта остановлена')
+        fut = Future()
+        self._queue.put((kind, args, fut))
+        return fut.result(timeout)
+
+    def _load(self):
+        data = self._load_fn()
+        regions, stats, max_seq = read_log(self._log_path, data.last_seq)
+        if regions or stats:
+            self._flush_fn(regions, stats, max_seq)
+            data = self._load_fn()
+        self._regions = dict(data.regions)
+        self._versions = dict(data.versions)
+        self._db_versions = dict(data.versions)
+        self._version = max(max(self._versions.values(), default=0), int(data.version or 0))
+        self._locked = frozenset(data.locked)
+        self._structure_mults = dict(data.structure_mults)
+        self._dirty = set()
+        self._stats = {}
+        self._seq = max(data.last_seq, max_seq)
+        if self._log_path:
+            if self._log_file is None:
+                self._log_file = open(self._log_path, 'a', encoding='utf-8')
+            self._truncate_log()
+
+    def _truncate_log(self):
+        self._log_file.seek(0)
+        self._log_file.truncate()
+        self._log_dirty = False
+
+    def _set_region(self, region_index, owner_clan_id, strength):
+        self._version += 1
+        self._regions[region_index] = (owner_clan_id, strength)
+        self._versions[region_index] = self._version
+        self._dirty.add(region_index)
+
+    def _log(self, region_index, owner_clan_id, strength, user_id=None, damage=0, influence=0):
+        self._seq += 1
+        if self._log_file is None:
+            return
+        self._log_file.write(json.dumps({
+            'seq': self._seq, 'r': region_index, 'o': owner_clan_id, 's': strength, 'v': self._version,
+            'e': self._db_versions.get(region_index), 'u': user_id, 'd': damage, 'i': influence,
+        }, separators=(',', ':')) + '\n')
+        self._log_file.flush()
+        self._log_dirty = True
+
+    def _flush(self):
+        if self._log_file is not None and self._log_dirty:
+            os.fsync(self._log_file.fileno())
+        regions = {
+            ri: self._regions[ri] + (self._versions[ri], self._db_versions.get(ri)) for ri in self._dirty
+        }
+        reload_requested = self._flush_fn(regions, self._stats, self._seq)
+        for ri in self._dirty:
+            self._db_versions[ri] = self._versions[ri]
+        self._dirty = set()
+        self._stats = {}
+        if self._log_file is not None and self._log_dirty:
+            self._truncate_log()
+        if reload_requested:
+            self._load()
+
+    # --- Действия (выполняются в потоке актора) ----------------------------------------
+
+    def _do_capture(self, region_index, clan_id, user_id, attack_power, defense_power):
+        current = self._regions.get(region_index)
+        if current is None:
+            return None
+        old_owner_clan_id, old_strength = current
+        is_own_region = old_owner_clan_id == clan_id
+        power = defense_power if is_own_region else attack_power
+        owner_clan_id, strength, damage, influence = self._outcome(old_owner_clan_id, old_strength, clan_id, power)
+        self._set_region(region_index, owner_clan_id, strength)
+        if damage or influence:
+            delta = self._stats.setdefault(user_id, [0, 0])
+            delta[0] += damage
+            delta[1] += influence
+        self._log(region_index, owner_clan_id, strength, user_id, damage, influence)
+        return {
+            'owner_clan_id': owner_clan_id,
+            'strength': int(strength or 0),
+            'captured_neutral': old_owner_clan_id is None,
+            'captured_enemy': (
+                old_owner_clan_id is not None and old_owner_clan_id != clan_id
+                and owner_clan_id == clan_id and int(old_strength or 0) > 0
+            ),
+            'damage': damage,
+            'influence': influence,
+            'is_own_region': is_own_region,
+        }
+
+    def _do_drain(self, region_index, amount):
+        current = self._regions.get(region_index)
+        if current is None:
+            return None
+        owner_clan_id, strength = current
+        strength = max(0, int(strength or 0) - int(amount))
+        self._set_region(region_index, owner_clan_id, strength)
+        self._log(region_index, owner_clan_id, strength)
+        return strength
+
+    def _do_pause(self, paused, resume, timeout):
+        try:
+            self._flush()
+        finally:
+            paused.set()
+        resume.wait(timeout)
+        self._load()
+
+    def _do_reload(self):
+        self._flush()
+        self._load()
+
+    # --- API для потоков запросов ------------------------------------------------------
+
+    def capture(self, region_index, clan_id, user_id, attack_power, defense_power):
+        """Удар клана по области: сила выбирается по владельцу на момент применения
+        (defense_power — своя область, attack_power — чужая/нейтральная).
+        dict как у _territory_capture_apply плюс is_own_region, или None, если области нет."""
+        return self._call('capture', region_index, clan_id, user_id, int(attack_power), int(defense_power))
+
+    def drain(self, region_index, amount):
+        """Уменьшить силу области (Демогоргоны); новая сила или None, если области нет."""
+        return self._call('drain', region_index, amount)
+
+    def reload(self):
+        """Записать накопленное и перечитать карту из БД."""
+        return self._call('reload', timeout=30)
+
+    @contextmanager
+    def paused(self, timeout=30):
+        """Записать накопленное в БД и не применять действия, пока выполняется блок
+        (изменения карты в обход актора: очистка, роспуск клана, сброс); затем перечитать карту."""
+        paused, resume = threading.Event(), threading.Event()
+        fut = Future()
+        if not self.alive:
+            raise RuntimeError('Горячая карта остановлена')
+        self._queue.put(('pause', (paused, resume, timeout), fut))
+        if not paused.wait(timeout):
+            raise RuntimeError('Горячая карта не ответила')
+        if fut.done() and fut.exception() is not None:
+            raise fut.exception()
+        try:
+            yield
+        finally:
+            resume.set()
+            fut.result(timeout)
+
+    def stop(self, timeout=30):
+        if self.alive:
+            self._call('stop', timeout=timeout)
+            self._thread.join(timeout)
+
+    def region(self, region_index):
+        """(owner_clan_id, strength) или None."""
+        return self._regions.get(region_index)
+
+    def is_locked(self, region_index):
+        return region_index in self._locked
+
+    def structure_multipliers(self, region_index):
+        return self._structure_mults.get(region_index, (1.0, 1.0))
+
+    def snapshot(self):
+        """{region_index: (owner_clan_id, strength)} — копия на момент вызова."""
+        return dict(self._regions)
+
+    @property
+    def version(self):
+        """Номер последнего изменения карты."""
+        return self._version
+
+    def changes_since(self, version):
+        """(текущая версия, {region_index: (owner_clan_id, strength, version)} областей, изменённых
+        после version). Версию читаем первой: изменения позже неё клиент получит следующим запросом."""
+        current = self._version
+        regions = self._regions
+        return current, {
+            ri: regions[ri] + (v,) for ri, v in list(self._versions.items()) if v > version
+        }
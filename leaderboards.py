@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+Таблицы рейтинга (/game-rating, report_rating_top.py): готовые места в leaderboard_entry.
+
+Каждая доска (clans, pve, pvp) пересобирается одним INSERT ... SELECT с ROW_NUMBER() в транзакции
+под блокировкой своей строки leaderboard_state. Пересборка пропускается, если не изменился
+отпечаток исходных данных (несколько агрегатов без сортировки), поэтому задача планировщика
+раз в LEADERBOARD_REFRESH_SECONDS почти всегда только читает.
+
+Значения score/score2/score3 по доскам:
+  clans — областей у клана, сумма урона+защиты участников, 0;
+  pve   — урон+защита, урон, защита;
+  pvp   — побед в дуэлях, 0, 0.
+
+Страница — диапазон мест (rank > offset), место игрока или клана — поиск по (board, entity_id);
+оба запроса идут по индексу и не зависят от числа строк доски.
+"""
+import hashlib
+import json
+import sys
+from datetime import datetime
+
+BOARD_CLANS = 'clans'
+BOARD_PVE = 'pve'
+BOARD_PVP = 'pvp'
+BOARDS = (BOARD_CLANS, BOARD_PVE, BOARD_PVP)
+
+_PVE_SCORES_SQL = '''
+    SELECT u.id AS id,
+           COALESCE(t.total_damage_dealt, 0) AS damage,
+           COALESCE(t.total_influence_points, 0) AS influence
+    FROM "user" u LEFT JOIN user_territory_stats t ON t.user_id = u.id
+'''
+
+_BOARD_SELECT_SQL = {
+    BOARD_PVE: f'''
+        SELECT ROW_NUMBER() OVER (ORDER BY damage + influence DESC, id ASC) AS rank, id AS entity_id,
+               damage + influence AS score, damage AS score2, influence AS score3
+        FROM ({_PVE_SCORES_SQL}) x
+    ''',
+    BOARD_PVP: '''
+        SELECT ROW_NUMBER() OVER (ORDER BY wins DESC, id ASC) AS rank, id AS entity_id,
+               wins AS score, 0 AS score2, 0 AS score3
+        FROM (
+            SELECT u.id AS id, COALESCE(p.wins, 0) AS wins
+            FROM "user" u LEFT JOIN user_pvp_stats p ON p.user_id = u.id
+        ) x
+    ''',
+    BOARD_CLANS: '''
+        SELECT ROW_NUMBER() OVER (ORDER BY territory_count DESC, clan_score DESC, id ASC) AS rank, id AS entity_id,
+               territory_count AS score, clan_score AS score2, 0 AS score3
+        FROM (
+            SELECT c.id AS id,
+                   COALESCE(r.territory_count, 0) AS territory_count,
+                   COALESCE(m.clan_score, 0) AS clan_score
+            FROM clan c
+            LEFT JOIN (
+                SELECT owner_clan_id, COUNT(*) AS territory_count FROM territory_region_state
+                WHERE owner_clan_id IS NOT NULL GROUP BY owner_clan_id
+            ) r ON r.owner_clan_id = c.id
+            LEFT JOIN (
+                SELECT u.clan_id AS clan_id,
+                       SUM(COALESCE(t.total_damage_dealt, 0) + COALESCE(t.total_influence_points, 0)) AS clan_score
+                FROM "user" u LEFT JOIN user_territory_stats t ON t.user_id = u.id
+                WHERE u.clan_id IS NOT NULL
+                GROUP BY u.clan_id
+            ) m ON m.clan_id = c.id
+        ) x
+    ''',
+}
+
+# Отпечатки исходных данных: агрегаты без сортировки, меняются при любом изменении доски
+_FINGERPRINT_SQL = {
+    BOARD_PVE: [
+        'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM "user"',
+        'SELECT COUNT(*), COALESCE(SUM(total_damage_dealt), 0), COALESCE(SUM(total_influence_points), 0), '
+        'COALESCE(SUM(CAST(user_id AS BIGINT) * (total_damage_dealt + total_influence_points)), 0) FROM user_territory_stats',
+    ],
+    BOARD_PVP: [
+        'SELECT COUNT(*), COALESCE(MAX(id), 0) FROM "user"',
+        'SELECT COALESCE(SUM(wins), 0), COALESCE(SUM(CAST(user_id AS BIGINT) * wins), 0) FROM user_pvp_stats',
+    ],
+    BOARD_CLANS: [
+        'SELECT COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(id), 0) FROM clan',
+        'SELECT region_index, owner_clan_id FROM territory_region_state ORDER BY region_index',
+        'SELECT COUNT(clan_id), COALESCE(SUM(clan_id), 0), COALESCE(SUM(CAST(clan_id AS BIGINT) * id), 0) FROM "user"',
+        'SELECT COALESCE(SUM(t.total_damage_dealt + t.total_influence_points), 0), '
+        'COALESCE(SUM(CAST(u.clan_id AS BIGINT) * (t.total_damage_dealt + t.total_influence_points)), 0) '
+        'FROM user_territory_stats t JOIN "user" u ON u.id = t.user_id WHERE u.clan_id IS NOT NULL',
+    ],
+}
+
+
+def _app_module():
+    """Модуль с db и моделями (при `python app.py` это __main__, не дубликат app)."""
+    main = sys.modules.get('__main__')
+    if main is not None and hasattr(main, 'db'):
+        return main
+    import app as app_module
+    return app_module
+
+
+def _fingerprint(session, board):
+    from sqlalchemy import text
+
+    parts = [[list(row) for row in session.execute(text(sql)).all()] for sql in _FINGERPRINT_SQL[board]]
+    return hashlib.sha1(json.dumps(parts, default=str).encode('utf-8')).hexdigest()
+
+
+def refresh_board(board, *, force=False, session=None):
+    """Пересобрать доску, если изменились исходные данные (force — в любом случае).
+    Коммитит транзакцию сессии. Возвращает True, если доска пересобрана."""
+    from sqlalchemy import text
+
+    m = _app_module()
+    session = session or m.db.session
+    state = (
+        session.query(m.LeaderboardState)
+        .filter_by(board=board)
+        .populate_existing()
+        .with_for_update()
+        .first()
+    )
+    if state is None:
+        state = m.LeaderboardState(board=board, total=0)
+        session.add(state)
+        session.flush()
+    fingerprint = _fingerprint(session, board)
+    state.checked_at = datetime.now()
+    if not force and state.refreshed_at is not None and state.fingerprint == fingerprint:
+        session.commit()
+        return False
+    session.execute(text('DELETE FROM leaderboard_entry WHERE board = :board'), {'board': board})
+    session.execute(
+        text(
+            'INSERT INTO leaderboard_entry (board, rank, entity_id, score, score2, score3) '
+            f'SELECT :board, x.rank, x.entity_id, x.score, x.score2, x.score3 FROM ({_BOARD_SELECT_SQL[board]}) x'
+        ),
+        {'board': board},
+    )
+    state.total = int(session.execute(
+        text('SELECT COUNT(*) FROM leaderboard_entry WHERE board = :board'), {'board': board}
+    ).scalar() or 0)
+    state.fingerprint = fingerprint
+    state.refreshed_at = datetime.now()
+    session.commit()
+    return True
+
+
+def refresh_all(*, force=False, session=None):
+    """Пересобрать изменившиеся доски; список пересобранных."""
+    return [board for board in BOARDS if refresh_board(board, force=force, session=session)]
+
+
+def board_state(board, *, max_age_seconds=None):
+    """LeaderboardState доски. Если доска ещё не собиралась или её не проверяли дольше
+    max_age_seconds (планировщик не работает) — сначала обновить."""
+    m = _app_module()
+    state = m.db.session.get(m.LeaderboardState, board)
+    stale = state is None or state.refreshed_at is None or (
+        max_age_seconds is not None
+        and (datetime.now() - (state.checked_at or state.refreshed_at)).total_seconds() > max_age_seconds
+    )
+    if stale:
+        refresh_board(board)
+        state = m.db.session.get(m.LeaderboardState, board)
+    return state
+
+
+def page_entries(board, after_rank, limit):
+    """Места after_rank+1 … after_rank+limit (диапазон по индексу (board, rank), без OFFSET)."""
+    m = _app_module()
+    Entry = m.LeaderboardEntry
+    return (
+        Entry.query.filter(Entry.board == board, Entry.rank > after_rank)
+        .order_by(Entry.rank)
+        .limit(limit)
+        .all()
+    )
+
+
+def rank_of(board, entity_id):
+    """Строка доски игрока/клана (rank, score…) или None."""
+    if entity_id is None:
+        return None
+    m = _app_module()
+    return m.LeaderboardEntry.query.filter_by(board=board, entity_id=entity_id).first()
@@ -0,0 +1,81 @@
+"""
+Очистить territory_task от сгенерированных задач.
+
+Раньше каждая выданная задача (битва за территорию, PvP-дуэль, Демогоргоны) сохранялась
+строкой territory_task. Теперь задачи выдаются подписанным токеном (app.task_tokens) и в БД
+не пишутся, а накопленные строки больше не нужны.
+
+Остаются:
+  - базовый набор задач (app.TERRITORY_DEFAULT_TASKS) — запасной источник задач;
+  - последние --keep-last строк по id — задачи, выданные до обновления и ещё не решённые
+    (ответ по старому числовому task_id продолжает приниматься).
+
+Без --apply только показывает, сколько строк будет удалено. Удаление — пачками по --batch.
+
+Запуск:
+  python purge_territory_tasks.py
+  python purge_territory_tasks.py --apply
+  python purge_territory_tasks.py --apply --keep-last 0 --batch 20000
+"""
+from __future__ import annotations
+
+import argparse
+from typing import Sequence
+
+from sqlalchemy import and_, not_, or_
+
+from app import app, db, TerritoryTask, TERRITORY_DEFAULT_TASKS
+
+
+def _default_task_filter():
+    return or_(*[
+        and_(TerritoryTask.title == title, TerritoryTask.text == task_text, TerritoryTask.correct_answer == answer)
+        for title, task_text, answer, _xp in TERRITORY_DEFAULT_TASKS
+    ])
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--apply", action="store_true", help="Удалить (без флага — только подсчёт)")
+    parser.add_argument("--keep-last", type=int, default=1000, help="Сколько последних строк оставить")
+    parser.add_argument("--batch", type=int, default=5000, help="Строк за одну транзакцию")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        total = TerritoryTask.query.count()
+        cutoff = None
+        if args.keep_last > 0:
+            row = (
+                db.session.query(TerritoryTask.id)
+                .order_by(TerritoryTask.id.desc())
+                .offset(args.keep_last - 1)
+                .first()
+            )
+            cutoff = row[0] if row else None
+            if cutoff is None:
+                print(f"Строк: {total}, все входят в последние {args.keep_last} — удалять нечего.")
+                return 0
+        q = db.session.query(TerritoryTask.id).filter(not_(_default_task_filter()))
+        if cutoff is not None:
+            q = q.filter(TerritoryTask.id < cutoff)
+        to_delete = q.count()
+        print(f"Строк в territory_task: {total}; к удалению: {to_delete}")
+        if not args.apply:
+            print("Пробный запуск. Для удаления добавьте --apply")
+            return 0
+
+        deleted = 0
+        while True:
+            ids = [r[0] for r in q.order_by(TerritoryTask.id).limit(max(1, args.batch)).all()]
+            if not ids:
+                break
+            TerritoryTask.query.filter(TerritoryTask.id.in_(ids)).delete(synchronize_session=False)
+            db.session.commit()
+            deleted += len(ids)
+            print(f"  удалено {deleted} / {to_delete}")
+        print(f"Готово. Осталось строк: {TerritoryTask.query.count()}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
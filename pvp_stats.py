@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Итоги дуэлей игрока (user_pvp_stats): дуэли, победы, поражения, ничьи, победы со ставкой,
+выигранные/проигранные по ставкам нумы, последняя дуэль.
+
+record_finish() вызывается в транзакции завершения дуэли (ответ, истечение времени, сдача) —
+строки обоих участников блокируются и увеличиваются вместе с записью результата дуэли. Рейтинг,
+профиль и достижения читают одну строку вместо COUNT по всей истории pvp_duel.
+
+recount() — полный пересчёт по pvp_duel (одна группировка); на нём построены заполнение
+таблицы (backfill) и проверка расхождений (check), см. sync_pvp_stats.py.
+"""
+import sys
+
+FIELDS = ('duels', 'wins', 'losses', 'draws', 'wager_wins', 'nums_won', 'nums_lost', 'last_duel_id', 'last_duel_at')
+
+# Каждая завершённая дуэль — по строке на участника
+_PARTICIPANTS_SQL = '''
+    SELECT challenger_id AS uid, id, winner_id, COALESCE(wager, 0) AS wager,
+           COALESCE(finished_at, created_at) AS finished_at
+    FROM pvp_duel WHERE status = 'finished'
+    UNION ALL
+    SELECT defender_id AS uid, id, winner_id, COALESCE(wager, 0) AS wager,
+           COALESCE(finished_at, created_at) AS finished_at
+    FROM pvp_duel WHERE status = 'finished'
+'''
+
+_RECOUNT_SQL = f'''
+    SELECT uid,
+           COUNT(*) AS duels,
+           SUM(CASE WHEN winner_id = uid THEN 1 ELSE 0 END) AS wins,
+           SUM(CASE WHEN winner_id IS NOT NULL AND winner_id <> uid THEN 1 ELSE 0 END) AS losses,
+           SUM(CASE WHEN winner_id IS NULL THEN 1 ELSE 0 END) AS draws,
+           SUM(CASE WHEN winner_id = uid AND wager > 0 THEN 1 ELSE 0 END) AS wager_wins,
+           SUM(CASE WHEN winner_id = uid AND wager > 0 THEN wager ELSE 0 END) AS nums_won,
+           SUM(CASE WHEN winner_id IS NOT NULL AND winner_id <> uid AND wager > 0 THEN wager ELSE 0 END) AS nums_lost
+    FROM ({_PARTICIPANTS_SQL}) d
+    GROUP BY uid
+'''
+
+_LAST_DUEL_SQL = f'''
+    SELECT uid, id, finished_at FROM (
+        SELECT uid, id, finished_at,
+               ROW_NUMBER() OVER (PARTITION BY uid ORDER BY finished_at DESC, id DESC) AS rn
+        FROM ({_PARTICIPANTS_SQL}) d
+        WHERE finished_at IS NOT NULL
+    ) x WHERE rn = 1
+'''
+
+
+def _app_module():
+    """Модуль с db и моделями (при `python app.py` это __main__, не дубликат app)."""
+    main = sys.modules.get('__main__')
+    if main is not None and hasattr(main, 'db'):
+        return main
+    import app as app_module
+    return app_module
+
+
+def _empty(user_id):
+    row = _app_module().UserPvPStats(user_id=user_id)
+    for name in FIELDS[:7]:
+        setattr(row, name, 0)
+    return row
+
+
+def _locked_row(user_id):
+    """Строка итогов игрока под FOR UPDATE; создаётся, если её ещё нет."""
+    from sqlalchemy.exc import IntegrityError
+
+    m = _app_module()
+    query = m.UserPvPStats.query.filter_by(user_id=user_id).populate_existing().with_for_update()
+    row = query.first()
+    if row is not None:
+        return row
+    try:
+        with m.db.session.begin_nested():
+            row = _empty(user_id)
+            m.db.session.add(row)
+    except IntegrityError:
+        # Первую дуэль игрока параллельно завершил другой запрос
+        row = query.first()
+    return row
+
+
+def get(user_id):
+    """Строка итогов игрока или None (дуэлей ещё не было)."""
+    m = _app_module()
+    return m.db.session.get(m.UserPvPStats, user_id)
+
+
+def record_finish(duel):
+    """Учесть завершённую дуэль в итогах обоих участников (в транзакции завершения, один раз)."""
+    wager = max(0, int(duel.wager or 0))
+    finished_at = duel.finished_at
+    # Строки блокируются в порядке user_id — два завершения не ждут друг друга крест-накрест
+    for user_id in sorted((duel.challenger_id, duel.defender_id)):
+        row = _locked_row(user_id)
+        row.duels = (row.duels or 0) + 1
+        if duel.winner_id is None:
+            row.draws = (row.draws or 0) + 1
+        elif duel.winner_id == user_id:
+            row.wins = (row.wins or 0) + 1
+            if wager:
+                row.wager_wins = (row.wager_wins or 0) + 1
+                row.nums_won = (row.nums_won or 0) + wager
+        else:
+            row.losses = (row.losses or 0) + 1
+            row.nums_lost = (row.nums_lost or 0) + wager
+        if finished_at is not None and (
+            row.last_duel_at is None
+            or (finished_at, duel.id) >= (row.last_duel_at, row.last_duel_id or 0)
+        ):
+            row.last_duel_id = duel.id
+            row.last_duel_at = finished_at
+
+
+def recount(session=None):
+    """Итоги всех игроков по pvp_duel: {user_id: {поле: значение}}."""
+    from sqlalchemy import text
+
+    session = session or _app_module().db.session
+    result = {}
+    for row in session.execute(text(_RECOUNT_SQL)).mappings():
+        values = {name: int(row[name] or 0) for name in FIELDS[:7]}
+        values['last_duel_id'] = None
+        values['last_duel_at'] = None
+        result[row['uid']] = values
+    for uid, duel_id, finished_at in session.execute(text(_LAST_DUEL_SQL)).all():
+        if uid in result:
+            result[uid]['last_duel_id'] = duel_id
+            result[uid]['last_duel_at'] = finished_at
+    return result
+
+
+def _as_datetime(value):
+    """SQLite отдаёт время из сырого SQL строкой."""
+    if isinstance(value, str):
+        from datetime import datetime
+        return datetime.fromisoformat(value)
+    return value
+
+
+def check(user_ids=None):
+    """Расхождения итогов с пересчётом: [(user_id, поле, сохранено, должно быть)]."""
+    m = _app_module()
+    expected = recount()
+    stored = {row.user_id: row for row in m.UserPvPStats.query.all()}
+    scope = set(expected) | set(stored)
+    if user_ids:
+        scope &= set(user_ids)
+    problems = []
+    for user_id in sorted(scope):
+        want = expected.get(user_id)
+        row = stored.get(user_id)
+        for name in FIELDS:
+            have = getattr(row, name) if row is not None else None
+            should = want[name] if want is not None else None
+            if name == 'last_duel_at':
+                should = _as_datetime(should)
+            if name not in ('last_duel_id', 'last_duel_at'):
+                have, should = int(have or 0), int(should or 0)
+            if have != should:
+                problems.append((user_id, name, have, should))
+    return problems
+
+
+def backfill(user_ids=None, session=None):
+    """Записать итоги из пересчёта (создать недостающие строки, исправить расхождения).
+    Коммитит. Возвращает число записанных строк."""
+    from sqlalchemy import text
+
+    m = _app_module()
+    session = session or m.db.session
+    # Недостающие строки создаются пустыми отдельной транзакцией, чтобы дальше заблокировать все строки
+    players = {uid for (uid,) in session.execute(text(f'SELECT DISTINCT uid FROM ({_PARTICIPANTS_SQL}) d'))}
+    missing = players - {uid for (uid,) in session.query(m.UserPvPStats.user_id).all()}
+    if user_ids:
+        missing &= set(user_ids)
+    for user_id in sorted(missing):
+        _locked_row(user_id)
+    session.commit()
+
+    query = m.UserPvPStats.query.populate_existing().with_for_update().order_by(m.UserPvPStats.user_id)
+    if user_ids:
+        query = query.filter(m.UserPvPStats.user_id.in_(user_ids))
+    rows = query.all()
+    # Пересчёт после блокировки: завершение дуэли ждёт её в record_finish и прибавит свою дуэль
+    # уже к записанным итогам
+    expected = recount(session)
+    written = 0
+    for row in rows:
+        values = expected.get(row.user_id)
+        changed = False
+        for name in FIELDS:
+            value = values[name] if values is not None else (0 if name in FIELDS[:7] else None)
+            if name == 'last_duel_at':
+                value = _as_datetime(value)
+            if getattr(row, name) != value:
+                setattr(row, name, value)
+                changed = True
+        written += changed
+    session.commit()
+    return written
@@ -146,8 +146,10 @@ def _query_participants_by_class(
     correct_only: bool,
     mode: str,
     dedup_by_name: bool,
+    anonymous_only: bool = False,
 ) -> list[sqlite3.Row]:
     """
+    anonymous_only: только решения без user_id (остальных участников даёт таблица лидеров).
     mode:
       - "main": каждому пользователю назначается один "главный" класс (как в топах: по числу решений, тай-брейк по времени)
       - "used": пользователь считается в каждом классе, где он участвовал
@@ -156,6 +158,8 @@ def _query_participants_by_class(
     params: list[object] = [boss_id]
     if correct_only:
         where += " AND s.is_correct IS TRUE"
+    if anonymous_only:
+        where += " AND s.user_id IS NULL"
 
     # user_key:
     # - по умолчанию: если есть user_id — считаем по нему, иначе по имени как есть
@@ -245,6 +249,7 @@ def _query_participant_names_by_class(
     correct_only: bool,
     mode: str,
     dedup_by_name: bool,
+    anonymous_only: bool = False,
 ) -> list[sqlite3.Row]:
     """
     Возвращает строки: {class_id, class_name, display_name, user_key}
@@ -254,6 +259,8 @@ def _query_participant_names_by_class(
     params: list[object] = [boss_id]
     if correct_only:
         where += " AND s.is_correct IS TRUE"
+    if anonymous_only:
+        where += " AND s.user_id IS NULL"
 
     user_key_expr = (
         "canon_name(s.user_name)"
@@ -349,6 +356,72 @@ def _query_participant_names_by_class(
     raise ValueError(f"Unknown mode: {mode}")
 
 
+def _leaderboard_ready(conn: sqlite3.Connection, boss_id: int) -> bool:
+    """
+    Таблица лидеров рейда (boss_leaderboard, см. boss_top.py) есть и заполнена для босса.
+    Приложение ведёт её при каждом правильном ответе: строка kind='user' — пользователь
+    с его главным классом, поэтому режим main по правильным решениям читает её вместо
+    группировок по всем решениям.
+    """
+    if not _table_exists(conn, "boss_leaderboard"):
+        return False
+    row = conn.execute(
+        "SELECT 1 FROM boss_leaderboard WHERE boss_id = ? AND kind = 'user' LIMIT 1",
+        (boss_id,),
+    ).fetchone()
+    return row is not None
+
+
+def _query_participants_from_leaderboard(conn: sqlite3.Connection, *, boss_id: int) -> list[dict]:
+    """
+    Режим main по правильным решениям: пользователи с user_id — из таблицы лидеров,
+    участники без user_id (по имени) — прежним запросом только по их решениям.
+    """
+    counts: dict[tuple[int | None, str | None], int] = {}
+    rows = conn.execute(
+        """
+        SELECT e.main_class_id AS class_id, c.name AS class_name, COUNT(*) AS users
+        FROM boss_leaderboard e
+        LEFT JOIN class c ON c.id = e.main_class_id
+        WHERE e.boss_id = ? AND e.kind = 'user'
+        GROUP BY e.main_class_id, c.name
+        """,
+        (boss_id,),
+    ).fetchall()
+    anonymous = _query_participants_by_class(
+        conn, boss_id=boss_id, correct_only=True, mode="main", dedup_by_name=False, anonymous_only=True
+    )
+    for r in list(rows) + anonymous:
+        key = (r["class_id"], r["class_name"])
+        counts[key] = counts.get(key, 0) + int(r["users"])
+    result = [
+        {"class_id": class_id, "class_name": class_name, "users": users}
+        for (class_id, class_name), users in counts.items()
+    ]
+    result.sort(key=lambda r: (-r["users"], r["class_name"] or ""))
+    return result
+
+
+def _query_participant_names_from_leaderboard(conn: sqlite3.Connection, *, boss_id: int) -> list[sqlite3.Row]:
+    rows = conn.execute(
+        """
+        SELECT
+            e.main_class_id AS class_id,
+            c.name AS class_name,
+            e.user_name AS display_name,
+            e.key AS user_key
+        FROM boss_leaderboard e
+        LEFT JOIN class c ON c.id = e.main_class_id
+        WHERE e.boss_id = ? AND e.kind = 'user'
+        """,
+        (boss_id,),
+    ).fetchall()
+    anonymous = _query_participant_names_by_class(
+        conn, boss_id=boss_id, correct_only=True, mode="main", dedup_by_name=False, anonymous_only=True
+    )
+    return list(rows) + anonymous
+
+
 def _print_names_by_class(rows: list[sqlite3.Row]) -> None:
     if not rows:
         print("\nСписки участников: нет данных.")
@@ -447,28 +520,50 @@ def main() -> int:
                 return 2
 
         correct_only = not bool(args.any)
-        rows = _query_participants_by_class(
-            conn,
-            boss_id=boss.id,
-            correct_only=correct_only,
-            mode=args.mode,
-            dedup_by_name=bool(args.dedup_by_name),
+        # Главные классы по правильным решениям уже посчитаны в таблице лидеров приложения;
+        # --any и --dedup-by-name (своя нормализация имён) считаются по решениям
+        from_leaderboard = (
+            correct_only
+            and args.mode == "main"
+            and not args.dedup_by_name
+            and _leaderboard_ready(conn, boss.id)
         )
+        if from_leaderboard:
+            rows = _query_participants_from_leaderboard(conn, boss_id=boss.id)
+        else:
+            rows = _query_participants_by_class(
+                conn,
+                boss_id=boss.id,
+                correct_only=correct_only,
+                mode=args.mode,
+                dedup_by_name=bool(args.dedup_by_name),
+            )
 
         total_user_key_expr = (
             "canon_name(user_name)"
             if args.dedup_by_name
             else "COALESCE(CAST(user_id AS TEXT), 'name:' || user_name)"
         )
-        total_users_row = conn.execute(
-            f"""
-            SELECT COUNT(DISTINCT {total_user_key_expr}) AS total_users
-            FROM boss_task_solution
-            WHERE boss_id = ?
-            {"AND is_correct IS TRUE" if correct_only else ""}
-            """,
-            (boss.id,),
-        ).fetchone()
+        if from_leaderboard:
+            total_users_row = conn.execute(
+                """
+                SELECT
+                    (SELECT COUNT(*) FROM boss_leaderboard WHERE boss_id = ? AND kind = 'user')
+                    + (SELECT COUNT(DISTINCT user_name) FROM boss_task_solution
+                       WHERE boss_id = ? AND is_correct IS TRUE AND user_id IS NULL) AS total_users
+                """,
+                (boss.id, boss.id),
+            ).fetchone()
+        else:
+            total_users_row = conn.execute(
+                f"""
+                SELECT COUNT(DISTINCT {total_user_key_expr}) AS total_users
+                FROM boss_task_solution
+                WHERE boss_id = ?
+                {"AND is_correct IS TRUE" if correct_only else ""}
+                """,
+                (boss.id,),
+            ).fetchone()
         total_users = int(total_users_row["total_users"] if total_users_row else 0)
 
         title = (
@@ -482,13 +577,16 @@ def main() -> int:
         _print_table(rows, title=title)
 
         if args.list_names:
-            name_rows = _query_participant_names_by_class(
-                conn,
-                boss_id=boss.id,
-                correct_only=correct_only,
-                mode=args.mode,
-                dedup_by_name=bool(args.dedup_by_name),
-            )
+            if from_leaderboard:
+                name_rows = _query_participant_names_from_leaderboard(conn, boss_id=boss.id)
+            else:
+                name_rows = _query_participant_names_by_class(
+                    conn,
+                    boss_id=boss.id,
+                    correct_only=correct_only,
+                    mode=args.mode,
+                    dedup_by_name=bool(args.dedup_by_name),
+                )
             _print_names_by_class(name_rows)
         return 0
     finally:
@@ -3,6 +3,9 @@
 1) Топ-3 клана: для каждого — название и все участники по урону+защите.
 2) Топ-10 PvE по суммарному урону и защите.
 3) Топ-10 PvP по числу выигранных дуэлей (как на /game-rating?tab=pvp).
+
+Места берутся из тех же досок, что и на странице рейтинга (leaderboards.py); перед отчётом
+изменившиеся доски пересобираются.
 """
 from app import (
     app,
@@ -10,9 +13,8 @@ from app import (
     User,
     Clan,
     UserTerritoryStats,
-    TerritoryRegionState,
-    PvPDuel,
 )
+import leaderboards
 from sqlalchemy import func
 
 
@@ -40,40 +42,29 @@ def _append_clan_block(lines, rank, clan_id, territory_count, members_by_clan):
     lines.append("")
 
 
+def _board_users(entries):
+    """[(строка доски, User)] в порядке мест."""
+    ids = [e.entity_id for e in entries]
+    users = {u.id: u for u in User.query.filter(User.id.in_(ids)).all()} if ids else {}
+    return [(e, users[e.entity_id]) for e in entries if e.entity_id in users]
+
+
 def main() -> None:
     with app.app_context():
-        # Рейтинг кланов: как на странице «Топ кланов» — территория (убыв.), затем сумма (урон+защита) участников
-        all_clans_territory = db.session.query(
-            Clan.id,
-            func.coalesce(func.count(TerritoryRegionState.region_index), 0).label('territory_count')
-        ).outerjoin(TerritoryRegionState, Clan.id == TerritoryRegionState.owner_clan_id).group_by(Clan.id).all()
+        leaderboards.refresh_all()
 
-        score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(
-            UserTerritoryStats.total_influence_points, 0
-        )
-        clan_scores_rows = db.session.query(
-            User.clan_id,
-            func.coalesce(func.sum(score_expr), 0).label('clan_score')
-        ).outerjoin(UserTerritoryStats, User.id == UserTerritoryStats.user_id).filter(
-            User.clan_id.isnot(None)
-        ).group_by(User.clan_id).all()
-        clan_score_by_id = {row[0]: int(row[1] or 0) for row in clan_scores_rows}
-
-        sorted_clans = sorted(
-            all_clans_territory,
-            key=lambda r: (r[1], clan_score_by_id.get(r[0], 0)),
-            reverse=True
-        )
+        # Рейтинг кланов: как на странице «Топ кланов» — территория (убыв.), затем сумма (урон+защита) участников
+        top_clans = leaderboards.page_entries(leaderboards.BOARD_CLANS, 0, 3)
+        clan_ids = [e.entity_id for e in top_clans]
 
         score_expr = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(
             UserTerritoryStats.total_influence_points, 0
         )
-        clan_ids_all = [r[0] for r in sorted_clans]
         all_members = []
-        if clan_ids_all:
+        if clan_ids:
             all_members = db.session.query(User, UserTerritoryStats).outerjoin(
                 UserTerritoryStats, User.id == UserTerritoryStats.user_id
-            ).filter(User.clan_id.in_(clan_ids_all)).order_by(
+            ).filter(User.clan_id.in_(clan_ids)).order_by(
                 User.clan_id, score_expr.desc()
             ).all()
 
@@ -84,24 +75,8 @@ def main() -> None:
                 members_by_clan[cid] = []
             members_by_clan[cid].append((u, stats))
 
-        pve_score = func.coalesce(UserTerritoryStats.total_damage_dealt, 0) + func.coalesce(
-            UserTerritoryStats.total_influence_points, 0
-        )
-        pve_rows = db.session.query(User, UserTerritoryStats).outerjoin(
-            UserTerritoryStats, User.id == UserTerritoryStats.user_id
-        ).order_by(pve_score.desc()).limit(10).all()
-
-        wins_subq = db.session.query(
-            PvPDuel.winner_id,
-            func.count(PvPDuel.id).label('wins')
-        ).filter(
-            PvPDuel.status == 'finished',
-            PvPDuel.winner_id.isnot(None)
-        ).group_by(PvPDuel.winner_id).subquery()
-
-        pvp_rows = db.session.query(User, func.coalesce(wins_subq.c.wins, 0).label('wins')).outerjoin(
-            wins_subq, User.id == wins_subq.c.winner_id
-        ).order_by(func.coalesce(wins_subq.c.wins, 0).desc(), User.id.asc()).limit(10).all()
+        pve_rows = _board_users(leaderboards.page_entries(leaderboards.BOARD_PVE, 0, 10))
+        pvp_rows = _board_users(leaderboards.page_entries(leaderboards.BOARD_PVP, 0, 10))
 
         lines = []
         lines.append("=" * 60)
@@ -111,21 +86,22 @@ def main() -> None:
 
         lines.append("1) ТОП-3 КЛАНА — все участники каждого")
         lines.append("-" * 40)
-        if not sorted_clans:
+        if not top_clans:
             lines.append("Нет кланов.")
             lines.append("")
         else:
-            for rank, (clan_id, territory_count) in enumerate(sorted_clans[:3], start=1):
-                _append_clan_block(lines, rank, clan_id, territory_count, members_by_clan)
+            for entry in top_clans:
+                _append_clan_block(lines, entry.rank, entry.entity_id, int(entry.score or 0), members_by_clan)
 
         lines.append("2) ТОП-10 PvE (по суммарному урону и защите)")
         lines.append("-" * 40)
         if not pve_rows:
             lines.append("Нет данных.")
         else:
-            for rank, (u, stats) in enumerate(pve_rows, 1):
-                name, dmg, inf, total = _member_display(u, stats)
-                lines.append(f"  {rank}. {name}  — урон: {dmg}, защита: {inf}, всего: {total}")
+            for entry, u in pve_rows:
+                name = u.character_name or u.username or f"User#{u.id}"
+                dmg, inf, total = int(entry.score2 or 0), int(entry.score3 or 0), int(entry.score or 0)
+                lines.append(f"  {entry.rank}. {name}  — урон: {dmg}, защита: {inf}, всего: {total}")
         lines.append("")
 
         lines.append("3) ТОП-10 PvP (по выигранным дуэлям)")
@@ -133,10 +109,10 @@ def main() -> None:
         if not pvp_rows:
             lines.append("Нет данных.")
         else:
-            for rank, (u, wins) in enumerate(pvp_rows, 1):
+            for entry, u in pvp_rows:
                 name = u.character_name or u.username or f"User#{u.id}"
-                w = int(wins or 0)
-                lines.append(f"  {rank}. {name}  — побед: {w}")
+                w = int(entry.score or 0)
+                lines.append(f"  {entry.rank}. {name}  — побед: {w}")
         lines.append("")
         lines.append("=" * 60)
 
@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Планировщик задач: кто из экземпляров им владеет (аренда) и как выполняются задачи (метрики).
+
+Аренда на PostgreSQL — advisory lock уровня сессии (pg_try_advisory_lock) на отдельном соединении.
+Лок держится, пока живо соединение: при падении процесса PostgreSQL снимает его сам, и ждущий
+экземпляр забирает планировщик при следующей попытке, без TTL и без записи строк. Продление —
+проверка, что соединение живо. На SQLite работает прежний лок строкой scheduler_instance_lock
+(app.py передаёт его функции в CallbackLease).
+
+SchedulerMetrics собирает по событиям APScheduler для каждой задачи: число запусков и ошибок,
+длительность (от передачи в пул до завершения), задержку старта от планового времени, пропуски
+(misfire), запуски поверх ещё идущего и пропуски из-за max_instances; плюс события аренды —
+захваты, потери, время передачи от прошлого владельца.
+"""
+import threading
+from datetime import datetime
+
+from apscheduler.events import (
+    EVENT_JOB_ERROR, EVENT_JOB_EXECUTED, EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED,
+)
+
+METRICS_EVENT_MASK = (
+    EVENT_JOB_SUBMITTED | EVENT_JOB_EXECUTED | EVENT_JOB_ERROR | EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES
+)
+
+
+class AdvisoryLease:
+    """Лидерство через pg_try_advisory_lock на собственном соединении (connect() -> DBAPI psycopg2)."""
+
+    backend = 'advisory'
+
+    def __init__(self, connect, key):
+        self._connect = connect
+        self._key = int(key)
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def held(self):
+        return self._conn is not None
+
+    def try_acquire(self):
+        with self._lock:
+            if self._conn is not None:
+                return self._ping()
+            conn = self._connect()
+            conn.autocommit = True
+            try:
+                with conn.cursor() as cur:
+                    cur.execute('SELECT pg_try_advisory_lock(%s)', (self._key,))
+                    acquired = bool(cur.fetchone()[0])
+            except Exception:
+                conn.close()
+                raise
+            if not acquired:
+                conn.close()
+                return False
+            self._conn = conn
+            return True
+
+    def renew(self):
+        """Лок всё ещё наш: соединение живо (иначе PostgreSQL его уже снял)."""
+        with self._lock:
+            return self._conn is not None and self._ping()
+
+    def _ping(self):
+        try:
+            with self._conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            return True
+        except Exception:
+            self._close()
+            return False
+
+    def release(self):
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                with self._conn.cursor() as cur:
+                    cur.execute('SELECT pg_advisory_unlock(%s)', (self._key,))
+            except Exception:
+                pass
+            self._close()
+
+    def _close(self):
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+
+class CallbackLease:
+    """Аренда через функции приложения (лок строкой с TTL): acquire() -> bool, renew() -> bool."""
+
+    backend = 'row'
+
+    def __init__(self, acquire, renew, release=None):
+        self._acquire = acquire
+        self._renew = renew
+        self._release = release
+        self.held = False
+
+    def try_acquire(self):
+        self.held = bool(self._acquire())
+        return self.held
+
+    def renew(self):
+        self.held = bool(self._renew())
+        return self.held
+
+    def release(self):
+        if self.held and self._release is not None:
+            self._release()
+        self.held = False
+
+
+class _JobStats:
+    __slots__ = (
+        'runs', 'errors', 'missed', 'skipped_max_instances', 'overlapped', 'running', '_started',
+        'last_run_at', 'last_duration_ms', 'max_duration_ms', 'total_duration_ms',
+        'last_lag_ms', 'max_lag_ms', 'last_error',
+    )
+
+    def __init__(self):
+        self.runs = self.errors = self.missed = self.skipped_max_instances = self.overlapped = self.running = 0
+        self._started = []
+        self.last_run_at = None
+        self.last_duration_ms = self.max_duration_ms = self.total_duration_ms = 0.0
+        self.last_lag_ms = self.max_lag_ms = 0.0
+        self.last_error = None
+
+    def as_dict(self):
+        return {
+            'runs': self.runs,
+            'errors': self.errors,
+            'missed': self.missed,
+            'skipped_max_instances': self.skipped_max_instances,
+            'overlapped': self.overlapped,
+            'running': self.running,
+            'last_run_at': self.last_run_at.isoformat() if self.last_run_at else None,
+            'last_duration_ms': round(self.last_duration_ms, 2),
+            'avg_duration_ms': round(self.total_duration_ms / self.runs, 2) if self.runs else 0.0,
+            'max_duration_ms': round(self.max_duration_ms, 2),
+            'last_lag_ms': round(self.last_lag_ms, 2),
+            'max_lag_ms': round(self.max_lag_ms, 2),
+            'last_error': self.last_error,
+        }
+
+
+class SchedulerMetrics:
+    """Метрики задач и аренды планировщика в памяти процесса (listener — для scheduler.add_listener)."""
+
+    def __init__(self, clock=datetime.now):
+        self._clock = clock
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self.lease = {
+            'attempts': 0,
+            'acquired': 0,
+            'lost': 0,
+            'renewals': 0,
+            'renew_failures': 0,
+            'acquired_at': None,
+            'last_handoff_ms': None,
+        }
+
+    def _job(self, job_id):
+        stats = self._jobs.get(job_id)
+        if stats is None:
+            stats = self._jobs[job_id] = _JobStats()
+        return stats
+
+    def listener(self, event):
+        now = self._clock()
+        with self._lock:
+            stats = self._job(event.job_id)
+            if event.code == EVENT_JOB_SUBMITTED:
+                scheduled = event.scheduled_run_times[-1] if event.scheduled_run_times else None
+                if scheduled is not None:
+                    lag = (datetime.now(scheduled.tzinfo) - scheduled).total_seconds() * 1000
+                    stats.last_lag_ms = max(0.0, lag)
+                    stats.max_lag_ms = max(stats.max_lag_ms, stats.last_lag_ms)
+                if stats.running:
+                    stats.overlapped += 1
+                stats.running += 1
+                stats._started.append(now)
+            elif event.code in (EVENT_JOB_EXECUTED, EVENT_JOB_ERROR):
+                started = stats._started.pop(0) if stats._started else now
+                stats.running = max(0, stats.running - 1)
+                duration = (now - started).total_seconds() * 1000
+                stats.runs += 1
+                stats.last_run_at = now
+                stats.last_duration_ms = duration
+                stats.max_duration_ms = max(stats.max_duration_ms, duration)
+                stats.total_duration_ms += duration
+                if event.code == EVENT_JOB_ERROR:
+                    stats.errors += 1
+                    stats.last_error = repr(event.exception)[:300]
+            elif event.code == EVENT_JOB_MISSED:
+                stats.missed += 1
+            elif event.code == EVENT_JOB_MAX_INSTANCES:
+                stats.skipped_max_instances += 1
+
+    def last_run_at(self, job_id):
+        """Время последнего завершения задачи (None — ещё не выполнялась)."""
+        with self._lock:
+            stats = self._jobs.get(job_id)
+            return stats.last_run_at if stats is not None else None
+
+    def lease_attempt(self, acquired, handoff_seconds=None):
+        with self._lock:
+            self.lease['attempts'] += 1
+            if acquired:
+                self.lease['acquired'] += 1
+                self.lease['acquired_at'] = self._clock().isoformat()
+                if handoff_seconds is not None:
+                    self.lease['last_handoff_ms'] = round(max(0.0, handoff_seconds) * 1000, 1)
+
+    def lease_renewed(self, ok):
+        with self._lock:
+            if ok:
+                self.lease['renewals'] += 1
+            else:
+                self.lease['renew_failures'] += 1
+                self.lease['lost'] += 1
+                self.lease['acquired_at'] = None
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'lease': dict(self.lease),
+                'jobs': {job_id: stats.as_dict() for job_id, stats in sorted(self._jobs.items())},
+            }
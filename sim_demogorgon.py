@@ -0,0 +1,122 @@
+"""
+Прогон армии Демогоргонов (demogorgon_sim) в виртуальном времени — без БД и без ожидания.
+
+Для каждого из --runs случайных состояний карты армия проходит --hours часов тремя способами:
+  - один вызов advance() на весь период (догоняющий тик после долгого простоя);
+  - вызов на каждый тик (как задача планировщика раз в tick_seconds);
+  - вызовы через случайные промежутки (пропуски и задержки задачи планировщика).
+Итоговое состояние армии, сила областей и список перемещений должны совпасть. Дополнительно
+проверяется: сила областей не отрицательна, снятая сила = тики * урон, пока армия на карте,
+last_damage_tick_at лежит на сетке тиков.
+
+Запуск:
+  python sim_demogorgon.py
+  python sim_demogorgon.py --hours 12 --runs 50 --seed 3
+"""
+from __future__ import annotations
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Sequence
+
+from demogorgon_sim import ArmyState, SimParams, advance
+
+
+def _initial(rng: random.Random, regions: int, max_strength: int, params: SimParams):
+    start = datetime(2026, 1, 1, 12, 0, 0)
+    strengths = {ri: rng.choice((0, rng.randint(1, max_strength))) for ri in range(regions)}
+    state = ArmyState(
+        rng.randrange(regions), rng.random(), rng.random(), True, start,
+        start + timedelta(minutes=rng.randint(params.min_move_minutes, params.max_move_minutes)),
+    )
+    return state, strengths
+
+
+def _run(state, strengths, seed, params, times):
+    """Последовательные вызовы advance() в моменты times; (состояние, сила, снято всего, тиков, перемещения)."""
+    drained, ticks, moves = 0, 0, []
+    for now in times:
+        result = advance(state, strengths, now, seed, params)
+        state, strengths = result.state, result.strengths
+        drained += sum(result.drains.values())
+        ticks += result.ticks
+        moves.extend(result.moves)
+    return state, strengths, drained, ticks, moves
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hours", type=float, default=6, help="Виртуальных часов на прогон")
+    parser.add_argument("--runs", type=int, default=20, help="Число случайных карт")
+    parser.add_argument("--regions", type=int, default=28, help="Областей на карте")
+    parser.add_argument("--max-strength", type=int, default=5000, help="Максимальная начальная сила области")
+    parser.add_argument("--tick-seconds", type=int, default=2)
+    parser.add_argument("--damage", type=int, default=150, help="Снятие силы за тик")
+    parser.add_argument("--min-move", type=int, default=5, help="Минут до плановой смены области, от")
+    parser.add_argument("--max-move", type=int, default=10, help="Минут до плановой смены области, до")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    params = SimParams(args.tick_seconds, args.damage, args.min_move, args.max_move)
+    rng = random.Random(args.seed)
+    period = timedelta(hours=args.hours)
+    step = timedelta(seconds=args.tick_seconds)
+    failures = 0
+    timings = {'catch-up': 0.0, 'per-tick': 0.0, 'jitter': 0.0}
+    total_ticks = total_moves = calls = 0
+
+    for run in range(args.runs):
+        state, strengths = _initial(rng, args.regions, args.max_strength, params)
+        army_id = rng.randrange(1, 10 ** 6)
+        start = state.last_damage_tick_at
+        end = start + period
+
+        per_tick_times = [start + step * k for k in range(1, period // step + 1)]
+        jitter_times, t = [], start
+        while t < end:
+            t = min(end, t + timedelta(seconds=rng.uniform(0, 120)))
+            jitter_times.append(t)
+        schedules = {'catch-up': [end], 'per-tick': per_tick_times + [end], 'jitter': jitter_times}
+
+        results = {}
+        for name, times in schedules.items():
+            t0 = time.perf_counter()
+            results[name] = _run(state, strengths, army_id, params, times)
+            timings[name] += time.perf_counter() - t0
+            calls += len(times)
+
+        reference = results['catch-up']
+        final, final_strengths, drained, ticks, moves = reference
+        total_ticks += ticks
+        total_moves += len(moves)
+        problems = []
+        for name, other in results.items():
+            if other != reference:
+                problems.append(f'{name} расходится с одним вызовом')
+        if min(final_strengths.values(), default=0) < 0:
+            problems.append('отрицательная сила области')
+        if drained != ticks * args.damage:
+            problems.append(f'снято {drained}, ожидалось {ticks * args.damage}')
+        if (final.last_damage_tick_at - start) % step:
+            problems.append('last_damage_tick_at вне сетки тиков')
+        if final.is_active and final.last_damage_tick_at != start + step * (period // step):
+            problems.append('армия на карте, но тики применены не до конца периода')
+        if problems:
+            failures += 1
+            print(f"Прогон {run}: " + '; '.join(problems), file=sys.stderr)
+
+    print(f"Прогонов: {args.runs} x {args.hours:g} ч, тиков: {total_ticks}, перемещений: {total_moves}, вызовов: {calls}")
+    for name, seconds in timings.items():
+        print(f"  {name:9s} {seconds * 1000 / max(1, args.runs):8.2f} мс на прогон")
+    if failures:
+        print(f"Расхождений: {failures}", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
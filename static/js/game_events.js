@@ -0,0 +1,107 @@
+/*
+ * Серверные события (/api/stream) для страниц игры.
+ *
+ * GameEvents.on(topic, handler)        — handler(event, data) на события темы; event 'resync' —
+ *                                        поток переподключился, данные нужно перечитать.
+ * GameEvents.poll(topic, ms, fn, liveMs) — замена setInterval(fn, ms): пока поток по теме работает,
+ *                                        fn вызывается не чаще раза в liveMs (0 — не вызывается).
+ * GameEvents.live(topic)               — поток подключён и сервер принял тему.
+ *
+ * Один EventSource на страницу со всеми темами. Если поток выключен, сервер отказал
+ * (лимит соединений) или браузер не поддерживает EventSource — страницы опрашивают API как раньше.
+ */
+(function () {
+    'use strict';
+
+    var enabled = !!window.GAME_EVENTS_ENABLED && typeof EventSource !== 'undefined';
+    var RETRY_AFTER_FAIL_MS = 60000;
+    var handlers = {};
+    var accepted = {};
+    var source = null;
+    var sourceTopics = '';
+    var connectTimer = null;
+    var connectedOnce = false;
+
+    function topicList() {
+        return Object.keys(handlers).sort();
+    }
+
+    function dispatch(topic, event, data) {
+        (handlers[topic] || []).forEach(function (fn) {
+            try { fn(event, data); } catch (e) { /* ошибка обработчика не рвёт поток */ }
+        });
+    }
+
+    function resyncAll() {
+        Object.keys(accepted).forEach(function (topic) { dispatch(topic, 'resync', null); });
+    }
+
+    function disconnect() {
+        if (source) source.close();
+        source = null;
+        sourceTopics = '';
+        accepted = {};
+    }
+
+    function connect() {
+        connectTimer = null;
+        var topics = topicList();
+        if (!enabled || !topics.length) return;
+        var key = topics.join(',');
+        if (source && sourceTopics === key) return;
+        disconnect();
+        sourceTopics = key;
+        source = new EventSource('/api/stream?topics=' + encodeURIComponent(key));
+        source.addEventListener('hello', function (e) {
+            var data = {};
+            try { data = JSON.parse(e.data); } catch (err) { /* пустой hello */ }
+            accepted = {};
+            (data.topics || []).forEach(function (t) { accepted[t] = true; });
+            // При первом подключении страница только что загрузила данные сама
+            if (connectedOnce) resyncAll();
+            connectedOnce = true;
+        });
+        source.onmessage = function (e) {
+            var msg;
+            try { msg = JSON.parse(e.data); } catch (err) { return; }
+            if (msg.event === 'resync' && !msg.topic) {
+                resyncAll();
+                return;
+            }
+            if (accepted[msg.topic]) dispatch(msg.topic, msg.event, msg.data);
+        };
+        source.onerror = function () {
+            accepted = {};
+            if (source && source.readyState === EventSource.CLOSED) {
+                // Сервер ответил ошибкой (поток выключен, лимит соединений) — опрос, повтор позже
+                disconnect();
+                scheduleConnect(RETRY_AFTER_FAIL_MS);
+            }
+        };
+    }
+
+    function scheduleConnect(delay) {
+        if (!enabled || connectTimer) return;
+        connectTimer = setTimeout(connect, delay || 0);
+    }
+
+    window.GameEvents = {
+        on: function (topic, handler) {
+            if (!topic) return;
+            (handlers[topic] = handlers[topic] || []).push(handler);
+            if (sourceTopics.split(',').indexOf(topic) === -1) scheduleConnect(0);
+        },
+        live: function (topic) {
+            return !!(source && source.readyState === EventSource.OPEN && accepted[topic]);
+        },
+        poll: function (topic, intervalMs, fn, liveIntervalMs) {
+            var lastRun = Date.now();
+            return setInterval(function () {
+                var now = Date.now();
+                if (window.GameEvents.live(topic) && (!liveIntervalMs || now - lastRun < liveIntervalMs)) return;
+                lastRun = now;
+                fn();
+            }, intervalMs);
+        }
+    };
+})();
@@ -0,0 +1,41 @@
+"""
+Полная (ретроактивная) синхронизация счётчиков достижений.
+
+Во время игры счётчики обновляются по ходу действий, а подсчёт по таблицам (дуэли, покупки,
+снаряжение и т.п.) выполняется только здесь, в /api/admin/achievements/sync и при первом
+открытии кабинета игроком, ещё не прошедшим текущую версию синхронизации
+(achievements.ACHIEVEMENT_SYNC_VERSION).
+
+Без --force пропускает уже синхронизированных игроков. Commit — после каждой пачки.
+
+Запуск:
+  python sync_achievements.py
+  python sync_achievements.py --force --batch 500
+  python sync_achievements.py --user-id 12 --user-id 15
+"""
+from __future__ import annotations
+
+import argparse
+from typing import Sequence
+
+from app import app
+from achievements import sync_all_achievement_counters
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--force", action="store_true", help="Пересчитать и уже синхронизированных игроков")
+    parser.add_argument("--batch", type=int, default=200, help="Игроков за одну транзакцию")
+    parser.add_argument("--user-id", type=int, action="append", dest="user_ids", help="Только этот игрок (можно несколько)")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        result = sync_all_achievement_counters(
+            args.user_ids, force=args.force, batch_size=args.batch, log=print,
+        )
+    print(f"Готово. Игроков: {result['users']}, открыто достижений: {result['unlocked']}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
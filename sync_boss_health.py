@@ -0,0 +1,47 @@
+"""
+Счётчики здоровья рейд-боссов (boss.total_health, boss.damage_dealt): проверка и пересчёт.
+
+Во время игры счётчики меняются при правильном ответе и при добавлении, изменении и удалении
+задач; при добавлении колонок они заполняются сами (ensure_database_tables). Скрипт — для
+правок в обход приложения (ручной SQL, импорт задач). --check только сравнивает счётчики
+с полным пересчётом по boss_task и boss_task_solution и завершается с кодом 1 при расхождениях;
+без --check счётчики с расхождениями перезаписываются пересчётом.
+
+Запуск:
+  python sync_boss_health.py --check
+  python sync_boss_health.py
+  python sync_boss_health.py --boss-id 3
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import Sequence
+
+from app import app
+import boss_stats
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--check", action="store_true", help="Только проверить, ничего не записывать")
+    parser.add_argument("--boss-id", type=int, action="append", dest="boss_ids", help="Только этот босс (можно несколько)")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        if not args.check:
+            fixed = boss_stats.reconcile(args.boss_ids)
+            print(f"Исправлено боссов: {fixed}")
+        problems = boss_stats.check(args.boss_ids)
+
+    for boss_id, field, stored, expected in problems:
+        print(f"  boss_id={boss_id} {field}: сохранено {stored}, по задачам {expected}", file=sys.stderr)
+    if problems:
+        print(f"Расхождений: {len(problems)}", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,48 @@
+"""
+Итоги дуэлей игроков (user_pvp_stats): заполнение по истории pvp_duel и проверка расхождений.
+
+Во время игры итоги обновляются при завершении дуэли. Таблица заполняется сама при её создании
+(ensure_database_tables); этот скрипт — для повторного заполнения и проверки. --check только
+сравнивает сохранённые итоги с полным пересчётом и завершается с кодом 1 при расхождениях;
+без --check строки с расхождениями перезаписываются пересчётом.
+
+Запуск:
+  python sync_pvp_stats.py --check
+  python sync_pvp_stats.py
+  python sync_pvp_stats.py --user-id 12 --user-id 15
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+from typing import Sequence
+
+from app import app
+import pvp_stats
+
+
+def main(argv: Sequence[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--check", action="store_true", help="Только проверить, ничего не записывать")
+    parser.add_argument("--user-id", type=int, action="append", dest="user_ids", help="Только этот игрок (можно несколько)")
+    parser.add_argument("--limit", type=int, default=50, help="Сколько расхождений вывести")
+    args = parser.parse_args(list(argv) if argv is not None else None)
+
+    with app.app_context():
+        if not args.check:
+            written = pvp_stats.backfill(args.user_ids)
+            print(f"Записано строк: {written}")
+        problems = pvp_stats.check(args.user_ids)
+
+    for user_id, field, stored, expected in problems[:args.limit]:
+        print(f"  user_id={user_id} {field}: сохранено {stored}, по дуэлям {expected}", file=sys.stderr)
+    if problems:
+        users = len({p[0] for p in problems})
+        print(f"Расхождений: {len(problems)} у {users} игроков", file=sys.stderr)
+        return 1
+    print("Расхождений нет")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+Раздача задач рейд-босса: перемешанная очередь нерешённых задач босса в памяти процесса.
+
+Очередь собирается одним запросом (id нерешённых задач), перемешивается и выдаётся по кругу:
+next() — O(1) в среднем, без COUNT и OFFSET по задачам. Подряд идущие запросы получают разные
+задачи, пока не пройден весь круг, поэтому одновременные игроки не попадают на одну задачу,
+пока нерешённых хватает на всех. Решённые задачи удаляются из множества живых и пропускаются
+при выдаче; в конце круга очередь сжимается и перемешивается заново.
+
+Решения других воркеров дочитываются по возрастанию id решения (load_solved_since) — когда
+меняется solved_version (урон по боссу) и не реже раза в check_seconds. Id решений выдаются до
+commit, поэтому решение с меньшим id может стать видимым позже большего: дочитывание начинается
+на reread решений ниже последнего известного, повторно прочитанные задачи просто ещё раз
+исключаются. Очередь собирается заново при смене tasks_version (задачи босса изменились), по
+invalidate() и раз в rebuild_seconds.
+"""
+import random
+import threading
+import time
+
+
+class _Queue:
+    __slots__ = ('order', 'pos', 'live', 'tasks_version', 'solved_version', 'recent',
+                 'built_at', 'checked_at', 'lock')
+
+    def __init__(self):
+        self.order = []
+        self.pos = 0
+        self.live = set()
+        self.tasks_version = None
+        self.solved_version = None
+        # Последние известные id решений (по возрастанию, не больше reread + 1)
+        self.recent = []
+        self.built_at = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+
+class TaskDispenser:
+    """Очереди задач по боссам: next() -> id нерешённой задачи или None (все решены)."""
+
+    def __init__(self, check_seconds=5.0, rebuild_seconds=600, reread=32, clock=time.monotonic, rng=None):
+        self.check_seconds = float(check_seconds)
+        self.rebuild_seconds = float(rebuild_seconds)
+        self.reread = max(0, int(reread))
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._queues = {}
+        self._lock = threading.Lock()
+        self.draws = 0
+        self.rebuilds = 0
+        self.refreshes = 0
+
+    def _queue(self, boss_id):
+        with self._lock:
+            queue = self._queues.get(boss_id)
+            if queue is None:
+                queue = self._queues[boss_id] = _Queue()
+            return queue
+
+    def next(self, boss_id, tasks_version, solved_version, load_unsolved, load_solved_since):
+        """Следующая задача босса.
+
+        load_unsolved(n) -> (id нерешённых задач, последние n id решений);
+        load_solved_since(solution_id) -> [(id решения, id задачи)] для решений с id > solution_id.
+        """
+        queue = self._queue(boss_id)
+        with queue.lock:
+            now = self._clock()
+            if (
+                queue.built_at is None
+                or queue.tasks_version != tasks_version
+                or now - queue.built_at >= self.rebuild_seconds
+            ):
+                task_ids, solution_ids = load_unsolved(self.reread + 1)
+                queue.order = list(task_ids)
+                self._rng.shuffle(queue.order)
+                queue.pos = 0
+                queue.live = set(queue.order)
+                queue.recent = self._recent(solution_ids)
+                queue.tasks_version = tasks_version
+                queue.solved_version = solved_version
+                queue.built_at = queue.checked_at = now
+                self.rebuilds += 1
+            elif queue.solved_version != solved_version or now - queue.checked_at >= self.check_seconds:
+                # С запасом reread ниже последнего: решения, закоммиченные позже соседей с большим id
+                floor_id = queue.recent[0] if len(queue.recent) > self.reread else 0
+                rows = load_solved_since(floor_id)
+                queue.live.difference_update(task_id for _, task_id in rows)
+                queue.recent = self._recent(queue.recent + [solution_id for solution_id, _ in rows])
+                queue.solved_version = solved_version
+                queue.checked_at = now
+                self.refreshes += 1
+            self.draws += 1
+            return self._pop(queue)
+
+    def _recent(self, solution_ids):
+        return sorted(set(solution_ids))[-(self.reread + 1):]
+
+    def _pop(self, queue):
+        if not queue.live:
+            return None
+        while True:
+            if queue.pos >= len(queue.order):
+                # Круг пройден: оставить только нерешённые и перемешать заново
+                queue.order = [task_id for task_id in queue.order if task_id in queue.live]
+                self._rng.shuffle(queue.order)
+                queue.pos = 0
+            task_id = queue.order[queue.pos]
+            queue.pos += 1
+            if task_id in queue.live:
+                return task_id
+
+    def solved(self, boss_id, task_id):
+        """Задачу решили в этом процессе — больше не выдавать."""
+        with self._lock:
+            queue = self._queues.get(boss_id)
+        if queue is not None:
+            with queue.lock:
+                queue.live.discard(task_id)
+
+    def invalidate(self, boss_id=None):
+        """Задачи босса изменились — следующий next() соберёт очередь заново."""
+        with self._lock:
+            if boss_id is None:
+                self._queues.clear()
+            else:
+                self._queues.pop(boss_id, None)
+
+    def stats(self):
+        with self._lock:
+            queues = {boss_id: len(q.live) for boss_id, q in self._queues.items()}
+        return {'unsolved': queues, 'draws': self.draws, 'rebuilds': self.rebuilds, 'refreshes': self.refreshes}
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Подписанные токены сгенерированных задач (вместо строки territory_task на каждую задачу).
+
+В токене: игрок, область действия (территория / дуэль / Демогоргоны), срок годности, опыт,
+название задачи, правильный ответ и его разобранный ключ (answer_checkers.compile_answer_key).
+Содержимое зашифровано (HMAC-SHA256 в режиме счётчика) и подписано (HMAC-SHA256,
+encrypt-then-MAC), поэтому клиент не видит ответ и не может подделать задачу, а проверка
+ответа не требует обращения к БД.
+
+Формат: "v2." + base64url(nonce(12) | шифротекст | тег(16)). Токены "v1." (до ключа ответа в
+содержимом) отклоняются: они живут не дольше ttl_seconds, клиент просто запрашивает новую задачу.
+"""
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from collections import namedtuple
+
+TASK_TOKEN_PREFIX = 'v2.'
+# Прежние форматы: распознаются как токены (не id строки territory_task), но не принимаются
+LEGACY_TASK_TOKEN_PREFIXES = ('v1.',)
+_NONCE_LEN = 12
+_TAG_LEN = 16
+
+# id — сам токен (его клиент присылает обратно как task_id)
+IssuedTask = namedtuple('IssuedTask', 'id title correct_answer xp_reward user_id scope expires_at answer_key')
+
+
+def is_task_token(value):
+    """Похоже ли значение task_id на токен (а не на id строки territory_task)."""
+    return isinstance(value, str) and value.startswith((TASK_TOKEN_PREFIX,) + LEGACY_TASK_TOKEN_PREFIXES)
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+
+class TaskTokenCodec:
+    """Выпуск и проверка токенов задач. secret — SECRET_KEY приложения."""
+
+    def __init__(self, secret, ttl_seconds=7200):
+        secret = secret.encode('utf-8') if isinstance(secret, str) else bytes(secret)
+        self._enc_key = hmac.new(secret, b'task-token:enc', hashlib.sha256).digest()
+        self._mac_key = hmac.new(secret, b'task-token:mac', hashlib.sha256).digest()
+        self.ttl_seconds = max(1, int(ttl_seconds))
+
+    def _keystream_xor(self, nonce, data):
+        out = bytearray(len(data))
+        for block in range(0, len(data), 32):
+            pad = hmac.new(self._enc_key, nonce + (block // 32).to_bytes(4, 'big'), hashlib.sha256).digest()
+            chunk = data[block:block + 32]
+            for i, b in enumerate(chunk):
+                out[block + i] = b ^ pad[i]
+        return bytes(out)
+
+    def _tag(self, nonce, ciphertext):
+        return hmac.new(self._mac_key, b'v2' + nonce + ciphertext, hashlib.sha256).digest()[:_TAG_LEN]
+
+    def issue(self, title, correct_answer, xp_reward, user_id, scope, answer_key=None, now=None):
+        """Новый токен задачи; возвращает IssuedTask (id = токен).
+        answer_key — (answer_type, кортеж) из answer_checkers, сохраняется как есть."""
+        now = time.time() if now is None else now
+        expires_at = int(now) + self.ttl_seconds
+        payload = json.dumps(
+            [int(user_id), scope, expires_at, int(xp_reward or 0), title or '', correct_answer or '', answer_key],
+            ensure_ascii=False, separators=(',', ':'),
+        ).encode('utf-8')
+        nonce = os.urandom(_NONCE_LEN)
+        ciphertext = self._keystream_xor(nonce, payload)
+        token = TASK_TOKEN_PREFIX + _b64encode(nonce + ciphertext + self._tag(nonce, ciphertext))
+        return IssuedTask(
+            token, title or '', correct_answer or '', int(xp_reward or 0), int(user_id), scope, expires_at, answer_key,
+        )
+
+    def verify(self, token, user_id, scopes, now=None):
+        """IssuedTask, если токен подлинный, не истёк, выдан user_id и его scope входит в scopes; иначе None."""
+        if not isinstance(token, str) or not token.startswith(TASK_TOKEN_PREFIX):
+            return None
+        try:
+            raw = _b64decode(token[len(TASK_TOKEN_PREFIX):])
+        except (ValueError, TypeError):
+            return None
+        if len(raw) <= _NONCE_LEN + _TAG_LEN:
+            return None
+        nonce, ciphertext, tag = raw[:_NONCE_LEN], raw[_NONCE_LEN:-_TAG_LEN], raw[-_TAG_LEN:]
+        if not hmac.compare_digest(tag, self._tag(nonce, ciphertext)):
+            return None
+        try:
+            uid, scope, expires_at, xp, title, answer, answer_key = json.loads(
+                self._keystream_xor(nonce, ciphertext).decode('utf-8')
+            )
+        except (ValueError, TypeError):
+            return None
+        now = time.time() if now is None else now
+        if uid != user_id or scope not in scopes or now > expires_at:
+            return None
+        if answer_key:
+            answer_key = (answer_key[0], tuple(answer_key[1]))
+        return IssuedTask(token, title, answer, xp, uid, scope, expires_at, answer_key)
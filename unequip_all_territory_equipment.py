@@ -6,7 +6,7 @@
   python unequip_all_territory_equipment.py
 """
 
-from app import app, db, User, UserEquipment
+from app import app, db, User, UserEquipment, bump_bonus_versions
 
 
 def main() -> None:
@@ -17,6 +17,8 @@ def main() -> None:
             return
 
         UserEquipment.query.delete(synchronize_session=False)
+        # Кэш бонусов в запущенных воркерах сбрасывается по user.bonus_version
+        bump_bonus_versions()
         db.session.commit()
         print(f"Снято записей экипировки: {count}")
 